@@ -14,7 +14,7 @@ setup(
     python_requires=">=3.8.0",
     install_requires=[
         "transformers >= 4.29.2",
-        "coremltools >= 7.0b1",
+        "coremltools >= 8.0",
     ],
     classifiers=[
     ],
@@ -14,6 +14,8 @@
 # limitations under the License.
 """Core ML conversion for Hugging Face Transformers models."""
 
+from .cache import ExportCache, ReferenceOutputStore, TraceStore
 from .config import CoreMLConfig
-from .convert import export
-from .validate import validate_model_outputs
+from .convert import export, trace_pytorch
+from .interpreter import MILInterpreter
+from .validate import ValidationResult, validate_model_on_data, validate_model_outputs, validate_model_samples
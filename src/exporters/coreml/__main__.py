@@ -13,26 +13,170 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import multiprocessing
+import sys
 import warnings
 
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
 from pathlib import Path
 
 from coremltools import ComputeUnit
-from coremltools.models import MLModel
-from coremltools.models.utils import _is_macos, _macos_version
+from coremltools.models.utils import _is_macos
 
-from transformers.models.auto import AutoFeatureExtractor, AutoProcessor, AutoTokenizer
+from transformers.models.auto import AutoConfig, AutoFeatureExtractor, AutoProcessor, AutoTokenizer
 from transformers.onnx.utils import get_preprocessor
 
+from .cache import (
+    DEFAULT_MAX_CACHE_SIZE,
+    WEIGHTS_HASH_METADATA_KEY,
+    ExportCache,
+    ReferenceOutputStore,
+    TraceStore,
+    format_size,
+    get_path_size,
+    hash_model_weights,
+)
+from .cache import main as cache_main
+from .chunking import export_chunks, validate_chunks
+from .compression import (
+    PALETTIZATION_GRANULARITIES,
+    PALETTIZATION_NBITS,
+    PRUNING_MODES,
+    QUANTIZE_OPTIONS,
+    ActivationQuantizationConfig,
+    LinearQuantizationConfig,
+    PalettizationConfig,
+    PruningConfig,
+    record_validation_error,
+)
 from .convert import export
+from .data import CalibrationData, ValidationData
 from .features import FeaturesManager
-from .validate import validate_model_outputs
+from .memory import LoggingCallback, MemoryTracker
+from .multifunction import export_multifunction
+from .profiling import ExportProfiler, get_profile_dir
+from .report import ExportReport, get_report_filename
+from .validate import (
+    VALIDATION_BACKENDS,
+    get_validation_backend,
+    load_validation_model,
+    validate_model_on_data,
+    validate_model_outputs,
+    validate_model_samples,
+)
+from .variants import ExportVariant, export_variants
 from ..utils import logging
 
 
-def convert_model(preprocessor, model, model_coreml_config, args, use_past=False, seq2seq=None):
-    coreml_config = model_coreml_config(model.config, use_past=use_past, seq2seq=seq2seq)
+logger = logging.get_logger("exporters.coreml")  # pylint: disable=invalid-name
+
+SEQ2SEQ_FEATURES = ["text2text-generation", "speech-seq2seq"]
+
+
+def get_output_filename(output, seq2seq=None):
+    """Where the Core ML model is saved. The encoder and decoder of seq2seq models get a filename prefix."""
+    if seq2seq == "encoder":
+        output = output.parent / ("encoder_" + output.name)
+    elif seq2seq == "decoder":
+        output = output.parent / ("decoder_" + output.name)
+    return output
+
+
+def get_compression(args, coreml_config, preprocessor):
+    """The compression requested on the command line, if any, besides the integer `--quantize` options."""
+    if args.quantize == "w8a8":
+        calibration_data = CalibrationData(
+            args.calibration_data, coreml_config, preprocessor, num_samples=args.calibration_samples
+        )
+        return ActivationQuantizationConfig(calibration_data)
+    palettization = None
+    if args.palettize is not None:
+        palettization = PalettizationConfig(
+            nbits=args.palettize,
+            granularity=args.palettize_granularity,
+            group_size=args.palettize_group_size,
+        )
+    if args.prune is None:
+        return palettization
+    return PruningConfig(
+        mode=args.prune,
+        target_sparsity=args.prune_sparsity,
+        threshold=args.prune_threshold,
+        layers=args.prune_layers.split(",") if args.prune_layers else None,
+        palettization=palettization,
+    )
+
+
+def get_atol(args, coreml_config, compression=None):
+    """The validation tolerance: as given on the command line, or a default that allows for compression."""
+    if args.atol is not None:
+        return args.atol
+    if compression is not None:
+        return max(coreml_config.atol_for_validation, compression.atol_for_validation)
+    return coreml_config.atol_for_validation
+
+
+def validate_model(coreml_config, preprocessor, model, mlmodel, atol, args, memory_tracker=None, **reference_kwargs):
+    """
+    Validates the exported model on one sample, on `--validation_samples` samples, or on the examples of
+    `--validation_data`. Returns the largest error and the [`~coreml.validate.ValidationResult`] of the samples,
+    if there were several. The keyword arguments tell where to find the reference outputs, see
+    [`~coreml.validate.validate_model_outputs`].
+    """
+    if args.validation_data is not None:
+        if model is None:
+            model = reference_kwargs["load_reference_model"]()
+        data = ValidationData(
+            args.validation_data, coreml_config, preprocessor, num_samples=args.validation_data_samples
+        )
+        result = validate_model_on_data(
+            coreml_config, preprocessor, model, mlmodel, atol, data, memory_tracker=memory_tracker
+        )
+        result.raise_for_failure()
+        return result.max_error, result
+
+    if args.validation_samples <= 1:
+        error = validate_model_outputs(
+            coreml_config, preprocessor, model, mlmodel, atol, memory_tracker=memory_tracker, **reference_kwargs
+        )
+        return error, None
+
+    result = validate_model_samples(
+        coreml_config,
+        preprocessor,
+        model,
+        mlmodel,
+        atol,
+        num_samples=args.validation_samples,
+        memory_tracker=memory_tracker,
+        **reference_kwargs,
+    )
+    result.raise_for_failure()
+    return result.max_error, result
+
+
+def convert_model(
+    preprocessor,
+    model,
+    model_coreml_config,
+    args,
+    use_past=False,
+    seq2seq=None,
+    cache=None,
+    trace_store=None,
+    memory_tracker=None,
+    reference_store=None,
+):
+    coreml_config = model_coreml_config(
+        model.config,
+        use_past=use_past,
+        seq2seq=seq2seq,
+        stateful=args.stateful,
+        kv_cache_capacity=args.kv_cache_capacity,
+        kv_cache_sliding_window=args.kv_cache_sliding_window,
+        sequence_length_buckets=args.sequence_length_buckets,
+        batch_size=args.batch_size,
+    )
 
     compute_units = ComputeUnit.ALL
     if args.compute_units == "cpu_and_gpu":
@@ -42,37 +186,314 @@ def convert_model(preprocessor, model, model_coreml_config, args, use_past=False
     elif args.compute_units == "cpu_and_ne":
         compute_units = ComputeUnit.CPU_AND_NE
 
+    compression = get_compression(args, coreml_config, preprocessor)
+
+    if memory_tracker is None:
+        memory_tracker = MemoryTracker(callbacks=[LoggingCallback()] if args.profile else None)
+
     mlmodel = export(
         preprocessor,
         model,
         coreml_config,
+        # W8A8 models compute in float16 in between the quantized activations.
+        quantize="float16" if args.quantize == "w8a8" else args.quantize,
+        compute_units=compute_units,
+        cache=cache,
+        trace_store=trace_store,
+        compression=compression,
+        memory_tracker=memory_tracker,
+    )
+
+    filename = get_output_filename(args.output, seq2seq).as_posix()
+
+    weights_hash = None
+    if reference_store is not None:
+        # Lets the model be validated again later without loading the reference model.
+        weights_hash = hash_model_weights(model)
+        mlmodel.user_defined_metadata[WEIGHTS_HASH_METADATA_KEY] = weights_hash
+
+    with memory_tracker.span("save"):
+        mlmodel.save(filename)
+
+    # The integer quantize options compress the weights too, and need the same allowances in validation.
+    if compression is None:
+        compression = LinearQuantizationConfig.from_quantize(args.quantize)
+
+    atol = get_atol(args, coreml_config, compression)
+    error = None
+    validation_result = None
+    validation_backend = get_validation_backend(filename, args.validation_backend)
+    if validation_backend is not None:
+        with memory_tracker.phase("validate"):
+            mlmodel = load_validation_model(filename, validation_backend)
+            error, validation_result = validate_model(
+                coreml_config,
+                preprocessor,
+                model,
+                mlmodel,
+                atol,
+                args,
+                memory_tracker=memory_tracker,
+                reference_store=reference_store,
+                weights_hash=weights_hash,
+            )
+        if compression is not None:
+            del mlmodel
+            record_validation_error(filename, error)
+
+    if args.report:
+        report = ExportReport.from_export(
+            model,
+            coreml_config,
+            filename,
+            memory_tracker,
+            quantize=args.quantize,
+            compression=compression,
+            atol=atol,
+            max_error=error,
+            validation_backend=validation_backend,
+            validation_result=validation_result,
+        )
+        report_filename = get_report_filename(filename)
+        report.save(report_filename)
+        logger.info(f"Saved export report at: {report_filename}")
+
+    logger.info(f"All good, model saved at: {filename} ({format_size(get_path_size(filename))})")
+    return filename
+
+
+def convert_multifunction_model(preprocessor, model, model_coreml_config, args, trace_store=None):
+    coreml_config = model_coreml_config(model.config, use_past=True, batch_size=args.batch_size)
+
+    compute_units = ComputeUnit.ALL
+    if args.compute_units == "cpu_and_gpu":
+        compute_units = ComputeUnit.CPU_AND_GPU
+    elif args.compute_units == "cpu_only":
+        compute_units = ComputeUnit.CPU_ONLY
+    elif args.compute_units == "cpu_and_ne":
+        compute_units = ComputeUnit.CPU_AND_NE
+
+    compression = get_compression(args, coreml_config, preprocessor)
+    filename = args.output.as_posix()
+
+    step_configs = export_multifunction(
+        preprocessor,
+        model,
+        coreml_config,
+        filename,
         quantize=args.quantize,
         compute_units=compute_units,
+        compression=compression,
+        prefill_length=args.prefill_length,
+        trace_store=trace_store,
     )
 
-    filename = args.output
-    if seq2seq == "encoder":
-        filename = filename.parent / ("encoder_" + filename.name)
-    elif seq2seq == "decoder":
-        filename = filename.parent / ("decoder_" + filename.name)
-    filename = filename.as_posix()
+    if compression is None:
+        compression = LinearQuantizationConfig.from_quantize(args.quantize)
 
-    mlmodel.save(filename)
+    # Core ML runs multifunction models from macOS 15.
+    validation_backend = get_validation_backend(filename, args.validation_backend, minimum_macos_version=(15, 0))
+    if validation_backend is not None:
+        for name, step_config in step_configs.items():
+            logger.info(f"Validating {name} function...")
+            mlmodel = load_validation_model(filename, validation_backend, function_name=name)
+            validate_model_outputs(
+                step_config, preprocessor, model, mlmodel, get_atol(args, step_config, compression)
+            )
 
-    if args.atol is None:
-        args.atol = coreml_config.atol_for_validation
+    logger.info(f"All good, model saved at: {filename} ({format_size(get_path_size(filename))})")
+    return filename
 
-    if not _is_macos() or _macos_version() < (12, 0):
-        logger.info("Skipping model validation, requires macOS 12.0 or later")
-    else:
-        # Run validation on CPU
-        mlmodel = MLModel(filename, compute_units=ComputeUnit.CPU_ONLY)
-        validate_model_outputs(coreml_config, preprocessor, model, mlmodel, args.atol)
 
-    logger.info(f"All good, model saved at: {filename}")
+def convert_chunked_model(preprocessor, model, model_coreml_config, args):
+    coreml_config = model_coreml_config(
+        model.config,
+        use_past=args.use_past,
+        kv_cache_capacity=args.kv_cache_capacity,
+        kv_cache_sliding_window=args.kv_cache_sliding_window,
+        batch_size=args.batch_size,
+    )
+
+    compute_units = ComputeUnit.ALL
+    if args.compute_units == "cpu_and_gpu":
+        compute_units = ComputeUnit.CPU_AND_GPU
+    elif args.compute_units == "cpu_only":
+        compute_units = ComputeUnit.CPU_ONLY
+    elif args.compute_units == "cpu_and_ne":
+        compute_units = ComputeUnit.CPU_AND_NE
 
+    compression = get_compression(args, coreml_config, preprocessor)
 
-def main():
+    results = export_chunks(
+        preprocessor,
+        model,
+        coreml_config,
+        args.output,
+        args.chunks,
+        quantize=args.quantize,
+        compute_units=compute_units,
+        compression=compression,
+        num_workers=args.chunk_workers,
+    )
+    filenames = [result.path for result in results]
+
+    if compression is None:
+        compression = LinearQuantizationConfig.from_quantize(args.quantize)
+
+    validation_backend = get_validation_backend(filenames[0], args.validation_backend)
+    if validation_backend is not None:
+        mlmodels = [load_validation_model(filename, validation_backend) for filename in filenames]
+        error = validate_chunks(
+            coreml_config, preprocessor, model, mlmodels, get_atol(args, coreml_config, compression)
+        )
+        if compression is not None:
+            del mlmodels
+            for filename in filenames:
+                record_validation_error(filename, error)
+
+    total_size = sum(result.size for result in results)
+    logger.info(f"All good, {len(filenames)} chunks saved ({format_size(total_size)} in total)")
+    return filenames
+
+
+def convert_model_variants(
+    preprocessor,
+    model,
+    model_coreml_config,
+    args,
+    variants,
+    use_past=False,
+    seq2seq=None,
+    trace_store=None,
+    reference_store=None,
+):
+    coreml_config = model_coreml_config(
+        model.config,
+        use_past=use_past,
+        seq2seq=seq2seq,
+        stateful=args.stateful,
+        kv_cache_capacity=args.kv_cache_capacity,
+        kv_cache_sliding_window=args.kv_cache_sliding_window,
+        sequence_length_buckets=args.sequence_length_buckets,
+        batch_size=args.batch_size,
+    )
+
+    results = export_variants(
+        preprocessor,
+        model,
+        coreml_config,
+        variants,
+        get_output_filename(args.output, seq2seq),
+        num_workers=args.variant_workers,
+        trace_store=trace_store,
+    )
+
+    # The reference model gives the same outputs for every variant, so it only runs for the first one.
+    weights_hash = hash_model_weights(model) if reference_store is not None else None
+
+    for result in results:
+        # Variants can be in different formats, so each one gets its own backend.
+        validation_backend = get_validation_backend(result.path, args.validation_backend)
+        if validation_backend is not None:
+            logger.info(f"Validating variant {result.variant.name}...")
+            compression = result.variant.compression or LinearQuantizationConfig.from_quantize(result.variant.quantize)
+            mlmodel = load_validation_model(result.path, validation_backend)
+            error, _ = validate_model(
+                coreml_config,
+                preprocessor,
+                model,
+                mlmodel,
+                get_atol(args, coreml_config, compression),
+                args,
+                reference_store=reference_store,
+                weights_hash=weights_hash,
+            )
+            if compression is not None:
+                del mlmodel
+                record_validation_error(result.path, error)
+
+    logger.info(f"All good, {len(results)} variants saved")
+    return [result.path for result in results]
+
+
+def _convert_model_process(log_level, *convert_args, **convert_kwargs):
+    logger.setLevel(log_level)
+
+    # The two halves share the machine, so don't let each of them claim all the cores.
+    import torch
+    torch.set_num_threads(max(1, torch.get_num_threads() // 2))
+
+    convert_model(*convert_args, **convert_kwargs)
+
+
+def convert_seq2seq_model(
+    preprocessor, model, model_coreml_config, args, cache=None, trace_store=None, reference_store=None
+):
+    """
+    Converts and validates the encoder and decoder of a seq2seq model at the same time, each in its own
+    process. The model weights are moved to shared memory before the children are started, so they are not
+    loaded twice.
+    """
+    # Use fresh processes instead of forking: loading the model may already have started torch's thread
+    # pool, and forking a process that uses Apple frameworks is not safe either.
+    model.share_memory()
+    mp_context = multiprocessing.get_context("spawn")
+
+    log_level = logger.getEffectiveLevel()
+    processes = {}
+    for seq2seq in ["encoder", "decoder"]:
+        logger.info(f"Converting {seq2seq} model...")
+        processes[seq2seq] = mp_context.Process(
+            target=_convert_model_process,
+            args=(log_level, preprocessor, model, model_coreml_config, args),
+            kwargs={
+                "use_past": args.use_past if seq2seq == "decoder" else False,
+                "seq2seq": seq2seq,
+                "cache": cache,
+                "trace_store": trace_store,
+                "reference_store": reference_store,
+            },
+        )
+        processes[seq2seq].start()
+
+    for process in processes.values():
+        process.join()
+
+    failed = [seq2seq for seq2seq, process in processes.items() if process.exitcode != 0]
+    if len(failed) > 0:
+        raise RuntimeError(f"Conversion of the {' and '.join(failed)} model failed, see the error above")
+
+    return [get_output_filename(args.output, seq2seq).as_posix() for seq2seq in processes]
+
+
+def _parse_variant(spec):
+    try:
+        return ExportVariant.from_string(spec)
+    except ValueError as e:
+        raise ArgumentTypeError(str(e))
+
+
+def _parse_sequence_length_buckets(spec):
+    try:
+        return [int(length) for length in spec.split(",")]
+    except ValueError:
+        raise ArgumentTypeError(f"Invalid sequence length buckets '{spec}', expected for example 32,64,128")
+
+
+def _parse_batch_size(spec):
+    try:
+        if "," in spec:
+            return [int(size) for size in spec.split(",")]
+        elif "-" in spec.lstrip("-"):
+            min_size, max_size = spec.split("-", 1)
+            return (int(min_size), int(max_size))
+        else:
+            return int(spec)
+    except ValueError:
+        raise ArgumentTypeError(f"Invalid batch size '{spec}', expected for example 8, 1-32 or 1,8,32")
+
+
+def get_parser():
     parser = ArgumentParser("Hugging Face Transformers Core ML exporter")
     parser.add_argument(
         "-m", "--model", type=str, required=True, help="Model ID on huggingface.co or path on disk to load model from."
@@ -89,16 +510,134 @@ def main():
     parser.add_argument(
         "--use_past", action="store_true", help="Export the model with precomputed hidden states (key and values in the attention blocks) for fast autoregressive decoding."
     )
+    parser.add_argument(
+        "--stateful", action="store_true", help="Keep the precomputed hidden states in Core ML model state, which is updated in place, instead of passing them in and out of the model. Implies --use_past. Only for decoder models, requires iOS 18 / macOS 15."
+    )
+    parser.add_argument(
+        "--multifunction", action="store_true", help="Export a text generation model as one multifunction model with a prefill function for the prompt and a decode function for one token at a time, which share their weights. Implies --use_past, requires iOS 18 / macOS 15."
+    )
+    parser.add_argument(
+        "--prefill_length", type=int, default=None, help="With --multifunction, the number of prompt tokens the prefill function processes. Defaults to half of the maximum sequence length."
+    )
+    parser.add_argument(
+        "--chunks", type=int, default=None, help="Split a text generation model into this many models that each hold a contiguous range of its decoder layers, for models too large to convert or load as a single package. The first chunk also embeds the tokens and the last one also computes the logits. Only for GPT-2 and Llama models, with --kv_cache_capacity or without --use_past."
+    )
+    parser.add_argument(
+        "--chunk_workers", type=int, default=None, help="With --chunks, the number of chunks to convert at the same time. Defaults to as many as fit in memory."
+    )
+    parser.add_argument(
+        "--kv_cache_capacity", type=int, default=None, help="Give the key-value cache a fixed number of slots. The model then takes one token per prediction plus its position, and all shapes are fixed. Implies --use_past."
+    )
+    parser.add_argument(
+        "--kv_cache_sliding_window", action="store_true", help="With --kv_cache_capacity, overwrite the oldest tokens once the cache is full, so generation can continue past the capacity."
+    )
+    parser.add_argument(
+        "--sequence_length_buckets",
+        type=_parse_sequence_length_buckets,
+        default=None,
+        help="Comma-separated list of sequence lengths the text inputs may have, for example 32,64,128,256,512. Unlike flexible shapes, these still run on GPU and Neural Engine. Not for --use_past.",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=_parse_batch_size,
+        default=None,
+        help="Number of examples per prediction: a fixed size such as 8, a range such as 1-32, or a comma-separated list of sizes such as 1,8,32. Defaults to a single example.",
+    )
+    parser.add_argument(
+        "--low_cpu_mem_usage", action="store_true", help="Load the PyTorch model without materializing its weights twice: create it on the meta device and load the checkpoint one shard at a time, memory-mapping safetensors files. Requires Accelerate."
+    )
+    parser.add_argument(
+        "--report", action="store_true", help="Write a JSON report next to the exported model, Model.report.json for Model.mlpackage, with the export options, the package size, the number of parameters, the duration and peak memory of each phase, the time spent in each step and the validation error."
+    )
+    parser.add_argument(
+        "--profile", action="store_true", help="Profile the export. Logs how long each step takes as it finishes, such as generating the dummy inputs, tracing, patching ops, converting, renaming the features, saving and validating, and the slowest steps at the end. Also runs the export under cProfile and tracemalloc, and saves the statistics, a summary of the hotspots and memory snapshots after tracing, converting and saving in the Model.profile folder next to Model.mlpackage. Profiling slows the export down."
+    )
     parser.add_argument(
         "--framework", type=str, choices=["pt", "tf"], default="pt", help="The framework to use for the Core ML export."
     )
     parser.add_argument(
-        "--quantize", type=str, choices=["float32", "float16"], default="float32", help="Quantization option for the model weights."
+        "--quantize", type=str, choices=QUANTIZE_OPTIONS + ["w8a8"], default="float32", help="Quantization option for the model weights. int8 quantizes per output channel, int4-block<n> per block of n input channels. w8a8 quantizes both the weights and the activations to int8, using --calibration_data. The int options require the ML Program format and compute in float16."
+    )
+    parser.add_argument(
+        "--calibration_data", type=Path, default=None, help="With --quantize w8a8, a directory of images for vision models, or of text files with one example per line for text models, to measure the activation ranges on. Calibration requires macOS."
+    )
+    parser.add_argument(
+        "--calibration_samples", type=int, default=128, help="Maximum number of examples to read from --calibration_data."
+    )
+    parser.add_argument(
+        "--palettize", type=int, choices=PALETTIZATION_NBITS, default=None, help="Compress the weights after conversion to this many bits per weight, by clustering them into a lookup table. Requires the ML Program format."
+    )
+    parser.add_argument(
+        "--palettize_granularity", type=str, choices=PALETTIZATION_GRANULARITIES, default="per_tensor", help="With --palettize, use one lookup table per weight tensor, or one per group of output channels. Grouped lookup tables are more accurate but require iOS 18 / macOS 15."
+    )
+    parser.add_argument(
+        "--palettize_group_size", type=int, default=16, help="With --palettize_granularity per_grouped_channel, the number of output channels that share a lookup table."
+    )
+    parser.add_argument(
+        "--prune", type=str, choices=PRUNING_MODES, default=None, help="Set the smallest weights to zero after conversion and store them in the sparse format: the --prune_sparsity fraction of each weight tensor with magnitude, or the weights below --prune_threshold with threshold. Can be combined with --quantize float16 and --palettize. Requires the ML Program format."
+    )
+    parser.add_argument(
+        "--prune_sparsity", type=float, default=0.5, help="With --prune magnitude, the fraction of weights to set to zero."
+    )
+    parser.add_argument(
+        "--prune_threshold", type=float, default=1e-3, help="With --prune threshold, the magnitude below which weights are set to zero."
+    )
+    parser.add_argument(
+        "--prune_layers", type=str, default=None, help="With --prune, a comma-separated list of the PyTorch parameter names to prune, which can use wildcards, for example 'transformer.h.*.mlp.*'. Defaults to all weights."
     )
     parser.add_argument(
         "--compute_units", type=str, choices=["all", "cpu_and_gpu", "cpu_only", "cpu_and_ne"], default="all", help="Optimize the model for CPU, GPU, and/or Neural Engine."
     )
     # parser.add_argument("--cache_dir", type=str, default=None, help="Path indicating where to store cache.")
+    parser.add_argument(
+        "--export_cache", action="store_true", help="Reuse a previously exported model with the same weights, configuration and options, and store newly exported models in the export cache."
+    )
+    parser.add_argument(
+        "--export_cache_dir", type=str, default=None, help="Location of the export cache. Defaults to $HF_HOME/exporters/coreml."
+    )
+    parser.add_argument(
+        "--export_cache_max_size", type=str, default=str(DEFAULT_MAX_CACHE_SIZE), help="Size limit of the export cache, for example 20GB. Least recently used models are evicted first."
+    )
+    parser.add_argument(
+        "--trace_cache", action="store_true", help="Save the TorchScript trace of the model, and reuse it when the same model is exported again. Useful when retrying a conversion that failed."
+    )
+    parser.add_argument(
+        "--trace_cache_dir", type=str, default=None, help="Location of the TorchScript trace store. Defaults to $HF_HOME/exporters/traces."
+    )
+    parser.add_argument(
+        "--reference_cache", action="store_true", help="Store the outputs of the PyTorch model on the validation inputs, and reuse them to validate other variants or exports of the same model instead of running it again."
+    )
+    parser.add_argument(
+        "--reference_cache_dir", type=str, default=None, help="Location of the store of reference outputs. Defaults to $HF_HOME/exporters/reference_outputs."
+    )
+    parser.add_argument(
+        "--validate_only", action="store_true", help="Don't export, validate the model that was exported to the output path before. With --reference_cache, the PyTorch model is only loaded if its outputs are not in the store."
+    )
+    parser.add_argument(
+        "--variant",
+        type=_parse_variant,
+        action="append",
+        default=None,
+        help="Export a variant of the model, for example quantize=float16,compute_units=cpu_and_ne,minimum_deployment_target=iOS16,format=mlprogram. Can be repeated. The model is traced only once for all variants.",
+    )
+    parser.add_argument(
+        "--variant_workers", type=int, default=None, help="Number of variants to convert at the same time. Defaults to as many as fit in memory."
+    )
+    parser.add_argument(
+        "--sequential", action="store_true", help="Convert the encoder and decoder of seq2seq models one after the other, instead of in two parallel processes. Uses less memory."
+    )
+    parser.add_argument(
+        "--validation_backend", type=str, choices=VALIDATION_BACKENDS, default="auto", help="What runs the exported model to validate it: Core ML, which requires macOS, or the NumPy interpreter, which only supports ML Programs. 'auto' uses Core ML when it is available and the NumPy interpreter otherwise."
+    )
+    parser.add_argument(
+        "--validation_samples", type=int, default=1, help="Number of random samples to validate the model on. With more than one, also logs the mean and relative errors, the cosine similarity and, for classifiers, how often both models predict the same class."
+    )
+    parser.add_argument(
+        "--validation_data", type=Path, default=None, help="Validate on real examples instead of random samples: a text file or a directory of text files with one example per line for text models, a directory of images for vision models, or of wav files for audio models. The files are streamed in batches, so they can be larger than memory."
+    )
+    parser.add_argument(
+        "--validation_data_samples", type=int, default=None, help="Maximum number of examples to read from --validation_data. Defaults to all of them."
+    )
     parser.add_argument(
         "--preprocessor",
         type=str,
@@ -107,12 +646,22 @@ def main():
         help="Which type of preprocessor to use. 'auto' tries to automatically detect it.",
     )
     parser.add_argument("output", type=Path, help="Path indicating where to store generated Core ML model.")
+    return parser
 
-    args = parser.parse_args()
 
-    if (not args.output.is_file()) and (args.output.suffix not in [".mlpackage", ".mlmodel"]):
-        args.output = args.output.joinpath("Model.mlpackage")
-    if not args.output.parent.exists():
+def resolve_output_path(output):
+    """If the output path is a folder, the model is saved in that folder as `Model.mlpackage`."""
+    if (not output.is_file()) and (output.suffix not in [".mlpackage", ".mlmodel"]):
+        output = output.joinpath("Model.mlpackage")
+    return output
+
+
+def export_from_args(args):
+    """
+    Runs the export described by the parsed command line arguments. Returns the paths of the saved models.
+    """
+    args.output = resolve_output_path(args.output)
+    if not args.output.parent.exists() and not args.validate_only:
         args.output.parent.mkdir(parents=True)
 
     # Instantiate the appropriate preprocessor
@@ -134,45 +683,291 @@ def main():
         deprecation_message = f"Feature '{feature}' is deprecated, please use '{args.feature}' instead."
         warnings.warn(deprecation_message, FutureWarning)
 
+    if args.stateful or args.kv_cache_capacity is not None:
+        if args.feature in SEQ2SEQ_FEATURES:
+            raise ValueError(f"--stateful and --kv_cache_capacity are not supported for feature '{args.feature}'")
+        args.use_past = True
+
+    if args.multifunction:
+        if args.feature != "text-generation":
+            raise ValueError(f"--multifunction is not supported for feature '{args.feature}'")
+        if args.stateful or args.kv_cache_capacity is not None or args.sequence_length_buckets is not None:
+            raise ValueError("--multifunction cannot be combined with --stateful, --kv_cache_capacity or --sequence_length_buckets")
+        if args.variant:
+            raise ValueError("--multifunction cannot be combined with --variant")
+        args.use_past = True
+    elif args.prefill_length is not None:
+        raise ValueError("--prefill_length requires --multifunction")
+
+    if args.chunks is not None:
+        if args.feature != "text-generation":
+            raise ValueError(f"--chunks is not supported for feature '{args.feature}'")
+        if args.stateful or args.multifunction or args.sequence_length_buckets is not None:
+            raise ValueError("--chunks cannot be combined with --stateful, --multifunction or --sequence_length_buckets")
+        if args.use_past and args.kv_cache_capacity is None:
+            raise ValueError("--chunks with --use_past requires --kv_cache_capacity")
+        if args.variant or args.quantize == "w8a8":
+            raise ValueError("--chunks cannot be combined with --variant or --quantize w8a8")
+
+    if args.quantize == "w8a8":
+        if args.calibration_data is None:
+            raise ValueError("--quantize w8a8 requires --calibration_data")
+        if not _is_macos():
+            raise ValueError("--quantize w8a8 runs the model on the calibration data, which requires macOS")
+        if args.palettize is not None or args.prune is not None:
+            raise ValueError("--quantize w8a8 cannot be combined with --palettize or --prune")
+        if args.use_past or args.feature in SEQ2SEQ_FEATURES:
+            raise ValueError(f"--quantize w8a8 is not supported with --use_past or for feature '{args.feature}'")
+
+    if args.sequence_length_buckets is not None and (args.use_past or args.feature in SEQ2SEQ_FEATURES):
+        raise ValueError(f"--sequence_length_buckets is not supported with --use_past or for feature '{args.feature}'")
+
+    if args.sequence_length_buckets is not None and isinstance(args.batch_size, tuple):
+        raise ValueError("--sequence_length_buckets cannot be combined with a range of batch sizes, use a list such as 1,8,32")
+
+    if args.validate_only and (args.variant or args.chunks is not None or args.multifunction):
+        raise ValueError("--validate_only cannot be combined with --variant, --chunks or --multifunction")
+
+    if args.validation_samples > 1 and (
+        args.stateful or args.kv_cache_capacity is not None or args.multifunction or args.chunks is not None
+    ):
+        raise ValueError(
+            "--validation_samples cannot be combined with --stateful, --kv_cache_capacity, --multifunction or --chunks"
+        )
+
+    if args.validation_data is not None and (
+        args.use_past
+        or args.feature in SEQ2SEQ_FEATURES
+        or args.kv_cache_capacity is not None
+        or args.multifunction
+        or args.chunks is not None
+    ):
+        raise ValueError(
+            f"--validation_data is not supported with --use_past, --kv_cache_capacity, --multifunction or --chunks, "
+            f"or for feature '{args.feature}'"
+        )
+
+    if args.report and (args.variant or args.chunks is not None or args.multifunction):
+        logger.warning("--report is only written for single models, not for variants, chunks or multifunction models")
+
+    memory_tracker = MemoryTracker(callbacks=[LoggingCallback()] if args.profile else None)
+    run = validate_exported_model if args.validate_only else _load_and_export
+    if args.profile:
+        if args.variant or (args.feature in SEQ2SEQ_FEATURES and not args.sequential):
+            logger.warning(
+                "--profile only covers this process, not the worker processes that convert variants or, "
+                "without --sequential, the encoder and decoder"
+            )
+        profiler = ExportProfiler(get_profile_dir(args.output))
+        memory_tracker.add_callback(profiler)
+        with profiler:
+            filenames = run(args, preprocessor, memory_tracker)
+    else:
+        filenames = run(args, preprocessor, memory_tracker)
+
+    memory_tracker.log_summary()
+    if args.profile:
+        memory_tracker.log_spans()
+    return filenames
+
+
+def validate_exported_model(args, preprocessor, memory_tracker):
+    """
+    Validates the models that were exported to the output path before, for `--validate_only`. Returns their
+    paths. With `--reference_cache`, the reference model is only loaded when its outputs are not in the store.
+    """
+    model = None
+
+    def load_reference_model():
+        nonlocal model
+        if model is None:
+            # This may run during the validate phase, and phases don't overlap, so the load is timed as a span.
+            with memory_tracker.span("load_reference_model"):
+                model = FeaturesManager.get_model_from_feature(
+                    args.feature, args.model, framework=args.framework, low_cpu_mem_usage=args.low_cpu_mem_usage
+                )
+        return model
+
+    reference_store = None
+    if args.reference_cache:
+        reference_store = ReferenceOutputStore(args.reference_cache_dir, max_size=args.export_cache_max_size)
+    else:
+        with memory_tracker.phase("load"):
+            load_reference_model()
+
+    model_config = AutoConfig.from_pretrained(args.model)
+    model_coreml_config = FeaturesManager.get_config(model_config.model_type.replace("-", "_"), args.feature)
+
+    filenames = []
+    for seq2seq in (["encoder", "decoder"] if args.feature in SEQ2SEQ_FEATURES else [None]):
+        coreml_config = model_coreml_config(
+            model_config,
+            use_past=args.use_past if seq2seq != "encoder" else False,
+            seq2seq=seq2seq,
+            stateful=args.stateful,
+            kv_cache_capacity=args.kv_cache_capacity,
+            kv_cache_sliding_window=args.kv_cache_sliding_window,
+            sequence_length_buckets=args.sequence_length_buckets,
+            batch_size=args.batch_size,
+        )
+        filename = get_output_filename(args.output, seq2seq).as_posix()
+        if not Path(filename).exists():
+            raise ValueError(f"There is no exported model at {filename} to validate")
+        validation_backend = get_validation_backend(filename, args.validation_backend)
+        if validation_backend is None:
+            raise ValueError(f"{filename} cannot be validated on this machine, see --validation_backend")
+
+        compression = get_compression(args, coreml_config, preprocessor)
+        if compression is None:
+            compression = LinearQuantizationConfig.from_quantize(args.quantize)
+
+        with memory_tracker.phase("validate"):
+            mlmodel = load_validation_model(filename, validation_backend)
+            validate_model(
+                coreml_config,
+                preprocessor,
+                model,
+                mlmodel,
+                get_atol(args, coreml_config, compression),
+                args,
+                memory_tracker=memory_tracker,
+                reference_store=reference_store,
+                load_reference_model=load_reference_model,
+            )
+        logger.info(f"All good, {filename} is valid")
+        filenames.append(filename)
+
+    return filenames
+
+
+def _load_and_export(args, preprocessor, memory_tracker):
     # Allocate the model
-    model = FeaturesManager.get_model_from_feature(
-        args.feature, args.model, framework=args.framework, #cache_dir=args.cache_dir
-    )
+    with memory_tracker.phase("load"):
+        model = FeaturesManager.get_model_from_feature(
+            args.feature,
+            args.model,
+            framework=args.framework,
+            #cache_dir=args.cache_dir
+            low_cpu_mem_usage=args.low_cpu_mem_usage,
+        )
     model_kind, model_coreml_config = FeaturesManager.check_supported_model_or_raise(model, feature=args.feature)
 
-    if args.feature in ["text2text-generation", "speech-seq2seq"]:
+    cache = None
+    if args.export_cache:
+        cache = ExportCache(args.export_cache_dir, max_size=args.export_cache_max_size)
+
+    trace_store = None
+    if args.trace_cache:
+        trace_store = TraceStore(args.trace_cache_dir, max_size=args.export_cache_max_size)
+
+    reference_store = None
+    if args.reference_cache:
+        reference_store = ReferenceOutputStore(args.reference_cache_dir, max_size=args.export_cache_max_size)
+
+    if args.variant:
+        if args.export_cache:
+            logger.warning("The export cache is not used when exporting variants")
+
+        filenames = []
+        with memory_tracker.phase("export"):
+            for seq2seq in (["encoder", "decoder"] if args.feature in SEQ2SEQ_FEATURES else [None]):
+                filenames += convert_model_variants(
+                    preprocessor,
+                    model,
+                    model_coreml_config,
+                    args,
+                    args.variant,
+                    use_past=args.use_past if seq2seq != "encoder" else False,
+                    seq2seq=seq2seq,
+                    trace_store=trace_store,
+                    reference_store=reference_store,
+                )
+    elif args.chunks is not None:
+        if args.export_cache or args.trace_cache or args.reference_cache:
+            logger.warning("The export cache, trace cache and reference cache are not used for chunked models")
+        with memory_tracker.phase("export"):
+            filenames = convert_chunked_model(preprocessor, model, model_coreml_config, args)
+    elif args.multifunction:
+        if args.export_cache or args.reference_cache:
+            logger.warning("The export cache and reference cache are not used for multifunction models")
+        with memory_tracker.phase("export"):
+            filenames = [
+                convert_multifunction_model(preprocessor, model, model_coreml_config, args, trace_store=trace_store)
+            ]
+    elif args.feature in SEQ2SEQ_FEATURES and not args.sequential:
+        # The encoder and decoder are converted in child processes, which are not measured.
+        filenames = convert_seq2seq_model(
+            preprocessor,
+            model,
+            model_coreml_config,
+            args,
+            cache=cache,
+            trace_store=trace_store,
+            reference_store=reference_store,
+        )
+    elif args.feature in SEQ2SEQ_FEATURES:
         logger.info(f"Converting encoder model...")
 
-        convert_model(
+        encoder_filename = convert_model(
             preprocessor,
             model,
             model_coreml_config,
             args,
             use_past=False,
-            seq2seq="encoder"
+            seq2seq="encoder",
+            cache=cache,
+            trace_store=trace_store,
+            memory_tracker=memory_tracker,
+            reference_store=reference_store,
         )
 
         logger.info(f"Converting decoder model...")
 
-        convert_model(
+        decoder_filename = convert_model(
             preprocessor,
             model,
             model_coreml_config,
             args,
             use_past=args.use_past,
-            seq2seq="decoder"
+            seq2seq="decoder",
+            cache=cache,
+            trace_store=trace_store,
+            memory_tracker=memory_tracker,
+            reference_store=reference_store,
         )
+        filenames = [encoder_filename, decoder_filename]
     else:
-        convert_model(
+        filename = convert_model(
             preprocessor,
             model,
             model_coreml_config,
             args,
             use_past=args.use_past,
+            cache=cache,
+            trace_store=trace_store,
+            memory_tracker=memory_tracker,
+            reference_store=reference_store,
         )
+        filenames = [filename]
+
+    return filenames
+
+
+def main():
+    # Subcommands that don't perform an export.
+    if len(sys.argv) > 1 and sys.argv[1] == "cache":
+        return cache_main(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == "batch":
+        from .batch import main as batch_main
+        return batch_main(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == "benchmark":
+        from .benchmark import main as benchmark_main
+        return benchmark_main(sys.argv[2:])
+
+    args = get_parser().parse_args()
+    export_from_args(args)
 
 
 if __name__ == "__main__":
-    logger = logging.get_logger("exporters.coreml")  # pylint: disable=invalid-name
     logger.setLevel(logging.INFO)
     main()
@@ -0,0 +1,291 @@
+# coding=utf-8
+# Copyright 2022 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Export many models with a pool of worker processes."""
+
+import contextlib
+import io
+import json
+import multiprocessing
+import re
+import time
+import traceback
+from argparse import ArgumentParser, _AppendAction
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from .__main__ import export_from_args, get_parser
+from ..utils import logging
+
+
+logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
+
+
+def load_manifest(path: Path) -> List[Dict[str, Any]]:
+    """
+    Read the list of export jobs from a manifest file.
+
+    The manifest is either a JSON file holding a list of jobs, or a JSON Lines file with one job per line.
+    Every job is a dictionary with the same options as the command line exporter, for example:
+
+    ```json
+    {"model": "distilbert-base-uncased", "feature": "text-classification", "quantize": "float16", "output": "exported/distilbert.mlpackage"}
+    ```
+
+    An optional `"name"` identifies the job in the result files.
+    """
+    with open(path, "r") as f:
+        text = f.read()
+
+    if path.suffix == ".jsonl":
+        jobs = [json.loads(line) for line in text.splitlines() if line.strip()]
+    else:
+        jobs = json.loads(text)
+
+    if not isinstance(jobs, list):
+        raise ValueError(f"Manifest {path} must contain a list of jobs")
+
+    for i, job in enumerate(jobs):
+        if "model" not in job or "output" not in job:
+            raise ValueError(f"Job {i} in manifest {path} needs at least a 'model' and an 'output'")
+
+    return jobs
+
+
+def job_name(index: int, job: Dict[str, Any]) -> str:
+    """A filesystem-friendly name for the job."""
+    if "name" in job:
+        name = job["name"]
+    else:
+        name = f"{index:04d}-{job['model']}-{job.get('feature', 'feature-extraction')}"
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", name)
+
+
+def job_to_argv(job: Dict[str, Any], extra_argv: Optional[List[str]] = None) -> List[str]:
+    """
+    Turn a manifest entry into command line arguments for the exporter. Options that are not in the
+    manifest entry take their value from `extra_argv`, or otherwise use the exporter's defaults.
+
+    A list is passed as one flag per element for options that can be repeated, such as
+    `"variant": ["quantize=float16", "quantize=int8"]`, and as a comma-separated list otherwise, such as
+    `"sequence_length_buckets": [32, 64, 128]`.
+    """
+    repeatable = [
+        option
+        for action in get_parser()._actions
+        if isinstance(action, _AppendAction)
+        for option in action.option_strings
+    ]
+    argv = list(extra_argv or [])
+    for key, value in job.items():
+        if key in ["name", "output"]:
+            continue
+        flag = f"--{key}"
+        if isinstance(value, bool):
+            if value:
+                argv.append(flag)
+        elif isinstance(value, list) and flag in repeatable:
+            for element in value:
+                argv += [flag, str(element)]
+        elif isinstance(value, list):
+            argv += [flag, ",".join(str(element) for element in value)]
+        else:
+            argv += [flag, str(value)]
+    argv.append(str(job["output"]))
+    return argv
+
+
+def parse_job_args(parser, argv: List[str]):
+    """
+    Parses the command line arguments of a job. Raises a `ValueError` with argparse's message if they are
+    invalid, instead of exiting.
+    """
+    stderr = io.StringIO()
+    try:
+        with contextlib.redirect_stderr(stderr):
+            return parser.parse_args(argv)
+    except SystemExit:
+        lines = stderr.getvalue().strip().splitlines()
+        raise ValueError(lines[-1] if len(lines) > 0 else f"invalid arguments {argv}")
+
+
+def _init_worker(log_level: int):
+    # Import the heavy libraries once, so every job that runs in this worker starts warm.
+    import coremltools  # noqa: F401
+    import torch  # noqa: F401
+    import transformers  # noqa: F401
+
+    logging.get_logger("exporters.coreml").setLevel(log_level)
+
+
+def _run_job(name: str, argv: List[str]) -> Dict[str, Any]:
+    result = {"name": name, "argv": argv, "started": time.time()}
+    try:
+        args = get_parser().parse_args(argv)
+        # Don't start more processes for the encoder and decoder: the pool already runs jobs in parallel,
+        # and this worker has used torch in earlier jobs, so forking it is not safe.
+        args.sequential = True
+        result["artifacts"] = export_from_args(args)
+        result["status"] = "succeeded"
+    except BaseException as e:
+        result["status"] = "failed"
+        result["error"] = f"{type(e).__name__}: {e}"
+        result["traceback"] = traceback.format_exc()
+    result["duration"] = time.time() - result["started"]
+    return result
+
+
+def _read_result(results_dir: Path, name: str) -> Dict[str, Any]:
+    # The result of the previous run of the job, empty if it wrote no result file.
+    try:
+        with open(results_dir / f"{name}.json", "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_result(results_dir: Path, result: Dict[str, Any]):
+    with open(results_dir / f"{result['name']}.json", "w") as f:
+        json.dump(result, f, indent=2)
+
+
+def run_batch(
+    manifest: Path,
+    num_workers: int = 1,
+    results_dir: Optional[Path] = None,
+    extra_argv: Optional[List[str]] = None,
+    force: bool = False,
+) -> List[Dict[str, Any]]:
+    """
+    Run all the export jobs from a manifest on a pool of worker processes.
+
+    The workers are started once and reused for all the jobs, so torch and coremltools are only imported
+    once per worker. Each job writes a JSON file with its outcome to `results_dir`. Jobs that succeeded
+    before with the same arguments and whose output files still exist are skipped, unless `force` is set. A job that failed after
+    saving its output, for example in validation, runs again.
+
+    Args:
+        manifest (`Path`):
+            The manifest file, see [`~coreml.batch.load_manifest`].
+        num_workers (`int`, *optional*, defaults to 1):
+            How many exports to run at the same time.
+        results_dir (`Path`, *optional*):
+            Where to write the per-job result files. Defaults to a `<manifest>.results` folder next to the
+            manifest.
+        extra_argv (`List[str]`, *optional*):
+            Command line options that apply to every job, unless the job overrides them.
+        force (`bool`, *optional*, defaults to `False`):
+            Also run the jobs that succeeded before.
+
+    Returns:
+        `List[Dict[str, Any]]`: the result of every job, in manifest order.
+    """
+    jobs = load_manifest(manifest)
+    if results_dir is None:
+        results_dir = manifest.parent / f"{manifest.stem}.results"
+    results_dir.mkdir(parents=True, exist_ok=True)
+
+    parser = get_parser()
+    results = {}
+    pending = []
+    for i, job in enumerate(jobs):
+        name = job_name(i, job)
+        argv = job_to_argv(job, extra_argv)
+        try:
+            parse_job_args(parser, argv)
+        except ValueError as e:
+            # Only this job fails, the others still run.
+            logger.error(f"Job {name} failed: {e}")
+            results[name] = {"name": name, "argv": argv, "status": "failed", "error": f"{type(e).__name__}: {e}"}
+            _write_result(results_dir, results[name])
+            continue
+
+        # The files the job saved before, rather than the paths it would use, which depend on many options.
+        previous = _read_result(results_dir, name)
+        artifacts = previous.get("artifacts")
+        succeeded = previous.get("status") in ["succeeded", "skipped"] and previous.get("argv") == argv
+        if not force and succeeded and artifacts and all(Path(path).exists() for path in artifacts):
+            logger.info(f"Skipping job {name}, it succeeded before and its output exists")
+            results[name] = {"name": name, "argv": argv, "status": "skipped", "artifacts": artifacts}
+            _write_result(results_dir, results[name])
+        else:
+            pending.append((name, argv))
+
+    if len(pending) > 0:
+        logger.info(f"Running {len(pending)} export jobs on {num_workers} worker(s)")
+
+        # Use fresh processes instead of forking, since the parent may already have
+        # started threads (for example torch's thread pool).
+        mp_context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=mp_context,
+            initializer=_init_worker,
+            initargs=(logging.get_logger("exporters.coreml").getEffectiveLevel(),),
+        ) as executor:
+            futures = {executor.submit(_run_job, name, argv): (name, argv) for name, argv in pending}
+            for future in as_completed(futures):
+                name, argv = futures[future]
+                try:
+                    result = future.result()
+                except BrokenProcessPool as e:
+                    # A worker died, for example because it ran out of memory.
+                    result = {"name": name, "argv": argv, "status": "failed", "error": f"worker crashed: {e}"}
+
+                results[name] = result
+                _write_result(results_dir, result)
+                if result["status"] == "succeeded":
+                    logger.info(f"Job {name} succeeded in {result['duration']:.1f} s")
+                else:
+                    logger.error(f"Job {name} failed: {result['error']}")
+
+    return [results[job_name(i, job)] for i, job in enumerate(jobs)]
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = ArgumentParser(
+        "Hugging Face Transformers Core ML batch exporter",
+        epilog="Any other options are passed on to every export job, for example --export_cache.",
+    )
+    parser.add_argument("manifest", type=Path, help="JSON or JSON Lines file that lists the models to export.")
+    parser.add_argument(
+        "--workers", type=int, default=1, help="Number of worker processes that export models in parallel."
+    )
+    parser.add_argument(
+        "--results_dir", type=Path, default=None, help="Where to write the result file of each job. Defaults to <manifest>.results next to the manifest."
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="Also run jobs that succeeded before and whose output files still exist."
+    )
+    args, extra_argv = parser.parse_known_args(argv)
+
+    logging.get_logger("exporters.coreml").setLevel(logging.INFO)
+
+    results = run_batch(
+        args.manifest,
+        num_workers=args.workers,
+        results_dir=args.results_dir,
+        extra_argv=extra_argv,
+        force=args.force,
+    )
+
+    counts = {}
+    for result in results:
+        counts[result["status"]] = counts.get(result["status"], 0) + 1
+    logger.info("Batch finished: " + ", ".join(f"{count} {status}" for status, count in sorted(counts.items())))
+
+    if counts.get("failed", 0) > 0:
+        raise SystemExit(1)
@@ -0,0 +1,563 @@
+# coding=utf-8
+# Copyright 2022 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Measure the inference latency and throughput of an exported Core ML model."""
+
+import itertools
+import platform
+import time
+from argparse import ArgumentParser
+from dataclasses import asdict, dataclass
+from functools import partial
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Union
+
+import coremltools as ct
+import numpy as np
+from coremltools.models.utils import _is_macos
+from coremltools.proto import FeatureTypes_pb2 as ft
+from transformers.utils import is_vision_available
+
+from .benchmark import save_results
+from .config import GENERATION_STEPS, CoreMLConfig
+from .interpreter import MILInterpreter
+from .report import get_versions
+from ..utils import logging
+
+
+if is_vision_available():
+    from PIL import Image
+
+
+logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
+
+LATENCY_PERCENTILES = (50, 90, 99)
+
+# The axes of the inputs that hold the batch and the sequence.
+_BATCH_AXIS = 0
+_SEQUENCE_AXIS = 1
+
+_ARRAY_DTYPES = {
+    ft.ArrayFeatureType.INT32: np.int32,
+    ft.ArrayFeatureType.FLOAT16: np.float16,
+    ft.ArrayFeatureType.FLOAT32: np.float32,
+    ft.ArrayFeatureType.DOUBLE: np.float64,
+}
+
+_GRAYSCALE = (ft.ImageFeatureType.GRAYSCALE, ft.ImageFeatureType.GRAYSCALE_FLOAT16)
+
+_BACKENDS = {}
+
+
+def register_backend(name: str):
+    """
+    Registers a function that loads a saved model for benchmarking, as `load(filename, function_name,
+    compute_units)`. The loaded model needs a `predict()` method and, for stateful models, a `make_state()`
+    method, like `ct.models.MLModel`.
+    """
+
+    def decorator(load):
+        _BACKENDS[name] = load
+        return load
+
+    return decorator
+
+
+@register_backend("coreml")
+def _load_coreml(filename: str, function_name: Optional[str], compute_units: ct.ComputeUnit):
+    if not _is_macos():
+        raise ValueError("The Core ML backend requires macOS, use the numpy backend on other platforms")
+    return ct.models.MLModel(filename, compute_units=compute_units, function_name=function_name)
+
+
+@register_backend("numpy")
+def _load_interpreter(filename: str, function_name: Optional[str], compute_units: ct.ComputeUnit):
+    # The interpreter always runs on the CPU. Its timings are not those of Core ML, but they exercise the
+    # harness on machines without Core ML.
+    return MILInterpreter(filename, function_name=function_name, emulate_float16=False)
+
+
+def get_bench_backends() -> List[str]:
+    """The names of the registered backends, and `"auto"`."""
+    return ["auto"] + sorted(_BACKENDS)
+
+
+def get_bench_backend(backend: str = "auto") -> str:
+    """Resolves `"auto"` to Core ML on macOS and to the NumPy interpreter elsewhere."""
+    if backend == "auto":
+        return "coreml" if _is_macos() else "numpy"
+    if backend not in _BACKENDS:
+        raise ValueError(f"Unknown backend '{backend}', choose one of {get_bench_backends()}")
+    return backend
+
+
+def load_bench_model(
+    filename: Union[str, Path],
+    backend: str = "auto",
+    function_name: Optional[str] = None,
+    compute_units: ct.ComputeUnit = ct.ComputeUnit.ALL,
+):
+    """
+    Loads a saved model with one of the registered backends.
+
+    Args:
+        filename (`str` or `Path`):
+            The saved Core ML model.
+        backend (`str`, *optional*, defaults to `"auto"`):
+            One of [`~coreml.bench.get_bench_backends`].
+        function_name (`str`, *optional*):
+            The function to run, for multifunction models. Defaults to the default function of the model.
+        compute_units (`ct.ComputeUnit`, *optional*, defaults to `ct.ComputeUnit.ALL`):
+            What Core ML may run the model on. Ignored by the NumPy interpreter.
+    """
+    return _BACKENDS[get_bench_backend(backend)](Path(filename).as_posix(), function_name, compute_units)
+
+
+def get_function_description(spec, function_name: Optional[str] = None):
+    """The description of the inputs of a model, or of one of its functions for multifunction models."""
+    description = spec.description
+    if len(description.functions) == 0:
+        return description
+    if function_name is None:
+        function_name = description.defaultFunctionName
+    for function_description in description.functions:
+        if function_description.name == function_name:
+            return function_description
+    raise ValueError(f"The model has no function named '{function_name}'")
+
+
+def _flexible_sizes(array_type, axis: int) -> Optional[List[int]]:
+    # The sizes to benchmark along an axis that can vary: all enumerated sizes, or the bounds of the range.
+    # `None` for an axis of fixed size.
+    flexibility = array_type.WhichOneof("ShapeFlexibility")
+    if flexibility == "enumeratedShapes":
+        sizes = {list(shape.shape)[axis] for shape in array_type.enumeratedShapes.shapes if axis < len(shape.shape)}
+        return sorted(sizes) if len(sizes) > 1 else None
+    if flexibility == "shapeRange" and axis < len(array_type.shapeRange.sizeRanges):
+        size_range = array_type.shapeRange.sizeRanges[axis]
+        if size_range.lowerBound == size_range.upperBound:
+            return None
+        sizes = [max(size_range.lowerBound, 1)]
+        if size_range.upperBound > sizes[0]:
+            sizes.append(size_range.upperBound)
+        return sizes
+    return None
+
+
+def get_bench_sizes(description) -> Dict[str, List[Optional[int]]]:
+    """
+    The batch sizes and sequence lengths to benchmark by default, from the shapes of the inputs: every
+    enumerated size, or the smallest and largest size of a range. `[None]` when the model has a fixed size.
+    """
+    sizes = {}
+    for name, axis in [("batch_size", _BATCH_AXIS), ("sequence_length", _SEQUENCE_AXIS)]:
+        values = set()
+        for feature in description.input:
+            if feature.type.WhichOneof("Type") == "multiArrayType":
+                values.update(_flexible_sizes(feature.type.multiArrayType, axis) or [])
+        sizes[name] = sorted(values) if len(values) > 0 else [None]
+    return sizes
+
+
+def get_config_options(spec, function_name: Optional[str] = None) -> Dict[str, Any]:
+    """
+    The options of [`~coreml.config.CoreMLConfig`] that a model was exported with, as far as they shape its
+    inputs: the key and value cache, the generation step, the sequence length buckets and the batch size. A
+    configuration created with these options generates inputs that fit the model. `kv_cache_sliding_window`
+    doesn't change the inputs and is not recovered.
+
+    Args:
+        spec:
+            The spec of the model.
+        function_name (`str`, *optional*):
+            The function to read, for multifunction models. Defaults to the default function of the model.
+    """
+    description = get_function_description(spec, function_name)
+    inputs = {feature.name: feature.type for feature in description.input}
+    options = {}
+
+    if len(spec.description.functions) > 0 and description.name in GENERATION_STEPS:
+        prefill_inputs = {feature.name: feature.type for feature in get_function_description(spec, "prefill").input}
+        options["use_past"] = True
+        options["generation_step"] = description.name
+        options["prefill_length"] = prefill_inputs["input_ids"].multiArrayType.shape[_SEQUENCE_AXIS]
+
+    if len(description.state) > 0:
+        options["use_past"] = True
+        options["stateful"] = True
+    elif any(name.startswith("past_key_values_") for name in inputs):
+        options["use_past"] = True
+
+    if "position" in inputs:
+        # A fixed-size cache, which holds the tokens on its second to last axis.
+        if len(description.state) > 0:
+            cache_shape = description.state[0].type.stateType.arrayType.shape
+        else:
+            cache_shape = inputs["past_key_values_0_key"].multiArrayType.shape
+        options["kv_cache_capacity"] = cache_shape[-2]
+
+    main_input = description.input[0].type
+    if main_input.WhichOneof("Type") == "multiArrayType":
+        array_type = main_input.multiArrayType
+        flexibility = array_type.WhichOneof("ShapeFlexibility")
+        if flexibility == "enumeratedShapes":
+            batch_sizes = _flexible_sizes(array_type, _BATCH_AXIS)
+            if batch_sizes is not None:
+                options["batch_size"] = batch_sizes
+            if "use_past" not in options:
+                buckets = _flexible_sizes(array_type, _SEQUENCE_AXIS)
+                if buckets is not None:
+                    options["sequence_length_buckets"] = buckets
+        elif flexibility == "shapeRange":
+            size_range = array_type.shapeRange.sizeRanges[_BATCH_AXIS]
+            if size_range.lowerBound != size_range.upperBound:
+                options["batch_size"] = (size_range.lowerBound, size_range.upperBound)
+        if "batch_size" not in options and array_type.shape[_BATCH_AXIS] > 1:
+            options["batch_size"] = array_type.shape[_BATCH_AXIS]
+
+    return options
+
+
+def _input_shape(name: str, array_type, requested: Dict[int, Optional[int]]) -> List[int]:
+    shape = list(array_type.shape)
+    flexibility = array_type.WhichOneof("ShapeFlexibility")
+    if flexibility == "enumeratedShapes":
+        # Only the axes that differ between the enumerated shapes follow the requested sizes.
+        axes = [axis for axis, size in requested.items() if size is not None and _flexible_sizes(array_type, axis)]
+        for enumerated in array_type.enumeratedShapes.shapes:
+            candidate = list(enumerated.shape)
+            if all(candidate[axis] == requested[axis] for axis in axes):
+                return candidate
+        sizes = ", ".join(str(list(shape.shape)) for shape in array_type.enumeratedShapes.shapes)
+        raise ValueError(f"Input '{name}' only accepts the shapes {sizes}")
+
+    if flexibility == "shapeRange":
+        for axis, size in requested.items():
+            if size is None or _flexible_sizes(array_type, axis) is None:
+                continue
+            size_range = array_type.shapeRange.sizeRanges[axis]
+            if size < size_range.lowerBound or (size_range.upperBound != -1 and size > size_range.upperBound):
+                upper = "unbounded" if size_range.upperBound == -1 else size_range.upperBound
+                raise ValueError(
+                    f"Input '{name}' accepts sizes from {size_range.lowerBound} to {upper} on axis {axis}, not {size}"
+                )
+            shape[axis] = size
+    return shape
+
+
+def generate_spec_inputs(
+    description, batch_size: Optional[int] = None, sequence_length: Optional[int] = None, seed: int = 0
+) -> Dict[str, Any]:
+    """
+    Generates inputs from the description of a model's inputs, for models without a matching
+    [`~coreml.config.CoreMLConfig`]. Float arrays are random, masks are all ones and other integer arrays
+    are all zeros, which every model accepts as token ids and positions.
+
+    Args:
+        description:
+            The description of the model or of one of its functions, from
+            [`~coreml.bench.get_function_description`].
+        batch_size (`int`, *optional*):
+            The size of the first axis of the inputs where it can vary. Defaults to the default shape.
+        sequence_length (`int`, *optional*):
+            The size of the second axis of the inputs where it can vary. Defaults to the default shape.
+        seed (`int`, *optional*, defaults to 0):
+            Seed of the random values.
+    """
+    array_types = [
+        feature.type.multiArrayType
+        for feature in description.input
+        if feature.type.WhichOneof("Type") == "multiArrayType"
+    ]
+    sizes = get_bench_sizes(description)
+    requested = {_BATCH_AXIS: batch_size, _SEQUENCE_AXIS: sequence_length}
+    for name, axis in [("batch_size", _BATCH_AXIS), ("sequence_length", _SEQUENCE_AXIS)]:
+        # A size that the model doesn't let vary is only accepted if it is the size the model has.
+        fixed_sizes = {array_type.shape[axis] for array_type in array_types if axis < len(array_type.shape)}
+        size = requested[axis]
+        if size is not None and sizes[name] == [None] and size not in fixed_sizes:
+            raise ValueError(f"The model has a fixed {name.replace('_', ' ')}, it can't be {size}")
+
+    rng = np.random.default_rng(seed)
+    inputs = {}
+    for feature in description.input:
+        feature_type = feature.type.WhichOneof("Type")
+        if feature_type == "imageType":
+            image_type = feature.type.imageType
+            if not is_vision_available():
+                raise ValueError(f"Generating image input '{feature.name}' requires Pillow (pip install Pillow)")
+            if image_type.colorSpace in _GRAYSCALE:
+                pixels = rng.integers(0, 256, (image_type.height, image_type.width), dtype=np.uint8)
+                inputs[feature.name] = Image.fromarray(pixels, mode="L")
+            else:
+                pixels = rng.integers(0, 256, (image_type.height, image_type.width, 3), dtype=np.uint8)
+                inputs[feature.name] = Image.fromarray(pixels, mode="RGB")
+        elif feature_type == "multiArrayType":
+            array_type = feature.type.multiArrayType
+            shape = _input_shape(feature.name, array_type, requested)
+            dtype = _ARRAY_DTYPES.get(array_type.dataType, np.float32)
+            if np.issubdtype(dtype, np.floating):
+                inputs[feature.name] = rng.standard_normal(shape).astype(dtype)
+            elif "mask" in feature.name:
+                inputs[feature.name] = np.ones(shape, dtype=dtype)
+            else:
+                inputs[feature.name] = np.zeros(shape, dtype=dtype)
+        else:
+            raise ValueError(f"Cannot generate input '{feature.name}' of type {feature_type}")
+    return inputs
+
+
+def generate_config_inputs(
+    config: CoreMLConfig,
+    preprocessor: Union["PreTrainedTokenizerBase", "ImageProcessingMixin", "ProcessorMixin"],
+    batch_size: Optional[int] = None,
+    sequence_length: Optional[int] = None,
+) -> Dict[str, Any]:
+    """
+    Generates the inputs of the model with [`~coreml.config.CoreMLConfig.generate_dummy_inputs`], which
+    produces token ids and images that look like the real thing.
+    """
+    input_descs = config.inputs
+    dummy_inputs = config.generate_dummy_inputs(preprocessor, sequence_length=sequence_length, batch_size=batch_size)
+    return {input_descs[name].name: coreml_value for name, (_, coreml_value) in dummy_inputs.items()}
+
+
+@dataclass
+class LatencyResult:
+    """
+    The speed of a model at one batch size and sequence length.
+
+    Args:
+        batch_size (`int`):
+            Number of examples per prediction.
+        sequence_length (`int`, *optional*):
+            The requested sequence length, or `None` for the default shape of the model.
+        num_runs (`int`):
+            Number of timed predictions.
+        latency (`Dict[str, float]`):
+            The 50th, 90th and 99th percentiles of the seconds per prediction, as `"p50"`, `"p90"` and `"p99"`.
+        mean_latency (`float`):
+            The average seconds per prediction.
+        throughput (`float`):
+            Examples per second.
+    """
+
+    batch_size: int
+    sequence_length: Optional[int]
+    num_runs: int
+    latency: Dict[str, float]
+    mean_latency: float
+    throughput: float
+
+    @classmethod
+    def from_latencies(cls, latencies: List[float], batch_size: int, sequence_length: Optional[int] = None):
+        latencies = np.asarray(latencies)
+        return cls(
+            batch_size=batch_size,
+            sequence_length=sequence_length,
+            num_runs=len(latencies),
+            latency={f"p{q}": float(np.percentile(latencies, q)) for q in LATENCY_PERCENTILES},
+            mean_latency=float(latencies.mean()),
+            throughput=batch_size * len(latencies) / float(latencies.sum()),
+        )
+
+
+def measure_latency(
+    mlmodel, inputs: Dict[str, Any], num_warmup: int = 3, num_runs: int = 20, stateful: bool = False
+) -> List[float]:
+    """
+    Runs the model `num_warmup` times, which loads it onto the compute units and fills the caches, and then
+    returns the seconds taken by each of `num_runs` predictions. Stateful models start every prediction from
+    a new state, which is created outside of the timing.
+    """
+    def run():
+        state = mlmodel.make_state() if stateful else None
+        start = time.perf_counter()
+        if state is None:
+            mlmodel.predict(inputs)
+        else:
+            mlmodel.predict(inputs, state=state)
+        return time.perf_counter() - start
+
+    for _ in range(num_warmup):
+        run()
+    return [run() for _ in range(num_runs)]
+
+
+def _num_examples(inputs: Dict[str, Any]) -> int:
+    for value in inputs.values():
+        if isinstance(value, np.ndarray) and value.ndim > 0:
+            return value.shape[_BATCH_AXIS]
+    return 1
+
+
+def benchmark_model(
+    mlmodel,
+    batch_sizes: Optional[List[int]] = None,
+    sequence_lengths: Optional[List[int]] = None,
+    num_warmup: int = 3,
+    num_runs: int = 20,
+    generate_inputs: Optional[Callable[..., Dict[str, Any]]] = None,
+) -> List[LatencyResult]:
+    """
+    Measure the latency and throughput of a model at several batch sizes and sequence lengths.
+
+    Args:
+        mlmodel (`ct.models.MLModel` or [`~coreml.interpreter.MILInterpreter`]):
+            The model, as loaded by [`~coreml.bench.load_bench_model`].
+        batch_sizes (`List[int]`, *optional*):
+            The batch sizes to measure. Defaults to those of [`~coreml.bench.get_bench_sizes`].
+        sequence_lengths (`List[int]`, *optional*):
+            The sequence lengths to measure. Defaults to those of [`~coreml.bench.get_bench_sizes`].
+        num_warmup (`int`, *optional*, defaults to 3):
+            Number of predictions before the timed ones, for each batch size and sequence length.
+        num_runs (`int`, *optional*, defaults to 20):
+            Number of timed predictions.
+        generate_inputs (`Callable`, *optional*):
+            Called with `batch_size` and `sequence_length` to create the inputs, for example a partial of
+            [`~coreml.bench.generate_config_inputs`]. Defaults to [`~coreml.bench.generate_spec_inputs`].
+
+    Returns:
+        `List[LatencyResult]`: the speed at each batch size and sequence length that the model accepts.
+    """
+    description = get_function_description(mlmodel.get_spec(), getattr(mlmodel, "function_name", None))
+    sizes = get_bench_sizes(description)
+    if generate_inputs is None:
+        generate_inputs = partial(generate_spec_inputs, description)
+    stateful = len(description.state) > 0
+
+    results = []
+    for batch_size, sequence_length in itertools.product(
+        batch_sizes or sizes["batch_size"], sequence_lengths or sizes["sequence_length"]
+    ):
+        try:
+            inputs = generate_inputs(batch_size=batch_size, sequence_length=sequence_length)
+        except ValueError as e:
+            logger.warning(f"Skipping batch size {batch_size} and sequence length {sequence_length}: {e}")
+            continue
+
+        latencies = measure_latency(mlmodel, inputs, num_warmup=num_warmup, num_runs=num_runs, stateful=stateful)
+        result = LatencyResult.from_latencies(latencies, _num_examples(inputs), sequence_length)
+        logger.info(_format_result(result))
+        results.append(result)
+
+    if len(results) == 0:
+        raise ValueError("The model accepts none of the batch sizes and sequence lengths to benchmark")
+    return results
+
+
+def _format_result(result: LatencyResult) -> str:
+    sequence_length = "default" if result.sequence_length is None else result.sequence_length
+    latency = ", ".join(f"{name} {value * 1000:.2f} ms" for name, value in result.latency.items())
+    return (
+        f"Batch size {result.batch_size}, sequence length {sequence_length}: {latency}, "
+        f"{result.throughput:.1f} examples/s"
+    )
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = ArgumentParser("Hugging Face Transformers Core ML inference benchmark")
+    parser.add_argument("model", type=Path, help="The exported model, an .mlpackage or .mlmodel.")
+    parser.add_argument(
+        "--backend", type=str, choices=get_bench_backends(), default="auto", help="What runs the model: Core ML, which requires macOS, or the NumPy interpreter, which only supports ML Programs and only tests the harness. 'auto' uses Core ML on macOS and the NumPy interpreter otherwise."
+    )
+    parser.add_argument(
+        "--compute_units",
+        type=str,
+        choices=["all", "cpu_and_gpu", "cpu_only", "cpu_and_ne"],
+        default="all",
+        help="What Core ML may run the model on.",
+    )
+    parser.add_argument(
+        "--function_name", type=str, default=None, help="The function to benchmark, for multifunction models. Defaults to the default function."
+    )
+    parser.add_argument(
+        "--batch_size", type=int, nargs="+", default=None, help="Batch sizes to measure. Defaults to every size the model accepts, or the smallest and largest of a range."
+    )
+    parser.add_argument(
+        "--sequence_length", type=int, nargs="+", default=None, help="Sequence lengths to measure. Defaults to every length the model accepts, or the shortest and longest of a range."
+    )
+    parser.add_argument(
+        "--warmup", type=int, default=3, help="Number of predictions before the timed ones, for each batch size and sequence length."
+    )
+    parser.add_argument("--runs", type=int, default=20, help="Number of timed predictions.")
+    parser.add_argument(
+        "--config_model", type=str, default=None, help="Name or path of the model that was exported, to generate the inputs with its Core ML configuration and preprocessor instead of from the input shapes. Requires --feature."
+    )
+    parser.add_argument(
+        "--feature", type=str, default=None, help="The feature the model was exported for, with --config_model."
+    )
+    parser.add_argument("--output", type=Path, default=None, help="JSON file to write the results to.")
+    args = parser.parse_args(argv)
+
+    logging.get_logger("exporters.coreml").setLevel(logging.INFO)
+
+    if args.warmup < 0 or args.runs < 1:
+        raise ValueError("--warmup can't be negative and --runs must be positive")
+    if args.config_model is not None and args.feature is None:
+        raise ValueError("--config_model requires --feature")
+
+    backend = get_bench_backend(args.backend)
+    compute_units = ct.ComputeUnit[args.compute_units.upper()]
+    mlmodel = load_bench_model(args.model, backend, function_name=args.function_name, compute_units=compute_units)
+
+    generate_inputs = None
+    if args.config_model is not None:
+        from transformers import AutoConfig
+        from transformers.onnx.utils import get_preprocessor
+
+        from .features import FeaturesManager
+
+        spec = mlmodel.get_spec()
+        description = get_function_description(spec, args.function_name)
+        model_config = AutoConfig.from_pretrained(args.config_model)
+        config_constructor = FeaturesManager.get_config(model_config.model_type.replace("-", "_"), args.feature)
+        config = config_constructor(model_config, **get_config_options(spec, args.function_name))
+        expected = sorted(feature.name for feature in description.input)
+        actual = sorted(desc.name for desc in config.inputs.values())
+        if actual != expected:
+            raise ValueError(
+                f"The inputs of the Core ML configuration {actual} don't match those of the model {expected}, "
+                "leave out --config_model to generate the inputs from the model"
+            )
+        generate_inputs = partial(generate_config_inputs, config, get_preprocessor(args.config_model))
+
+    logger.info(f"Benchmarking {args.model} with the {backend} backend...")
+    results = benchmark_model(
+        mlmodel,
+        batch_sizes=args.batch_size,
+        sequence_lengths=args.sequence_length,
+        num_warmup=args.warmup,
+        num_runs=args.runs,
+        generate_inputs=generate_inputs,
+    )
+
+    if args.output is not None:
+        save_results(
+            {
+                "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "platform": platform.platform(),
+                "versions": get_versions(),
+                "model": args.model.as_posix(),
+                "backend": backend,
+                "compute_units": args.compute_units,
+                "results": [asdict(result) for result in results],
+            },
+            args.output,
+        )
+        logger.info(f"Saved the results at: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
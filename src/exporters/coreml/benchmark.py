@@ -0,0 +1,530 @@
+# coding=utf-8
+# Copyright 2022 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmark the conversion of every supported architecture, using tiny randomly initialized models."""
+
+import json
+import os
+import platform
+import tempfile
+import time
+import traceback
+from argparse import ArgumentParser
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from transformers import AutoConfig, BertTokenizer, PretrainedConfig, ViTImageProcessor
+
+from .cache import format_size
+from .compression import QUANTIZE_OPTIONS
+from .convert import export
+from .features import FeaturesManager
+from .memory import MemoryTracker, release_memory
+from .report import get_versions
+from ..utils import logging
+
+
+logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
+
+# Model types whose name in Transformers differs from the name in `FeaturesManager`.
+_TRANSFORMERS_MODEL_TYPES = {
+    "blenderbot_small": "blenderbot-small",
+    "data2vec": "data2vec-text",
+}
+
+# The tokenizer of the tiny text models has this many tokens. The special tokens come first.
+TINY_VOCAB_SIZE = 100
+
+_TINY_TEXT_CONFIG = {
+    "vocab_size": TINY_VOCAB_SIZE,
+    "hidden_size": 32,
+    "num_hidden_layers": 2,
+    "num_attention_heads": 2,
+    "intermediate_size": 37,
+    "pad_token_id": 0,
+    "bos_token_id": 2,
+    "eos_token_id": 3,
+}
+
+_TINY_SEQ2SEQ_CONFIG = {
+    **_TINY_TEXT_CONFIG,
+    "d_model": 32,
+    "encoder_layers": 2,
+    "decoder_layers": 2,
+    "encoder_attention_heads": 2,
+    "decoder_attention_heads": 2,
+    "encoder_ffn_dim": 37,
+    "decoder_ffn_dim": 37,
+    "decoder_start_token_id": 2,
+}
+
+_TINY_VISION_CONFIG = {
+    "image_size": 32,
+    "patch_size": 4,
+    "hidden_size": 32,
+    "num_hidden_layers": 2,
+    "num_attention_heads": 2,
+    "intermediate_size": 37,
+}
+
+# Overrides of the model configurations that make every supported architecture small enough to convert in
+# seconds. Options that are lists, such as the sizes of the stages of convolutional models, must be
+# shrunk together.
+TINY_CONFIGS = {
+    "bart": _TINY_SEQ2SEQ_CONFIG,
+    "beit": {
+        **_TINY_VISION_CONFIG,
+        "num_hidden_layers": 4,
+        "out_indices": [1, 2, 3, 4],
+        "auxiliary_channels": 16,
+        "pool_scales": [1, 2],
+    },
+    "bert": _TINY_TEXT_CONFIG,
+    "big_bird": {**_TINY_TEXT_CONFIG, "attention_type": "original_full"},
+    "bigbird_pegasus": {**_TINY_SEQ2SEQ_CONFIG, "attention_type": "original_full"},
+    "blenderbot": _TINY_SEQ2SEQ_CONFIG,
+    "blenderbot_small": _TINY_SEQ2SEQ_CONFIG,
+    "bloom": _TINY_TEXT_CONFIG,
+    "convnext": {"image_size": 32, "num_stages": 2, "hidden_sizes": [16, 32], "depths": [1, 1]},
+    "ctrl": {**_TINY_TEXT_CONFIG, "dff": 37, "n_positions": 512},
+    "cvt": {
+        "image_size": 64,
+        "embed_dim": [16, 32],
+        "num_heads": [1, 2],
+        "depth": [1, 2],
+        "patch_sizes": [7, 3],
+        "patch_stride": [4, 2],
+        "patch_padding": [2, 1],
+        "mlp_ratio": [2.0, 2.0],
+        "attention_drop_rate": [0.0, 0.0],
+        "drop_rate": [0.0, 0.0],
+        "drop_path_rate": [0.0, 0.0],
+        "qkv_bias": [True, True],
+        "cls_token": [False, True],
+        "qkv_projection_method": ["dw_bn", "dw_bn"],
+        "kernel_qkv": [3, 3],
+        "padding_kv": [1, 1],
+        "stride_kv": [2, 2],
+        "padding_q": [1, 1],
+        "stride_q": [1, 1],
+    },
+    "data2vec": _TINY_TEXT_CONFIG,
+    "distilbert": {**_TINY_TEXT_CONFIG, "hidden_dim": 37},
+    "ernie": _TINY_TEXT_CONFIG,
+    "gpt2": _TINY_TEXT_CONFIG,
+    "gpt_bigcode": _TINY_TEXT_CONFIG,
+    "gptj": {**_TINY_TEXT_CONFIG, "rotary_dim": 8},
+    "gpt_neo": {
+        **_TINY_TEXT_CONFIG,
+        "num_layers": 2,
+        "num_heads": 2,
+        "attention_types": [[["global", "local"], 1]],
+        "window_size": 16,
+    },
+    "gpt_neox": _TINY_TEXT_CONFIG,
+    "levit": {
+        # Transformers picks the model class for image classification from the architectures.
+        "architectures": ["LevitForImageClassification"],
+        "image_size": 64,
+        "hidden_sizes": [16, 32, 48],
+        "num_attention_heads": [1, 2, 3],
+        "depths": [1, 1, 1],
+        "key_dim": [8, 8, 8],
+    },
+    "llama": _TINY_TEXT_CONFIG,
+    "m2m_100": _TINY_SEQ2SEQ_CONFIG,
+    "marian": _TINY_SEQ2SEQ_CONFIG,
+    "mobilebert": {**_TINY_TEXT_CONFIG, "embedding_size": 16, "intra_bottleneck_size": 16},
+    "mobilevit": {
+        "image_size": 64,
+        "hidden_sizes": [16, 24, 32],
+        "neck_hidden_sizes": [8, 8, 16, 16, 24, 32, 64],
+        "aspp_out_channels": 16,
+    },
+    "mvp": _TINY_SEQ2SEQ_CONFIG,
+    "pegasus": _TINY_SEQ2SEQ_CONFIG,
+    "plbart": _TINY_SEQ2SEQ_CONFIG,
+    "roberta": _TINY_TEXT_CONFIG,
+    "roformer": _TINY_TEXT_CONFIG,
+    "segformer": {
+        "image_size": 32,
+        "num_encoder_blocks": 2,
+        "depths": [1, 1],
+        "sr_ratios": [2, 1],
+        "hidden_sizes": [16, 32],
+        "patch_sizes": [7, 3],
+        "strides": [4, 2],
+        "num_attention_heads": [1, 2],
+        "mlp_ratios": [2, 2],
+        "decoder_hidden_size": 32,
+    },
+    "splinter": {**_TINY_TEXT_CONFIG, "question_token_id": 5},
+    "squeezebert": {**_TINY_TEXT_CONFIG, "intermediate_size": 64, "embedding_size": 32},
+    "t5": {**_TINY_TEXT_CONFIG, "d_model": 32, "num_layers": 2, "num_heads": 2, "d_ff": 37, "d_kv": 16},
+    "vit": {**_TINY_VISION_CONFIG, "encoder_stride": 4},
+    "yolos": {**_TINY_VISION_CONFIG, "image_size": [32, 32], "num_detection_tokens": 4},
+}
+
+# The default allowed increase of a duration or a peak memory before it counts as a regression.
+DEFAULT_THRESHOLD = 0.25
+
+# Differences below these are noise, however large they are relative to the baseline.
+MIN_DURATION_CHANGE = 0.25
+MIN_MEMORY_CHANGE = 32 * 1024 * 1024
+
+
+def get_benchmark_cases(
+    model_types: Optional[List[str]] = None, features: Optional[List[str]] = None
+) -> List[Tuple[str, str]]:
+    """
+    The `(model_type, feature)` pairs to benchmark: every supported feature of every supported architecture,
+    optionally limited to some model types and features.
+    """
+    cases = []
+    for model_type, model_features in FeaturesManager._SUPPORTED_MODEL_TYPE.items():
+        if model_types is not None and model_type not in model_types:
+            continue
+        for feature in model_features:
+            if features is None or feature in features:
+                cases.append((model_type, feature))
+    return cases
+
+
+def get_tiny_model_config(model_type: str, feature: str) -> PretrainedConfig:
+    """The configuration of a tiny model of the given architecture, for the given feature."""
+    if model_type not in TINY_CONFIGS:
+        raise ValueError(f"No tiny configuration for model type '{model_type}'")
+
+    overrides = dict(TINY_CONFIGS[model_type])
+    if feature.endswith("-with-past"):
+        # Encoder models such as BERT only return their past keys and values when used as a decoder.
+        overrides["is_decoder"] = True
+    return AutoConfig.for_model(_TRANSFORMERS_MODEL_TYPES.get(model_type, model_type), **overrides)
+
+
+def get_tiny_preprocessor(model_config: PretrainedConfig, modality: str, tmp_dir: Union[str, Path]):
+    """
+    A tokenizer or image processor for a tiny model, created without downloading anything. The tokenizer
+    has a vocabulary of `TINY_VOCAB_SIZE` made-up tokens, and is saved in `tmp_dir`.
+    """
+    if modality == "vision":
+        image_size = model_config.image_size
+        if isinstance(image_size, (list, tuple)):
+            height, width = image_size
+        else:
+            height, width = image_size, image_size
+        return ViTImageProcessor(size={"height": height, "width": width})
+
+    vocab_file = os.path.join(tmp_dir, "vocab.txt")
+    with open(vocab_file, "w") as f:
+        tokens = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"] + [f"token{i}" for i in range(TINY_VOCAB_SIZE - 5)]
+        f.write("\n".join(tokens))
+    return BertTokenizer(vocab_file)
+
+
+@dataclass
+class BenchmarkResult:
+    """
+    The outcome of converting one tiny model.
+
+    Args:
+        model_type (`str`):
+            The architecture of the model.
+        feature (`str`):
+            The feature it was exported for.
+        status (`str`):
+            `"succeeded"` or `"failed"`.
+        error (`str`, *optional*):
+            Why the conversion failed.
+        num_parameters (`int`, *optional*):
+            Number of parameters of the PyTorch model.
+        duration (`float`):
+            Total seconds of all phases of the export.
+        phases (`Dict[str, Dict[str, Any]]`):
+            The `"duration"`, `"peak_memory"` and `"peak_increase"` of each phase of the export. For
+            encoder-decoder models, the encoder and decoder are added up.
+        spans (`Dict[str, float]`):
+            The seconds spent in each step of the export.
+    """
+
+    model_type: str
+    feature: str
+    status: str
+    error: Optional[str] = None
+    num_parameters: Optional[int] = None
+    duration: float = 0.0
+    phases: Dict[str, Dict[str, Any]] = field(default_factory=dict)
+    spans: Dict[str, float] = field(default_factory=dict)
+
+    @property
+    def name(self) -> str:
+        return f"{self.model_type}/{self.feature}"
+
+
+def run_case(model_type: str, feature: str, quantize: str = "float32") -> BenchmarkResult:
+    """
+    Create a tiny randomly initialized model of the given architecture and convert it for the given feature.
+    Encoder-decoder models are converted as an encoder and a decoder. The model is not saved or validated.
+    """
+    model_class = FeaturesManager.get_model_class_for_feature(feature)
+    config_constructor = FeaturesManager.get_config(model_type, feature)
+
+    try:
+        model_config = get_tiny_model_config(model_type, feature)
+        model = model_class.from_config(model_config).eval()
+        model.config.architectures = [type(model).__name__]
+        seq2seqs = ["encoder", "decoder"] if feature.startswith("text2text-generation") else [None]
+
+        memory_tracker = MemoryTracker()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for seq2seq in seq2seqs:
+                config = config_constructor(model.config, seq2seq=seq2seq)
+                preprocessor = get_tiny_preprocessor(model.config, config.modality, tmp_dir)
+                mlmodel = export(preprocessor, model, config, quantize=quantize, memory_tracker=memory_tracker)
+                del mlmodel
+    except Exception as e:
+        logger.debug(traceback.format_exc())
+        return BenchmarkResult(model_type, feature, status="failed", error=f"{type(e).__name__}: {e}")
+
+    return BenchmarkResult(
+        model_type,
+        feature,
+        status="succeeded",
+        num_parameters=model.num_parameters(),
+        duration=sum(phase.duration for phase in memory_tracker.phases.values()),
+        phases={
+            name: {"duration": phase.duration, "peak_memory": phase.peak_memory, "peak_increase": phase.peak_increase}
+            for name, phase in memory_tracker.phases.items()
+        },
+        spans={name: span.duration for name, span in memory_tracker.spans.items()},
+    )
+
+
+def run_benchmark(
+    model_types: Optional[List[str]] = None,
+    features: Optional[List[str]] = None,
+    quantize: str = "float32",
+    repeat: int = 1,
+) -> Dict[str, Any]:
+    """
+    Convert a tiny model for every supported architecture and feature, and measure the duration and the peak
+    memory of each phase of the export. Nothing is downloaded, so the benchmark also runs on machines
+    without network access, and on Linux.
+
+    The first conversion in a process is slower than the next ones because it imports and initializes code,
+    so a warm-up conversion runs first and is not part of the results.
+
+    Args:
+        model_types (`List[str]`, *optional*):
+            Only benchmark these model types. Defaults to all supported model types.
+        features (`List[str]`, *optional*):
+            Only benchmark these features. Defaults to all features of each model type.
+        quantize (`str`, *optional*, defaults to `"float32"`):
+            The quantize option of the exports, as for [`~coreml.convert.export`].
+        repeat (`int`, *optional*, defaults to 1):
+            How many times to convert each model. The fastest conversion is kept, which makes the results
+            less noisy.
+
+    Returns:
+        `Dict[str, Any]`: the results as a JSON-compatible dictionary, with the package versions and the
+        platform they were measured with, for [`~coreml.benchmark.save_results`] and
+        [`~coreml.benchmark.compare_results`].
+    """
+    cases = get_benchmark_cases(model_types, features)
+    if len(cases) == 0:
+        raise ValueError("No model types and features to benchmark")
+
+    logger.info("Warming up...")
+    run_case("bert", "feature-extraction", quantize=quantize)
+
+    results = []
+    for i, (model_type, feature) in enumerate(cases):
+        best = None
+        for _ in range(repeat):
+            release_memory()
+            result = run_case(model_type, feature, quantize=quantize)
+            if best is None or result.status == "failed" or result.duration < best.duration:
+                best = result
+            if result.status == "failed":
+                break
+
+        if best.status == "succeeded":
+            logger.info(f"[{i + 1}/{len(cases)}] {best.name}: {best.duration:.2f}s, {_format_peak(best)}")
+        else:
+            logger.error(f"[{i + 1}/{len(cases)}] {best.name} failed: {best.error}")
+        results.append(best)
+
+    return {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "platform": platform.platform(),
+        "versions": get_versions(),
+        "quantize": quantize,
+        "results": [asdict(result) for result in results],
+    }
+
+
+def _format_peak(result: BenchmarkResult) -> str:
+    increases = [phase["peak_increase"] for phase in result.phases.values() if phase["peak_increase"] is not None]
+    if len(increases) == 0:
+        return "peak memory not measured"
+    return f"peak {format_size(max(increases))} above the start of a phase"
+
+
+def save_results(results: Dict[str, Any], path: Union[str, Path]):
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+        f.write("\n")
+
+
+def load_results(path: Union[str, Path]) -> Dict[str, Any]:
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+@dataclass
+class Regression:
+    """
+    A measurement that got worse than the baseline by more than the threshold.
+
+    Args:
+        name (`str`):
+            The model type and feature, such as `"bert/feature-extraction"`.
+        metric (`str`):
+            What got worse: `"status"`, `"duration"`, `"<phase>.duration"` or `"<phase>.peak_increase"`.
+        baseline (`Any`):
+            The value in the baseline results.
+        current (`Any`):
+            The value in the new results.
+    """
+
+    name: str
+    metric: str
+    baseline: Any
+    current: Any
+
+    def __str__(self):
+        if self.metric == "status":
+            return f"{self.name} failed: {self.current}"
+        if self.metric.endswith("peak_increase"):
+            baseline, current = format_size(self.baseline), format_size(self.current)
+        else:
+            baseline, current = f"{self.baseline:.2f}s", f"{self.current:.2f}s"
+        change = self.current / self.baseline - 1 if self.baseline > 0 else float("inf")
+        return f"{self.name} {self.metric}: {baseline} -> {current} (+{change:.0%})"
+
+
+def _is_regression(baseline: Optional[float], current: Optional[float], threshold: float, min_change: float) -> bool:
+    if baseline is None or current is None:
+        return False
+    return current - baseline > max(baseline * threshold, min_change)
+
+
+def compare_results(
+    baseline: Dict[str, Any], current: Dict[str, Any], threshold: float = DEFAULT_THRESHOLD
+) -> List[Regression]:
+    """
+    Compare benchmark results with a baseline, for example from the previous commit or another version of
+    coremltools. A model that converted in the baseline and now fails is a regression, and so is a duration
+    or a peak memory increase of a phase that is larger than `threshold` times the baseline value. Changes
+    below `MIN_DURATION_CHANGE` seconds or `MIN_MEMORY_CHANGE` bytes are ignored as noise, as are models
+    that are only in one of the two results.
+
+    Args:
+        baseline (`Dict[str, Any]`):
+            The results to compare with, as returned by [`~coreml.benchmark.run_benchmark`].
+        current (`Dict[str, Any]`):
+            The new results.
+        threshold (`float`, *optional*, defaults to 0.25):
+            The allowed relative increase.
+
+    Returns:
+        `List[Regression]`: the measurements that got worse.
+    """
+    if baseline.get("quantize") != current.get("quantize"):
+        logger.warning(
+            f"Comparing results of quantize {current.get('quantize')} with a baseline of {baseline.get('quantize')}"
+        )
+
+    baseline_results = {(result["model_type"], result["feature"]): result for result in baseline["results"]}
+    regressions = []
+    for result in current["results"]:
+        base = baseline_results.get((result["model_type"], result["feature"]))
+        if base is None or base["status"] != "succeeded":
+            continue
+
+        name = f"{result['model_type']}/{result['feature']}"
+        if result["status"] != "succeeded":
+            regressions.append(Regression(name, "status", base["status"], result["error"]))
+            continue
+
+        if _is_regression(base["duration"], result["duration"], threshold, MIN_DURATION_CHANGE):
+            regressions.append(Regression(name, "duration", base["duration"], result["duration"]))
+
+        for phase_name, phase in result["phases"].items():
+            base_phase = base["phases"].get(phase_name)
+            if base_phase is None:
+                continue
+            for metric, min_change in [("duration", MIN_DURATION_CHANGE), ("peak_increase", MIN_MEMORY_CHANGE)]:
+                if _is_regression(base_phase[metric], phase[metric], threshold, min_change):
+                    regressions.append(
+                        Regression(name, f"{phase_name}.{metric}", base_phase[metric], phase[metric])
+                    )
+
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = ArgumentParser("Hugging Face Transformers Core ML conversion benchmark")
+    parser.add_argument("output", type=Path, help="JSON file to write the results to.")
+    parser.add_argument(
+        "--model_type", type=str, nargs="+", default=None, help="Only benchmark these model types. Defaults to all supported model types."
+    )
+    parser.add_argument(
+        "--feature", type=str, nargs="+", default=None, help="Only benchmark these features. Defaults to all features of each model type."
+    )
+    parser.add_argument(
+        "--quantize",
+        type=str,
+        choices=QUANTIZE_OPTIONS,
+        default="float32",
+        help="Quantization option of the exports.",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=1, help="Convert each model this many times and keep the fastest conversion."
+    )
+    parser.add_argument(
+        "--baseline", type=Path, default=None, help="Results of an earlier run to compare with. Exits with an error if any conversion got slower, used more memory, or failed."
+    )
+    parser.add_argument(
+        "--threshold", type=float, default=DEFAULT_THRESHOLD, help="Allowed relative increase of a duration or peak memory over the baseline, 0.25 by default."
+    )
+    args = parser.parse_args(argv)
+
+    logging.get_logger("exporters.coreml").setLevel(logging.INFO)
+
+    results = run_benchmark(args.model_type, args.feature, quantize=args.quantize, repeat=args.repeat)
+    save_results(results, args.output)
+    failed = [result for result in results["results"] if result["status"] == "failed"]
+    logger.info(
+        f"Benchmarked {len(results['results'])} conversions, {len(failed)} failed. Saved the results at: {args.output}"
+    )
+
+    if args.baseline is not None:
+        regressions = compare_results(load_results(args.baseline), results, threshold=args.threshold)
+        for regression in regressions:
+            logger.error(f"Regression: {regression}")
+        if len(regressions) > 0:
+            raise SystemExit(1)
+        logger.info(f"No regressions compared to {args.baseline}")
@@ -0,0 +1,626 @@
+# coding=utf-8
+# Copyright 2022 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""On-disk caches of exported Core ML models, TorchScript traces and reference model outputs."""
+
+import dataclasses
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import tempfile
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Mapping, Optional, Tuple, Union
+
+import coremltools as ct
+import numpy as np
+
+from transformers.utils import is_torch_available
+from transformers.utils.versions import importlib_metadata
+
+from .config import CoreMLConfig
+from ..utils import logging
+
+
+if TYPE_CHECKING:
+    import torch
+    from transformers.feature_extraction_utils import FeatureExtractionMixin
+    from transformers.modeling_utils import PreTrainedModel
+    from transformers.processing_utils import ProcessorMixin
+    from transformers.tokenization_utils import PreTrainedTokenizer
+    from .compression import CompressionConfig
+
+
+logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
+
+
+DEFAULT_CACHE_ROOT = os.path.join(os.getenv("HF_HOME", os.path.join("~", ".cache", "huggingface")), "exporters")
+
+DEFAULT_MAX_CACHE_SIZE = 50 * 1024**3
+
+_ENTRY_FILENAME = "entry.json"
+
+# Metadata field of an exported model that holds `hash_model_weights()` of the model it was exported from.
+WEIGHTS_HASH_METADATA_KEY = "co.huggingface.exporters.weights_hash"
+
+_SIZE_UNITS = {"": 1, "B": 1, "KB": 1024, "MB": 1024**2, "GB": 1024**3, "TB": 1024**4}
+
+
+def parse_size(size: Union[int, str]) -> int:
+    """Parse a size such as `"20GB"` or `"512MB"` into a number of bytes."""
+    if isinstance(size, int):
+        return size
+    size = size.strip().upper()
+    for unit in sorted(_SIZE_UNITS.keys(), key=len, reverse=True):
+        if unit and size.endswith(unit):
+            return int(float(size[: -len(unit)]) * _SIZE_UNITS[unit])
+    return int(float(size))
+
+
+def format_size(num_bytes: int) -> str:
+    """Format a number of bytes for display."""
+    for unit in ["B", "KB", "MB", "GB"]:
+        if abs(num_bytes) < 1024:
+            return f"{num_bytes:.1f} {unit}" if unit != "B" else f"{num_bytes} B"
+        num_bytes /= 1024
+    return f"{num_bytes:.1f} TB"
+
+
+def get_path_size(path: Union[str, Path]) -> int:
+    """Return the size in bytes of a file, or of all the files inside a directory."""
+    path = Path(path)
+    if path.is_file():
+        return path.stat().st_size
+    return sum(p.stat().st_size for p in path.rglob("*") if p.is_file())
+
+
+def _package_version(name: str) -> str:
+    try:
+        return importlib_metadata.version(name)
+    except importlib_metadata.PackageNotFoundError:
+        return ""
+
+
+def hash_model_weights(model: "PreTrainedModel") -> str:
+    """
+    Compute a SHA-256 digest of the model's parameters and buffers.
+
+    The names, dtypes, shapes, and raw bytes of all the tensors in the state dict go into the hash,
+    so two checkpoints only hash the same if they hold exactly the same weights.
+    """
+    import torch
+
+    hasher = hashlib.sha256()
+    state_dict = model.state_dict()
+    for name in sorted(state_dict.keys()):
+        tensor = state_dict[name]
+        hasher.update(f"{name}:{tensor.dtype}:{tuple(tensor.shape)}".encode("utf-8"))
+        data = tensor.detach().to("cpu").contiguous().reshape(-1).view(torch.uint8).numpy()
+        hasher.update(memoryview(data))
+    return hasher.hexdigest()
+
+
+def _function_fingerprint(func: Any) -> str:
+    try:
+        source = inspect.getsource(func)
+    except (OSError, TypeError):
+        source = getattr(func, "__qualname__", repr(func))
+    return hashlib.sha256(source.encode("utf-8")).hexdigest()
+
+
+def _preprocessor_fingerprint(preprocessor: Any) -> Dict[str, Any]:
+    fingerprint = {"class": type(preprocessor).__name__}
+    if hasattr(preprocessor, "to_dict"):
+        fingerprint["settings"] = preprocessor.to_dict()
+    else:
+        fingerprint["vocab_size"] = getattr(preprocessor, "vocab_size", None)
+        fingerprint["settings"] = getattr(preprocessor, "init_kwargs", {})
+    return fingerprint
+
+
+def _model_config_fingerprint(model: "PreTrainedModel", config: CoreMLConfig) -> Dict[str, Any]:
+    # Use the model config as it will look after export_pytorch applied the overrides,
+    # so the key doesn't depend on whether the model was already exported in this process.
+    model_config = model.config.to_dict()
+    model_config.update(config.values_override or {})
+    return model_config
+
+
+def _library_versions() -> Dict[str, str]:
+    return {
+        "exporters": _package_version("exporters"),
+        "coremltools": ct.__version__,
+        "torch": _package_version("torch") if is_torch_available() else "",
+        "transformers": _package_version("transformers"),
+    }
+
+
+def _hash_description(description: Dict[str, Any]) -> str:
+    blob = json.dumps(description, sort_keys=True, default=str)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+def config_fingerprint(config: CoreMLConfig) -> Dict[str, Any]:
+    """
+    Describe everything about a `CoreMLConfig` that influences the exported model.
+    """
+    patched_ops = config.patch_pytorch_ops() or {}
+    return {
+        "class": f"{type(config).__module__}.{type(config).__qualname__}",
+        "modality": config.modality,
+        "task": config.task,
+        "use_past": config.use_past,
+        "seq2seq": config.seq2seq,
+        "stateful": config.stateful,
+        "kv_cache_shape": config.kv_cache_shape if config.stateful or config.kv_cache_capacity else None,
+        "kv_cache_sliding_window": config.kv_cache_sliding_window,
+        "batch_size": config.batch_size,
+        "generation_step": config.generation_step,
+        "inputs": {name: dataclasses.asdict(desc) for name, desc in config.inputs.items()},
+        "outputs": {name: dataclasses.asdict(desc) for name, desc in config.outputs.items()},
+        "values_override": config.values_override,
+        "use_legacy_format": config.use_legacy_format,
+        "compression_exclude": config.compression_exclude,
+        "patched_ops": {name: _function_fingerprint(func) for name, func in sorted(patched_ops.items())},
+    }
+
+
+@dataclasses.dataclass
+class CacheEntry:
+    """
+    Data class that describes a model stored in the export cache.
+
+    Args:
+        key (`str`):
+            The content hash that identifies this entry.
+        path (`Path`):
+            Location of the `.mlpackage` or `.mlmodel` file.
+        size (`int`):
+            Size of the stored model in bytes.
+        created (`float`):
+            Timestamp of when the entry was added to the cache.
+        last_access (`float`):
+            Timestamp of when the entry was last used. This is used for LRU eviction.
+        info (`Dict[str, Any]`):
+            Human-readable details about the export, such as the model name and task.
+    """
+    key: str
+    path: Path
+    size: int
+    created: float
+    last_access: float
+    info: Dict[str, Any] = dataclasses.field(default_factory=dict)
+
+
+class _DiskCache:
+    """
+    Base class for the on-disk caches. Every entry is a directory named after its key, holding the cached
+    file and an `entry.json` with details about it. The modification time of `entry.json` records when
+    the entry was last used.
+    """
+    default_subdir = None
+
+    def __init__(
+        self,
+        cache_dir: Optional[Union[str, Path]] = None,
+        max_size: Union[int, str] = DEFAULT_MAX_CACHE_SIZE,
+    ):
+        if cache_dir is None:
+            cache_dir = os.path.join(os.getenv("EXPORTERS_CACHE", DEFAULT_CACHE_ROOT), self.default_subdir)
+        self.cache_dir = Path(cache_dir).expanduser()
+        self.max_size = parse_size(max_size)
+
+    def _entry_dir(self, key: str) -> Path:
+        return self.cache_dir / key
+
+    def _read_entry(self, entry_dir: Path) -> Optional[CacheEntry]:
+        entry_file = entry_dir / _ENTRY_FILENAME
+        try:
+            with open(entry_file, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        return CacheEntry(
+            key=entry_dir.name,
+            path=entry_dir / data["filename"],
+            size=data["size"],
+            created=data["created"],
+            last_access=entry_file.stat().st_mtime,
+            info=data.get("info", {}),
+        )
+
+    def lookup(self, key: str) -> Optional[CacheEntry]:
+        """
+        Return the cache entry for `key`, or `None` if it is not in the cache.
+        """
+        entry = self._read_entry(self._entry_dir(key))
+        if entry is None or not entry.path.exists():
+            return None
+        return entry
+
+    def _use(self, key: str) -> Optional[CacheEntry]:
+        entry = self.lookup(key)
+        if entry is not None:
+            # Touch the entry so that it counts as recently used.
+            os.utime(self._entry_dir(key) / _ENTRY_FILENAME)
+        return entry
+
+    def _store(
+        self, key: str, filename: str, save_fn: Callable[[str], Any], info: Optional[Dict[str, Any]] = None
+    ) -> CacheEntry:
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+        # Save into a temporary directory first and move it into place when done, so that other
+        # processes sharing the cache never see a partially written entry.
+        tmp_dir = Path(tempfile.mkdtemp(prefix=".tmp-", dir=self.cache_dir))
+        try:
+            save_fn(str(tmp_dir / filename))
+            with open(tmp_dir / _ENTRY_FILENAME, "w") as f:
+                json.dump(
+                    {
+                        "filename": filename,
+                        "size": get_path_size(tmp_dir / filename),
+                        "created": time.time(),
+                        "info": info or {},
+                    },
+                    f,
+                    indent=2,
+                )
+            try:
+                os.rename(tmp_dir, self._entry_dir(key))
+            except OSError:
+                # Another process stored the same entry in the meantime.
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+        self.evict(keep=key)
+        return self.lookup(key)
+
+    def entries(self) -> List[CacheEntry]:
+        """
+        Return all entries in the cache, most recently used first.
+        """
+        if not self.cache_dir.is_dir():
+            return []
+
+        entries = []
+        for entry_dir in self.cache_dir.iterdir():
+            if entry_dir.is_dir() and not entry_dir.name.startswith("."):
+                entry = self._read_entry(entry_dir)
+                if entry is not None:
+                    entries.append(entry)
+
+        return sorted(entries, key=lambda entry: entry.last_access, reverse=True)
+
+    @property
+    def size(self) -> int:
+        """Total size in bytes of all the entries in the cache."""
+        return sum(entry.size for entry in self.entries())
+
+    def remove(self, key: str) -> bool:
+        """
+        Delete the entry for `key`. Returns `True` if the entry existed.
+        """
+        entry_dir = self._entry_dir(key)
+        if not entry_dir.is_dir():
+            return False
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        return True
+
+    def evict(self, max_size: Optional[int] = None, keep: Optional[str] = None) -> List[CacheEntry]:
+        """
+        Remove the least recently used entries until the cache is no larger than `max_size`.
+
+        Args:
+            max_size (`int`, *optional*):
+                Size limit in bytes. Defaults to the limit the cache was created with.
+            keep (`str`, *optional*):
+                Key of an entry that should never be evicted, such as the one that was just added.
+
+        Returns:
+            `List[CacheEntry]`: the entries that were removed.
+        """
+        if max_size is None:
+            max_size = self.max_size
+
+        entries = self.entries()
+        total_size = sum(entry.size for entry in entries)
+        evicted = []
+        for entry in reversed(entries):
+            if total_size <= max_size:
+                break
+            if entry.key == keep:
+                continue
+            logger.info(f"Evicting {entry.key[:12]} ({format_size(entry.size)}) from {self.cache_dir}")
+            self.remove(entry.key)
+            total_size -= entry.size
+            evicted.append(entry)
+        return evicted
+
+    def purge(self) -> int:
+        """
+        Remove all entries from the cache. Returns the number of entries removed.
+        """
+        entries = self.entries()
+        for entry in entries:
+            self.remove(entry.key)
+        return len(entries)
+
+
+class ExportCache(_DiskCache):
+    """
+    Content-addressed on-disk cache of exported Core ML models.
+
+    Every entry is keyed by a hash of the model weights, the resolved `CoreMLConfig`, the export options,
+    and the versions of the libraries involved in the conversion. When the total size of the cache
+    exceeds `max_size`, the least recently used entries are removed.
+
+    Args:
+        cache_dir (`str` or `Path`, *optional*):
+            Where to store the exported models. Defaults to `$HF_HOME/exporters/coreml`. The
+            `EXPORTERS_CACHE` environment variable can be used to replace `$HF_HOME/exporters`.
+        max_size (`int` or `str`, *optional*, defaults to `"50GB"`):
+            Maximum total size of the cache, as a number of bytes or a string such as `"20GB"`.
+    """
+    default_subdir = "coreml"
+
+    def key_for(
+        self,
+        preprocessor: Union["PreTrainedTokenizer", "FeatureExtractionMixin", "ProcessorMixin"],
+        model: "PreTrainedModel",
+        config: CoreMLConfig,
+        quantize: str = "float32",
+        compute_units: ct.ComputeUnit = ct.ComputeUnit.ALL,
+        compression: Optional["CompressionConfig"] = None,
+    ) -> str:
+        """
+        Compute the cache key for exporting `model` with the given configuration and options.
+        """
+        options = {
+            "quantize": quantize,
+            "compute_units": compute_units.name,
+        }
+        if compression is not None:
+            options["compression"] = compression.fingerprint()
+
+        description = {
+            "weights": hash_model_weights(model),
+            "model_name": model.name_or_path,
+            "model_config": _model_config_fingerprint(model, config),
+            "config": config_fingerprint(config),
+            "preprocessor": _preprocessor_fingerprint(preprocessor),
+            "options": options,
+            "versions": _library_versions(),
+        }
+        return _hash_description(description)
+
+    def get(self, key: str, compute_units: ct.ComputeUnit = ct.ComputeUnit.ALL) -> Optional[ct.models.MLModel]:
+        """
+        Load the cached model for `key`. Returns `None` on a cache miss.
+        """
+        entry = self._use(key)
+        if entry is None:
+            return None
+        return ct.models.MLModel(str(entry.path), compute_units=compute_units)
+
+    def put(self, key: str, mlmodel: ct.models.MLModel, info: Optional[Dict[str, Any]] = None) -> CacheEntry:
+        """
+        Store an exported model in the cache under `key`, then evict old entries if the cache has grown
+        too large.
+        """
+        filename = "Model.mlpackage" if mlmodel.is_package else "Model.mlmodel"
+        return self._store(key, filename, mlmodel.save, info)
+
+
+class TraceStore(_DiskCache):
+    """
+    On-disk store of TorchScript traces of the `Wrapper` module, so that a conversion can start directly at
+    `ct.convert` when it is run again.
+
+    Traces are keyed by a hash of the model weights, the task, `use_past`, `seq2seq`, the inputs and outputs
+    of the `CoreMLConfig`, and the shapes of the dummy inputs used for tracing. Overrides from
+    `patch_pytorch_ops` are not part of the key as they only affect the conversion step.
+
+    Args:
+        cache_dir (`str` or `Path`, *optional*):
+            Where to store the traces. Defaults to `$HF_HOME/exporters/traces`. The `EXPORTERS_CACHE`
+            environment variable can be used to replace `$HF_HOME/exporters`.
+        max_size (`int` or `str`, *optional*, defaults to `"50GB"`):
+            Maximum total size of the store, as a number of bytes or a string such as `"20GB"`.
+    """
+    default_subdir = "traces"
+
+    def key_for(
+        self,
+        preprocessor: Union["PreTrainedTokenizer", "FeatureExtractionMixin", "ProcessorMixin"],
+        model: "PreTrainedModel",
+        config: CoreMLConfig,
+        dummy_inputs: Mapping[str, Tuple[Any, Any]],
+    ) -> str:
+        """
+        Compute the key for the trace of `model` made with the given configuration and dummy inputs.
+        """
+        fingerprint = config_fingerprint(config)
+        del fingerprint["patched_ops"]
+        del fingerprint["use_legacy_format"]
+
+        description = {
+            "weights": hash_model_weights(model),
+            "model_config": _model_config_fingerprint(model, config),
+            "config": fingerprint,
+            "preprocessor": _preprocessor_fingerprint(preprocessor),
+            "input_shapes": {
+                name: list(getattr(ref_value, "shape", ())) for name, (ref_value, _) in dummy_inputs.items()
+            },
+            "versions": _library_versions(),
+        }
+        return _hash_description(description)
+
+    def get(self, key: str) -> Optional["torch.jit.ScriptModule"]:
+        """
+        Load the stored trace for `key`. Returns `None` if there is no such trace.
+        """
+        import torch
+
+        entry = self._use(key)
+        if entry is None:
+            return None
+        return torch.jit.load(str(entry.path), map_location="cpu")
+
+    def put(self, key: str, traced_model: "torch.jit.ScriptModule", info: Optional[Dict[str, Any]] = None) -> CacheEntry:
+        """
+        Store a trace under `key`, then evict old entries if the store has grown too large.
+        """
+        import torch
+
+        return self._store(key, "trace.pt", lambda path: torch.jit.save(traced_model, path), info)
+
+
+class ReferenceOutputStore(_DiskCache):
+    """
+    On-disk store of the outputs of the reference model on the validation inputs, so that validating another
+    variant of the same model, or validating an exported model again, doesn't need to run the reference model.
+
+    Outputs are keyed by the hash of the model weights, the configuration, the preprocessor and a description
+    of the inputs, such as their random seed and shapes. Options of the export such as `quantize` are not
+    part of the key, as they don't change the reference model. Each output is stored as a `.npy` file and
+    memory-mapped when loaded.
+
+    Args:
+        cache_dir (`str` or `Path`, *optional*):
+            Where to store the outputs. Defaults to `$HF_HOME/exporters/reference_outputs`. The
+            `EXPORTERS_CACHE` environment variable can be used to replace `$HF_HOME/exporters`.
+        max_size (`int` or `str`, *optional*, defaults to `"50GB"`):
+            Maximum total size of the store, as a number of bytes or a string such as `"20GB"`.
+    """
+    default_subdir = "reference_outputs"
+
+    def key_for(
+        self,
+        preprocessor: Union["PreTrainedTokenizer", "FeatureExtractionMixin", "ProcessorMixin"],
+        config: CoreMLConfig,
+        weights_hash: str,
+        **inputs: Any,
+    ) -> str:
+        """
+        Compute the key for the reference outputs of the model with the weights `weights_hash`, as returned by
+        `hash_model_weights()`. The keyword arguments describe the inputs, for example `seed=0`.
+        """
+        fingerprint = config_fingerprint(config)
+        for name in ["patched_ops", "use_legacy_format", "compression_exclude"]:
+            del fingerprint[name]
+
+        # Loading the model for export sets `torchscript`, which doesn't change its outputs. Leave it out so
+        # that the key is the same when only the model config is loaded.
+        model_config = config._config.to_dict()
+        model_config.pop("torchscript", None)
+        model_config.update(config.values_override or {})
+
+        description = {
+            "weights": weights_hash,
+            "model_config": model_config,
+            "config": fingerprint,
+            "preprocessor": _preprocessor_fingerprint(preprocessor),
+            "inputs": inputs,
+            "versions": _library_versions(),
+        }
+        return _hash_description(description)
+
+    def get(self, key: str) -> Optional[Dict[str, np.ndarray]]:
+        """
+        Load the outputs stored under `key` as read-only memory-mapped arrays. Returns `None` if there are no
+        such outputs.
+        """
+        entry = self._use(key)
+        if entry is None:
+            return None
+        names = entry.info.get("outputs", [])
+        return {name: np.load(entry.path / f"{name}.npy", mmap_mode="r") for name in names}
+
+    def put(self, key: str, outputs: Mapping[str, np.ndarray], info: Optional[Dict[str, Any]] = None) -> CacheEntry:
+        """
+        Store the reference outputs under `key`, then evict old entries if the store has grown too large.
+        """
+
+        def save(path):
+            os.makedirs(path)
+            for name, value in outputs.items():
+                np.save(os.path.join(path, f"{name}.npy"), np.asarray(value))
+
+        info = dict(info or {})
+        info["outputs"] = list(outputs.keys())
+        return self._store(key, "outputs", save, info)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = ArgumentParser("Hugging Face Transformers Core ML export cache")
+    parser.add_argument(
+        "command", choices=["list", "remove", "purge", "evict"], help="What to do with the cache."
+    )
+    parser.add_argument("keys", nargs="*", help="Cache keys (or unique key prefixes) for the `remove` command.")
+    parser.add_argument(
+        "--export_cache_dir", type=str, default=None, help="Location of the export cache."
+    )
+    parser.add_argument(
+        "--export_cache_max_size", type=str, default=str(DEFAULT_MAX_CACHE_SIZE), help="Size limit for the `evict` command, for example 20GB."
+    )
+    parser.add_argument(
+        "--traces", action="store_true", help="Operate on the TorchScript trace store instead of the export cache."
+    )
+    parser.add_argument(
+        "--trace_cache_dir", type=str, default=None, help="Location of the TorchScript trace store."
+    )
+    parser.add_argument(
+        "--reference_outputs", action="store_true", help="Operate on the store of reference model outputs instead of the export cache."
+    )
+    parser.add_argument(
+        "--reference_cache_dir", type=str, default=None, help="Location of the store of reference model outputs."
+    )
+    args = parser.parse_args(argv)
+
+    if args.traces:
+        cache = TraceStore(args.trace_cache_dir, max_size=args.export_cache_max_size)
+    elif args.reference_outputs:
+        cache = ReferenceOutputStore(args.reference_cache_dir, max_size=args.export_cache_max_size)
+    else:
+        cache = ExportCache(args.export_cache_dir, max_size=args.export_cache_max_size)
+
+    if args.command == "list":
+        entries = cache.entries()
+        for entry in entries:
+            last_access = time.strftime("%Y-%m-%d %H:%M", time.localtime(entry.last_access))
+            description = " ".join(str(value) for value in entry.info.values())
+            print(f"{entry.key[:12]}  {format_size(entry.size):>10}  {last_access}  {description}")
+        print(f"{len(entries)} entries, {format_size(sum(e.size for e in entries))} in {cache.cache_dir}")
+
+    elif args.command == "remove":
+        for prefix in args.keys:
+            matches = [entry for entry in cache.entries() if entry.key.startswith(prefix)]
+            if len(matches) != 1:
+                raise ValueError(f"'{prefix}' matches {len(matches)} cache entries, expected exactly one")
+            cache.remove(matches[0].key)
+            print(f"Removed {matches[0].key}")
+
+    elif args.command == "purge":
+        print(f"Removed {cache.purge()} entries from {cache.cache_dir}")
+
+    elif args.command == "evict":
+        evicted = cache.evict()
+        print(f"Evicted {len(evicted)} entries, cache size is now {format_size(cache.size)}")
@@ -0,0 +1,722 @@
+# coding=utf-8
+# Copyright 2022 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Export a language model as a chain of Core ML models that each hold a contiguous range of its layers."""
+
+import itertools
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple, Union
+
+import coremltools as ct
+import numpy as np
+
+from transformers.utils import TensorType, is_torch_available
+
+from .cache import format_size, get_path_size
+from .compression import ActivationQuantizationConfig, CompressionConfig, LinearQuantizationConfig, compress_weights
+from .config import CoreMLConfig
+from .convert import _apply_values_override, _patch_torch_ops, _restore_torch_ops, get_user_defined_metadata
+from .memory import release_memory
+from .interpreter import MILInterpreter
+from .validate import _check_step_outputs, _fixed_cache_reference_steps
+from .variants import _CONVERSION_MEMORY_FACTOR, _CONVERSION_MEMORY_OVERHEAD, _available_memory, _init_worker
+from ..utils import logging
+
+
+if is_torch_available():
+    import torch
+    from transformers.modeling_utils import PreTrainedModel
+
+if TYPE_CHECKING:
+    from transformers.feature_extraction_utils import FeatureExtractionMixin
+    from transformers.processing_utils import ProcessorMixin
+    from transformers.tokenization_utils import PreTrainedTokenizer
+
+
+logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
+
+# The metadata field that holds the inputs and outputs of a chunk, and how they connect to the other chunks.
+CHUNK_METADATA_KEY = "co.huggingface.exporters.chunk"
+
+
+class _GPT2DecoderStack:
+    def __init__(self, model):
+        self.model = model
+        self.layers = model.transformer.h
+        self.embedding_modules = [model.transformer.wte, model.transformer.wpe]
+        self.head_modules = [model.transformer.ln_f, model.lm_head]
+
+    def embed(self, input_ids, position_ids):
+        transformer = self.model.transformer
+        return transformer.drop(transformer.wte(input_ids) + transformer.wpe(position_ids))
+
+    def get_attention_mask(self, attention_mask, hidden_states, past_length):
+        # The layers apply the causal mask themselves, this one only masks out padding.
+        attention_mask = attention_mask[:, None, None, :].to(hidden_states.dtype)
+        return (1.0 - attention_mask) * torch.finfo(hidden_states.dtype).min
+
+    def run_layer(self, layer, hidden_states, attention_mask, position_ids, past_key_value):
+        outputs = layer(hidden_states, layer_past=past_key_value, attention_mask=attention_mask, use_cache=True)
+        return outputs[0], outputs[1]
+
+    def head(self, hidden_states):
+        return self.model.lm_head(self.model.transformer.ln_f(hidden_states))
+
+
+class _LlamaDecoderStack:
+    def __init__(self, model):
+        self.model = model
+        self.layers = model.model.layers
+        self.embedding_modules = [model.model.embed_tokens]
+        self.head_modules = [model.model.norm, model.lm_head]
+
+    def embed(self, input_ids, position_ids):
+        return self.model.model.embed_tokens(input_ids)
+
+    def get_attention_mask(self, attention_mask, hidden_states, past_length):
+        return self.model.model._prepare_decoder_attention_mask(
+            attention_mask, hidden_states.shape[:2], hidden_states, past_length
+        )
+
+    def run_layer(self, layer, hidden_states, attention_mask, position_ids, past_key_value):
+        outputs = layer(
+            hidden_states,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_value=past_key_value,
+            use_cache=True,
+        )
+        return outputs[0], outputs[1]
+
+    def head(self, hidden_states):
+        return self.model.lm_head(self.model.model.norm(hidden_states))
+
+
+# How to run the embeddings, a single decoder layer, and the language modeling head of each architecture.
+_DECODER_STACKS = {
+    "gpt2": _GPT2DecoderStack,
+    "llama": _LlamaDecoderStack,
+}
+
+
+def get_decoder_stack(model: "PreTrainedModel"):
+    if model.config.model_type not in _DECODER_STACKS:
+        raise ValueError(
+            f"Chunked export is not supported for model type '{model.config.model_type}', only for "
+            f"{', '.join(_DECODER_STACKS)}"
+        )
+    return _DECODER_STACKS[model.config.model_type](model)
+
+
+@dataclass(frozen=True)
+class ModelChunk:
+    """
+    One model of a chunked export: the decoder layers `start_layer` up to but not including `end_layer`. The
+    first chunk also embeds the input tokens, and the last chunk also computes the logits.
+
+    Args:
+        index (`int`):
+            Position of the chunk in the chain, starting at 0.
+        num_chunks (`int`):
+            Number of chunks in the chain.
+        start_layer (`int`):
+            The first decoder layer of the chunk.
+        end_layer (`int`):
+            The decoder layer after the last one of the chunk.
+    """
+
+    index: int
+    num_chunks: int
+    start_layer: int
+    end_layer: int
+
+    @property
+    def is_first(self) -> bool:
+        return self.index == 0
+
+    @property
+    def is_last(self) -> bool:
+        return self.index == self.num_chunks - 1
+
+    @property
+    def name(self) -> str:
+        return f"chunk{self.index + 1}of{self.num_chunks}"
+
+    def get_output_filename(self, output: Path) -> Path:
+        """The chunk is saved next to `output`, with its name added to the filename."""
+        output = Path(output)
+        return output.with_name(f"{output.stem}_{self.name}{output.suffix}")
+
+
+@dataclass
+class ChunkResult:
+    """
+    The outcome of converting one [`~coreml.chunking.ModelChunk`].
+
+    Args:
+        chunk ([`~coreml.chunking.ModelChunk`]):
+            The chunk that was converted.
+        path (`str`):
+            Where the Core ML model was saved.
+        convert_time (`float`):
+            Seconds spent in the Core ML conversion and compression.
+        size (`int`):
+            Size of the saved model in bytes.
+    """
+
+    chunk: ModelChunk
+    path: str
+    convert_time: float
+    size: int
+
+
+def split_layers(layer_sizes: List[int], num_chunks: int) -> List[Tuple[int, int]]:
+    """
+    Split the layers into `num_chunks` contiguous ranges of about the same total size. Every range has at
+    least one layer.
+
+    Args:
+        layer_sizes (`List[int]`):
+            The size of each layer, for example its number of parameters.
+        num_chunks (`int`):
+            Number of ranges.
+
+    Returns:
+        `List[Tuple[int, int]]`: the first layer and the layer after the last one of each range.
+    """
+    num_layers = len(layer_sizes)
+    if not 1 <= num_chunks <= num_layers:
+        raise ValueError(f"Cannot split {num_layers} layers into {num_chunks} chunks")
+
+    cumulative_sizes = list(itertools.accumulate(layer_sizes))
+    total_size = cumulative_sizes[-1]
+
+    boundaries = [0]
+    for k in range(1, num_chunks):
+        target = total_size * k / num_chunks
+        # Leave at least one layer for this chunk and for each of the chunks after it.
+        candidates = range(boundaries[-1] + 1, num_layers - (num_chunks - k) + 1)
+        boundaries.append(min(candidates, key=lambda end: abs(cumulative_sizes[end - 1] - target)))
+    boundaries.append(num_layers)
+
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def get_model_chunks(model: "PreTrainedModel", num_chunks: int) -> List[ModelChunk]:
+    """
+    Split the decoder layers of `model` into `num_chunks` contiguous ranges with about the same amount of
+    weights. The embeddings count towards the first chunk and the language modeling head towards the last.
+    """
+    stack = get_decoder_stack(model)
+
+    def num_parameters(modules):
+        return sum(p.numel() for module in modules for p in module.parameters())
+
+    layer_sizes = [num_parameters([layer]) for layer in stack.layers]
+    layer_sizes[0] += num_parameters(stack.embedding_modules)
+    layer_sizes[-1] += num_parameters(stack.head_modules)
+
+    return [
+        ModelChunk(index, num_chunks, start_layer, end_layer)
+        for index, (start_layer, end_layer) in enumerate(split_layers(layer_sizes, num_chunks))
+    ]
+
+
+def get_chunk_features(
+    config: CoreMLConfig, chunk: ModelChunk
+) -> Tuple["OrderedDict[str, Tuple[List[int], str]]", "OrderedDict[str, Tuple[List[int], str]]"]:
+    """
+    The inputs and outputs of a chunk, in order, with their shapes and descriptions.
+
+    Every chunk takes the attention mask, or with a fixed-size cache the position of the token, and the
+    cache slices of its own layers. The first chunk takes the token IDs, the others take the hidden states
+    that the chunk before them outputs, named `hidden_states_<k>` after the layer they go into. The last
+    chunk outputs the logits, the others the hidden states.
+    """
+    input_descs = config.inputs
+    output_descs = config.outputs
+    model_config = config._config
+    capacity = config.kv_cache_capacity
+
+    sequence_length = 1 if capacity is not None else config.input_ids_sequence_length
+
+    inputs = OrderedDict()
+    if chunk.is_first:
+        input_desc = input_descs["input_ids"]
+        inputs[input_desc.name] = ([1, sequence_length], input_desc.description)
+    else:
+        inputs[f"hidden_states_{chunk.start_layer}"] = (
+            [1, sequence_length, model_config.hidden_size],
+            f"Hidden states that go into decoder layer {chunk.start_layer}, from the previous chunk",
+        )
+
+    if capacity is not None:
+        input_desc = input_descs["position"]
+        inputs[input_desc.name] = ([1], input_desc.description)
+    else:
+        input_desc = input_descs["attention_mask"]
+        inputs[input_desc.name] = ([1, sequence_length], input_desc.description)
+
+    outputs = OrderedDict()
+    if chunk.is_last:
+        output_desc = output_descs["logits"]
+        outputs[output_desc.name] = ([1, sequence_length, model_config.vocab_size], output_desc.description)
+    else:
+        outputs[f"hidden_states_{chunk.end_layer}"] = (
+            [1, sequence_length, model_config.hidden_size],
+            f"Hidden states that go into decoder layer {chunk.end_layer}, for the next chunk",
+        )
+
+    if capacity is not None:
+        cache_shape = list(config.kv_cache_shape[1:])
+        for i in range(chunk.start_layer, chunk.end_layer):
+            for kind in ["key", "value"]:
+                input_desc = input_descs[f"past_key_values_{i}_{kind}"]
+                inputs[input_desc.name] = (cache_shape, f"The {kind}s of layer {i} in the cache")
+                output_desc = output_descs[f"present_{i}_{kind}"]
+                outputs[output_desc.name] = (cache_shape, f"The {kind}s of layer {i} including the new token")
+
+    return inputs, outputs
+
+
+def describe_chunk(config: CoreMLConfig, chunk: ModelChunk) -> Dict[str, Any]:
+    """
+    The I/O contract of a chunk, as stored in its `co.huggingface.exporters.chunk` metadata field: the shapes
+    of the inputs and outputs, which inputs are outputs of the previous chunk, and which cache inputs are
+    outputs of the previous prediction of the same chunk.
+    """
+    inputs, outputs = get_chunk_features(config, chunk)
+    previous_chunk = {}
+    if not chunk.is_first:
+        name = f"hidden_states_{chunk.start_layer}"
+        previous_chunk[name] = name
+    cache = {}
+    if config.kv_cache_capacity is not None:
+        for i in range(chunk.start_layer, chunk.end_layer):
+            for kind in ["key", "value"]:
+                cache[config.inputs[f"past_key_values_{i}_{kind}"].name] = config.outputs[f"present_{i}_{kind}"].name
+
+    return {
+        "index": chunk.index,
+        "num_chunks": chunk.num_chunks,
+        "layers": [chunk.start_layer, chunk.end_layer],
+        "inputs": {name: shape for name, (shape, _) in inputs.items()},
+        "outputs": {name: shape for name, (shape, _) in outputs.items()},
+        "previous_chunk": previous_chunk,
+        "cache": cache,
+    }
+
+
+if is_torch_available():
+
+    class ChunkWrapper(torch.nn.Module):
+        """
+        Runs the decoder layers of one chunk, and for the first and last chunk, the embeddings and the head.
+        The inputs and outputs are those of [`~coreml.chunking.get_chunk_features`].
+        """
+
+        def __init__(self, model, config, chunk):
+            super().__init__()
+            self.model = model.eval()
+            self.config = config
+            self.chunk = chunk
+            self.stack = get_decoder_stack(model)
+
+        def forward(self, *inputs):
+            capacity = self.config.kv_cache_capacity
+            if capacity is not None:
+                # The same slots and mask as the Wrapper of a model with a fixed-size cache.
+                position = inputs[1]
+                slot = position % capacity if self.config.kv_cache_sliding_window else position
+                slots = torch.arange(capacity)
+                written = (slots < position) & (slots != slot)
+                attention_mask = torch.cat([written, torch.ones(1, dtype=torch.bool)]).to(torch.int64).unsqueeze(0)
+                position_ids = position.reshape(1, 1)
+                past_length = capacity
+            else:
+                attention_mask = inputs[1]
+                position_ids = torch.arange(attention_mask.shape[-1]).unsqueeze(0)
+                past_length = 0
+
+            if self.chunk.is_first:
+                hidden_states = self.stack.embed(inputs[0], position_ids)
+            else:
+                hidden_states = inputs[0]
+
+            attention_mask = self.stack.get_attention_mask(attention_mask, hidden_states, past_length)
+
+            presents = ()
+            for i, layer in enumerate(self.stack.layers[self.chunk.start_layer : self.chunk.end_layer]):
+                past_key_value = None
+                if capacity is not None:
+                    past_key_value = (inputs[2 + 2 * i], inputs[3 + 2 * i])
+
+                hidden_states, present = self.stack.run_layer(
+                    layer, hidden_states, attention_mask, position_ids, past_key_value
+                )
+
+                if capacity is not None:
+                    # Scatter the key and value of the new token into its slot in the cache.
+                    for cache, new in zip(past_key_value, present):
+                        new = new[:, :, -1:]
+                        index = slot.reshape(1, 1, 1, 1).expand(new.shape)
+                        presents = presents + (torch.scatter(cache, 2, index, new),)
+
+            if self.chunk.is_last:
+                hidden_states = self.stack.head(hidden_states)
+                if self.config.outputs["logits"].do_softmax:
+                    hidden_states = torch.nn.functional.softmax(hidden_states, dim=-1)
+
+            return (hidden_states,) + presents
+
+
+def _get_example_inputs(config, chunk, dummy_inputs, hidden_states):
+    example_inputs = []
+    for name in get_chunk_features(config, chunk)[0]:
+        example_inputs.append(hidden_states if name.startswith("hidden_states_") else dummy_inputs[name][0])
+    return example_inputs
+
+
+def get_num_chunk_workers(model: "PreTrainedModel", num_chunks: int) -> int:
+    """
+    How many chunks can be converted at the same time without running out of memory or CPUs.
+    """
+    num_workers = min(num_chunks, os.cpu_count() or 1)
+
+    available = _available_memory()
+    if available is not None:
+        chunk_weights_size = sum(p.numel() for p in model.parameters()) * 4 // num_chunks
+        per_worker = chunk_weights_size * _CONVERSION_MEMORY_FACTOR + _CONVERSION_MEMORY_OVERHEAD
+        num_workers = min(num_workers, available // per_worker)
+
+    return max(1, num_workers)
+
+
+def _convert_chunk(model_config, config, chunk, trace_path, quantize, compute_units, compression, filename):
+    traced_model = torch.jit.load(trace_path)
+    inputs, outputs = get_chunk_features(config, chunk)
+
+    minimum_deployment_target = None
+    if compression is not None:
+        minimum_deployment_target = compression.minimum_deployment_target
+
+    integer_names = [config.inputs[name].name for name in ["input_ids", "attention_mask", "position"] if name in config.inputs]
+    input_types = [
+        ct.TensorType(name=name, shape=shape, dtype=np.int32 if name in integer_names else np.float32)
+        for name, (shape, _) in inputs.items()
+    ]
+
+    start = time.perf_counter()
+
+    restore_ops = _patch_torch_ops(config)
+    try:
+        mlmodel = ct.convert(
+            traced_model,
+            inputs=input_types,
+            outputs=[ct.TensorType(name=name) for name in outputs],
+            convert_to="mlprogram",
+            compute_units=compute_units,
+            compute_precision=ct.precision.FLOAT32 if quantize == "float32" else ct.precision.FLOAT16,
+            minimum_deployment_target=minimum_deployment_target,
+            skip_model_load=True,
+        )
+    finally:
+        _restore_torch_ops(restore_ops)
+    del traced_model
+
+    # The weights are already saved in the model's `weights_dir`, the MIL program's copy is not needed.
+    mlmodel._mil_program = None
+    release_memory()
+
+    for name, (_, description) in inputs.items():
+        mlmodel.input_description[name] = description
+    for name, (_, description) in outputs.items():
+        mlmodel.output_description[name] = description
+
+    metadata = get_user_defined_metadata(model_config, config, quantize)
+    metadata[CHUNK_METADATA_KEY] = json.dumps(describe_chunk(config, chunk))
+    mlmodel.user_defined_metadata.update(metadata)
+    mlmodel.short_description = (
+        f"{config.short_description} Chunk {chunk.index + 1} of {chunk.num_chunks}: "
+        f"layers {chunk.start_layer} to {chunk.end_layer - 1}."
+    )
+
+    if compression is not None:
+        mlmodel = compress_weights(mlmodel, config, compression)
+
+    convert_time = time.perf_counter() - start
+    mlmodel.save(filename)
+    return ChunkResult(chunk, filename, convert_time, get_path_size(filename))
+
+
+def export_chunks(
+    preprocessor: Union["PreTrainedTokenizer", "FeatureExtractionMixin", "ProcessorMixin"],
+    model: "PreTrainedModel",
+    config: CoreMLConfig,
+    output: Union[str, Path],
+    num_chunks: int,
+    quantize: str = "float32",
+    compute_units: ct.ComputeUnit = ct.ComputeUnit.ALL,
+    compression: Optional[CompressionConfig] = None,
+    num_workers: Optional[int] = None,
+) -> List[ChunkResult]:
+    """
+    Export a text generation model as a chain of `num_chunks` ML Programs that each hold a contiguous range
+    of its decoder layers. The first chunk embeds the tokens and runs the first layers, the last chunk runs
+    the last layers and computes the logits, and each chunk passes its hidden states on to the next one.
+
+    A model that is split this way never has its whole graph traced or converted at once, so the peak memory
+    of the export is that of a single chunk, and the packages stay small enough to be memory-mapped on
+    device. The chunks are traced one after the other, and converted in parallel worker processes when there
+    is enough memory for it.
+
+    The chunks have fixed input shapes: a prompt of `config.max_sequence_length` tokens with its attention
+    mask, or with `config.kv_cache_capacity`, one token and its position, plus the key and value cache of
+    the chunk's own layers. The `co.huggingface.exporters.chunk` metadata field describes how the inputs and
+    outputs of each chunk connect, as JSON.
+
+    Args:
+        preprocessor ([`PreTrainedTokenizer`], [`FeatureExtractionMixin`] or [`ProcessorMixin`]):
+            The preprocessor used for encoding the data.
+        model ([`PreTrainedModel`]):
+            The model to export.
+        config ([`~coreml.config.CoreMLConfig`]):
+            A configuration for the `"text-generation"` task, without a cache or with a fixed-size cache
+            that is not stateful.
+        output (`str` or `Path`):
+            The output path of the model. Each chunk is saved next to it, with `_chunk<i>of<n>` added to the
+            filename.
+        num_chunks (`int`):
+            Number of chunks, at most the number of decoder layers.
+        quantize (`str`, *optional*, defaults to `"float32"`):
+            Quantization options, as for [`~coreml.convert.export`].
+        compute_units (`ct.ComputeUnit`, *optional*, defaults to `ct.ComputeUnit.ALL`):
+            Whether to optimize the model for CPU, GPU, and/or Neural Engine.
+        compression (`CompressionConfig`, *optional*):
+            If provided, the weights of every chunk are compressed with this method.
+        num_workers (`int`, *optional*):
+            How many chunks to convert at the same time. By default this is based on the size of the model
+            and the available memory.
+
+    Returns:
+        `List[ChunkResult]`: the saved file, timing and size of each chunk, in order.
+    """
+    if not (is_torch_available() and issubclass(type(model), PreTrainedModel)):
+        raise ValueError(f"Cannot convert unknown model type: {type(model)}")
+    if config.task != "text-generation" or config.seq2seq is not None:
+        raise ValueError("Chunked export requires the text-generation task of a decoder-only model")
+    if config.stateful or config.generation_step is not None:
+        raise ValueError("Chunked export does not support stateful models or generation steps")
+    if config.use_past and config.kv_cache_capacity is None:
+        raise ValueError("Chunked export with use_past requires a fixed-size cache, set kv_cache_capacity")
+    if not isinstance(config.input_ids_sequence_length, int):
+        raise ValueError("Chunked export requires a fixed sequence length")
+    if config.batch_size is not None:
+        raise ValueError("Chunked export does not support batch_size")
+    if config.use_legacy_format:
+        raise ValueError("Chunked export cannot use the legacy NeuralNetwork format")
+    if isinstance(compression, ActivationQuantizationConfig):
+        raise ValueError("Chunked export does not support activation quantization")
+
+    weight_quantization = LinearQuantizationConfig.from_quantize(quantize)
+    if weight_quantization is not None:
+        if compression is not None:
+            raise ValueError(f"Quantize option '{quantize}' cannot be combined with compression '{compression.name}'")
+        compression = weight_quantization
+
+    output = Path(output)
+    chunks = get_model_chunks(model, num_chunks)
+    filenames = [chunk.get_output_filename(output).as_posix() for chunk in chunks]
+
+    _apply_values_override(model, config)
+    dummy_inputs = config.generate_dummy_inputs(preprocessor, framework=TensorType.PYTORCH)
+
+    if num_workers is None:
+        num_workers = get_num_chunk_workers(model, num_chunks)
+    num_workers = min(num_workers, num_chunks)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Each trace is saved to disk, so that only one chunk's graph is in memory at a time.
+        trace_paths = []
+        hidden_states = None
+        for chunk in chunks:
+            start = time.perf_counter()
+            example_inputs = _get_example_inputs(config, chunk, dummy_inputs, hidden_states)
+            wrapper = ChunkWrapper(model, config, chunk).eval()
+            with torch.no_grad():
+                hidden_states = wrapper(*example_inputs)[0]
+            traced_model = torch.jit.trace(wrapper, example_inputs, strict=True)
+
+            trace_path = os.path.join(tmp_dir, f"{chunk.name}.pt")
+            torch.jit.save(traced_model, trace_path)
+            trace_paths.append(trace_path)
+            del traced_model
+            logger.info(
+                f"Traced chunk {chunk.index + 1} of {num_chunks}, layers {chunk.start_layer} to "
+                f"{chunk.end_layer - 1}, in {time.perf_counter() - start:.1f} s"
+            )
+
+        convert_args = [
+            (model.config, config, chunk, trace_path, quantize, compute_units, compression, filename)
+            for chunk, trace_path, filename in zip(chunks, trace_paths, filenames)
+        ]
+
+        if num_workers <= 1:
+            results = []
+            for args in convert_args:
+                logger.info(f"Converting {args[2].name}...")
+                results.append(_convert_chunk(*args))
+        else:
+            logger.info(f"Converting {num_chunks} chunks with {num_workers} worker processes...")
+
+            # Use fresh processes instead of forking: the chunks were traced and run, so torch's thread pool is
+            # already started. The workers load the saved traces from disk.
+            mp_context = multiprocessing.get_context("spawn")
+            num_threads = max(1, torch.get_num_threads() // num_workers)
+
+            with ProcessPoolExecutor(
+                max_workers=num_workers,
+                mp_context=mp_context,
+                initializer=_init_worker,
+                initargs=(logging.get_logger("exporters.coreml").getEffectiveLevel(), num_threads),
+            ) as executor:
+                futures = [executor.submit(_convert_chunk, *args) for args in convert_args]
+                results = [future.result() for future in futures]
+
+    for result in results:
+        logger.info(
+            f"Chunk {result.chunk.name}: layers {result.chunk.start_layer} to {result.chunk.end_layer - 1}, "
+            f"converted in {result.convert_time:.1f} s, {format_size(result.size)} at {result.path}"
+        )
+
+    return results
+
+
+def _predict_chunks(mlmodels, contracts, model_inputs, caches):
+    # Run the chunks one after the other. Returns the outputs of every chunk, and updates the caches.
+    all_outputs = []
+    previous_outputs = {}
+    for mlmodel, contract in zip(mlmodels, contracts):
+        coreml_inputs = {}
+        for name in contract["inputs"]:
+            if name in contract["previous_chunk"]:
+                coreml_inputs[name] = previous_outputs[contract["previous_chunk"][name]]
+            elif name in contract["cache"]:
+                coreml_inputs[name] = caches[name]
+            else:
+                coreml_inputs[name] = model_inputs[name]
+
+        previous_outputs = mlmodel.predict(coreml_inputs)
+        for input_name, output_name in contract["cache"].items():
+            caches[input_name] = previous_outputs[output_name]
+        all_outputs.append(previous_outputs)
+    return all_outputs
+
+
+def _log_chunk_errors(contracts, all_outputs, ref_hidden_states, step):
+    # The hidden states in between the chunks show which chunk the differences come from.
+    for contract, outputs in zip(contracts[:-1], all_outputs[:-1]):
+        end_layer = contract["layers"][1]
+        error = np.amax(np.abs(ref_hidden_states[end_layer].numpy() - outputs[f"hidden_states_{end_layer}"]))
+        logger.info(
+            f"\t- Chunk {contract['index'] + 1}, hidden states after layer {end_layer - 1} at step {step + 1}: "
+            f"max difference {error:.6g}"
+        )
+
+
+def validate_chunks(
+    config: CoreMLConfig,
+    preprocessor: Union["PreTrainedTokenizer", "FeatureExtractionMixin", "ProcessorMixin"],
+    reference_model: "PreTrainedModel",
+    mlmodels: List[Union[ct.models.MLModel, MILInterpreter]],
+    atol: float,
+    num_steps: int = 16,
+) -> float:
+    """
+    Validate the chunks of a chunked export by running them one after the other, each on the outputs of the
+    chunk before it, and comparing the logits of the last chunk against the reference model. The differences
+    in the hidden states in between the chunks are logged.
+
+    A model with a fixed-size cache is validated by generating `num_steps` tokens, with the cache of each
+    chunk passed back into it at the next step.
+
+    Args:
+        config ([`~coreml.config.CoreMLConfig`]):
+            The Core ML configuration the chunks were exported with.
+        preprocessor ([`PreTrainedTokenizer`], [`FeatureExtractionMixin`] or [`ProcessorMixin`]):
+            The preprocessor used for encoding the data.
+        reference_model ([`PreTrainedModel`]):
+            The model used for the export.
+        mlmodels (`List[ct.models.MLModel]` or `List[MILInterpreter]`):
+            The exported chunks, in order, or interpreters running them.
+        atol (`float`):
+            Absolute tolerance for the logits.
+
+    Returns:
+        `float`: the largest absolute difference between the logits of the reference model and the chunks.
+    """
+    import torch
+
+    contracts = [json.loads(mlmodel.user_defined_metadata[CHUNK_METADATA_KEY]) for mlmodel in mlmodels]
+    if [contract["index"] for contract in contracts] != list(range(len(mlmodels))):
+        raise ValueError("The chunks are incomplete or not in order")
+
+    logger.info(f"Validating {len(mlmodels)} chained chunks...")
+    output_descs = OrderedDict(logits=config.outputs["logits"])
+    logits_name = output_descs["logits"].name
+    reference_model.to("cpu").eval()
+
+    if config.kv_cache_capacity is None:
+        dummy_inputs = config.generate_dummy_inputs(preprocessor, framework=TensorType.PYTORCH)
+        input_ids = dummy_inputs["input_ids"][0]
+        attention_mask = dummy_inputs["attention_mask"][0]
+        with torch.no_grad():
+            ref_outputs = reference_model(
+                input_ids, attention_mask=attention_mask, output_hidden_states=True, return_dict=True
+            )
+
+        model_inputs = {
+            config.inputs["input_ids"].name: input_ids.numpy().astype(np.int32),
+            config.inputs["attention_mask"].name: attention_mask.numpy().astype(np.int32),
+        }
+        all_outputs = _predict_chunks(mlmodels, contracts, model_inputs, {})
+        _log_chunk_errors(contracts, all_outputs, ref_outputs["hidden_states"], 0)
+        return _check_step_outputs(output_descs, ref_outputs, all_outputs[-1], atol, 0)
+
+    caches = {}
+    for contract in contracts:
+        for name in contract["cache"]:
+            caches[name] = np.zeros(contract["inputs"][name], dtype=np.float32)
+
+    max_error = 0.0
+    steps = _fixed_cache_reference_steps(config, preprocessor, reference_model, num_steps, output_hidden_states=True)
+    for position, input_ids, ref_outputs in steps:
+        model_inputs = {
+            config.inputs["input_ids"].name: input_ids.numpy().astype(np.int32),
+            config.inputs["position"].name: np.array([position], dtype=np.int32),
+        }
+        all_outputs = _predict_chunks(mlmodels, contracts, model_inputs, caches)
+        _log_chunk_errors(contracts, all_outputs, ref_outputs["hidden_states"], position)
+        error = _check_step_outputs(output_descs, ref_outputs, all_outputs[-1], atol, position)
+        max_error = max(max_error, error)
+
+    return max_error
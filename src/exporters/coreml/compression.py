@@ -0,0 +1,494 @@
+# coding=utf-8
+# Copyright 2022 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compress the weights of an exported Core ML model."""
+
+import dataclasses
+import fnmatch
+import json
+import os
+import shutil
+import tempfile
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple, Union
+
+import coremltools as ct
+import coremltools.optimize.coreml as cto
+import numpy as np
+
+from coremltools.models.utils import _is_macos
+
+from .cache import format_size, get_path_size
+from .config import CoreMLConfig
+from ..utils import logging
+
+
+if TYPE_CHECKING:
+    from .data import CalibrationData
+
+
+logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
+
+PALETTIZATION_NBITS = [2, 4, 6, 8]
+PALETTIZATION_GRANULARITIES = ["per_tensor", "per_grouped_channel"]
+
+LINEAR_QUANTIZATION_BLOCK_SIZES = [32, 64, 128]
+
+# The options of `quantize`: float precisions, and integer weights that are computed with in float16.
+QUANTIZE_OPTIONS = ["float32", "float16", "int8"] + [f"int4-block{size}" for size in LINEAR_QUANTIZATION_BLOCK_SIZES]
+
+# Compressed models drift further from the original model than float16 does. These are loose default
+# tolerances for validation, pass an explicit `atol` to be stricter.
+_PALETTIZATION_ATOL = {2: 2.0, 4: 0.5, 6: 0.1, 8: 0.05}
+
+_LINEAR_QUANTIZATION_ATOL = {"int8": 0.05, "int4": 0.5}
+_ACTIVATION_QUANTIZATION_ATOL = 0.1
+_PRUNING_ATOL = 0.5
+
+PRUNING_MODES = ["magnitude", "threshold"]
+
+# Constants with values this large are masks, not weights.
+_MASK_MAGNITUDE = 1e4
+
+
+@dataclass(frozen=True)
+class PalettizationConfig:
+    """
+    Palettize the weights: cluster the values of every weight tensor with k-means into `2**nbits` values,
+    and store the weights as `nbits`-bit indices into this lookup table.
+
+    Args:
+        nbits (`int`, *optional*, defaults to 4):
+            Number of bits per weight. Possible values: 2, 4, 6, 8.
+        granularity (`str`, *optional*, defaults to `"per_tensor"`):
+            `"per_tensor"` for one lookup table per weight tensor, or `"per_grouped_channel"` for one lookup
+            table for every `group_size` output channels. Grouped lookup tables are more accurate but
+            require iOS 18 / macOS 15.
+        group_size (`int`, *optional*, defaults to 16):
+            Number of output channels that share a lookup table, with `"per_grouped_channel"`.
+        weight_threshold (`int`, *optional*, defaults to 2048):
+            Weight tensors with fewer elements than this are not compressed.
+    """
+
+    nbits: int = 4
+    granularity: str = "per_tensor"
+    group_size: int = 16
+    weight_threshold: int = 2048
+
+    def __post_init__(self):
+        if self.nbits not in PALETTIZATION_NBITS:
+            raise ValueError(f"Palettization supports {PALETTIZATION_NBITS} bits, got {self.nbits}")
+        if self.granularity not in PALETTIZATION_GRANULARITIES:
+            raise ValueError(f"Unknown palettization granularity '{self.granularity}'")
+
+    @property
+    def name(self) -> str:
+        """Short description of the compression, stored in the model metadata."""
+        if self.granularity == "per_grouped_channel":
+            return f"palettize{self.nbits}-group{self.group_size}"
+        return f"palettize{self.nbits}"
+
+    @property
+    def minimum_deployment_target(self) -> ct.target:
+        """The oldest OS version that can run the compressed model."""
+        return ct.target.iOS18 if self.granularity == "per_grouped_channel" else ct.target.iOS16
+
+    @property
+    def atol_for_validation(self) -> float:
+        """Default tolerance when validating the compressed model against the original one."""
+        return _PALETTIZATION_ATOL[self.nbits]
+
+    def fingerprint(self) -> Dict[str, Any]:
+        """Describe the compression, for the export cache."""
+        return dataclasses.asdict(self)
+
+    def op_config(self) -> cto.OpPalettizerConfig:
+        return cto.OpPalettizerConfig(
+            mode="kmeans",
+            nbits=self.nbits,
+            granularity=self.granularity,
+            group_size=self.group_size if self.granularity == "per_grouped_channel" else 32,
+            weight_threshold=self.weight_threshold,
+        )
+
+    def apply(self, mlmodel: ct.models.MLModel, optimization_config: cto.OptimizationConfig) -> ct.models.MLModel:
+        return cto.palettize_weights(mlmodel, optimization_config)
+
+
+@dataclass(frozen=True)
+class LinearQuantizationConfig:
+    """
+    Quantize the weights linearly: store every weight as a signed integer, together with a float scale
+    per output channel or per block of input channels.
+
+    Args:
+        dtype (`str`, *optional*, defaults to `"int8"`):
+            The integer type of the weights. Possible values: `"int8"`, `"int4"`.
+        block_size (`int`, *optional*):
+            Number of input channels that share a scale. If not set, there is one scale per output channel.
+            Block-wise quantization requires iOS 18 / macOS 15.
+        weight_threshold (`int`, *optional*, defaults to 2048):
+            Weight tensors with fewer elements than this are not compressed.
+    """
+
+    dtype: str = "int8"
+    block_size: Optional[int] = None
+    weight_threshold: int = 2048
+
+    def __post_init__(self):
+        if self.dtype not in _LINEAR_QUANTIZATION_ATOL:
+            raise ValueError(f"Unknown linear quantization type '{self.dtype}'")
+        if self.block_size is not None and self.block_size <= 0:
+            raise ValueError(f"The block size must be positive, got {self.block_size}")
+        if self.dtype == "int4" and self.block_size is None:
+            raise ValueError("int4 quantization needs a block size")
+
+    @classmethod
+    def from_quantize(cls, quantize: str) -> Optional["LinearQuantizationConfig"]:
+        """
+        The linear quantization for a `quantize` option such as `"int8"` or `"int4-block32"`, or `None` for
+        the float options.
+        """
+        if quantize not in QUANTIZE_OPTIONS:
+            raise ValueError(f"Unknown quantize option '{quantize}'")
+        if quantize == "int8":
+            return cls(dtype="int8")
+        if quantize.startswith("int4-block"):
+            return cls(dtype="int4", block_size=int(quantize[len("int4-block"):]))
+        return None
+
+    @property
+    def name(self) -> str:
+        """Short description of the compression, stored in the model metadata."""
+        if self.block_size is not None:
+            return f"{self.dtype}-block{self.block_size}"
+        return self.dtype
+
+    @property
+    def minimum_deployment_target(self) -> ct.target:
+        """The oldest OS version that can run the compressed model."""
+        return ct.target.iOS18 if self.block_size is not None else ct.target.iOS16
+
+    @property
+    def atol_for_validation(self) -> float:
+        """Default tolerance when validating the compressed model against the original one."""
+        return _LINEAR_QUANTIZATION_ATOL[self.dtype]
+
+    def fingerprint(self) -> Dict[str, Any]:
+        """Describe the compression, for the export cache."""
+        return dataclasses.asdict(self)
+
+    def op_config(self) -> cto.OpLinearQuantizerConfig:
+        return cto.OpLinearQuantizerConfig(
+            mode="linear_symmetric",
+            dtype=self.dtype,
+            granularity="per_channel" if self.block_size is None else "per_block",
+            block_size=self.block_size or 32,
+            weight_threshold=self.weight_threshold,
+        )
+
+    def apply(self, mlmodel: ct.models.MLModel, optimization_config: cto.OptimizationConfig) -> ct.models.MLModel:
+        return cto.linear_quantize_weights(mlmodel, optimization_config)
+
+
+@dataclass(frozen=True)
+class ActivationQuantizationConfig:
+    """
+    Quantize the activations and the weights to 8-bit integers (W8A8). The ranges of the activations are
+    measured by running the converted model on calibration data, which requires macOS. The weights are
+    quantized per output channel, like `quantize="int8"`.
+
+    Args:
+        calibration_data ([`~coreml.data.CalibrationData`]):
+            Example inputs that are representative of what the model will see.
+        weight_threshold (`int`, *optional*, defaults to 2048):
+            Weight tensors with fewer elements than this are not compressed.
+    """
+
+    calibration_data: "CalibrationData"
+    weight_threshold: int = 2048
+
+    @property
+    def name(self) -> str:
+        """Short description of the compression, stored in the model metadata."""
+        return "w8a8"
+
+    @property
+    def minimum_deployment_target(self) -> ct.target:
+        """The oldest OS version that can run the compressed model."""
+        return ct.target.iOS17
+
+    @property
+    def atol_for_validation(self) -> float:
+        """Default tolerance when validating the compressed model against the original one."""
+        return _ACTIVATION_QUANTIZATION_ATOL
+
+    def fingerprint(self) -> Dict[str, Any]:
+        """Describe the compression, for the export cache."""
+        return {
+            "name": self.name,
+            "calibration_data": self.calibration_data.fingerprint(),
+            "weight_threshold": self.weight_threshold,
+        }
+
+    def op_config(self) -> cto.OpLinearQuantizerConfig:
+        return cto.OpLinearQuantizerConfig(
+            mode="linear_symmetric",
+            dtype="int8",
+            granularity="per_channel",
+            weight_threshold=self.weight_threshold,
+        )
+
+    def apply(self, mlmodel: ct.models.MLModel, optimization_config: cto.OptimizationConfig) -> ct.models.MLModel:
+        if not _is_macos():
+            raise RuntimeError("Calibrating the activations runs the model with Core ML, which requires macOS")
+
+        activation_config = cto.OptimizationConfig(
+            global_config=cto.OpLinearQuantizerConfig(mode="linear_symmetric", dtype="int8")
+        )
+        logger.info("Measuring activation ranges on the calibration data...")
+        mlmodel = cto.linear_quantize_activations(mlmodel, activation_config, self.calibration_data)
+        return cto.linear_quantize_weights(mlmodel, optimization_config)
+
+
+@dataclass(frozen=True)
+class PruningConfig:
+    """
+    Prune the weights: set the smallest weights to zero, and store the weights in Core ML's sparse format,
+    which keeps only the nonzero values and a bit mask.
+
+    Args:
+        mode (`str`, *optional*, defaults to `"magnitude"`):
+            `"magnitude"` zeroes the `target_sparsity` fraction of each weight tensor with the smallest
+            magnitude. `"threshold"` zeroes all weights whose magnitude is below `threshold`.
+        target_sparsity (`float`, *optional*, defaults to 0.5):
+            With `"magnitude"`, the fraction of weights to set to zero.
+        threshold (`float`, *optional*, defaults to 1e-3):
+            With `"threshold"`, the magnitude below which weights are set to zero.
+        layers (`List[str]`, *optional*):
+            Names of the PyTorch parameters to prune, which can use wildcards such as `"*.attention.*"`. By
+            default, all weights are pruned.
+        palettization ([`~coreml.compression.PalettizationConfig`], *optional*):
+            Also palettize the nonzero weights. Pruning and palettizing the same weights requires iOS 18 /
+            macOS 15.
+        weight_threshold (`int`, *optional*, defaults to 2048):
+            Weight tensors with fewer elements than this are not compressed.
+    """
+
+    mode: str = "magnitude"
+    target_sparsity: float = 0.5
+    threshold: float = 1e-3
+    layers: Optional[Tuple[str, ...]] = None
+    palettization: Optional[PalettizationConfig] = None
+    weight_threshold: int = 2048
+
+    def __post_init__(self):
+        if self.mode not in PRUNING_MODES:
+            raise ValueError(f"Unknown pruning mode '{self.mode}'")
+        if not 0.0 < self.target_sparsity < 1.0:
+            raise ValueError(f"The target sparsity must be between 0 and 1, got {self.target_sparsity}")
+        if self.layers is not None:
+            # Keep the config hashable.
+            object.__setattr__(self, "layers", tuple(self.layers))
+
+    @property
+    def name(self) -> str:
+        """Short description of the compression, stored in the model metadata."""
+        if self.mode == "magnitude":
+            name = f"prune{self.target_sparsity:g}"
+        else:
+            name = f"prune-threshold{self.threshold:g}"
+        if self.palettization is not None:
+            name += "-" + self.palettization.name
+        return name
+
+    @property
+    def minimum_deployment_target(self) -> ct.target:
+        """The oldest OS version that can run the compressed model."""
+        return ct.target.iOS18 if self.palettization is not None else ct.target.iOS16
+
+    @property
+    def atol_for_validation(self) -> float:
+        """Default tolerance when validating the compressed model against the original one."""
+        if self.palettization is not None:
+            return max(_PRUNING_ATOL, self.palettization.atol_for_validation)
+        return _PRUNING_ATOL
+
+    def fingerprint(self) -> Dict[str, Any]:
+        """Describe the compression, for the export cache."""
+        return dataclasses.asdict(self)
+
+    def op_config(self) -> Union[cto.OpMagnitudePrunerConfig, cto.OpThresholdPrunerConfig]:
+        if self.mode == "magnitude":
+            return cto.OpMagnitudePrunerConfig(
+                target_sparsity=self.target_sparsity, weight_threshold=self.weight_threshold
+            )
+        return cto.OpThresholdPrunerConfig(
+            threshold=self.threshold, minimum_sparsity_percentile=0.0, weight_threshold=self.weight_threshold
+        )
+
+    def apply(self, mlmodel: ct.models.MLModel, optimization_config: cto.OptimizationConfig) -> ct.models.MLModel:
+        weights = cto.get_weights_metadata(mlmodel, weight_threshold=self.weight_threshold)
+
+        op_name_configs = dict(optimization_config.op_name_configs)
+        if self.layers is not None:
+            for name in weights:
+                if not _matches(name, self.layers):
+                    op_name_configs[name] = None
+
+        pruned_model = cto.prune_weights(
+            mlmodel,
+            cto.OptimizationConfig(global_config=optimization_config.global_config, op_name_configs=op_name_configs),
+        )
+
+        sparsity = _get_weight_sparsity(weights, pruned_model)
+        logger.info("Sparsity per layer:")
+        for name, value in sparsity.items():
+            logger.info(f"\t- {name}: {value:.1%}")
+        total = sum(weights[name].val.size for name in sparsity)
+        zeros = sum(weights[name].val.size * sparsity[name] for name in sparsity)
+        pruned_model.user_defined_metadata.update({
+            "co.huggingface.exporters.sparsity": f"{zeros / max(total, 1):.4f}",
+            "co.huggingface.exporters.layer_sparsity": json.dumps({name: round(value, 4) for name, value in sparsity.items()}),
+        })
+
+        if self.palettization is not None:
+            # Palettize the nonzero values of the pruned weights, and the other weights as usual. The
+            # conversion passes that run after pruning may fold the masks into constants with new names.
+            op_name_configs = dict(optimization_config.op_name_configs)
+            for name, metadata in cto.get_weights_metadata(pruned_model, weight_threshold=self.weight_threshold).items():
+                if _is_mask(metadata.val):
+                    op_name_configs[name] = None
+            palettization_config = cto.OptimizationConfig(
+                global_config=self.palettization.op_config(), op_name_configs=op_name_configs
+            )
+            pruned_model = cto.palettize_weights(pruned_model, palettization_config, joint_compression=True)
+
+        return pruned_model
+
+
+def _get_weight_sparsity(weights: Dict[str, Any], pruned_model: ct.models.MLModel) -> Dict[str, float]:
+    # A pruned weight is replaced by its nonzero values, in a constant whose name starts with the weight's name.
+    pruned_weights = cto.get_weights_metadata(pruned_model, weight_threshold=0)
+    sparsity = {}
+    for name, metadata in weights.items():
+        nonzero_data = f"{name}_sparsified_nonzero_data"
+        for pruned_name, pruned_metadata in pruned_weights.items():
+            if pruned_name.startswith(nonzero_data):
+                sparsity[name] = 1.0 - pruned_metadata.val.size / metadata.val.size
+                break
+    return sparsity
+
+
+# Any of the ways to compress the weights.
+CompressionConfig = Union[PalettizationConfig, LinearQuantizationConfig, ActivationQuantizationConfig, PruningConfig]
+
+
+def _matches(weight_name: str, patterns: List[str]) -> bool:
+    # Core ML weight names are the PyTorch parameter names with dots replaced by underscores, behind the
+    # "model_" prefix of the Wrapper module, and sometimes followed by a suffix such as "_to_fp16".
+    if weight_name.startswith("model_"):
+        weight_name = weight_name[len("model_"):]
+    for pattern in patterns:
+        pattern = pattern.replace(".", "_")
+        if fnmatch.fnmatchcase(weight_name, pattern) or fnmatch.fnmatchcase(weight_name, pattern + "_*"):
+            return True
+    return False
+
+
+def _is_mask(value: np.ndarray) -> bool:
+    # Attention masks that were folded into constants hold huge negative numbers. Clustering those
+    # together with regular values would break the masking.
+    if not np.issubdtype(value.dtype, np.floating):
+        return True
+    return not np.all(np.isfinite(value)) or np.amax(np.abs(value)) >= _MASK_MAGNITUDE
+
+
+def get_excluded_weights(mlmodel: ct.models.MLModel, config: CoreMLConfig, weight_threshold: int = 2048) -> List[str]:
+    """
+    The names of the weights in `mlmodel` that should not be compressed: those that match the
+    `compression_exclude` patterns of `config`, and constant masks.
+    """
+    patterns = config.compression_exclude
+    weights = cto.get_weights_metadata(mlmodel, weight_threshold=weight_threshold)
+    return [
+        name for name, metadata in weights.items() if _matches(name, patterns) or _is_mask(metadata.val)
+    ]
+
+
+def compress_weights(
+    mlmodel: ct.models.MLModel,
+    config: CoreMLConfig,
+    compression: CompressionConfig,
+) -> ct.models.MLModel:
+    """
+    Compress the weights of an ML Program, leaving out the weights that `config.compression_exclude` lists.
+    The compression method and the size of the weights before and after compression are recorded in the
+    model metadata.
+
+    Args:
+        mlmodel (`ct.models.MLModel`):
+            The exported Core ML model.
+        config ([`~coreml.config.CoreMLConfig`]):
+            The Core ML configuration associated with the exported model.
+        compression (`CompressionConfig`):
+            How to compress the model.
+
+    Returns:
+        `ct.models.MLModel`: the compressed Core ML model
+    """
+    excluded = get_excluded_weights(mlmodel, config, compression.weight_threshold)
+    for name in excluded:
+        logger.info(f"Not compressing weight {name}")
+
+    optimization_config = cto.OptimizationConfig(
+        global_config=compression.op_config(),
+        op_name_configs={name: None for name in excluded},
+    )
+
+    original_size = get_path_size(mlmodel.weights_dir)
+    metadata = dict(mlmodel.user_defined_metadata)
+
+    logger.info(f"Compressing weights ({compression.name})...")
+    mlmodel = compression.apply(mlmodel, optimization_config)
+
+    compressed_size = get_path_size(mlmodel.weights_dir)
+    logger.info(f"Compressed weights from {format_size(original_size)} to {format_size(compressed_size)}")
+
+    metadata.update({
+        "co.huggingface.exporters.compression": compression.name,
+        "co.huggingface.exporters.uncompressed_weights_size": str(original_size),
+        "co.huggingface.exporters.weights_size": str(compressed_size),
+        "co.huggingface.exporters.compression_ratio": f"{original_size / max(compressed_size, 1):.2f}",
+    })
+    mlmodel.user_defined_metadata.update(metadata)
+    return mlmodel
+
+
+def record_validation_error(filename: Union[str, Path], error: float):
+    """
+    Store the largest difference between the outputs of a saved, compressed model and the original model in
+    the model's metadata.
+    """
+    filename = Path(filename)
+    mlmodel = ct.models.MLModel(filename.as_posix(), skip_model_load=True)
+    mlmodel.user_defined_metadata["co.huggingface.exporters.validation_error"] = f"{error:.6g}"
+
+    # Saving replaces the destination, so the model can't be saved over the package it was loaded from.
+    with tempfile.TemporaryDirectory(dir=filename.parent) as tmp_dir:
+        tmp_filename = os.path.join(tmp_dir, filename.name)
+        mlmodel.save(tmp_filename)
+        shutil.rmtree(filename)
+        shutil.move(tmp_filename, filename)
@@ -40,6 +40,8 @@ if is_vision_available():
 
 logger = logging.get_logger(__name__)
 
+GENERATION_STEPS = ["prefill", "decode"]
+
 
 @dataclasses.dataclass
 class InputDescription:
@@ -58,13 +60,14 @@ class InputDescription:
             Sequence length for text inputs. If this is a single value, the sequence length will be a fixed size
             in the exported model, giving the input tensor the shape `(batch_size, sequence_length)`.
             If this is a tuple `(min, max)`, the sequence length is allowed to vary between those two sizes.
+            If this is a list, the sequence length must be exactly one of the listed sizes.
         color_layout (`str`, *optional*, defaults to `None`):
             Channel ordering for image inputs. Either `"RGB"` or `"BGR"`.
     """
     name: str
     description: str = ""
     is_optional: bool = False
-    sequence_length: Optional[Union[int, Tuple[int, int]]] = None
+    sequence_length: Optional[Union[int, Tuple[int, int], List[int]]] = None
     color_layout: Optional[str] = None
 
 
@@ -104,6 +107,28 @@ class CoreMLConfig():
             attention blocks) for fast autoregressive decoding.
         seq2seq: `None` if not an encoder-decoder model, `"encoder"` to export the encoder
             part of a seq2seq model, `"decoder"` to export the decoder part.
+        stateful: Together with `use_past`, keep the key and value cache inside the Core ML model as
+            state tensors that are updated in place, instead of passing them in and out of the model.
+        kv_cache_capacity: Together with `use_past`, give the key and value cache a fixed number of slots
+            instead of letting it grow. The model then processes one token per prediction, at the slot
+            given by its `position` input, and all its shapes are fixed.
+        kv_cache_sliding_window: With `kv_cache_capacity`, keep generating when the cache is full by
+            overwriting the oldest token, so the model attends to the last `kv_cache_capacity` tokens.
+        sequence_length_buckets: The sequence lengths the text inputs may have, for example
+            `[32, 64, 128, 256, 512]`. Unlike a `(min, max)` range of lengths, these enumerated shapes
+            still allow the model to run on the GPU and Neural Engine. Inputs are padded to the smallest
+            bucket that fits them.
+        batch_size: The number of examples in one prediction. Either a fixed size, a tuple `(min, max)`
+            of sizes where `max` may be `-1` for no limit, or a list of allowed sizes. By default, the
+            model takes a single example. With a batch, image inputs become tensors of pixel values and
+            classifiers output only the probabilities.
+        generation_step: Together with `use_past`, export one step of text generation with fixed input
+            shapes: `"prefill"` processes a prompt of `prefill_length` tokens without past keys and values,
+            `"decode"` processes a single token after up to `max_sequence_length - 1` past tokens. The two
+            steps can be combined into one multifunction model with
+            [`~coreml.multifunction.export_multifunction`].
+        prefill_length: With `generation_step`, the number of prompt tokens of the prefill step. Defaults
+            to half of `max_sequence_length`.
     """
     def __init__(
         self,
@@ -111,6 +136,13 @@ class CoreMLConfig():
         task: str,
         use_past: bool = False,
         seq2seq: Optional[str] = None,
+        stateful: bool = False,
+        kv_cache_capacity: Optional[int] = None,
+        kv_cache_sliding_window: bool = False,
+        sequence_length_buckets: Optional[List[int]] = None,
+        batch_size: Optional[Union[int, Tuple[int, int], List[int]]] = None,
+        generation_step: Optional[str] = None,
+        prefill_length: Optional[int] = None,
     ):
         if not hasattr(self, "modality"):
             raise ValueError("the CoreMLConfig subclass must have a modality property")
@@ -118,10 +150,95 @@ class CoreMLConfig():
         if use_past and seq2seq == "encoder":
             raise ValueError("invalid option `use_past=True` for encoder model")
 
+        if stateful and not use_past:
+            raise ValueError("option `stateful=True` requires `use_past=True`")
+
+        if stateful and (seq2seq is not None or self.modality != "text"):
+            raise ValueError("option `stateful=True` is only supported for decoder-only text models")
+
+        if kv_cache_capacity is not None and not use_past:
+            raise ValueError("option `kv_cache_capacity` requires `use_past=True`")
+
+        if kv_cache_capacity is not None and (seq2seq is not None or self.modality != "text"):
+            raise ValueError("option `kv_cache_capacity` is only supported for decoder-only text models")
+
+        if kv_cache_capacity is not None:
+            # The cache holds the past tokens and the new one.
+            if kv_cache_capacity < 2:
+                raise ValueError(f"invalid key and value cache capacity {kv_cache_capacity}, must be at least 2")
+            max_positions = getattr(config, "max_position_embeddings", None)
+            if max_positions is not None and kv_cache_capacity > max_positions:
+                raise ValueError(
+                    f"the key and value cache capacity {kv_cache_capacity} is larger than the {max_positions} "
+                    "positions the model supports"
+                )
+
+        if kv_cache_sliding_window and kv_cache_capacity is None:
+            raise ValueError("option `kv_cache_sliding_window=True` requires `kv_cache_capacity`")
+
+        if generation_step is not None:
+            if generation_step not in GENERATION_STEPS:
+                raise ValueError(f"unknown generation step '{generation_step}', expected one of {GENERATION_STEPS}")
+            if not use_past:
+                raise ValueError("option `generation_step` requires `use_past=True`")
+            if seq2seq is not None or self.modality != "text" or task != "text-generation":
+                raise ValueError("option `generation_step` is only supported for decoder-only text generation models")
+            if stateful or kv_cache_capacity is not None:
+                raise ValueError("option `generation_step` cannot be combined with `stateful` or `kv_cache_capacity`")
+
+        if prefill_length is not None:
+            if generation_step is None:
+                raise ValueError("option `prefill_length` requires `generation_step`")
+            if prefill_length < 1:
+                raise ValueError(f"invalid prefill length {prefill_length}")
+
+        if sequence_length_buckets is not None:
+            if use_past or seq2seq is not None or self.modality != "text":
+                raise ValueError("option `sequence_length_buckets` is only supported for text models without `use_past`")
+            if len(sequence_length_buckets) == 0 or any(length < 1 for length in sequence_length_buckets):
+                raise ValueError(f"invalid sequence length buckets {sequence_length_buckets}")
+            sequence_length_buckets = sorted(set(sequence_length_buckets))
+
+        if batch_size is not None:
+            if stateful or kv_cache_capacity is not None:
+                raise ValueError("option `batch_size` is not supported together with `stateful` or `kv_cache_capacity`")
+            if isinstance(batch_size, tuple):
+                if len(batch_size) != 2 or batch_size[0] < 1 or -1 < batch_size[1] < batch_size[0]:
+                    raise ValueError(f"invalid batch size range {batch_size}")
+                if sequence_length_buckets is not None:
+                    # Core ML can't mix a range with the enumerated shapes of the buckets in one input.
+                    raise ValueError(
+                        "a range of batch sizes cannot be combined with `sequence_length_buckets`, "
+                        "use a list of batch sizes instead"
+                    )
+            elif isinstance(batch_size, list):
+                if len(batch_size) == 0 or any(size < 1 for size in batch_size):
+                    raise ValueError(f"invalid batch sizes {batch_size}")
+                batch_size = sorted(set(batch_size))
+                if len(batch_size) == 1:
+                    batch_size = batch_size[0]
+            elif batch_size < 1:
+                raise ValueError(f"invalid batch size {batch_size}")
+            if batch_size == 1:
+                batch_size = None
+
         self._config = config
         self.task = task
         self.use_past = use_past
         self.seq2seq = seq2seq
+        self.stateful = stateful
+        self.kv_cache_capacity = kv_cache_capacity
+        self.kv_cache_sliding_window = kv_cache_sliding_window
+        self.sequence_length_buckets = sequence_length_buckets
+        self.batch_size = batch_size
+        self.generation_step = generation_step
+        self._prefill_length = prefill_length
+
+        if generation_step is not None and self.prefill_length >= self.max_sequence_length:
+            raise ValueError(
+                f"the prefill length {self.prefill_length} leaves no room for decoding in the maximum sequence "
+                f"length {self.max_sequence_length}"
+            )
 
     @classmethod
     def from_model_config(
@@ -130,6 +247,13 @@ class CoreMLConfig():
         task: str = "feature-extraction",
         use_past: bool = False,
         seq2seq: Optional[str] = None,
+        stateful: bool = False,
+        kv_cache_capacity: Optional[int] = None,
+        kv_cache_sliding_window: bool = False,
+        sequence_length_buckets: Optional[List[int]] = None,
+        batch_size: Optional[Union[int, Tuple[int, int], List[int]]] = None,
+        generation_step: Optional[str] = None,
+        prefill_length: Optional[int] = None,
     ) -> "CoreMLConfig":
         """
         Instantiate a `CoreMLConfig` for a specific model.
@@ -141,11 +265,30 @@ class CoreMLConfig():
                 attention blocks) for fast autoregressive decoding.
             seq2seq: `None` if not an encoder-decoder model, `"encoder"` to export the encoder
                 part of a seq2seq model, `"decoder"` to export the decoder part.
+            stateful: Keep the precomputed hidden states in Core ML model state. Requires `use_past`.
+            kv_cache_capacity: Number of slots in a fixed-size key and value cache. Requires `use_past`.
+            kv_cache_sliding_window: Overwrite the oldest tokens when the fixed-size cache is full.
+            sequence_length_buckets: The sequence lengths the text inputs may have. Not for `use_past`.
+            batch_size: The number of examples in one prediction: a size, a `(min, max)` range, or a list.
+            generation_step: `"prefill"` or `"decode"`, to export one step of text generation. Requires `use_past`.
+            prefill_length: The number of prompt tokens of the `"prefill"` step.
 
         Returns:
             `CoreMLConfig` for this model
         """
-        return cls(config, task=task, use_past=use_past, seq2seq=seq2seq)
+        return cls(
+            config,
+            task=task,
+            use_past=use_past,
+            seq2seq=seq2seq,
+            stateful=stateful,
+            kv_cache_capacity=kv_cache_capacity,
+            kv_cache_sliding_window=kv_cache_sliding_window,
+            sequence_length_buckets=sequence_length_buckets,
+            batch_size=batch_size,
+            generation_step=generation_step,
+            prefill_length=prefill_length,
+        )
 
     @classmethod
     def with_past(
@@ -153,6 +296,12 @@ class CoreMLConfig():
         config: "PretrainedConfig",
         task: str = "feature-extraction",
         seq2seq: Optional[str] = None,
+        stateful: bool = False,
+        kv_cache_capacity: Optional[int] = None,
+        kv_cache_sliding_window: bool = False,
+        batch_size: Optional[Union[int, Tuple[int, int], List[int]]] = None,
+        generation_step: Optional[str] = None,
+        prefill_length: Optional[int] = None,
     ) -> "CoreMLConfig":
         """
         Instantiate a `CoreMLConfig` with `use_past` attribute set to True
@@ -162,11 +311,28 @@ class CoreMLConfig():
             task: The model topology that will be exported.
             seq2seq: `None` if not an encoder-decoder model, `"encoder"` to export the encoder
                 part of a seq2seq model, `"decoder"` to export the decoder part.
+            stateful: Keep the precomputed hidden states in Core ML model state.
+            kv_cache_capacity: Number of slots in a fixed-size key and value cache.
+            kv_cache_sliding_window: Overwrite the oldest tokens when the fixed-size cache is full.
+            batch_size: The number of examples in one prediction: a size, a `(min, max)` range, or a list.
+            generation_step: `"prefill"` or `"decode"`, to export one step of text generation.
+            prefill_length: The number of prompt tokens of the `"prefill"` step.
 
         Returns:
             `CoreMLVisionConfig` for this model with `.use_past = True`
         """
-        return cls(config, task=task, use_past=True, seq2seq=seq2seq)
+        return cls(
+            config,
+            task=task,
+            use_past=True,
+            seq2seq=seq2seq,
+            stateful=stateful,
+            kv_cache_capacity=kv_cache_capacity,
+            kv_cache_sliding_window=kv_cache_sliding_window,
+            batch_size=batch_size,
+            generation_step=generation_step,
+            prefill_length=prefill_length,
+        )
 
     @property
     def inputs(self) -> "OrderedDict[str, InputDescription]":
@@ -175,7 +341,32 @@ class CoreMLConfig():
         """
         common_inputs = self._input_descriptions
 
-        if self.use_past:
+        if self.use_past and self.kv_cache_capacity is not None:
+            # One token at a time. The attention mask is computed inside the model from the position.
+            input_ids = common_inputs["input_ids"]
+            input_ids.sequence_length = 1
+            common_inputs = OrderedDict(
+                [
+                    ("input_ids", input_ids),
+                    (
+                        "position",
+                        InputDescription(
+                            "position",
+                            "Position of the token in the sequence, starting at 0",
+                        )
+                    ),
+                ]
+            )
+
+        if self.generation_step is not None:
+            # A fixed number of new tokens. Only the attention mask of the decode step also covers the
+            # past tokens, so its length is left open.
+            sequence_length = self.prefill_length if self.generation_step == "prefill" else 1
+            common_inputs["input_ids"].sequence_length = sequence_length
+            if self.generation_step == "prefill":
+                common_inputs["attention_mask"].sequence_length = sequence_length
+
+        if self.use_past and not self.stateful and self.generation_step != "prefill":
             self.fill_inputs_with_past_key_values_(common_inputs)
 
         return common_inputs
@@ -197,6 +388,18 @@ class CoreMLConfig():
                 return self._config.max_position_embeddings
         return 128
 
+    @property
+    def prefill_length(self) -> Optional[int]:
+        """
+        The number of prompt tokens the `"prefill"` generation step processes at once. Shorter prompts are
+        padded, and masked out with the attention mask.
+        """
+        if self.generation_step is None:
+            return None
+        if self._prefill_length is not None:
+            return self._prefill_length
+        return max(1, self.max_sequence_length // 2)
+
     @property
     def use_flexible_shapes(self) -> bool:
         """
@@ -213,8 +416,11 @@ class CoreMLConfig():
 
         - When returning a tuple, flexible shapes will be used. The tuple must contain two items,
         representing the minimum and maximum possible sequence lengths.
+        - When returning a list, enumerated shapes will be used: one for each of the `sequence_length_buckets`.
         - When returning an `int`, a fixed sequence length will be used.
         """
+        if self.sequence_length_buckets is not None:
+            return list(self.sequence_length_buckets)
         return (1, self.max_sequence_length) if self.use_flexible_shapes else self.max_sequence_length
 
 
@@ -394,7 +600,11 @@ class CoreMLConfig():
         """
         common_outputs = self._output_descriptions
 
-        if self.use_past:
+        if self.batch_size is not None and "class_labels" in common_outputs:
+            # Core ML classifiers describe a single example, a batch only has the probabilities.
+            del common_outputs["class_labels"]
+
+        if self.use_past and not self.stateful:
             self.fill_outputs_with_past_key_values_(common_outputs)
 
         return common_outputs
@@ -543,7 +753,8 @@ class CoreMLConfig():
         Determines which outputs require flexible shapes and on which axes.
 
         Flexible output shapes are used when `sequence_length` on the model input is a range of
-        allowed lengths.
+        allowed lengths, or a list of them, and when the batch size is flexible. For a list, the
+        `"lengths"` entry holds the allowed sizes.
         """
         output_shapes = {}
 
@@ -562,33 +773,36 @@ class CoreMLConfig():
             output_descs = self.outputs
 
             # If this model has flexible input shapes, it also needs flexible output shapes.
-            min_length, max_length = None, None
-            if self.use_past or self.seq2seq:
+            min_length, max_length, lengths = None, None, None
+            if self.use_past and (self.kv_cache_capacity is not None or self.generation_step is not None):
+                pass
+            elif self.use_past or self.seq2seq:
                 min_length, max_length = 1, -1
             else:
                 sequence_length = self.get_input_sequence_length(input_descs)
                 if isinstance(sequence_length, tuple):
                     min_length, max_length = sequence_length
+                elif isinstance(sequence_length, list):
+                    min_length, max_length, lengths = min(sequence_length), max(sequence_length), sequence_length
 
             if min_length is not None:
                 for key in ["last_hidden_state", "logits", "start_logits", "end_logits"]:
                     if key in output_descs:
                         output_shapes[key] = [
-                            #{ "axis": 0, "min": 1, "max": -1 },  # batch size  # TODO
                             { "axis": 1, "min": min_length, "max": max_length },
                         ]
+                        if lengths is not None:
+                            output_shapes[key][0]["lengths"] = list(lengths)
 
-        if self.use_past:
+        if self.use_past and not self.stateful and self.kv_cache_capacity is None and self.generation_step != "prefill":
             # TODO: Temporarily disabled until we can solve the issue with encoder past key/values
             #name = "decoder_present" if self.seq2seq == "decoder" else "present"
             name = "present"
             for i in range(self.num_layers):
                 output_shapes[f"{name}_{i}_key"] = [
-                    #{ "axis": 0, "min": 1, "max": -1 },  # batch size  # TODO
                     { "axis": 2, "min": 1, "max": -1 },
                 ]
                 output_shapes[f"{name}_{i}_value"] = [
-                    #{ "axis": 0, "min": 1, "max": -1 },  # batch size  # TODO
                     { "axis": 2, "min": 1, "max": -1 },
                 ]
 
@@ -602,6 +816,18 @@ class CoreMLConfig():
             #             { "axis": 2, "min": 1, "max": -1 },
             #         ]
 
+        # With a flexible batch size, every output has a flexible first axis.
+        if isinstance(self.batch_size, tuple):
+            batch_axis = { "axis": 0, "min": self.batch_size[0], "max": self.batch_size[1] }
+        elif isinstance(self.batch_size, list):
+            batch_axis = { "axis": 0, "min": self.batch_size[0], "max": self.batch_size[-1], "lengths": list(self.batch_size) }
+        else:
+            batch_axis = None
+
+        if batch_axis is not None:
+            for key in self.outputs:
+                output_shapes[key] = [dict(batch_axis)] + output_shapes.get(key, [])
+
         return output_shapes
 
     def get_input_sequence_length(self, input_descs):
@@ -665,6 +891,18 @@ class CoreMLConfig():
             )
         return self._config.num_attention_heads
 
+    @property
+    def kv_cache_shape(self) -> Tuple[int, int, int, int, int]:
+        """
+        Shape of the key and value state tensors of a stateful model:
+        `(num_layers, batch_size, num_key_value_heads, capacity, head_dim)`. The capacity is `kv_cache_capacity`
+        if set, otherwise the cache has room for `max_sequence_length` tokens, past and new ones together.
+        """
+        num_key_value_heads = getattr(self._config, "num_key_value_heads", None) or self.num_attention_heads
+        head_dim = self._config.hidden_size // self.num_attention_heads
+        capacity = self.kv_cache_capacity if self.kv_cache_capacity is not None else self.max_sequence_length
+        return (self.num_layers, 1, num_key_value_heads, capacity, head_dim)
+
     def fill_inputs_with_past_key_values_(self, inputs: "OrderedDict[str, InputDescription]"):
         # TODO: Temporarily disabled until we can solve the issue with encoder past key/values
         #name = "decoder_past_key_values" if self.seq2seq == "decoder" else "past_key_values"
@@ -726,6 +964,14 @@ class CoreMLConfig():
         """
         return False
 
+    @property
+    def compression_exclude(self) -> List[str]:
+        """
+        Names of PyTorch parameters whose weights should not be compressed, for layers that are too sensitive
+        to the loss of precision. These can use wildcards, such as `"*.lm_head.weight"`.
+        """
+        return []
+
     def patch_pytorch_ops(self) -> Mapping[str, Callable]:
         """
         Override this to provide implementation for PyTorch ops that the Core ML
@@ -747,6 +993,8 @@ class CoreMLConfig():
             "next-sentence-prediction",
             "text-classification"
         ]
+        if self.batch_size is not None:
+            return False
         return self.task in classifier_tasks and self.outputs["logits"].do_softmax
 
     def _rename_duplicate_labels(self, labels):
@@ -780,24 +1028,28 @@ class CoreMLConfig():
 
         return labels
 
-    def _generate_dummy_image(
-        self,
-        preprocessor: "ImageProcessingMixin",
-        framework: Optional[TensorType] = None,
-    ) -> Tuple[Any, Any]:
+    def _get_image_size(self, preprocessor: "ImageProcessingMixin") -> Tuple[int, int]:
         if hasattr(preprocessor, "crop_size") and preprocessor.do_center_crop:
             image_size = preprocessor.crop_size
         else:
             image_size = preprocessor.size
 
         if "shortest_edge" in image_size:
-            image_height = image_width = image_size["shortest_edge"]
+            return image_size["shortest_edge"], image_size["shortest_edge"]
         else:
-            image_height = image_size["height"]
-            image_width = image_size["width"]
+            return image_size["height"], image_size["width"]
 
-        pixel_values = np.random.randint(0, 256, (image_width, image_height, 3), dtype=np.uint8)
-        coreml_value = Image.fromarray(pixel_values)
+    def _preprocess_images(
+        self,
+        preprocessor: "ImageProcessingMixin",
+        images: List["Image.Image"],
+        framework: Optional[TensorType] = None,
+    ) -> Tuple[Any, Any]:
+        if self.batch_size is not None:
+            # A batch of images goes into the Core ML model as a tensor of pixel values.
+            coreml_value = np.stack([np.asarray(image) for image in images]).transpose(0, 3, 1, 2).astype(np.float32)
+        else:
+            coreml_value = list(images)
 
         # Hacky workaround: the Core ML input is the full-sized image, and so
         # the feature extractor should not resize or crop it, only normalize.
@@ -811,7 +1063,7 @@ class CoreMLConfig():
             old_crop_pct = preprocessor.crop_pct
             preprocessor.crop_pct = 1.0
 
-        ref_value = preprocessor(coreml_value, return_tensors=framework)["pixel_values"]
+        ref_value = preprocessor(images, return_tensors=framework)["pixel_values"]
 
         if old_do_resize is not None:
             preprocessor.do_resize = old_do_resize
@@ -820,6 +1072,32 @@ class CoreMLConfig():
 
         return (ref_value, coreml_value)
 
+    def _generate_dummy_image(
+        self,
+        preprocessor: "ImageProcessingMixin",
+        framework: Optional[TensorType] = None,
+        batch_size: int = 1,
+    ) -> Tuple[Any, Any]:
+        image_height, image_width = self._get_image_size(preprocessor)
+        pixel_values = np.random.randint(0, 256, (batch_size, image_width, image_height, 3), dtype=np.uint8)
+        images = [Image.fromarray(image) for image in pixel_values]
+
+        ref_value, coreml_value = self._preprocess_images(preprocessor, images, framework)
+        if self.batch_size is None:
+            coreml_value = coreml_value[0]
+        return (ref_value, coreml_value)
+
+    def _get_dummy_batch_size(self) -> int:
+        # Trace with more than one example, where possible, so that nothing in the model gets
+        # specialized for a batch size of 1.
+        if isinstance(self.batch_size, tuple):
+            min_size, max_size = self.batch_size
+            return max(min_size, 2) if max_size == -1 else min(max(min_size, 2), max_size)
+        elif isinstance(self.batch_size, list):
+            return next((size for size in self.batch_size if size > 1), self.batch_size[0])
+        else:
+            return self.batch_size or 1
+
     def _get_max_sequence_length(self, input_desc, default_length):
         if input_desc.sequence_length is None:
             return self.max_sequence_length
@@ -828,6 +1106,8 @@ class CoreMLConfig():
             if sequence_length == -1:
                 sequence_length = default_length
             return sequence_length
+        elif isinstance(input_desc.sequence_length, list):
+            return max(input_desc.sequence_length)
         else:
             return input_desc.sequence_length
 
@@ -843,6 +1123,8 @@ class CoreMLConfig():
         self,
         preprocessor: Union["PreTrainedTokenizerBase", "ImageProcessingMixin", "ProcessorMixin"],
         framework: Optional[TensorType] = None,
+        sequence_length: Optional[int] = None,
+        batch_size: Optional[int] = None,
     ) -> Mapping[str, Tuple[Any, Any]]:
         """
         Generate dummy input data to provide to the Core ML exporter.
@@ -852,6 +1134,11 @@ class CoreMLConfig():
                 The preprocessor associated with this model configuration.
             framework (`TensorType`, *optional*, defaults to `None`):
                 The framework (PyTorch or TensorFlow) that the preprocessor will generate tensors for.
+            sequence_length (`int`, *optional*, defaults to `None`):
+                Sequence length of the text inputs, for example one of the `sequence_length_buckets`.
+                By default, the maximum sequence length the inputs allow is used.
+            batch_size (`int`, *optional*, defaults to `None`):
+                Number of examples in the inputs. By default, a batch size the model allows is used.
 
         Returns:
             `Mapping[str, Tuple[Any, Any]]` holding tuples containing the reference and
@@ -861,7 +1148,8 @@ class CoreMLConfig():
         from transformers.tokenization_utils_base import PreTrainedTokenizerBase
         from transformers.processing_utils import ProcessorMixin
 
-        batch_size = 1
+        if batch_size is None:
+            batch_size = self._get_dummy_batch_size()
         input_descs = self.inputs
         dummy_inputs = {}
 
@@ -875,8 +1163,13 @@ class CoreMLConfig():
 
             input_desc = input_descs[input_ids_name]
 
-            # the dummy input will always use the maximum sequence length
-            sequence_length = self._get_max_sequence_length(input_desc, 64)
+            # the dummy input uses the maximum sequence length, unless asked otherwise
+            if sequence_length is None:
+                sequence_length = self._get_max_sequence_length(input_desc, 64)
+
+            # leave room in the key and value cache for the past tokens
+            if self.stateful:
+                sequence_length = max(1, min(sequence_length, self.max_sequence_length // 2))
 
             # don't want encoder and decoder to use same sequence length
             # (unless shapes are fixed)
@@ -924,11 +1217,11 @@ class CoreMLConfig():
             and isinstance(preprocessor, ImageProcessingMixin)
             and preprocessor.model_input_names[0] == "pixel_values"
         ):
-            dummy_inputs["pixel_values"] = self._generate_dummy_image(preprocessor, framework)
+            dummy_inputs["pixel_values"] = self._generate_dummy_image(preprocessor, framework, batch_size)
 
             if self.task == "masked-im":
                 num_patches = (self._config.image_size // self._config.patch_size) ** 2
-                bool_masked_pos = np.random.randint(low=0, high=2, size=(1, num_patches)).astype(bool)
+                bool_masked_pos = np.random.randint(low=0, high=2, size=(batch_size, num_patches)).astype(bool)
                 dummy_inputs["bool_masked_pos"] = (bool_masked_pos, bool_masked_pos.astype(np.int32))
 
         elif self.modality == "audio" and isinstance(preprocessor, ProcessorMixin):
@@ -979,7 +1272,31 @@ class CoreMLConfig():
                 "Unable to generate dummy inputs for the model. Please provide a tokenizer or a preprocessor."
             )
 
-        if self.use_past:
+        if self.use_past and self.kv_cache_capacity is not None:
+            # A single token, written halfway into the cache.
+            position = np.array([self.kv_cache_capacity // 2], dtype=np.int64)
+            dummy_inputs["position"] = (position, position.astype(np.int32))
+
+            if not self.stateful:
+                shape = self.kv_cache_shape[1:]
+                for i in range(self.num_layers):
+                    dummy_inputs[f"past_key_values_{i}_key"] = (
+                        np.zeros(shape, dtype=np.float32), np.zeros(shape, dtype=np.float32)
+                    )
+                    dummy_inputs[f"past_key_values_{i}_value"] = (
+                        np.zeros(shape, dtype=np.float32), np.zeros(shape, dtype=np.float32)
+                    )
+
+        elif self.use_past and self.stateful:
+            # The past keys and values are in the model's state, only the attention mask
+            # covers the past tokens.
+            batch, sequence_length = dummy_inputs[input_ids_name][0].shape
+            past_key_values_length = min(sequence_length + 2, self.max_sequence_length - sequence_length)
+            if attention_mask_name in dummy_inputs:
+                attention_mask = np.ones((batch, sequence_length + past_key_values_length), dtype=np.int64)
+                dummy_inputs[attention_mask_name] = (attention_mask, attention_mask.astype(np.int32))
+
+        elif self.use_past and self.generation_step != "prefill":
             batch, sequence_length = dummy_inputs[input_ids_name][0].shape
 
             # Not using the same length for past_key_values
@@ -1028,6 +1345,113 @@ class CoreMLConfig():
 
         return self._convert_dummy_inputs_to_framework(dummy_inputs, framework)
 
+    def generate_inputs(
+        self,
+        preprocessor: Union["PreTrainedTokenizerBase", "ImageProcessingMixin", "ProcessorMixin"],
+        examples: Union[List[str], List["Image.Image"], List[np.ndarray]],
+        framework: Optional[TensorType] = None,
+    ) -> Mapping[str, Tuple[Any, Any]]:
+        """
+        Preprocess real examples, such as calibration data, into inputs for the original and the Core ML model.
+        This goes through the same steps as [`~coreml.config.CoreMLConfig.generate_dummy_inputs`], so the
+        Core ML values match the model's inputs.
+
+        Args:
+            preprocessor: ([`PreTrainedTokenizerBase`], [`ImageProcessingMixin`] or [`ProcessorMixin`]):
+                The preprocessor associated with this model configuration.
+            examples (`List[str]`, `List[PIL.Image.Image]` or `List[np.ndarray]`):
+                Texts for text models, images for vision models, or waveforms at the sampling rate of the
+                feature extractor for audio models.
+            framework (`TensorType`, *optional*, defaults to `None`):
+                The framework (PyTorch or TensorFlow) that the preprocessor will generate tensors for.
+
+        Returns:
+            `Mapping[str, Tuple[Any, Any]]` holding tuples containing the reference and Core ML values. The
+            examples are stacked along the first axis, except for Core ML image inputs, which are a list of
+            images.
+        """
+        from transformers.image_processing_utils import ImageProcessingMixin
+        from transformers.processing_utils import ProcessorMixin
+        from transformers.tokenization_utils_base import PreTrainedTokenizerBase
+
+        if self.use_past or self.seq2seq is not None:
+            raise ValueError("Preprocessing examples is not supported with `use_past` or for seq2seq models")
+
+        input_descs = self.inputs
+        inputs = {}
+
+        if (
+            self.modality == "text"
+            and isinstance(preprocessor, PreTrainedTokenizerBase)
+            and self.task != "multiple-choice"
+        ):
+            input_desc = input_descs["input_ids"]
+            max_length = self._get_max_sequence_length(input_desc, 64)
+
+            old_pad_token = preprocessor.pad_token
+            if old_pad_token is None:
+                preprocessor.pad_token = preprocessor.eos_token or preprocessor.unk_token
+
+            if isinstance(input_desc.sequence_length, list):
+                # Pad to the smallest bucket that fits the longest example. Longer examples are truncated to
+                # the largest bucket.
+                encoded = preprocessor(list(examples), truncation=True, max_length=max_length)
+                longest = max(len(input_ids) for input_ids in encoded["input_ids"])
+                length = min(bucket for bucket in input_desc.sequence_length if bucket >= longest)
+                encoded = preprocessor.pad(encoded, padding="max_length", max_length=length, return_tensors="np")
+            else:
+                # A fixed sequence length needs padding to the full length.
+                padding = "longest" if isinstance(input_desc.sequence_length, tuple) else "max_length"
+                encoded = preprocessor(
+                    list(examples), padding=padding, truncation=True, max_length=max_length, return_tensors="np"
+                )
+
+            if old_pad_token is None:
+                preprocessor.pad_token = old_pad_token
+
+            for name in ["input_ids", "attention_mask", "token_type_ids"]:
+                if name in input_descs and name in encoded:
+                    value = encoded[name].astype(np.int64)
+                    inputs[name] = (value, value.astype(np.int32))
+
+        elif (
+            self.modality == "vision"
+            and isinstance(preprocessor, ImageProcessingMixin)
+            and preprocessor.model_input_names[0] == "pixel_values"
+            and self.task != "masked-im"
+        ):
+            # The Core ML image input has a fixed size.
+            image_height, image_width = self._get_image_size(preprocessor)
+            images = [image.convert("RGB").resize((image_width, image_height), Image.BICUBIC) for image in examples]
+            inputs["pixel_values"] = self._preprocess_images(preprocessor, images, framework)
+
+        elif self.modality == "audio" and isinstance(preprocessor, ProcessorMixin):
+            feature_extractor = preprocessor.feature_extractor
+            name = "input_features" if "input_features" in input_descs else "input_values"
+            input_desc = input_descs[name]
+            max_length = self._get_max_sequence_length(input_desc, 200 if name == "input_features" else 50000)
+            padding = "longest" if isinstance(input_desc.sequence_length, tuple) else "max_length"
+
+            encoded = feature_extractor(
+                list(examples),
+                sampling_rate=feature_extractor.sampling_rate,
+                padding=padding,
+                truncation=True,
+                max_length=max_length,
+                return_attention_mask="attention_mask" in input_descs,
+                return_tensors="np",
+            )
+            value = encoded[name].astype(np.float32)
+            inputs[name] = (value, value)
+            if "attention_mask" in input_descs:
+                attention_mask = encoded["attention_mask"].astype(np.int64)
+                inputs["attention_mask"] = (attention_mask, attention_mask.astype(np.int32))
+
+        else:
+            raise ValueError(f"Unable to preprocess examples for modality '{self.modality}' and task '{self.task}'")
+
+        return self._convert_dummy_inputs_to_framework(inputs, framework)
+
     def _convert_dummy_inputs_to_framework(self, dummy_inputs, framework):
         if framework == TensorType.PYTORCH and is_torch_available():
             import torch
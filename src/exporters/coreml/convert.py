@@ -13,8 +13,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import itertools
 import json
-from typing import TYPE_CHECKING, List, Union, Mapping
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple, Union, Mapping
 
 import coremltools as ct
 from coremltools.converters.mil.frontend.torch.torch_op_registry import _TORCH_OPS_REGISTRY
@@ -26,7 +27,9 @@ from transformers.utils import (
     is_torch_available,
     is_tf_available,
 )
+from .compression import CompressionConfig, LinearQuantizationConfig, compress_weights
 from .config import CoreMLConfig
+from .memory import MemoryTracker, release_memory
 from ..utils import logging
 
 
@@ -37,9 +40,11 @@ if is_tf_available():
     from transformers.modeling_tf_utils import TFPreTrainedModel
 
 if TYPE_CHECKING:
+    from transformers.configuration_utils import PretrainedConfig
     from transformers.feature_extraction_utils import FeatureExtractionMixin
     from transformers.processing_utils import ProcessorMixin
     from transformers.tokenization_utils import PreTrainedTokenizer
+    from .cache import ExportCache, TraceStore
 
 
 logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
@@ -68,12 +73,12 @@ def set_multiarray_shape(node, shape):
         node.type.multiArrayType.shape.append(x)
 
 
-def get_labels_as_list(model):
+def get_labels_as_list(model_config):
     """Return the labels of a classifier model as a sorted list."""
     labels = []
-    for i in range(len(model.config.id2label)):
-        if i in model.config.id2label.keys():
-            labels.append(model.config.id2label[i])
+    for i in range(len(model_config.id2label)):
+        if i in model_config.id2label.keys():
+            labels.append(model_config.id2label[i])
     return labels
 
 
@@ -82,6 +87,38 @@ def is_image_std_same(preprocessor: "FeatureExtractionMixin") -> bool:
     return preprocessor.image_std[0] == preprocessor.image_std[1] == preprocessor.image_std[2]
 
 
+def get_batch_dim(config: CoreMLConfig) -> Union[int, ct.RangeDim, List[int]]:
+    """
+    Returns the batch dimension of the inputs: a fixed size, a `ct.RangeDim`, or a list of allowed sizes.
+    """
+    if config.batch_size is None:
+        return 1
+    elif isinstance(config.batch_size, tuple):
+        return ct.RangeDim(*config.batch_size)
+    else:
+        return config.batch_size
+
+
+def make_shape(shape, default_shape) -> Union[ct.Shape, ct.EnumeratedShapes]:
+    """
+    Creates the ct.Shape object for a list of dimensions. Each dimension is a fixed size, a `ct.RangeDim`,
+    or a list of allowed sizes. Lists turn the shape into `ct.EnumeratedShapes`, with one shape for every
+    combination of sizes.
+    """
+    if not any(isinstance(dim, list) for dim in shape):
+        if any(isinstance(dim, ct.RangeDim) for dim in shape):
+            default_shape = None
+        return ct.Shape(shape, default=default_shape)
+
+    if any(isinstance(dim, ct.RangeDim) for dim in shape):
+        raise ValueError(
+            "A list of batch sizes or sequence lengths cannot be combined with a range of sizes in the same input"
+        )
+
+    shapes = [list(dims) for dims in itertools.product(*[dim if isinstance(dim, list) else [dim] for dim in shape])]
+    return ct.EnumeratedShapes(shapes=shapes, default=list(default_shape))
+
+
 def get_shape(config, input_desc, dummy_input, axis=-1):
     """
     Returns the ct.Shape object for the given input.
@@ -90,17 +127,58 @@ def get_shape(config, input_desc, dummy_input, axis=-1):
     shape = list(default_shape)
 
     # Does the input shape need to be flexible?
-    if config.use_past:
-        #shape[0] = ct.RangeDim()  # batch size  #TODO
+    if config.use_past and config.kv_cache_capacity is not None:
+        # A fixed-size cache gets one token at a time, all shapes are fixed.
+        pass
+    elif config.generation_step is not None and input_desc.sequence_length is not None:
+        # Each generation step takes a fixed number of new tokens.
+        pass
+    elif config.generation_step == "decode":
+        # The attention mask covers at least one past token and the new token.
+        shape[axis] = ct.RangeDim(2, config.max_sequence_length)
+    elif config.use_past and config.stateful:
+        # The new tokens and the past tokens must fit in the key and value cache.
+        shape[axis] = ct.RangeDim(1, config.max_sequence_length)
+    elif config.use_past:
         shape[axis] = ct.RangeDim()
-        default_shape = None
     elif isinstance(input_desc.sequence_length, tuple):
         min_length, max_length = input_desc.sequence_length
-        #shape[0] = ct.RangeDim()  # batch size  #TODO
         shape[axis] = ct.RangeDim(min_length, max_length)
-        default_shape = None
+    elif isinstance(input_desc.sequence_length, list) and len(input_desc.sequence_length) > 1:
+        # Enumerated shapes, unlike ranges, can still run on the GPU and Neural Engine.
+        shape[axis] = list(input_desc.sequence_length)
+
+    if config.batch_size is not None:
+        shape[0] = get_batch_dim(config)
+
+    return make_shape(shape, default_shape)
 
-    return ct.Shape(shape, default=default_shape)
+
+def get_image_scale_and_bias(preprocessor: "FeatureExtractionMixin") -> Tuple[float, List[float]]:
+    """
+    Returns the scale and per-channel bias that turn pixel values between 0 and 255 into the normalized
+    values the model expects.
+    """
+    if hasattr(preprocessor, "image_mean"):
+        bias = [
+            -preprocessor.image_mean[0],
+            -preprocessor.image_mean[1],
+            -preprocessor.image_mean[2],
+        ]
+    else:
+        bias = [0.0, 0.0, 0.0]
+
+    # If the stddev values are all equal, they can be folded into `bias` and
+    # `scale`. If not, Wrapper will insert an additional division operation.
+    if hasattr(preprocessor, "image_std") and is_image_std_same(preprocessor):
+        bias[0] /= preprocessor.image_std[0]
+        bias[1] /= preprocessor.image_std[1]
+        bias[2] /= preprocessor.image_std[2]
+        scale = 1.0 / (preprocessor.image_std[0] * 255.0)
+    else:
+        scale = 1.0 / 255
+
+    return scale, bias
 
 
 def get_input_types(
@@ -142,8 +220,13 @@ def get_input_types(
 
         if attention_mask_name in input_descs:
             input_desc = input_descs[attention_mask_name]
+            if config.stateful or config.generation_step is not None:
+                # Also covers the past tokens, so it is longer than the input_ids.
+                attention_mask_shape = get_shape(config, input_desc, dummy_inputs[attention_mask_name])
+            else:
+                attention_mask_shape = shape
             input_types.append(
-                ct.TensorType(name=input_desc.name, shape=shape, dtype=np.int32)
+                ct.TensorType(name=input_desc.name, shape=attention_mask_shape, dtype=np.int32)
             )
         else:
             logger.info(f"Skipping {attention_mask_name} input")
@@ -158,12 +241,14 @@ def get_input_types(
 
         if "encoder_outputs" in input_descs:
             input_desc = input_descs["encoder_outputs"]
-            shape = list(dummy_inputs["encoder_outputs"][0].shape)
-            #shape[0] = ct.RangeDim()  # batch size  #TODO
+            default_shape = dummy_inputs["encoder_outputs"][0].shape
+            shape = list(default_shape)
+            if config.batch_size is not None:
+                shape[0] = get_batch_dim(config)
             # TODO: only disable if we are using fixed shapes (which could be part of the configuration)
             # shape[1] = ct.RangeDim()
             input_types.append(
-                ct.TensorType(name=input_desc.name, shape=ct.Shape(shape), dtype=np.float32)
+                ct.TensorType(name=input_desc.name, shape=make_shape(shape, default_shape), dtype=np.float32)
             )
 
         if config.seq2seq == "decoder" and "attention_mask" in input_descs:
@@ -186,14 +271,25 @@ def get_input_types(
                 ct.TensorType(name=input_desc.name, shape=shape, dtype=np.int32)
             )
 
-        if config.use_past:
+        if "position" in input_descs:
+            input_desc = input_descs["position"]
+            input_types.append(
+                ct.TensorType(name=input_desc.name, shape=dummy_inputs["position"][1].shape, dtype=np.int32)
+            )
+
+        if config.use_past and not config.stateful and config.generation_step != "prefill":
             # TODO: Temporarily disabled until we can solve the issue with encoder past key/values
             # name = "decoder_past_key_values" if config.seq2seq == "decoder" else "past_key_values"
             name = "past_key_values"
-            shape = list(dummy_inputs[f"{name}_0_key"][1].shape)
-            #shape[0] = ct.RangeDim()  # batch size  #TODO
-            shape[2] = ct.RangeDim(0, -1)
-            shape = ct.Shape(shape)
+            default_shape = dummy_inputs[f"{name}_0_key"][1].shape
+            shape = list(default_shape)
+            if config.batch_size is not None:
+                shape[0] = get_batch_dim(config)
+            if config.generation_step == "decode":
+                shape[2] = ct.RangeDim(1, config.max_sequence_length - 1)
+            elif config.kv_cache_capacity is None:
+                shape[2] = ct.RangeDim(0, -1)
+            shape = make_shape(shape, default_shape)
 
             for i in range(config.num_layers):
                 input_types.append(ct.TensorType(name=f"{name}_{i}_key", shape=shape))
@@ -213,43 +309,36 @@ def get_input_types(
 
 
     elif config.modality == "vision":
-        if hasattr(preprocessor, "image_mean"):
-            bias = [
-                -preprocessor.image_mean[0],
-                -preprocessor.image_mean[1],
-                -preprocessor.image_mean[2],
-            ]
-        else:
-            bias = [0.0, 0.0, 0.0]
-
-        # If the stddev values are all equal, they can be folded into `bias` and
-        # `scale`. If not, Wrapper will insert an additional division operation.
-        if hasattr(preprocessor, "image_std") and is_image_std_same(preprocessor):
-            bias[0] /= preprocessor.image_std[0]
-            bias[1] /= preprocessor.image_std[1]
-            bias[2] /= preprocessor.image_std[2]
-            scale = 1.0 / (preprocessor.image_std[0] * 255.0)
-        else:
-            scale = 1.0 / 255
-
         input_desc = input_descs["pixel_values"]
-        input_types.append(
-            ct.ImageType(
-                name=input_desc.name,
-                shape=dummy_inputs["pixel_values"][0].shape,
-                scale=scale,
-                bias=bias,
-                color_layout=input_desc.color_layout or "RGB",
-                channel_first=True,
+        if config.batch_size is not None:
+            # A Core ML image input holds a single image. A batch of images is passed as a tensor
+            # of RGB pixel values between 0 and 255, which Wrapper normalizes.
+            input_types.append(
+                ct.TensorType(
+                    name=input_desc.name,
+                    shape=get_shape(config, input_desc, dummy_inputs["pixel_values"]),
+                    dtype=np.float32,
+                )
+            )
+        else:
+            scale, bias = get_image_scale_and_bias(preprocessor)
+            input_types.append(
+                ct.ImageType(
+                    name=input_desc.name,
+                    shape=dummy_inputs["pixel_values"][0].shape,
+                    scale=scale,
+                    bias=bias,
+                    color_layout=input_desc.color_layout or "RGB",
+                    channel_first=True,
+                )
             )
-        )
 
         if config.task == "masked-im":
             input_desc = input_descs["bool_masked_pos"]
             input_types.append(
                 ct.TensorType(
                     name=input_desc.name,
-                    shape=dummy_inputs["bool_masked_pos"][0].shape,
+                    shape=get_shape(config, input_desc, dummy_inputs["bool_masked_pos"]),
                     dtype=np.int32
                 )
             )
@@ -271,14 +360,11 @@ def get_input_types(
             )
 
         if "attention_mask" in input_descs:
+            # Same batch size and sequence length as the audio input.
+            attn_shape = get_shape(config, input_desc, dummy_inputs["attention_mask"], axis=1)
             input_desc = input_descs["attention_mask"]
-            attn_shape = list(dummy_inputs["attention_mask"][0].shape)
-            if isinstance(shape.shape[1], ct.RangeDim):
-                #attn_shape[0] = shape.shape[0]  # batch size  #TODO
-                attn_shape[-1] = shape.shape[1]
-
             input_types.append(
-                ct.TensorType(name=input_desc.name, shape=ct.Shape(attn_shape), dtype=np.int32)
+                ct.TensorType(name=input_desc.name, shape=attn_shape, dtype=np.int32)
             )
         else:
             logger.info("Skipping attention_mask input")
@@ -286,6 +372,17 @@ def get_input_types(
     return input_types
 
 
+def get_state_types(config: CoreMLConfig) -> List[ct.StateType]:
+    """
+    Create the ct.StateType objects for the key and value cache of a stateful model. The names match the
+    buffers of the `Wrapper` module.
+    """
+    return [
+        ct.StateType(wrapped_type=ct.TensorType(shape=config.kv_cache_shape, dtype=np.float16), name=name)
+        for name in ["key_cache", "value_cache"]
+    ]
+
+
 if is_torch_available():
     import torch
 
@@ -296,10 +393,24 @@ if is_torch_available():
             self.model = model.eval()
             self.config = config
 
+            # The key and value cache of a stateful model. These buffers become Core ML state
+            # tensors that the model reads and updates in place.
+            if config.stateful:
+                self.register_buffer("key_cache", torch.zeros(config.kv_cache_shape))
+                self.register_buffer("value_cache", torch.zeros(config.kv_cache_shape))
+
         def forward(self, *all_inputs):
             remaining = len(all_inputs)
             inputs = all_inputs[0]
 
+            # A batch of images is a tensor of pixel values in RGB order. Normalize it the same
+            # way as Core ML does for an image input.
+            if self.config.modality == "vision" and self.config.batch_size is not None:
+                if self.config.inputs["pixel_values"].color_layout == "BGR":
+                    inputs = inputs.flip(1)
+                scale, bias = get_image_scale_and_bias(self.preprocessor)
+                inputs = inputs * scale + torch.tensor(bias).reshape(1, -1, 1, 1)
+
             # Core ML's image preprocessing does not allow a different scaling
             # factor for each color channel, so do this manually.
             if hasattr(self.preprocessor, "image_std") and not is_image_std_same(self.preprocessor):
@@ -321,7 +432,40 @@ if is_torch_available():
             # An encoder-decoder model first gets all the decoder past_key_values
             # tensors, followed by the encoder ones, but they get combined into the
             # same 4-tuples.
-            if self.config.use_past:
+            if self.config.kv_cache_capacity is not None:
+                # The cache has a fixed number of slots. The new token goes into the slot at its
+                # position, or with a sliding window, overwrites the oldest token once the cache
+                # is full. The model attends to all slots written so far, plus the new token.
+                capacity = self.config.kv_cache_capacity
+                position = all_inputs[1]
+                if self.config.stateful:
+                    key_cache, value_cache = self.key_cache, self.value_cache
+                else:
+                    key_cache = torch.stack(all_inputs[2::2])
+                    value_cache = torch.stack(all_inputs[3::2])
+
+                slot = position % capacity if self.config.kv_cache_sliding_window else position
+                slots = torch.arange(capacity)
+                written = (slots < position) & (slots != slot)
+                attention_mask = torch.cat([written, torch.ones(1, dtype=torch.bool)]).to(torch.int64)
+
+                model_kwargs["attention_mask"] = attention_mask.unsqueeze(0)
+                model_kwargs["position_ids"] = position.reshape(1, 1)
+                model_kwargs["past_key_values"] = [
+                    (key_cache[i], value_cache[i]) for i in range(self.config.num_layers)
+                ]
+                remaining = 1
+            elif self.config.stateful:
+                # The attention mask covers both the past tokens and the new ones.
+                past_length = all_inputs[1].shape[-1] - inputs.shape[-1]
+                past_key_values = []
+                for i in range(self.config.num_layers):
+                    past_key_values.append((
+                        self.key_cache[i, :, :, :past_length],
+                        self.value_cache[i, :, :, :past_length],
+                    ))
+                model_kwargs["past_key_values"] = past_key_values
+            elif self.config.use_past and self.config.generation_step != "prefill":
                 # TODO: Temporarily disabled until we can solve the issue with encoder past key/values
                 if False and self.config.seq2seq == "decoder":
                     num_decoder_layers = self.config.num_layers
@@ -375,7 +519,29 @@ if is_torch_available():
 
             # Unpack the output `past_key_values` into a single tuple.
             presents = ()
-            if self.config.use_past:
+            if self.config.kv_cache_capacity is not None:
+                # Scatter the key and value of the new token into its slot in the cache.
+                past_key_values = outputs[-1]
+                new_keys = torch.stack([past_key_values[i][0][:, :, -1:] for i in range(len(past_key_values))])
+                new_values = torch.stack([past_key_values[i][1][:, :, -1:] for i in range(len(past_key_values))])
+                index = slot.reshape(1, 1, 1, 1, 1).expand(new_keys.shape)
+                key_cache = torch.scatter(key_cache, 3, index, new_keys)
+                value_cache = torch.scatter(value_cache, 3, index, new_values)
+
+                if self.config.stateful:
+                    self.key_cache[:] = key_cache
+                    self.value_cache[:] = value_cache
+                else:
+                    for i in range(len(past_key_values)):
+                        presents = presents + (key_cache[i], value_cache[i])
+            elif self.config.stateful:
+                # Write the keys and values of the new tokens into the cache.
+                past_key_values = outputs[-1]
+                end = all_inputs[1].shape[-1]
+                for i in range(len(past_key_values)):
+                    self.key_cache[i, :, :, past_length:end] = past_key_values[i][0][:, :, past_length:]
+                    self.value_cache[i, :, :, past_length:end] = past_key_values[i][1][:, :, past_length:]
+            elif self.config.use_past:
                 if len(outputs) < 2:
                     raise ValueError("expected at least two output tensors, got one")
 
@@ -467,45 +633,101 @@ if is_torch_available():
             raise AssertionError(f"Cannot compute outputs for unknown task '{self.config.task}'")
 
 
-def export_pytorch(
+def _patch_torch_ops(config: CoreMLConfig) -> Dict[str, Any]:
+    """
+    Install the `patch_pytorch_ops` overrides of `config`. Returns the conversion ops they replaced, `None`
+    for ops that were not registered before.
+    """
+    patched_ops = config.patch_pytorch_ops()
+    restore_ops = {}
+    if patched_ops is not None:
+        for name, func in patched_ops.items():
+            logger.info(f"Patching PyTorch conversion '{name}' with {func}")
+            if name in _TORCH_OPS_REGISTRY:
+                restore_ops[name] = _TORCH_OPS_REGISTRY[name]
+                del _TORCH_OPS_REGISTRY[name]
+            else:
+                restore_ops[name] = None
+            _TORCH_OPS_REGISTRY[name] = func
+    return restore_ops
+
+
+def _restore_torch_ops(restore_ops: Dict[str, Any]):
+    for name, func in restore_ops.items():
+        if func is not None:
+            logger.info(f"Restoring PyTorch conversion op '{name}' to {func}")
+            _TORCH_OPS_REGISTRY[name] = func
+        elif name in _TORCH_OPS_REGISTRY:
+            del _TORCH_OPS_REGISTRY[name]
+
+
+def get_user_defined_metadata(model_config: "PretrainedConfig", config: CoreMLConfig, quantize: str) -> Dict[str, str]:
+    """
+    The metadata that describes where an exported model comes from and how it was exported.
+    """
+    user_defined_metadata = {
+        "co.huggingface.exporters.name": model_config.name_or_path,
+        "co.huggingface.exporters.task": config.task,
+        "co.huggingface.exporters.architecture": next(iter(model_config.architectures), ""),
+        "co.huggingface.exporters.framework": "pytorch",
+        "co.huggingface.exporters.precision": quantize,
+    }
+    if model_config.transformers_version:
+        user_defined_metadata["transformers_version"] = model_config.transformers_version
+    return user_defined_metadata
+
+
+def _apply_values_override(model: "PreTrainedModel", config: CoreMLConfig):
+    """Check if we need to override certain configuration items."""
+    if config.values_override is not None:
+        logger.info(f"Overriding {len(config.values_override)} configuration item(s)")
+        for override_config_key, override_config_value in config.values_override.items():
+            logger.info(f"\t- {override_config_key} -> {override_config_value}")
+            setattr(model.config, override_config_key, override_config_value)
+
+
+def trace_pytorch(
     preprocessor: Union["PreTrainedTokenizer", "FeatureExtractionMixin", "ProcessorMixin"],
     model: "PreTrainedModel",
     config: CoreMLConfig,
-    quantize: str = "float32",
-    compute_units: ct.ComputeUnit = ct.ComputeUnit.ALL,
-) -> ct.models.MLModel:
+    dummy_inputs: Optional[Mapping[str, Tuple]] = None,
+) -> "torch.jit.ScriptModule":
     """
-    Export a PyTorch model to Core ML format.
+    Create the TorchScript trace of the model that gets converted to Core ML.
+
+    The result can be passed to [`~coreml.convert.export`] using the `traced_model` argument, which skips
+    this step. That is useful for retrying a conversion that failed, for example after adding an override
+    to `patch_pytorch_ops`.
 
     Args:
         preprocessor ([`PreTrainedTokenizer`], [`FeatureExtractionMixin`] or [`ProcessorMixin`]):
             The preprocessor used for encoding the data.
         model ([`PreTrainedModel`]):
-            The model to export.
+            The model to trace.
         config ([`~coreml.config.CoreMLConfig`]):
             The Core ML configuration associated with the exported model.
-        quantize (`str`, *optional*, defaults to `"float32"`):
-            Quantization options. Possible values: `"float32"`, `"float16"`.
-        compute_units (`ct.ComputeUnit`, *optional*, defaults to `ct.ComputeUnit.ALL`):
-            Whether to optimize the model for CPU, GPU, and/or Neural Engine.
+        dummy_inputs (`Mapping[str, Tuple]`, *optional*):
+            The example inputs to trace with, as returned by `config.generate_dummy_inputs()`. These are
+            generated if not provided.
 
     Returns:
-        `ct.models.MLModel`: the Core ML model object
+        `torch.jit.ScriptModule`: the traced `Wrapper` module
     """
     if not issubclass(type(model), PreTrainedModel):
         raise ValueError(f"Cannot convert unknown model type: {type(model)}")
 
-    logger.info(f"Using framework PyTorch: {torch.__version__}")
-
-    # Check if we need to override certain configuration items
-    if config.values_override is not None:
-        logger.info(f"Overriding {len(config.values_override)} configuration item(s)")
-        for override_config_key, override_config_value in config.values_override.items():
-            logger.info(f"\t- {override_config_key} -> {override_config_value}")
-            setattr(model.config, override_config_key, override_config_value)
+    _apply_values_override(model, config)
 
     # Create dummy input data for doing the JIT trace.
-    dummy_inputs = config.generate_dummy_inputs(preprocessor, framework=TensorType.PYTORCH)
+    if dummy_inputs is None:
+        dummy_inputs = config.generate_dummy_inputs(preprocessor, framework=TensorType.PYTORCH)
+
+    return _trace_wrapper(preprocessor, model, config, dummy_inputs)
+
+
+def _trace_wrapper(preprocessor, model, config, dummy_inputs, memory_tracker=None):
+    if memory_tracker is None:
+        memory_tracker = MemoryTracker()
 
     # Put the inputs in the order from the config.
     example_input = [dummy_inputs[key][0] for key in list(config.inputs.keys())]
@@ -515,55 +737,120 @@ def export_pytorch(
     # Running the model once with gradients disabled prevents an error during JIT tracing
     # that happens with certain models such as LeViT. The error message is: "Cannot insert
     # a Tensor that requires grad as a constant."
-    with torch.no_grad():
-        dummy_output = wrapper(*example_input)
+    with memory_tracker.span("forward"), torch.no_grad():
+        wrapper(*example_input)
 
-    traced_model = torch.jit.trace(wrapper, example_input, strict=True)
+    # The outputs of the exported model are validated against the original model afterwards. Checking the
+    # trace here as well would trace the model a second time, which adds to the peak memory and, in
+    # PyTorch, leaves part of that memory behind.
+    with memory_tracker.span("jit_trace"):
+        traced_model = torch.jit.trace(wrapper, example_input, strict=True, check_trace=False)
 
-    # Run the traced PyTorch model to get the shapes of the output tensors.
-    with torch.no_grad():
-        example_output = traced_model(*example_input)
+    # Running the model filled the key and value cache, but a new model starts out empty.
+    if config.stateful:
+        traced_model.key_cache.zero_()
+        traced_model.value_cache.zero_()
 
-    if isinstance(example_output, (tuple, list)):
-        example_output = [x.numpy() for x in example_output]
-    else:
-        example_output = [example_output.numpy()]
+    return traced_model
 
-    convert_kwargs = {}
-    if not config.use_legacy_format:
-        convert_kwargs["compute_precision"] = ct.precision.FLOAT16 if quantize == "float16" else ct.precision.FLOAT32
 
-    # For classification models, add the labels into the Core ML model and
-    # designate it as the special "classifier" model type.
-    if config.is_classifier:
-        convert_kwargs['classifier_config'] = ct.ClassifierConfig(config.get_class_labels())
+def _trace_or_load(preprocessor, model, config, dummy_inputs, trace_store=None, memory_tracker=None):
+    if memory_tracker is None:
+        memory_tracker = MemoryTracker()
 
-    input_tensors = get_input_types(preprocessor, config, dummy_inputs)
+    if trace_store is not None:
+        with memory_tracker.span("trace_store"):
+            trace_key = trace_store.key_for(preprocessor, model, config, dummy_inputs)
+            traced_model = trace_store.get(trace_key)
+        if traced_model is not None:
+            logger.info(f"Using stored TorchScript trace {trace_key[:12]} from {trace_store.cache_dir}")
+            return traced_model
+
+    traced_model = _trace_wrapper(preprocessor, model, config, dummy_inputs, memory_tracker)
+    if trace_store is not None:
+        with memory_tracker.span("trace_store"):
+            trace_store.put(trace_key, traced_model)
+        logger.info(f"Stored TorchScript trace {trace_key[:12]} in {trace_store.cache_dir}")
+    return traced_model
 
-    patched_ops = config.patch_pytorch_ops()
-    restore_ops = {}
-    if patched_ops is not None:
-        for name, func in patched_ops.items():
-            logger.info(f"Patching PyTorch conversion '{name}' with {func}")
-            if name in _TORCH_OPS_REGISTRY:
-                restore_ops[name] = _TORCH_OPS_REGISTRY[name]
-                del _TORCH_OPS_REGISTRY[name]
-            _TORCH_OPS_REGISTRY[name] = func
 
-    mlmodel = ct.convert(
+def export_pytorch(
+    preprocessor: Union["PreTrainedTokenizer", "FeatureExtractionMixin", "ProcessorMixin"],
+    model: "PreTrainedModel",
+    config: CoreMLConfig,
+    quantize: str = "float32",
+    compute_units: ct.ComputeUnit = ct.ComputeUnit.ALL,
+    traced_model: Optional["torch.jit.ScriptModule"] = None,
+    trace_store: Optional["TraceStore"] = None,
+    compression: Optional[CompressionConfig] = None,
+    memory_tracker: Optional[MemoryTracker] = None,
+) -> ct.models.MLModel:
+    """
+    Export a PyTorch model to Core ML format.
+
+    Args:
+        preprocessor ([`PreTrainedTokenizer`], [`FeatureExtractionMixin`] or [`ProcessorMixin`]):
+            The preprocessor used for encoding the data.
+        model ([`PreTrainedModel`]):
+            The model to export.
+        config ([`~coreml.config.CoreMLConfig`]):
+            The Core ML configuration associated with the exported model.
+        quantize (`str`, *optional*, defaults to `"float32"`):
+            Quantization options. Possible values: `"float32"`, `"float16"`, `"int8"`, `"int4-block32"`,
+            `"int4-block64"`, `"int4-block128"`. The integer options quantize the weights after conversion and
+            compute in float16.
+        compute_units (`ct.ComputeUnit`, *optional*, defaults to `ct.ComputeUnit.ALL`):
+            Whether to optimize the model for CPU, GPU, and/or Neural Engine.
+        traced_model (`torch.jit.ScriptModule`, *optional*):
+            A trace of the model made by [`~coreml.convert.trace_pytorch`] with the same configuration.
+            If provided, the model is not traced again.
+        trace_store ([`~coreml.cache.TraceStore`], *optional*):
+            If provided, the trace is loaded from this store when available, and saved into it otherwise.
+        compression (`CompressionConfig`, *optional*):
+            If provided, the weights of the converted model are compressed with this method.
+        memory_tracker ([`~coreml.memory.MemoryTracker`], *optional*):
+            If provided, the peak memory of the `"trace"` phase and of the phases of
+            [`~coreml.convert.convert_traced_pytorch`], and the time spent in each step, is recorded in this
+            tracker.
+
+    Returns:
+        `ct.models.MLModel`: the Core ML model object
+    """
+    if not issubclass(type(model), PreTrainedModel):
+        raise ValueError(f"Cannot convert unknown model type: {type(model)}")
+
+    logger.info(f"Using framework PyTorch: {torch.__version__}")
+
+    _apply_values_override(model, config)
+
+    if memory_tracker is None:
+        memory_tracker = MemoryTracker()
+
+    # Create dummy input data for doing the JIT trace. When a trace is provided,
+    # these are still needed to describe the shapes of the Core ML inputs.
+    with memory_tracker.span("dummy_inputs"):
+        dummy_inputs = config.generate_dummy_inputs(preprocessor, framework=TensorType.PYTORCH)
+
+    if traced_model is None:
+        with memory_tracker.phase("trace"):
+            traced_model = _trace_or_load(preprocessor, model, config, dummy_inputs, trace_store, memory_tracker)
+
+    return convert_traced_pytorch(
+        preprocessor,
+        model.config,
+        config,
         traced_model,
-        inputs=input_tensors,
-        convert_to="neuralnetwork" if config.use_legacy_format else "mlprogram",
+        dummy_inputs,
+        quantize=quantize,
         compute_units=compute_units,
-        **convert_kwargs,
+        compression=compression,
+        memory_tracker=memory_tracker,
     )
 
-    if restore_ops is not None:
-        for name, func in restore_ops.items():
-            if func is not None:
-                logger.info(f"Restoring PyTorch conversion op '{name}' to {func}")
-                _TORCH_OPS_REGISTRY[name] = func
 
+def _describe_mlmodel(mlmodel, model_config, config, quantize):
+    # Names the inputs and outputs of a converted model after the configuration, and adds their
+    # descriptions and the metadata.
     spec = mlmodel._spec
 
     input_descs = config.inputs
@@ -575,15 +862,7 @@ def export_pytorch(
         if input_desc.is_optional:
             spec.description.input[i].type.isOptional = True
 
-    user_defined_metadata = {
-        "co.huggingface.exporters.name": model.name_or_path,
-        "co.huggingface.exporters.task": config.task,
-        "co.huggingface.exporters.architecture": next(iter(model.config.architectures), ""),
-        "co.huggingface.exporters.framework": "pytorch",
-        "co.huggingface.exporters.precision": quantize,
-    }
-    if model.config.transformers_version:
-        user_defined_metadata["transformers_version"] = model.config.transformers_version
+    user_defined_metadata = get_user_defined_metadata(model_config, config, quantize)
 
     if config.is_classifier:
         output_desc = output_descs["logits"]
@@ -597,14 +876,17 @@ def export_pytorch(
         mlmodel.output_description[output_desc.name] = output_desc.description
     else:
         for i, (key, output_desc) in enumerate(output_descs.items()):
-            if i < len(example_output):
+            if i < len(spec.description.output):
                 output = spec.description.output[i]
                 ct.utils.rename_feature(spec, output.name, output_desc.name, rename_inputs=False)
                 mlmodel.output_description[output_desc.name] = output_desc.description
 
         if config.task in ["object-detection", "semantic-segmentation", "token-classification"]:
-            labels = get_labels_as_list(model)
+            labels = get_labels_as_list(model_config)
             user_defined_metadata["classes"] = ",".join(labels)
+        elif config.batch_size is not None and config.task in ["image-classification", "text-classification"]:
+            # A batched model only outputs the probabilities, so keep the labels in the metadata.
+            user_defined_metadata["classes"] = ",".join(config.get_class_labels())
 
         if config.task == "semantic-segmentation":
             # Make the model available in Xcode's previewer.
@@ -616,11 +898,157 @@ def export_pytorch(
 
     spec.description.metadata.shortDescription = config.short_description
 
-    # Reload the model in case any input / output names were changed.
-    mlmodel = ct.models.MLModel(mlmodel._spec, weights_dir=mlmodel.weights_dir)
 
-    if config.use_legacy_format and quantize == "float16":
-        mlmodel = ct.models.neural_network.quantization_utils.quantize_weights(mlmodel, nbits=16)
+def convert_traced_pytorch(
+    preprocessor: Union["PreTrainedTokenizer", "FeatureExtractionMixin", "ProcessorMixin"],
+    model_config: "PretrainedConfig",
+    config: CoreMLConfig,
+    traced_model: "torch.jit.ScriptModule",
+    dummy_inputs: Mapping[str, Tuple],
+    quantize: str = "float32",
+    compute_units: ct.ComputeUnit = ct.ComputeUnit.ALL,
+    use_legacy_format: Optional[bool] = None,
+    minimum_deployment_target: Optional[ct.target] = None,
+    compression: Optional[CompressionConfig] = None,
+    memory_tracker: Optional[MemoryTracker] = None,
+) -> ct.models.MLModel:
+    """
+    Convert a TorchScript trace made by [`~coreml.convert.trace_pytorch`] to Core ML format.
+
+    This is the second half of [`~coreml.convert.export_pytorch`]. It only needs the model's configuration,
+    not the model itself, so the same trace can be converted several times with different options.
+
+    Args:
+        preprocessor ([`PreTrainedTokenizer`], [`FeatureExtractionMixin`] or [`ProcessorMixin`]):
+            The preprocessor used for encoding the data.
+        model_config ([`PretrainedConfig`]):
+            The configuration of the traced model.
+        config ([`~coreml.config.CoreMLConfig`]):
+            The Core ML configuration associated with the exported model.
+        traced_model (`torch.jit.ScriptModule`):
+            The trace of the model.
+        dummy_inputs (`Mapping[str, Tuple]`):
+            The example inputs the model was traced with, as returned by `config.generate_dummy_inputs()`.
+        quantize (`str`, *optional*, defaults to `"float32"`):
+            Quantization options. Possible values: `"float32"`, `"float16"`, `"int8"`, `"int4-block32"`,
+            `"int4-block64"`, `"int4-block128"`. The integer options quantize the weights after conversion and
+            compute in float16.
+        compute_units (`ct.ComputeUnit`, *optional*, defaults to `ct.ComputeUnit.ALL`):
+            Whether to optimize the model for CPU, GPU, and/or Neural Engine.
+        use_legacy_format (`bool`, *optional*):
+            Produce a NeuralNetwork model instead of an ML Program. Defaults to `config.use_legacy_format`.
+        minimum_deployment_target (`ct.target`, *optional*):
+            The oldest OS version the model must run on. Defaults to the coremltools default.
+        compression (`CompressionConfig`, *optional*):
+            If provided, the weights of the converted model are compressed with this method. Weights that
+            match `config.compression_exclude` are left alone.
+        memory_tracker ([`~coreml.memory.MemoryTracker`], *optional*):
+            If provided, the peak memory of the `"convert"`, `"finalize"` and `"compress"` phases, and the
+            time spent in each step, is recorded in this tracker.
+
+    Returns:
+        `ct.models.MLModel`: the Core ML model object
+    """
+    if use_legacy_format is None:
+        use_legacy_format = config.use_legacy_format
+
+    weight_quantization = LinearQuantizationConfig.from_quantize(quantize)
+    if weight_quantization is not None:
+        if compression is not None:
+            raise ValueError(f"Quantize option '{quantize}' cannot be combined with compression '{compression.name}'")
+        compression = weight_quantization
+
+    convert_kwargs = {}
+
+    # Core ML supports state tensors starting with iOS 18 / macOS 15, and only in ML Programs.
+    if config.stateful:
+        if use_legacy_format:
+            raise ValueError("Stateful models cannot use the legacy NeuralNetwork format")
+        if minimum_deployment_target is None:
+            minimum_deployment_target = ct.target.iOS18
+        elif minimum_deployment_target < ct.target.iOS18:
+            raise ValueError("Stateful models require a minimum deployment target of iOS18 / macOS15 or later")
+        convert_kwargs["states"] = get_state_types(config)
+
+    # The compressed weight formats only exist in ML Programs, and some need a newer OS.
+    if compression is not None:
+        if use_legacy_format:
+            raise ValueError("Weight compression is not supported with the legacy NeuralNetwork format")
+        if minimum_deployment_target is None or minimum_deployment_target < compression.minimum_deployment_target:
+            if minimum_deployment_target is not None:
+                raise ValueError(
+                    f"Compression '{compression.name}' requires a minimum deployment target of "
+                    f"{compression.minimum_deployment_target.name} or later"
+                )
+            minimum_deployment_target = compression.minimum_deployment_target
+
+    if not use_legacy_format:
+        convert_kwargs["compute_precision"] = ct.precision.FLOAT32 if quantize == "float32" else ct.precision.FLOAT16
+
+    # For classification models, add the labels into the Core ML model and
+    # designate it as the special "classifier" model type.
+    if config.is_classifier:
+        convert_kwargs['classifier_config'] = ct.ClassifierConfig(config.get_class_labels())
+
+    input_tensors = get_input_types(preprocessor, config, dummy_inputs)
+
+    # ML Programs can have more than one input with enumerated shapes starting with iOS 18 / macOS 15.
+    num_enumerated = sum(isinstance(input_tensor.shape, ct.EnumeratedShapes) for input_tensor in input_tensors)
+    if num_enumerated > 1 and not use_legacy_format:
+        if minimum_deployment_target is None:
+            minimum_deployment_target = ct.target.iOS18
+        elif minimum_deployment_target < ct.target.iOS18:
+            raise ValueError(
+                "Enumerated shapes on more than one input require a minimum deployment target of "
+                "iOS18 / macOS15 or later, or the legacy NeuralNetwork format"
+            )
+
+    if memory_tracker is None:
+        memory_tracker = MemoryTracker()
+
+    with memory_tracker.span("patch_ops"):
+        restore_ops = _patch_torch_ops(config)
+
+    # The model is loaded once it is finished, not here as well. The ops are restored even if the conversion
+    # fails, since the process may go on to convert other models.
+    try:
+        with memory_tracker.phase("convert"):
+            mlmodel = ct.convert(
+                traced_model,
+                inputs=input_tensors,
+                convert_to="neuralnetwork" if use_legacy_format else "mlprogram",
+                compute_units=compute_units,
+                minimum_deployment_target=minimum_deployment_target,
+                skip_model_load=True,
+                **convert_kwargs,
+            )
+    finally:
+        _restore_torch_ops(restore_ops)
+
+    with memory_tracker.span("describe"):
+        _describe_mlmodel(mlmodel, model_config, config, quantize)
+
+    # The converted model holds on to its MIL program, with a copy of the weights that are already saved
+    # in `weights_dir`. Free it before the model is reloaded.
+    mlmodel._mil_program = None
+    release_memory()
+
+    # Reload the model in case any input / output names were changed. When the weights are quantized or
+    # compressed next, only that model is loaded.
+    quantize_legacy = use_legacy_format and quantize == "float16"
+    with memory_tracker.phase("finalize"):
+        mlmodel = ct.models.MLModel(
+            mlmodel._spec,
+            weights_dir=mlmodel.weights_dir,
+            skip_model_load=quantize_legacy or compression is not None,
+        )
+
+        if quantize_legacy:
+            mlmodel = ct.models.neural_network.quantization_utils.quantize_weights(mlmodel, nbits=16)
+
+    if compression is not None:
+        with memory_tracker.phase("compress"):
+            mlmodel = compress_weights(mlmodel, config, compression)
 
     return mlmodel
 
@@ -631,6 +1059,11 @@ def export(
     config: CoreMLConfig,
     quantize: str = "float32",
     compute_units: ct.ComputeUnit = ct.ComputeUnit.ALL,
+    cache: Optional["ExportCache"] = None,
+    traced_model: Optional["torch.jit.ScriptModule"] = None,
+    trace_store: Optional["TraceStore"] = None,
+    compression: Optional[CompressionConfig] = None,
+    memory_tracker: Optional[MemoryTracker] = None,
 ) -> ct.models.MLModel:
     """
     Export a Pytorch or TensorFlow model to Core ML format.
@@ -643,9 +1076,27 @@ def export(
         config ([`~coreml.config.CoreMLConfig`]):
             The Core ML configuration associated with the exported model.
         quantize (`str`, *optional*, defaults to `"float32"`):
-            Quantization options. Possible values: `"float32"`, `"float16"`.
+            Quantization options. Possible values: `"float32"`, `"float16"`, `"int8"`, `"int4-block32"`,
+            `"int4-block64"`, `"int4-block128"`. The integer options quantize the weights after conversion and
+            compute in float16.
         compute_units (`ct.ComputeUnit`, *optional*, defaults to `ct.ComputeUnit.ALL`):
             Whether to optimize the model for CPU, GPU, and/or Neural Engine.
+        cache ([`~coreml.cache.ExportCache`], *optional*):
+            If provided, a model that was previously exported with the same weights, configuration and
+            options is loaded from this cache instead of being converted again. Newly exported models
+            are added to the cache.
+        traced_model (`torch.jit.ScriptModule`, *optional*):
+            A trace of the model made by [`~coreml.convert.trace_pytorch`] with the same configuration.
+            If provided, the conversion starts directly from this trace.
+        trace_store ([`~coreml.cache.TraceStore`], *optional*):
+            If provided, the TorchScript trace is loaded from this store when available, and saved into
+            it otherwise.
+        compression (`CompressionConfig`, *optional*):
+            If provided, the weights of the converted model are compressed with this method.
+        memory_tracker ([`~coreml.memory.MemoryTracker`], *optional*):
+            If provided, the peak memory of the `"trace"` phase and of the phases of
+            [`~coreml.convert.convert_traced_pytorch`], and the time spent in each step, is recorded in this
+            tracker.
 
     Returns:
         `ct.models.MLModel`: the Core ML model object
@@ -656,7 +1107,39 @@ def export(
             "Please install torch or tensorflow first."
         )
 
-    if is_torch_available() and issubclass(type(model), PreTrainedModel):
-        return export_pytorch(preprocessor, model, config, quantize, compute_units)
-    else:
+    if not (is_torch_available() and issubclass(type(model), PreTrainedModel)):
         raise ValueError(f"Cannot convert unknown model type: {type(model)}")
+
+    if memory_tracker is None:
+        memory_tracker = MemoryTracker()
+
+    if cache is not None:
+        with memory_tracker.span("export_cache"):
+            cache_key = cache.key_for(preprocessor, model, config, quantize, compute_units, compression)
+            mlmodel = cache.get(cache_key, compute_units)
+        if mlmodel is not None:
+            logger.info(f"Using cached Core ML model {cache_key[:12]} from {cache.cache_dir}")
+            return mlmodel
+
+    mlmodel = export_pytorch(
+        preprocessor,
+        model,
+        config,
+        quantize,
+        compute_units,
+        traced_model=traced_model,
+        trace_store=trace_store,
+        compression=compression,
+        memory_tracker=memory_tracker,
+    )
+
+    if cache is not None:
+        with memory_tracker.span("export_cache"):
+            cache.put(
+                cache_key,
+                mlmodel,
+                info={"model": model.name_or_path, "task": config.task, "quantize": quantize},
+            )
+        logger.info(f"Stored Core ML model {cache_key[:12]} in {cache.cache_dir}")
+
+    return mlmodel
@@ -0,0 +1,331 @@
+# coding=utf-8
+# Copyright 2022 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Read example inputs for a Core ML model from local files."""
+
+import collections
+import itertools
+import os
+import threading
+import wave
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, Mapping, Optional, Tuple, Union
+
+import numpy as np
+from transformers.utils import TensorType, is_vision_available
+
+from .config import CoreMLConfig
+from ..utils import logging
+
+
+if is_vision_available():
+    from PIL import Image
+
+if TYPE_CHECKING:
+    from transformers.image_processing_utils import ImageProcessingMixin
+    from transformers.processing_utils import ProcessorMixin
+    from transformers.tokenization_utils_base import PreTrainedTokenizerBase
+
+
+logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
+
+IMAGE_EXTENSIONS = [".bmp", ".gif", ".jpeg", ".jpg", ".png", ".tif", ".tiff", ".webp"]
+TEXT_EXTENSIONS = [".txt"]
+AUDIO_EXTENSIONS = [".wav"]
+
+_MODALITY_EXTENSIONS = {"text": TEXT_EXTENSIONS, "vision": IMAGE_EXTENSIONS, "audio": AUDIO_EXTENSIONS}
+
+
+def _allows_single_example(config: CoreMLConfig) -> bool:
+    if config.batch_size is None:
+        return True
+    if isinstance(config.batch_size, tuple):
+        return config.batch_size[0] <= 1
+    if isinstance(config.batch_size, list):
+        return 1 in config.batch_size
+    return config.batch_size == 1
+
+
+def _find_files(path: Path, extensions: List[str]) -> List[Path]:
+    """The files with one of the extensions: `path` itself, or the files in the directory and its subdirectories."""
+    if path.is_file():
+        return [path] if path.suffix.lower() in extensions else []
+    return sorted(p for p in path.rglob("*") if p.is_file() and p.suffix.lower() in extensions)
+
+
+def _read_text_lines(path: Path) -> Iterator[str]:
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield line
+
+
+def _read_image(path: Path) -> "Image.Image":
+    with Image.open(path) as image:
+        image.load()
+        return image
+
+
+def read_wav(path: Union[str, Path]) -> Tuple[np.ndarray, int]:
+    """
+    Read a PCM wav file. Returns the samples as a float32 array between -1 and 1, with the channels averaged
+    into one, and the sampling rate.
+    """
+    with wave.open(str(path), "rb") as f:
+        sample_width = f.getsampwidth()
+        num_channels = f.getnchannels()
+        sampling_rate = f.getframerate()
+        frames = f.readframes(f.getnframes())
+
+    if sample_width == 1:
+        samples = (np.frombuffer(frames, dtype=np.uint8).astype(np.float32) - 128) / 128
+    elif sample_width in [2, 4]:
+        dtype = np.int16 if sample_width == 2 else np.int32
+        samples = np.frombuffer(frames, dtype=dtype).astype(np.float32) / -np.iinfo(dtype).min
+    else:
+        raise ValueError(f"Unsupported sample width of {sample_width} bytes in {path}")
+
+    return samples.reshape(-1, num_channels).mean(axis=1), sampling_rate
+
+
+class CalibrationData:
+    """
+    Example inputs for a Core ML model, read from a directory of images for vision models, or of text files
+    for text models, in which every non-empty line is an example.
+
+    The files are read lazily, `batch_size` examples at a time, and preprocessed with
+    [`~coreml.config.CoreMLConfig.generate_inputs`]. Only one batch is held in memory, and the data can be
+    iterated over more than once, which reads the files again.
+
+    Args:
+        data_dir (`str` or `Path`):
+            Directory with the examples. Files in subdirectories are included.
+        config ([`~coreml.config.CoreMLConfig`]):
+            The Core ML configuration associated with the exported model.
+        preprocessor ([`PreTrainedTokenizerBase`] or [`ImageProcessingMixin`]):
+            The preprocessor used for encoding the data.
+        num_samples (`int`, *optional*, defaults to 128):
+            The maximum number of examples to use.
+        batch_size (`int`, *optional*, defaults to 8):
+            Number of examples that are read and preprocessed at the same time.
+    """
+
+    def __init__(
+        self,
+        data_dir: Union[str, Path],
+        config: CoreMLConfig,
+        preprocessor: Union["PreTrainedTokenizerBase", "ImageProcessingMixin"],
+        num_samples: int = 128,
+        batch_size: int = 8,
+    ):
+        self.data_dir = Path(data_dir)
+        if not self.data_dir.is_dir():
+            raise ValueError(f"Calibration data directory {self.data_dir} does not exist")
+        if config.modality not in ["text", "vision"]:
+            raise ValueError(f"Calibration data is not supported for modality '{config.modality}'")
+        if not _allows_single_example(config):
+            raise ValueError("Calibration data requires a model that accepts a single example per prediction")
+        if num_samples < 1 or batch_size < 1:
+            raise ValueError("num_samples and batch_size must be positive")
+
+        self.config = config
+        self.preprocessor = preprocessor
+        self.num_samples = num_samples
+        self.batch_size = batch_size
+
+        extensions = _MODALITY_EXTENSIONS[config.modality]
+        self.files = _find_files(self.data_dir, extensions)
+        if len(self.files) == 0:
+            raise ValueError(f"No files with extension {', '.join(extensions)} found in {self.data_dir}")
+
+    def fingerprint(self) -> Dict[str, Any]:
+        """Describe the data, for the export cache."""
+        return {
+            "files": [(path.relative_to(self.data_dir).as_posix(), path.stat().st_size, path.stat().st_mtime) for path in self.files],
+            "num_samples": self.num_samples,
+        }
+
+    def examples(self) -> Iterator[Union[str, "Image.Image"]]:
+        """The raw examples: lines of text, or images."""
+        def read_examples():
+            for path in self.files:
+                if self.config.modality == "text":
+                    yield from _read_text_lines(path)
+                else:
+                    yield _read_image(path)
+
+        return itertools.islice(read_examples(), self.num_samples)
+
+    def batches(self) -> Iterator[List[Union[str, "Image.Image"]]]:
+        """The raw examples, in lists of `batch_size`."""
+        examples = self.examples()
+        while True:
+            batch = list(itertools.islice(examples, self.batch_size))
+            if len(batch) == 0:
+                return
+            yield batch
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        """
+        The Core ML inputs for one example at a time, in the format of `mlmodel.predict()`.
+        """
+        num_examples = 0
+        for batch in self.batches():
+            inputs = self.config.generate_inputs(self.preprocessor, batch)
+            yield from split_coreml_inputs(self.config, inputs)
+            num_examples += len(batch)
+
+        logger.info(f"Read {num_examples} calibration examples from {self.data_dir}")
+
+
+class ValidationData:
+    """
+    Real examples to validate a Core ML model on: the non-empty lines of a text file or of a directory of text
+    files for text models, a directory of images for vision models, or a directory of wav files for audio
+    models.
+
+    A pool of threads decodes the files and preprocesses them with
+    [`~coreml.config.CoreMLConfig.generate_inputs`], `batch_size` examples at a time, while the models run on
+    the batches that are ready. No more than `num_workers + 2` batches are in memory at any time, however large
+    the data is: the one the models run on, and up to `num_workers + 1` that are being prepared or are ready.
+
+    Args:
+        path (`str` or `Path`):
+            File or directory with the examples. Files in subdirectories are included.
+        config ([`~coreml.config.CoreMLConfig`]):
+            The Core ML configuration associated with the exported model.
+        preprocessor ([`PreTrainedTokenizerBase`], [`ImageProcessingMixin`] or [`ProcessorMixin`]):
+            The preprocessor used for encoding the data.
+        num_samples (`int`, *optional*):
+            The maximum number of examples to use. Defaults to all of them.
+        batch_size (`int`, *optional*, defaults to 8):
+            Number of examples that are preprocessed, and run through the reference model, at the same time.
+        num_workers (`int`, *optional*):
+            Number of threads that decode and preprocess the examples. Defaults to the number of CPUs, up to 4.
+    """
+
+    def __init__(
+        self,
+        path: Union[str, Path],
+        config: CoreMLConfig,
+        preprocessor: Union["PreTrainedTokenizerBase", "ImageProcessingMixin", "ProcessorMixin"],
+        num_samples: Optional[int] = None,
+        batch_size: int = 8,
+        num_workers: Optional[int] = None,
+    ):
+        self.path = Path(path)
+        if not self.path.exists():
+            raise ValueError(f"Validation data {self.path} does not exist")
+        if config.modality not in _MODALITY_EXTENSIONS:
+            raise ValueError(f"Validation data is not supported for modality '{config.modality}'")
+        if config.use_past or config.seq2seq is not None:
+            raise ValueError("Validation data is not supported with `use_past` or for seq2seq models")
+        if not _allows_single_example(config):
+            raise ValueError("Validation data requires a model that accepts a single example per prediction")
+        if (num_samples is not None and num_samples < 1) or batch_size < 1:
+            raise ValueError("num_samples and batch_size must be positive")
+
+        self.config = config
+        self.preprocessor = preprocessor
+        self.num_samples = num_samples
+        self.batch_size = batch_size
+        self.num_workers = num_workers or min(4, os.cpu_count() or 1)
+
+        extensions = _MODALITY_EXTENSIONS[config.modality]
+        self.files = _find_files(self.path, extensions)
+        if len(self.files) == 0:
+            raise ValueError(f"No files with extension {', '.join(extensions)} found in {self.path}")
+
+        # Fast tokenizers can't be called from several threads at once.
+        self._preprocessor_lock = threading.Lock() if config.modality == "text" else None
+
+    def _raw_examples(self) -> Iterator[Union[str, Path]]:
+        """Lines of text, which are cheap to read, or the paths of the files to decode in the worker threads."""
+        if self.config.modality == "text":
+            examples = itertools.chain.from_iterable(_read_text_lines(path) for path in self.files)
+        else:
+            examples = iter(self.files)
+        return itertools.islice(examples, self.num_samples)
+
+    def _decode(self, example: Union[str, Path]) -> Union[str, "Image.Image", np.ndarray]:
+        if self.config.modality == "vision":
+            return _read_image(example)
+        if self.config.modality == "audio":
+            samples, sampling_rate = read_wav(example)
+            expected_rate = self.preprocessor.feature_extractor.sampling_rate
+            if sampling_rate != expected_rate:
+                raise ValueError(f"{example} is sampled at {sampling_rate} Hz, the model expects {expected_rate} Hz")
+            return samples
+        return example
+
+    def _prepare(
+        self, raw_batch: List[Union[str, Path]], framework: Optional[TensorType]
+    ) -> Mapping[str, Tuple[Any, Any]]:
+        examples = [self._decode(example) for example in raw_batch]
+        if self._preprocessor_lock is None:
+            return self.config.generate_inputs(self.preprocessor, examples, framework)
+        with self._preprocessor_lock:
+            return self.config.generate_inputs(self.preprocessor, examples, framework)
+
+    def batches(self, framework: Optional[TensorType] = None) -> Iterator[Mapping[str, Tuple[Any, Any]]]:
+        """
+        The preprocessed batches, in the order of the files, as returned by
+        [`~coreml.config.CoreMLConfig.generate_inputs`].
+        """
+        raw_examples = self._raw_examples()
+        executor = ThreadPoolExecutor(max_workers=self.num_workers, thread_name_prefix="validation-data")
+        pending = collections.deque()
+        num_examples = 0
+        try:
+            while True:
+                while len(pending) <= self.num_workers:
+                    raw_batch = list(itertools.islice(raw_examples, self.batch_size))
+                    if len(raw_batch) == 0:
+                        break
+                    pending.append(executor.submit(self._prepare, raw_batch, framework))
+                if len(pending) == 0:
+                    break
+                batch = pending.popleft().result()
+                num_examples += len(next(iter(batch.values()))[0])
+                yield batch
+        finally:
+            # Don't prepare the batches that are left when the caller stops early. `cancel_futures` of
+            # `shutdown` would do the same, but needs Python 3.9.
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+        logger.info(f"Read {num_examples} validation examples from {self.path}")
+
+
+def split_coreml_inputs(config: CoreMLConfig, inputs: Mapping[str, Tuple[Any, Any]]) -> List[Dict[str, Any]]:
+    """
+    Split the Core ML values of a batch of inputs, as returned by
+    [`~coreml.config.CoreMLConfig.generate_inputs`], into one `mlmodel.predict()` input per example.
+    """
+    input_descs = config.inputs
+    num_examples = len(next(iter(inputs.values()))[1])
+    samples = []
+    for i in range(num_examples):
+        sample = {}
+        for name, (_, coreml_value) in inputs.items():
+            # Image inputs hold one image, tensors keep their batch dimension.
+            if isinstance(coreml_value, list):
+                sample[input_descs[name].name] = coreml_value[i]
+            else:
+                sample[input_descs[name].name] = coreml_value[i : i + 1]
+        samples.append(sample)
+    return samples
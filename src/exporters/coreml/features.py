@@ -17,6 +17,7 @@ from functools import partial, reduce
 from typing import TYPE_CHECKING, Callable, Dict, Optional, Tuple, Type, Union
 
 from transformers import PretrainedConfig, is_tf_available, is_torch_available
+from transformers.utils import is_accelerate_available
 from .config import CoreMLConfig
 from ..utils import logging
 
@@ -449,7 +450,7 @@ class FeaturesManager:
 
     @staticmethod
     def get_model_from_feature(
-        feature: str, model: str, framework: str = "pt", cache_dir: str = None
+        feature: str, model: str, framework: str = "pt", cache_dir: str = None, low_cpu_mem_usage: bool = False
     ) -> Union["PreTrainedModel", "TFPreTrainedModel"]:
         """
         Attempts to retrieve a model from a model's name and the feature to be enabled.
@@ -461,14 +462,27 @@ class FeaturesManager:
                 The name of the model to export.
             framework (`str`, *optional*, defaults to `"pt"`):
                 The framework to use for the export.
+            low_cpu_mem_usage (`bool`, *optional*, defaults to `False`):
+                Load a PyTorch model without materializing it twice: the model is created on the meta device,
+                without allocating or initializing its weights, and the checkpoint is then loaded into it one
+                shard at a time. Safetensors checkpoints are memory-mapped. Requires Accelerate.
 
         Returns:
             The instance of the model.
 
         """
         model_class = FeaturesManager.get_model_class_for_feature(feature, framework)
+
+        load_kwargs = {}
+        if low_cpu_mem_usage:
+            if framework != "pt":
+                raise ValueError("low_cpu_mem_usage is only supported for PyTorch models")
+            if not is_accelerate_available():
+                raise ImportError("low_cpu_mem_usage requires Accelerate: `pip install accelerate`")
+            load_kwargs["low_cpu_mem_usage"] = True
+
         try:
-            model = model_class.from_pretrained(model, cache_dir=cache_dir, torchscript=True)
+            model = model_class.from_pretrained(model, cache_dir=cache_dir, torchscript=True, **load_kwargs)
         except OSError:
             if framework == "pt":
                 model = model_class.from_pretrained(model, from_tf=True, cache_dir=cache_dir)
@@ -0,0 +1,1034 @@
+# coding=utf-8
+# Copyright 2022 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Run the MIL program of an ML Program model with NumPy, to validate exported models without Core ML."""
+
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Union
+
+import coremltools as ct
+import numpy as np
+from coremltools.converters.mil.frontend.milproto.load import load as load_mil_program
+from coremltools.converters.mil.mil import types
+from coremltools.converters.mil.mil.ops.defs._utils import get_squeeze_axes, solve_slice_by_index_slice
+
+from ..utils import logging
+
+
+logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
+
+# The NumPy implementation of each MIL op, by op type. A kernel is called with the inputs of the op as
+# keyword arguments, and returns the output, or a tuple for ops with several outputs.
+_OP_KERNELS: Dict[str, Callable] = {}
+
+# Ops that read or write the state of a stateful model, which the interpreter runs itself.
+_STATE_OPS = ("read_state", "coreml_update_state")
+
+_FLOAT16_MAX = float(np.finfo(np.float16).max)
+
+# Color spaces of image inputs, from `ImageFeatureType.ColorSpace`.
+_GRAYSCALE = (10, 40)
+_BGR = 30
+
+
+def register_op_kernel(*op_types: str):
+    """Register a NumPy implementation of one or more MIL ops."""
+
+    def decorator(kernel):
+        for op_type in op_types:
+            _OP_KERNELS[op_type] = kernel
+        return kernel
+
+    return decorator
+
+
+def get_supported_ops() -> List[str]:
+    """The MIL ops that [`~coreml.interpreter.MILInterpreter`] can run."""
+    return sorted(list(_OP_KERNELS) + ["const"] + list(_STATE_OPS))
+
+
+def _sigmoid(x):
+    return 0.5 * (np.tanh(0.5 * x) + 1.0)
+
+
+def _erf(x):
+    # Abramowitz and Stegun 7.1.26, accurate to 1.5e-7, which is well below the float32 validation tolerances.
+    sign = np.sign(x)
+    x = np.abs(x)
+    t = 1.0 / (1.0 + 0.3275911 * x)
+    y = 1.0 - (((((1.061405429 * t - 1.453152027) * t) + 1.421413741) * t - 0.284496736) * t + 0.254829592) * t * np.exp(-x * x)
+    return (sign * y).astype(x.dtype, copy=False)
+
+
+def _normalize_axis(axis, rank):
+    axis = int(axis)
+    return axis + rank if axis < 0 else axis
+
+
+def _axes_tuple(axes, rank):
+    if axes is None:
+        return tuple(range(rank))
+    return tuple(_normalize_axis(axis, rank) for axis in np.atleast_1d(axes))
+
+
+def _normalize_indices(indices, size):
+    indices = np.asarray(indices).astype(np.int64)
+    return np.where(indices < 0, indices + size, indices)
+
+
+# Element-wise ops
+
+_UNARY_OPS = {
+    "abs": np.abs,
+    "acos": np.arccos,
+    "asin": np.arcsin,
+    "atan": np.arctan,
+    "atanh": np.arctanh,
+    "ceil": np.ceil,
+    "cos": np.cos,
+    "cosh": np.cosh,
+    "erf": _erf,
+    "exp": np.exp,
+    "exp2": np.exp2,
+    "floor": np.floor,
+    "identity": lambda x: x,
+    "logical_not": np.logical_not,
+    "relu": lambda x: np.maximum(x, 0),
+    "relu6": lambda x: np.clip(x, 0, 6),
+    "round": np.round,
+    "sigmoid": _sigmoid,
+    "sign": np.sign,
+    "silu": lambda x: x * _sigmoid(x),
+    "sin": np.sin,
+    "sinh": np.sinh,
+    "softplus": lambda x: np.logaddexp(x, 0),
+    "softsign": lambda x: x / (1 + np.abs(x)),
+    "sqrt": np.sqrt,
+    "square": np.square,
+    "tan": np.tan,
+    "tanh": np.tanh,
+}
+
+_BINARY_OPS = {
+    "add": np.add,
+    "equal": np.equal,
+    "floor_div": np.floor_divide,
+    "greater": np.greater,
+    "greater_equal": np.greater_equal,
+    "less": np.less,
+    "less_equal": np.less_equal,
+    "logical_and": np.logical_and,
+    "logical_or": np.logical_or,
+    "logical_xor": np.logical_xor,
+    "maximum": np.maximum,
+    "minimum": np.minimum,
+    "mod": np.mod,
+    "mul": np.multiply,
+    "not_equal": np.not_equal,
+    "pow": np.power,
+    "real_div": np.true_divide,
+    "sub": np.subtract,
+}
+
+for _op_type, _function in _UNARY_OPS.items():
+    register_op_kernel(_op_type)(lambda x, _function=_function: _function(x))
+
+for _op_type, _function in _BINARY_OPS.items():
+    register_op_kernel(_op_type)(lambda x, y, _function=_function: _function(x, y))
+
+
+@register_op_kernel("rsqrt")
+def _rsqrt(x, epsilon=1e-12):
+    return 1.0 / np.sqrt(x + epsilon)
+
+
+@register_op_kernel("inverse")
+def _inverse(x, epsilon=1e-4):
+    return 1.0 / (x + epsilon)
+
+
+@register_op_kernel("log")
+def _log(x, epsilon=1e-45):
+    return np.log(x + epsilon)
+
+
+@register_op_kernel("clip")
+def _clip(x, alpha, beta):
+    return np.minimum(np.maximum(x, alpha), beta)
+
+
+@register_op_kernel("elu")
+def _elu(x, alpha=1.0):
+    return np.where(x > 0, x, alpha * (np.exp(np.minimum(x, 0)) - 1))
+
+
+@register_op_kernel("leaky_relu")
+def _leaky_relu(x, alpha=0.01):
+    return np.where(x >= 0, x, alpha * x)
+
+
+@register_op_kernel("thresholded_relu")
+def _thresholded_relu(x, alpha=1.0):
+    return np.where(x > alpha, x, 0).astype(x.dtype, copy=False)
+
+
+@register_op_kernel("sigmoid_hard")
+def _sigmoid_hard(x, alpha=0.2, beta=0.5):
+    return np.clip(alpha * x + beta, 0, 1)
+
+
+@register_op_kernel("scaled_tanh")
+def _scaled_tanh(x, alpha=1.0, beta=1.0):
+    return alpha * np.tanh(beta * x)
+
+
+@register_op_kernel("linear_activation")
+def _linear_activation(x, alpha=1.0, beta=0.0):
+    return alpha * x + beta
+
+
+@register_op_kernel("prelu")
+def _prelu(x, alpha):
+    alpha = np.reshape(alpha, (1, -1) + (1,) * (x.ndim - 2))
+    return np.where(x >= 0, x, alpha * x)
+
+
+@register_op_kernel("gelu")
+def _gelu(x, mode="EXACT"):
+    if mode == "TANH_APPROXIMATION":
+        return 0.5 * x * (1 + np.tanh(np.sqrt(2 / np.pi) * (x + 0.044715 * x**3)))
+    elif mode == "SIGMOID_APPROXIMATION":
+        return x * _sigmoid(1.702 * x)
+    return 0.5 * x * (1 + _erf(x / np.sqrt(2).astype(x.dtype)))
+
+
+@register_op_kernel("softmax")
+def _softmax(x, axis=-1):
+    exp = np.exp(x - np.max(x, axis=axis, keepdims=True))
+    return exp / np.sum(exp, axis=axis, keepdims=True)
+
+
+@register_op_kernel("select")
+def _select(cond, a, b):
+    return np.where(cond, a, b)
+
+
+@register_op_kernel("cast")
+def _cast(x, dtype):
+    # Converting to the dtype of the output happens for every op.
+    return x
+
+
+# Reductions
+
+def _reduction(function):
+    def kernel(x, axes=None, keep_dims=False):
+        return function(x, axis=_axes_tuple(axes, x.ndim), keepdims=keep_dims)
+
+    return kernel
+
+
+for _op_type, _function in {
+    "reduce_sum": np.sum,
+    "reduce_mean": np.mean,
+    "reduce_max": np.max,
+    "reduce_min": np.min,
+    "reduce_prod": np.prod,
+    "reduce_l1_norm": lambda x, axis, keepdims: np.sum(np.abs(x), axis=axis, keepdims=keepdims),
+    "reduce_l2_norm": lambda x, axis, keepdims: np.sqrt(np.sum(x * x, axis=axis, keepdims=keepdims)),
+    "reduce_sum_square": lambda x, axis, keepdims: np.sum(x * x, axis=axis, keepdims=keepdims),
+    "reduce_log_sum": lambda x, axis, keepdims: np.log(np.sum(x, axis=axis, keepdims=keepdims)),
+    "reduce_log_sum_exp": lambda x, axis, keepdims: np.log(np.sum(np.exp(x), axis=axis, keepdims=keepdims)),
+}.items():
+    register_op_kernel(_op_type)(_reduction(_function))
+
+
+@register_op_kernel("reduce_argmax", "reduce_argmin")
+def _reduce_arg(x, axis=-1, keep_dims=False, output_dtype="int32", _op_type="reduce_argmax"):
+    function = np.argmax if _op_type == "reduce_argmax" else np.argmin
+    return function(x, axis=int(axis), keepdims=keep_dims)
+
+
+@register_op_kernel("cumsum")
+def _cumsum(x, axis=0, exclusive=False, reverse=False):
+    axis = int(axis)
+    if reverse:
+        x = np.flip(x, axis=axis)
+    result = np.cumsum(x, axis=axis)
+    if exclusive:
+        result = result - x
+    if reverse:
+        result = np.flip(result, axis=axis)
+    return result
+
+
+@register_op_kernel("topk")
+def _topk(x, k=1, axis=-1, ascending=False, sort=True, return_indices=True, output_indices_dtype="int32"):
+    axis = int(axis)
+    indices = np.argsort(x if ascending else -x, axis=axis, kind="stable")
+    indices = np.take(indices, np.arange(int(k)), axis=axis)
+    values = np.take_along_axis(x, indices, axis=axis)
+    return (values, indices) if return_indices else values
+
+
+@register_op_kernel("argsort")
+def _argsort(x, axis=-1, ascending=False):
+    return np.argsort(x if ascending else -x, axis=int(axis), kind="stable")
+
+
+# Linear algebra and normalization
+
+@register_op_kernel("matmul")
+def _matmul(x, y, transpose_x=False, transpose_y=False):
+    if transpose_x:
+        x = np.swapaxes(x, -1, -2)
+    if transpose_y:
+        y = np.swapaxes(y, -1, -2)
+    return np.matmul(x, y)
+
+
+@register_op_kernel("linear")
+def _linear(x, weight, bias=None):
+    result = np.matmul(x, weight.T)
+    if bias is not None:
+        result += bias
+    return result
+
+
+@register_op_kernel("einsum")
+def _einsum(values, equation):
+    return np.einsum(equation, *values)
+
+
+@register_op_kernel("layer_norm")
+def _layer_norm(x, axes=None, gamma=None, beta=None, epsilon=1e-5):
+    axes = _axes_tuple(axes, x.ndim)
+    mean = np.mean(x, axis=axes, keepdims=True)
+    centered = x - mean
+    variance = np.mean(centered * centered, axis=axes, keepdims=True)
+    result = centered / np.sqrt(variance + epsilon)
+    shape = [x.shape[i] if i in axes else 1 for i in range(x.ndim)]
+    if gamma is not None:
+        result = result * np.reshape(gamma, shape)
+    if beta is not None:
+        result = result + np.reshape(beta, shape)
+    return result
+
+
+@register_op_kernel("batch_norm")
+def _batch_norm(x, mean, variance, gamma=None, beta=None, epsilon=1e-5):
+    shape = (1, -1) + (1,) * (x.ndim - 2)
+    result = (x - np.reshape(mean, shape)) / np.sqrt(np.reshape(variance, shape) + epsilon)
+    if gamma is not None:
+        result = result * np.reshape(gamma, shape)
+    if beta is not None:
+        result = result + np.reshape(beta, shape)
+    return result
+
+
+@register_op_kernel("instance_norm")
+def _instance_norm(x, gamma=None, beta=None, epsilon=1e-5):
+    axes = tuple(range(2, x.ndim))
+    mean = np.mean(x, axis=axes, keepdims=True)
+    variance = np.var(x, axis=axes, keepdims=True)
+    return _batch_norm(x - mean, np.zeros(1, x.dtype), variance, gamma, beta, epsilon)
+
+
+# Shapes, slicing and indexing
+
+@register_op_kernel("reshape")
+def _reshape(x, shape):
+    # A 0 copies the size of that dimension of the input.
+    shape = [x.shape[i] if size == 0 else int(size) for i, size in enumerate(np.asarray(shape))]
+    return np.reshape(x, shape)
+
+
+@register_op_kernel("transpose")
+def _transpose(x, perm):
+    return np.transpose(x, [int(axis) for axis in perm])
+
+
+@register_op_kernel("expand_dims")
+def _expand_dims(x, axes):
+    return np.expand_dims(x, axis=tuple(int(axis) for axis in np.atleast_1d(axes)))
+
+
+@register_op_kernel("squeeze")
+def _squeeze(x, axes=None):
+    if axes is None:
+        return np.squeeze(x)
+    return np.squeeze(x, axis=_axes_tuple(axes, x.ndim))
+
+
+@register_op_kernel("shape")
+def _shape(x):
+    return np.array(x.shape, dtype=np.int32)
+
+
+@register_op_kernel("fill")
+def _fill(shape, value=0.0):
+    return np.full([int(size) for size in np.atleast_1d(shape)], value)
+
+
+@register_op_kernel("range_1d")
+def _range_1d(end, start, step):
+    return np.arange(start, end, step)
+
+
+@register_op_kernel("tile")
+def _tile(x, reps):
+    return np.tile(x, [int(rep) for rep in reps])
+
+
+@register_op_kernel("concat")
+def _concat(values, axis, interleave=False):
+    # Scalars, such as the sizes of dynamic shapes, are concatenated into a vector.
+    values = [np.atleast_1d(value) for value in values]
+    axis = _normalize_axis(axis, values[0].ndim)
+    if interleave:
+        stacked = np.stack(values, axis=axis + 1)
+        shape = list(values[0].shape)
+        shape[axis] *= len(values)
+        return np.reshape(stacked, shape)
+    return np.concatenate(values, axis=axis)
+
+
+@register_op_kernel("stack")
+def _stack(values, axis):
+    return np.stack(values, axis=int(axis))
+
+
+@register_op_kernel("split")
+def _split(x, num_splits=None, split_sizes=None, axis=0):
+    axis = int(axis)
+    if split_sizes is not None:
+        return tuple(np.split(x, np.cumsum(split_sizes)[:-1], axis=axis))
+    return tuple(np.split(x, int(num_splits), axis=axis))
+
+
+def _slices(x, begin, end, stride, begin_mask, end_mask, squeeze_mask):
+    return solve_slice_by_index_slice(
+        x.shape,
+        np.asarray(begin),
+        np.asarray(end),
+        None if stride is None else [int(step) for step in stride],
+        begin_mask,
+        end_mask,
+        squeeze_mask,
+    )
+
+
+@register_op_kernel("slice_by_index")
+def _slice_by_index(x, begin, end, stride=None, begin_mask=None, end_mask=None, squeeze_mask=None):
+    result = x[_slices(x, begin, end, stride, begin_mask, end_mask, squeeze_mask)]
+    squeeze_axes = get_squeeze_axes(squeeze_mask, x.ndim)
+    if len(squeeze_axes) > 0:
+        result = np.squeeze(result, axis=tuple(squeeze_axes))
+    return result
+
+
+@register_op_kernel("slice_update")
+def _slice_update(x, update, begin, end, stride=None, begin_mask=None, end_mask=None, squeeze_mask=None):
+    result = np.array(x, copy=True)
+    slices = _slices(x, begin, end, stride, begin_mask, end_mask, squeeze_mask)
+    result[slices] = np.reshape(update, result[slices].shape)
+    return result
+
+
+@register_op_kernel("slice_by_size")
+def _slice_by_size(x, begin, size):
+    return x[tuple(slice(int(b), None if s == -1 else int(b) + int(s)) for b, s in zip(begin, size))]
+
+
+@register_op_kernel("gather")
+def _gather(x, indices, axis=0, batch_dims=0, validate_indices=False):
+    axis = _normalize_axis(axis, x.ndim)
+    indices = _normalize_indices(indices, x.shape[axis])
+    batch_dims = int(batch_dims)
+    if batch_dims == 0:
+        return np.take(x, indices, axis=axis)
+
+    batch_shape = x.shape[:batch_dims]
+    flat_x = np.reshape(x, (-1,) + x.shape[batch_dims:])
+    flat_indices = np.reshape(indices, (-1,) + indices.shape[batch_dims:])
+    result = np.stack([np.take(flat_x[i], flat_indices[i], axis=axis - batch_dims) for i in range(len(flat_x))])
+    return np.reshape(result, batch_shape + result.shape[1:])
+
+
+@register_op_kernel("gather_nd")
+def _gather_nd(x, indices, batch_dims=0, validate_indices=False):
+    batch_dims = int(batch_dims)
+    indices = np.asarray(indices).astype(np.int64)
+    if batch_dims == 0:
+        return x[tuple(np.moveaxis(indices, -1, 0))]
+
+    batch_shape = x.shape[:batch_dims]
+    flat_x = np.reshape(x, (-1,) + x.shape[batch_dims:])
+    flat_indices = np.reshape(indices, (-1,) + indices.shape[batch_dims:])
+    result = np.stack([flat_x[i][tuple(np.moveaxis(flat_indices[i], -1, 0))] for i in range(len(flat_x))])
+    return np.reshape(result, batch_shape + result.shape[1:])
+
+
+@register_op_kernel("gather_along_axis")
+def _gather_along_axis(x, indices, axis=0, validate_indices=False):
+    axis = _normalize_axis(axis, x.ndim)
+    return np.take_along_axis(x, _normalize_indices(indices, x.shape[axis]), axis=axis)
+
+
+_SCATTER_UFUNCS = {
+    "add": np.add,
+    "sub": np.subtract,
+    "mul": np.multiply,
+    "div": np.true_divide,
+    "max": np.maximum,
+    "min": np.minimum,
+}
+
+
+def _scatter_at(result, index, updates, mode):
+    if mode == "update":
+        result[index] = updates
+    else:
+        _SCATTER_UFUNCS[mode].at(result, index, updates)
+
+
+@register_op_kernel("scatter")
+def _scatter(data, indices, updates, axis=0, mode="add", validate_indices=False):
+    axis = _normalize_axis(axis, data.ndim)
+    result = np.array(data, copy=True)
+    indices = _normalize_indices(indices, data.shape[axis])
+    # Moving the axis to the front gives a view, so the updates land in `result`.
+    _scatter_at(np.moveaxis(result, axis, 0), indices, np.moveaxis(updates, axis, 0), mode)
+    return result
+
+
+@register_op_kernel("scatter_along_axis")
+def _scatter_along_axis(data, indices, updates, axis=0, mode="add", validate_indices=False):
+    axis = _normalize_axis(axis, data.ndim)
+    result = np.array(data, copy=True)
+    index = list(np.indices(indices.shape, sparse=True))
+    index[axis] = _normalize_indices(indices, data.shape[axis])
+    _scatter_at(result, tuple(index), updates, mode)
+    return result
+
+
+@register_op_kernel("scatter_nd")
+def _scatter_nd(data, indices, updates, mode="add", validate_indices=False):
+    result = np.array(data, copy=True)
+    _scatter_at(result, tuple(np.moveaxis(np.asarray(indices).astype(np.int64), -1, 0)), updates, mode)
+    return result
+
+
+@register_op_kernel("band_part")
+def _band_part(x, lower=-1, upper=-1):
+    rows = np.arange(x.shape[-2])[:, None]
+    cols = np.arange(x.shape[-1])[None, :]
+    mask = np.ones((x.shape[-2], x.shape[-1]), dtype=bool)
+    if lower >= 0:
+        mask &= rows - cols <= lower
+    if upper >= 0:
+        mask &= cols - rows <= upper
+    return np.where(mask, x, 0).astype(x.dtype, copy=False)
+
+
+@register_op_kernel("pad")
+def _pad(x, pad, mode="constant", constant_val=0.0):
+    pad = [int(size) for size in pad]
+    pad_width = [(0, 0)] * (x.ndim - len(pad) // 2) + [(pad[i], pad[i + 1]) for i in range(0, len(pad), 2)]
+    if mode == "constant":
+        return np.pad(x, pad_width, mode="constant", constant_values=constant_val)
+    return np.pad(x, pad_width, mode="edge" if mode == "replicate" else mode)
+
+
+@register_op_kernel("pixel_shuffle")
+def _pixel_shuffle(x, upscale_factor):
+    factor = int(upscale_factor)
+    n, c, h, w = x.shape
+    x = np.reshape(x, (n, c // (factor * factor), factor, factor, h, w))
+    return np.reshape(np.transpose(x, (0, 1, 4, 2, 5, 3)), (n, c // (factor * factor), h * factor, w * factor))
+
+
+# Convolutions, pooling and resizing
+
+def _get_pads(input_shape, kernel_shape, strides, dilations, pad_type, pad):
+    """The `(begin, end)` padding of each spatial dimension."""
+    if pad_type == "valid":
+        return [(0, 0)] * len(input_shape)
+    if pad_type == "custom":
+        pad = [int(size) for size in pad]
+        return [(pad[2 * i], pad[2 * i + 1]) for i in range(len(input_shape))]
+
+    pads = []
+    for size, kernel, stride, dilation in zip(input_shape, kernel_shape, strides, dilations):
+        extent = (kernel - 1) * dilation + 1
+        total = max((-(-size // stride) - 1) * stride + extent - size, 0)
+        begin = total // 2 if pad_type == "same" else total - total // 2
+        pads.append((begin, total - begin))
+    return pads
+
+
+def _windows(x, kernel_shape, strides, dilations):
+    """Sliding windows over the spatial dimensions: `[N, C, *output_shape, *kernel_shape]`, as a view."""
+    num_spatial = len(kernel_shape)
+    spatial_axes = tuple(range(2, 2 + num_spatial))
+    extents = [(kernel - 1) * dilation + 1 for kernel, dilation in zip(kernel_shape, dilations)]
+    windows = np.lib.stride_tricks.sliding_window_view(x, extents, axis=spatial_axes)
+    index = (slice(None), slice(None))
+    index += tuple(slice(None, None, stride) for stride in strides)
+    index += tuple(slice(None, None, dilation) for dilation in dilations)
+    return windows[index]
+
+
+def _conv_nd(x, weight, strides, dilations, groups):
+    num_spatial = weight.ndim - 2
+    windows = _windows(x, weight.shape[2:], strides, dilations)
+    n, c = x.shape[:2]
+    output_shape = windows.shape[2 : 2 + num_spatial]
+    num_positions = int(np.prod(output_shape))
+    kernel_size = int(np.prod(weight.shape[2:]))
+
+    # [N, G, C/G, *output, *kernel] -> [N, G, positions, C/G * kernel]
+    windows = np.reshape(windows, (n, groups, c // groups) + windows.shape[2:])
+    order = (0, 1) + tuple(range(3, 3 + num_spatial)) + (2,) + tuple(range(3 + num_spatial, 3 + 2 * num_spatial))
+    columns = np.reshape(np.transpose(windows, order), (n, groups, num_positions, (c // groups) * kernel_size))
+
+    out_channels = weight.shape[0]
+    kernels = np.reshape(weight, (groups, out_channels // groups, (c // groups) * kernel_size))
+    result = np.matmul(columns, np.swapaxes(kernels, -1, -2)[None])
+    result = np.swapaxes(result, -1, -2)
+    return np.reshape(result, (n, out_channels) + tuple(output_shape))
+
+
+@register_op_kernel("conv")
+def _conv(x, weight, bias=None, strides=None, pad_type="valid", pad=None, dilations=None, groups=1):
+    num_spatial = weight.ndim - 2
+    strides = [1] * num_spatial if strides is None else [int(stride) for stride in strides]
+    dilations = [1] * num_spatial if dilations is None else [int(dilation) for dilation in dilations]
+    pads = _get_pads(x.shape[2:], weight.shape[2:], strides, dilations, pad_type, pad)
+    x = np.pad(x, [(0, 0), (0, 0)] + pads)
+
+    result = _conv_nd(x, weight, strides, dilations, int(groups))
+    if bias is not None:
+        result += np.reshape(bias, (1, -1) + (1,) * num_spatial)
+    return result
+
+
+@register_op_kernel("conv_transpose")
+def _conv_transpose(
+    x, weight, bias=None, pad=None, output_shape=None, pad_type="valid", strides=None, dilations=None, groups=1
+):
+    num_spatial = weight.ndim - 2
+    groups = int(groups)
+    strides = [1] * num_spatial if strides is None else [int(stride) for stride in strides]
+    dilations = [1] * num_spatial if dilations is None else [int(dilation) for dilation in dilations]
+    kernel_shape = weight.shape[2:]
+
+    # A transposed convolution is a convolution over the input with zeros inserted in between the values,
+    # padded all around, with the kernel flipped and its input and output channels swapped.
+    n, c = x.shape[:2]
+    spread_shape = [(size - 1) * stride + 1 for size, stride in zip(x.shape[2:], strides)]
+    spread = np.zeros((n, c) + tuple(spread_shape), dtype=x.dtype)
+    spread[(slice(None), slice(None)) + tuple(slice(None, None, stride) for stride in strides)] = x
+    full_pads = [((kernel - 1) * dilation,) * 2 for kernel, dilation in zip(kernel_shape, dilations)]
+    spread = np.pad(spread, [(0, 0), (0, 0)] + full_pads)
+
+    out_channels = weight.shape[1] * groups
+    kernels = np.reshape(weight, (groups, c // groups, weight.shape[1]) + kernel_shape)
+    kernels = np.swapaxes(kernels, 1, 2)[(Ellipsis,) + (slice(None, None, -1),) * num_spatial]
+    kernels = np.reshape(kernels, (out_channels, c // groups) + kernel_shape)
+    result = _conv_nd(spread, kernels, [1] * num_spatial, dilations, groups)
+
+    # Remove the padding from the full result.
+    full_shape = result.shape[2:]
+    if pad_type == "custom":
+        pad = [int(size) for size in pad]
+        begins = [pad[2 * i] for i in range(num_spatial)]
+        sizes = [full - pad[2 * i] - pad[2 * i + 1] for i, full in enumerate(full_shape)]
+    elif pad_type == "same":
+        sizes = [size * stride for size, stride in zip(x.shape[2:], strides)]
+        begins = [(full - size) // 2 for full, size in zip(full_shape, sizes)]
+    else:
+        begins = [0] * num_spatial
+        sizes = list(full_shape)
+    if output_shape is not None:
+        sizes = [int(size) for size in list(output_shape)[2:]]
+
+    # An output larger than the full result, from `output_padding`, only gets the bias at the end.
+    extra = [max(begin + size - full, 0) for begin, size, full in zip(begins, sizes, full_shape)]
+    if any(extra):
+        result = np.pad(result, [(0, 0), (0, 0)] + [(0, e) for e in extra])
+    result = result[(slice(None), slice(None)) + tuple(slice(b, b + s) for b, s in zip(begins, sizes))]
+    if bias is not None:
+        result = result + np.reshape(bias, (1, -1) + (1,) * num_spatial)
+    return result
+
+
+def _pool(x, kernel_sizes, strides, pad_type, pad, ceil_mode, pad_value):
+    """Sliding windows over the padded input, with the padding and the axes of the windows."""
+    num_spatial = len(kernel_sizes)
+    kernel_sizes = [int(size) for size in kernel_sizes]
+    strides = [1] * num_spatial if strides is None else [int(stride) for stride in strides]
+    pads = _get_pads(x.shape[2:], kernel_sizes, strides, [1] * num_spatial, pad_type, pad)
+    if ceil_mode:
+        # Pad the end so that a partial window at the end produces an output.
+        ceil_pads = []
+        for size, kernel, stride, (begin, end) in zip(x.shape[2:], kernel_sizes, strides, pads):
+            padded = size + begin + end
+            num_outputs = -(-(padded - kernel) // stride) + 1
+            ceil_pads.append((begin, end + max((num_outputs - 1) * stride + kernel - padded, 0)))
+        pads = ceil_pads
+    padded = np.pad(x, [(0, 0), (0, 0)] + pads, constant_values=pad_value)
+    windows = _windows(padded, kernel_sizes, strides, [1] * num_spatial)
+    return windows, pads, tuple(range(-num_spatial, 0))
+
+
+@register_op_kernel("max_pool")
+def _max_pool(x, kernel_sizes, strides=None, pad_type="valid", pad=None, ceil_mode=False):
+    windows, _, axes = _pool(x, kernel_sizes, strides, pad_type, pad, ceil_mode, -np.inf)
+    return np.max(windows, axis=axes)
+
+
+@register_op_kernel("avg_pool")
+def _avg_pool(
+    x, kernel_sizes, strides=None, pad_type="valid", pad=None, ceil_mode=False, exclude_padding_from_average=False
+):
+    windows, pads, axes = _pool(x, kernel_sizes, strides, pad_type, pad, ceil_mode, 0.0)
+    total = np.sum(windows, axis=axes)
+    if exclude_padding_from_average:
+        # Count the values of the input in each window by pooling ones the same way.
+        ones = np.ones((1, 1) + x.shape[2:], dtype=x.dtype)
+        counts, _, _ = _pool(ones, kernel_sizes, strides, pad_type, pad, ceil_mode, 0.0)
+        return total / np.sum(counts, axis=axes)
+    return total / float(np.prod([int(size) for size in kernel_sizes]))
+
+
+def _source_coordinates(input_size, output_size, align_corners, half_pixel_centers):
+    positions = np.arange(output_size, dtype=np.float64)
+    if align_corners:
+        spacing = (input_size - 1) / (output_size - 1) if output_size > 1 else 0.0
+        coordinates = positions * spacing
+    elif half_pixel_centers:
+        coordinates = (positions + 0.5) * input_size / output_size - 0.5
+    else:
+        coordinates = positions * input_size / output_size
+    return np.clip(coordinates, 0, input_size - 1)
+
+
+def _interpolate_axis(x, axis, coordinates):
+    low = np.floor(coordinates).astype(np.int64)
+    high = np.minimum(low + 1, x.shape[axis] - 1)
+    shape = [1] * x.ndim
+    shape[axis] = -1
+    weight = np.reshape(coordinates - low, shape).astype(x.dtype)
+    return np.take(x, low, axis=axis) * (1 - weight) + np.take(x, high, axis=axis) * weight
+
+
+@register_op_kernel("upsample_bilinear")
+def _upsample_bilinear(
+    x, scale_factor_height=1, scale_factor_width=1, align_corners=True, half_pixel_centers=None
+):
+    if half_pixel_centers is None:
+        half_pixel_centers = not align_corners
+    height, width = x.shape[-2:]
+    out_height, out_width = int(np.floor(height * scale_factor_height)), int(np.floor(width * scale_factor_width))
+    x = _interpolate_axis(x, -2, _source_coordinates(height, out_height, align_corners, half_pixel_centers))
+    return _interpolate_axis(x, -1, _source_coordinates(width, out_width, align_corners, half_pixel_centers))
+
+
+@register_op_kernel("resize_bilinear")
+def _resize_bilinear(x, target_size_height=1, target_size_width=1, sampling_mode="DEFAULT"):
+    height, width = x.shape[-2:]
+    align_corners = sampling_mode == "STRICT_ALIGN_CORNERS" or sampling_mode == "ALIGN_CORNERS"
+    half_pixel_centers = sampling_mode == "UNALIGN_CORNERS"
+    x = _interpolate_axis(x, -2, _source_coordinates(height, int(target_size_height), align_corners, half_pixel_centers))
+    return _interpolate_axis(x, -1, _source_coordinates(width, int(target_size_width), align_corners, half_pixel_centers))
+
+
+@register_op_kernel("upsample_nearest_neighbor")
+def _upsample_nearest_neighbor(x, scale_factor_height=1, scale_factor_width=1):
+    height, width = x.shape[-2:]
+    out_height, out_width = int(np.floor(height * scale_factor_height)), int(np.floor(width * scale_factor_width))
+    rows = np.minimum(np.floor(np.arange(out_height) * height / out_height).astype(np.int64), height - 1)
+    cols = np.minimum(np.floor(np.arange(out_width) * width / out_width).astype(np.int64), width - 1)
+    return np.take(np.take(x, rows, axis=-2), cols, axis=-1)
+
+
+# Classifier output
+
+@register_op_kernel("classify")
+def _classify(probabilities, classes):
+    probabilities = np.reshape(probabilities, -1)
+    label = classes[int(np.argmax(probabilities))]
+    return label, {name: float(probability) for name, probability in zip(classes, probabilities)}
+
+
+class InterpreterState:
+    """The values of the states of a stateful model, as created by [`~coreml.interpreter.MILInterpreter.make_state`]."""
+
+    def __init__(self, values: Dict[str, np.ndarray]):
+        self._values = values
+
+    def read_state(self, name: str) -> np.ndarray:
+        return np.array(self._values[name], copy=True)
+
+    def write_state(self, name: str, value: np.ndarray):
+        self._values[name] = np.array(value, dtype=self._values[name].dtype).reshape(self._values[name].shape)
+
+
+class MILInterpreter:
+    """
+    Runs an ML Program model with NumPy instead of Core ML, so that an export can be validated on Linux. It
+    has the same `predict()` and `make_state()` methods as `ct.models.MLModel`, and can be passed to
+    [`~coreml.validate.validate_model_outputs`] in its place.
+
+    The MIL program is loaded from the saved model, so the interpreter runs exactly what Core ML would run,
+    including compressed weights. Every op is computed in float32. Values that the program stores in float16
+    are rounded to float16 after each op, which emulates the precision of Core ML on the GPU and the Neural
+    Engine. The interpreter is slower than Core ML and doesn't support models in the NeuralNetwork format.
+
+    Args:
+        model (`ct.models.MLModel`, `str` or `Path`):
+            The model, or the path of an `.mlpackage`.
+        function_name (`str`, *optional*):
+            The function to run, for multifunction models. Defaults to the default function of the model.
+        emulate_float16 (`bool`, *optional*, defaults to `True`):
+            Round the float16 values of the program to float16. When `False`, everything stays in float32,
+            which separates the conversion errors from the loss of precision.
+    """
+
+    def __init__(
+        self,
+        model: Union[ct.models.MLModel, str, Path],
+        function_name: Optional[str] = None,
+        emulate_float16: bool = True,
+    ):
+        if not isinstance(model, ct.models.MLModel):
+            model = ct.models.MLModel(str(model), skip_model_load=True)
+
+        spec = model.get_spec()
+        if spec.WhichOneof("Type") != "mlProgram":
+            raise ValueError("Only models in the ML Program format can be run with the NumPy interpreter")
+
+        self._spec = spec
+        self.emulate_float16 = emulate_float16
+
+        description = spec.description
+        if function_name is None:
+            function_name = description.defaultFunctionName or "main"
+        for function_description in description.functions:
+            if function_description.name == function_name:
+                description = function_description
+        self.function_name = function_name
+
+        program = load_mil_program(spec, spec.specificationVersion, file_weights_dir=model.weights_dir)
+        if function_name not in program.functions:
+            raise ValueError(f"The model has no function named '{function_name}'")
+        function = program.functions[function_name]
+
+        self._image_inputs = {
+            feature.name: feature.type.imageType.colorSpace
+            for feature in description.input
+            if feature.type.WhichOneof("Type") == "imageType"
+        }
+        self._inputs = {}
+        self._states = {}
+        for name, var in function.inputs.items():
+            if types.is_state(var.sym_type):
+                self._states[name] = var.sym_type.wrapped_type()
+            else:
+                self._inputs[name] = var
+        self._output_vars = list(function.outputs)
+
+        self._constants = {}
+        self._steps = []
+        self._compile(function)
+
+    def _compile(self, function):
+        # Work out the constant values once, and the inputs of the ops that are computed on every prediction.
+        unsupported = set()
+        for op in function.operations:
+            if len(op.blocks) > 0:
+                unsupported.add(op.op_type)
+                continue
+
+            if op.op_type == "const" or op.op_type.startswith("constexpr_"):
+                values = op.outputs[0].val if op.op_type == "const" else op.materialized_val_inference()
+                if len(op.outputs) == 1:
+                    values = (values,)
+                for var, value in zip(op.outputs, values):
+                    self._constants[var.name] = self._from_var_value(var, value)
+                continue
+
+            if op.op_type not in _STATE_OPS and all(var.val is not None for var in op.outputs):
+                # Values known at conversion time, such as shapes of fixed size.
+                for var in op.outputs:
+                    self._constants[var.name] = self._from_var_value(var, var.val)
+                continue
+
+            if op.op_type not in _OP_KERNELS and op.op_type not in _STATE_OPS:
+                unsupported.add(op.op_type)
+                continue
+
+            params = {name: value for name, value in op.default_inputs().items() if value is not None}
+            dynamic = {}
+            for name, var in op.inputs.items():
+                if isinstance(var, (list, tuple)):
+                    if all(v.name in self._constants for v in var):
+                        params[name] = [self._constants[v.name] for v in var]
+                    else:
+                        dynamic[name] = [v.name for v in var]
+                elif types.is_state(var.sym_type):
+                    # The state is passed to `predict()`, not computed by the program.
+                    params["state_name"] = var.name
+                elif var.name in self._constants:
+                    params[name] = self._constants[var.name]
+                else:
+                    dynamic[name] = var.name
+            if op.op_type in ("reduce_argmax", "reduce_argmin"):
+                params["_op_type"] = op.op_type
+
+            self._steps.append((op.op_type, params, dynamic, op.outputs))
+
+        if len(unsupported) > 0:
+            raise NotImplementedError(
+                f"The NumPy interpreter doesn't support these ops yet: {', '.join(sorted(unsupported))}"
+            )
+
+        # Forget intermediate values as soon as the last op that uses them has run.
+        output_names = {var.name for var in self._output_vars}
+        last_use = {}
+        for index, (_, _, dynamic, _) in enumerate(self._steps):
+            for names in dynamic.values():
+                for name in names if isinstance(names, list) else [names]:
+                    last_use[name] = index
+        self._release_after = [[] for _ in self._steps]
+        for name, index in last_use.items():
+            if name not in output_names:
+                self._release_after[index].append(name)
+
+    def _from_var_value(self, var, value):
+        if types.is_tensor(var.sym_type) or types.is_scalar(var.sym_type):
+            value = np.asarray(value)
+            if value.dtype == np.float16:
+                # float16 values are kept in float32, which holds them exactly. The converter turns large
+                # constants, such as the minimum value of attention masks, into infinities when it stores
+                # them as float16. Saturating them keeps `0 * -inf` in the masks from becoming NaN.
+                value = np.clip(value.astype(np.float32), -_FLOAT16_MAX, _FLOAT16_MAX)
+            if value.ndim == 0:
+                # NumPy doesn't accept 0-d arrays for arguments such as `keepdims`, but does accept scalars.
+                value = value[()]
+        return value
+
+    def _to_var_dtype(self, var, value):
+        if not (types.is_tensor(var.sym_type) or types.is_scalar(var.sym_type)):
+            return value
+        dtype = var.dtype
+        if dtype == types.fp16:
+            value = np.asarray(value, dtype=np.float32)
+            if self.emulate_float16:
+                # Like Core ML, values too large for float16 saturate instead of becoming infinite.
+                value = np.clip(value, -_FLOAT16_MAX, _FLOAT16_MAX).astype(np.float16).astype(np.float32)
+            return value
+        return np.asarray(value, dtype=types.nptype_from_builtin(dtype))
+
+    def _convert_input(self, name: str, value: Any) -> np.ndarray:
+        if name in self._image_inputs:
+            color_space = self._image_inputs[name]
+            image = value.convert("L" if color_space in _GRAYSCALE else "RGB")
+            array = np.asarray(image, dtype=np.float32)
+            array = array[None, None] if array.ndim == 2 else np.transpose(array, (2, 0, 1))[None]
+            if color_space == _BGR:
+                array = array[:, ::-1]
+            value = array
+        return self._to_var_dtype(self._inputs[name], value)
+
+    def get_spec(self):
+        return self._spec
+
+    @property
+    def user_defined_metadata(self) -> Dict[str, str]:
+        return dict(self._spec.description.metadata.userDefined)
+
+    @property
+    def input_names(self) -> List[str]:
+        return list(self._inputs)
+
+    @property
+    def output_names(self) -> List[str]:
+        return [var.name for var in self._output_vars]
+
+    def make_state(self) -> InterpreterState:
+        """A new state for a stateful model, with all values zero."""
+        return InterpreterState(
+            {
+                name: np.zeros(state_type.get_shape(), dtype=types.nptype_from_builtin(state_type.get_primitive()))
+                for name, state_type in self._states.items()
+            }
+        )
+
+    def predict(self, data: Dict[str, Any], state: Optional[InterpreterState] = None) -> Dict[str, Any]:
+        """
+        Run the model on the given inputs: NumPy arrays, or PIL images for image inputs.
+
+        Args:
+            data (`Dict[str, Any]`):
+                The inputs by name.
+            state ([`~coreml.interpreter.InterpreterState`], *optional*):
+                The state of a stateful model, from `make_state()`. It is updated by the prediction.
+
+        Returns:
+            `Dict[str, Any]`: the outputs by name.
+        """
+        if len(self._states) > 0 and state is None:
+            raise ValueError("This model is stateful, pass a state from make_state()")
+        missing = [name for name in self._inputs if name not in data]
+        if len(missing) > 0:
+            raise ValueError(f"Missing inputs: {', '.join(missing)}")
+
+        values = dict(self._constants)
+        for name in self._inputs:
+            values[name] = self._convert_input(name, data[name])
+
+        for (op_type, params, dynamic, outputs), release in zip(self._steps, self._release_after):
+            kwargs = dict(params)
+            for name, value_names in dynamic.items():
+                if isinstance(value_names, list):
+                    kwargs[name] = [values[value_name] for value_name in value_names]
+                else:
+                    kwargs[name] = values[value_names]
+
+            if op_type == "read_state":
+                result = state.read_state(params["state_name"])
+            elif op_type == "coreml_update_state":
+                state.write_state(params["state_name"], kwargs["value"])
+                result = kwargs["value"]
+            else:
+                result = _OP_KERNELS[op_type](**kwargs)
+
+            if len(outputs) == 1:
+                values[outputs[0].name] = self._to_var_dtype(outputs[0], result)
+            else:
+                for var, value in zip(outputs, result):
+                    values[var.name] = self._to_var_dtype(var, value)
+
+            for name in release:
+                del values[name]
+
+        results = {}
+        for var in self._output_vars:
+            value = values[var.name]
+            if isinstance(value, np.ndarray) and var.dtype == types.fp16:
+                value = value.astype(np.float16)
+            results[var.name] = value
+        return results
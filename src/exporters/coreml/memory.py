@@ -0,0 +1,278 @@
+# coding=utf-8
+# Copyright 2022 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Measure the peak memory use and the duration of the phases and steps of an export."""
+
+import contextlib
+import ctypes
+import gc
+import sys
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Iterator, List, Optional
+
+from .cache import format_size
+from ..utils import logging
+
+
+logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
+
+
+def _read_proc_status(field: str) -> Optional[int]:
+    # Sizes in /proc/self/status are in kB.
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def get_memory_usage() -> Optional[int]:
+    """The resident memory of this process in bytes, or `None` where it can't be measured."""
+    return _read_proc_status("VmRSS")
+
+
+def get_peak_memory() -> Optional[int]:
+    """
+    The largest resident memory of this process in bytes since it started, or since the last call to
+    [`reset_peak_memory`] when that is supported. Returns `None` where it can't be measured.
+    """
+    peak = _read_proc_status("VmHWM")
+    if peak is not None:
+        return peak
+
+    try:
+        import resource
+    except ImportError:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, other systems kilobytes.
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def reset_peak_memory() -> bool:
+    """
+    Start measuring the peak memory again from the current resident memory. This is only supported on Linux.
+    Returns whether the peak was reset.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def release_memory():
+    """
+    Free unreachable objects, such as the reference cycles of a MIL program, and on Linux hand the freed heap
+    back to the operating system, so the resident memory only counts what is still in use.
+    """
+    gc.collect()
+    if sys.platform.startswith("linux"):
+        try:
+            ctypes.CDLL("libc.so.6").malloc_trim(0)
+        except (OSError, AttributeError):
+            # Not glibc.
+            pass
+
+
+def _format_peak(peak_memory: Optional[int]) -> str:
+    return "unknown" if peak_memory is None else format_size(peak_memory)
+
+
+@dataclass
+class MemoryPhase:
+    """
+    The memory use of one phase of an export.
+
+    Args:
+        name (`str`):
+            Name of the phase, for example `"load"`, `"trace"` or `"convert"`.
+        peak_memory (`int`, *optional*):
+            The largest resident memory during the phase in bytes. When the peak can't be reset, as on macOS,
+            this is the largest resident memory since the process started.
+        duration (`float`):
+            Seconds the phase took.
+        is_reset (`bool`):
+            Whether the peak was measured from the start of this phase.
+        peak_increase (`int`, *optional*):
+            How far the peak rose above the resident memory at the start of the phase, in bytes. This is the
+            memory the phase itself needed. Only known where the peak can be reset.
+    """
+
+    name: str
+    peak_memory: Optional[int]
+    duration: float
+    is_reset: bool
+    peak_increase: Optional[int] = None
+
+
+@dataclass
+class Span:
+    """
+    The time spent in one step of an export.
+
+    Args:
+        name (`str`):
+            Name of the step, for example `"dummy_inputs"`, `"jit_trace"` or `"save"`.
+        duration (`float`):
+            Total seconds spent in the step.
+        count (`int`):
+            How many times the step ran.
+    """
+
+    name: str
+    duration: float
+    count: int
+
+
+class ExportCallback:
+    """
+    Base class for objects that are notified as the phases and spans of an export begin and end, for example
+    to forward them to a monitoring system. Pass them to [`MemoryTracker`]. The methods do nothing by default.
+    """
+
+    def on_phase_begin(self, name: str):
+        pass
+
+    def on_phase_end(self, phase: MemoryPhase):
+        """Called with the measurement of this run of the phase, before it is merged with earlier runs."""
+        pass
+
+    def on_span_begin(self, name: str):
+        pass
+
+    def on_span_end(self, name: str, duration: float):
+        pass
+
+
+class LoggingCallback(ExportCallback):
+    """Logs how long each span took as it ends."""
+
+    def on_span_end(self, name: str, duration: float):
+        logger.info(f"{name} took {duration:.2f}s")
+
+
+class MemoryTracker:
+    """
+    Records the peak memory and the duration of the phases of an export, such as loading the model, tracing
+    and converting it. This makes it possible to size the machines that export large models.
+
+    Phases don't overlap. Within them, spans time the individual steps, such as generating the dummy
+    inputs or renaming the features, without measuring memory.
+
+    ```python
+    tracker = MemoryTracker()
+    with tracker.phase("load"):
+        model = ...
+    tracker.log_summary()
+    ```
+
+    Args:
+        callbacks (`List[ExportCallback]`, *optional*):
+            Objects to notify as phases and spans begin and end.
+    """
+
+    def __init__(self, callbacks: Optional[List[ExportCallback]] = None):
+        self.phases = OrderedDict()
+        self.spans = OrderedDict()
+        self.callbacks = list(callbacks) if callbacks is not None else []
+
+    def add_callback(self, callback: ExportCallback):
+        self.callbacks.append(callback)
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """Measure the peak memory of the code in the `with` block as the phase `name`."""
+        # What earlier phases left behind would otherwise count toward this one.
+        release_memory()
+        for callback in self.callbacks:
+            callback.on_phase_begin(name)
+        is_reset = reset_peak_memory()
+        start_memory = get_memory_usage()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            peak_memory = get_peak_memory()
+            duration = time.perf_counter() - start
+            peak_increase = None
+            if is_reset and peak_memory is not None and start_memory is not None:
+                peak_increase = max(peak_memory - start_memory, 0)
+            message = f"Peak memory during {name}: {_format_peak(peak_memory)}"
+            if peak_increase is not None:
+                message += f", {format_size(peak_increase)} above the start of the phase"
+            logger.info(message)
+
+            phase = MemoryPhase(name, peak_memory, duration, is_reset, peak_increase)
+            for callback in self.callbacks:
+                callback.on_phase_end(phase)
+
+            # A phase that runs more than once, such as converting the encoder and the decoder, is
+            # recorded with its largest peak and its total duration.
+            if name in self.phases:
+                previous = self.phases[name]
+                if previous.peak_memory is not None and peak_memory is not None:
+                    peak_memory = max(peak_memory, previous.peak_memory)
+                if previous.peak_increase is not None and peak_increase is not None:
+                    peak_increase = max(peak_increase, previous.peak_increase)
+                duration += previous.duration
+                is_reset = is_reset and previous.is_reset
+            self.phases[name] = MemoryPhase(name, peak_memory, duration, is_reset, peak_increase)
+
+    @contextlib.contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        """Time the code in the `with` block as the span `name`. Spans can be nested in phases and in each other."""
+        for callback in self.callbacks:
+            callback.on_span_begin(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            for callback in self.callbacks:
+                callback.on_span_end(name, duration)
+
+            if name in self.spans:
+                previous = self.spans[name]
+                self.spans[name] = Span(name, previous.duration + duration, previous.count + 1)
+            else:
+                self.spans[name] = Span(name, duration, 1)
+
+    @property
+    def peak_memory(self) -> Optional[int]:
+        """The largest peak memory of all phases."""
+        peaks = [phase.peak_memory for phase in self.phases.values() if phase.peak_memory is not None]
+        return max(peaks) if len(peaks) > 0 else None
+
+    def log_summary(self):
+        if len(self.phases) == 0:
+            return
+        summary = ", ".join(f"{phase.name} {_format_peak(phase.peak_memory)}" for phase in self.phases.values())
+        if not all(phase.is_reset for phase in self.phases.values()):
+            summary += " (peak since the process started)"
+        logger.info(f"Peak memory per phase: {summary}")
+
+    def log_spans(self):
+        """Log the time spent in each span, the slowest first."""
+        if len(self.spans) == 0:
+            return
+        spans = sorted(self.spans.values(), key=lambda span: span.duration, reverse=True)
+        lines = [f"\t- {span.name}: {span.duration:.2f}s" + (f" ({span.count} times)" if span.count > 1 else "") for span in spans]
+        logger.info("Time per step:\n" + "\n".join(lines))
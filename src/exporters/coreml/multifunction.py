@@ -0,0 +1,221 @@
+# coding=utf-8
+# Copyright 2022 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Export the prefill and decode steps of text generation as one multifunction Core ML model."""
+
+import json
+import tempfile
+from collections import OrderedDict
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Union
+
+import coremltools as ct
+
+from transformers.utils import TensorType, is_torch_available
+
+from .cache import format_size, get_path_size
+from .compression import CompressionConfig
+from .config import GENERATION_STEPS, CoreMLConfig
+from .convert import _apply_values_override, _trace_or_load, convert_traced_pytorch
+from ..utils import logging
+
+
+if is_torch_available():
+    from transformers.modeling_utils import PreTrainedModel
+
+if TYPE_CHECKING:
+    from transformers.feature_extraction_utils import FeatureExtractionMixin
+    from transformers.processing_utils import ProcessorMixin
+    from transformers.tokenization_utils import PreTrainedTokenizer
+
+    from .cache import TraceStore
+
+
+logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
+
+# The function that `MLModel(path)` loads when no function name is given.
+DEFAULT_FUNCTION_NAME = "decode"
+
+
+def get_generation_step_configs(
+    config: CoreMLConfig, prefill_length: Optional[int] = None
+) -> "OrderedDict[str, CoreMLConfig]":
+    """
+    The Core ML configurations of the prefill and decode steps of a text generation model, by function name.
+
+    Args:
+        config ([`~coreml.config.CoreMLConfig`]):
+            A configuration for the `"text-generation"` task with `use_past=True`.
+        prefill_length (`int`, *optional*):
+            The number of prompt tokens of the prefill step. Defaults to half of `config.max_sequence_length`.
+    """
+    if config.task != "text-generation" or not config.use_past:
+        raise ValueError("A multifunction model requires the text-generation task with `use_past=True`")
+
+    return OrderedDict(
+        (
+            step,
+            type(config)(
+                config._config,
+                task=config.task,
+                use_past=True,
+                batch_size=config.batch_size,
+                generation_step=step,
+                prefill_length=prefill_length,
+            ),
+        )
+        for step in GENERATION_STEPS
+    )
+
+
+def _describe_features(features) -> Dict[str, Optional[List[Union[int, List[int]]]]]:
+    # The shape of each input or output. A dimension that can vary is a [min, max] pair, where -1 is unbounded,
+    # and outputs whose shape depends on the inputs have no shape.
+    shapes = {}
+    for feature in features:
+        array_type = feature.type.multiArrayType
+        size_ranges = array_type.shapeRange.sizeRanges
+        if len(size_ranges) > 0:
+            shapes[feature.name] = [
+                size.lowerBound if size.lowerBound == size.upperBound else [size.lowerBound, size.upperBound]
+                for size in size_ranges
+            ]
+        else:
+            shapes[feature.name] = list(array_type.shape) or None
+    return shapes
+
+
+def _describe_function(config: CoreMLConfig, spec) -> Dict[str, Any]:
+    if config.generation_step == "prefill":
+        description = (
+            f"Processes a prompt of {config.prefill_length} tokens, padded and masked out with the attention "
+            "mask if shorter, and returns the logits and the keys and values for decoding."
+        )
+    else:
+        description = (
+            "Processes one new token after the past keys and values, and returns the logits and the keys and "
+            f"values including the new token. The attention mask covers the past and new tokens, at most "
+            f"{config.max_sequence_length}."
+        )
+    return {
+        "description": description,
+        "inputs": _describe_features(spec.description.input),
+        "outputs": _describe_features(spec.description.output),
+    }
+
+
+def export_multifunction(
+    preprocessor: Union["PreTrainedTokenizer", "FeatureExtractionMixin", "ProcessorMixin"],
+    model: "PreTrainedModel",
+    config: CoreMLConfig,
+    output: Union[str, Path],
+    quantize: str = "float32",
+    compute_units: ct.ComputeUnit = ct.ComputeUnit.ALL,
+    compression: Optional[CompressionConfig] = None,
+    prefill_length: Optional[int] = None,
+    trace_store: Optional["TraceStore"] = None,
+) -> "OrderedDict[str, CoreMLConfig]":
+    """
+    Export a text generation model as one multifunction ML Program with a `"prefill"` function, which
+    processes the prompt, and a `"decode"` function, which processes one token at a time using the keys and
+    values of the past tokens. Each function has fixed input shapes for its step, and the functions share
+    their weights, so the package is about as large as a single model. Multifunction models require
+    iOS 18 / macOS 15.
+
+    Load a function with `ct.models.MLModel(path, function_name="prefill")`. Without a function name,
+    `"decode"` is loaded. The `co.huggingface.exporters.functions` metadata field describes the inputs and
+    outputs of each function as JSON.
+
+    Args:
+        preprocessor ([`PreTrainedTokenizer`], [`FeatureExtractionMixin`] or [`ProcessorMixin`]):
+            The preprocessor used for encoding the data.
+        model ([`PreTrainedModel`]):
+            The model to export.
+        config ([`~coreml.config.CoreMLConfig`]):
+            A configuration for the `"text-generation"` task with `use_past=True`.
+        output (`str` or `Path`):
+            Where to save the `.mlpackage`.
+        quantize (`str`, *optional*, defaults to `"float32"`):
+            Quantization options, as for [`~coreml.convert.export`].
+        compute_units (`ct.ComputeUnit`, *optional*, defaults to `ct.ComputeUnit.ALL`):
+            Whether to optimize the model for CPU, GPU, and/or Neural Engine.
+        compression (`CompressionConfig`, *optional*):
+            If provided, the weights of both functions are compressed with this method before they are
+            combined.
+        prefill_length (`int`, *optional*):
+            The number of prompt tokens of the prefill step. Defaults to half of `config.max_sequence_length`.
+        trace_store ([`~coreml.cache.TraceStore`], *optional*):
+            If provided, the TorchScript traces are loaded from this store when available, and saved into
+            it otherwise.
+
+    Returns:
+        `OrderedDict[str, CoreMLConfig]`: the Core ML configuration of each function, by function name.
+    """
+    if not (is_torch_available() and issubclass(type(model), PreTrainedModel)):
+        raise ValueError(f"Cannot convert unknown model type: {type(model)}")
+    if config.use_legacy_format:
+        raise ValueError("Multifunction models cannot use the legacy NeuralNetwork format")
+
+    output = Path(output)
+    step_configs = get_generation_step_configs(config, prefill_length)
+
+    functions = {}
+    metadata = {}
+    with tempfile.TemporaryDirectory(dir=output.parent) as tmp_dir:
+        descriptor = ct.utils.MultiFunctionDescriptor()
+
+        for name, step_config in step_configs.items():
+            logger.info(f"Converting {name} function...")
+            _apply_values_override(model, step_config)
+            dummy_inputs = step_config.generate_dummy_inputs(preprocessor, framework=TensorType.PYTORCH)
+            traced_model = _trace_or_load(preprocessor, model, step_config, dummy_inputs, trace_store)
+
+            mlmodel = convert_traced_pytorch(
+                preprocessor,
+                model.config,
+                step_config,
+                traced_model,
+                dummy_inputs,
+                quantize=quantize,
+                compute_units=compute_units,
+                minimum_deployment_target=ct.target.iOS18,
+                compression=compression,
+            )
+            del traced_model
+
+            filename = Path(tmp_dir) / f"{name}.mlpackage"
+            mlmodel.save(filename.as_posix())
+            functions[name] = _describe_function(step_config, mlmodel.get_spec())
+            metadata = dict(mlmodel.user_defined_metadata)
+            short_description = mlmodel.short_description
+            del mlmodel
+
+            descriptor.add_function(filename.as_posix(), "main", name)
+            logger.info(f"Converted {name} function, {format_size(get_path_size(filename))}")
+
+        # Identical weights in the two functions are stored only once.
+        descriptor.default_function_name = DEFAULT_FUNCTION_NAME
+        combined = (Path(tmp_dir) / "combined.mlpackage").as_posix()
+        ct.utils.save_multifunction(descriptor, combined)
+
+        # The combined model has no metadata of its own.
+        mlmodel = ct.models.MLModel(combined, skip_model_load=True)
+        metadata["co.huggingface.exporters.functions"] = json.dumps(functions)
+        metadata["co.huggingface.exporters.default_function"] = DEFAULT_FUNCTION_NAME
+        mlmodel.user_defined_metadata.update(metadata)
+        mlmodel.short_description = short_description
+        mlmodel.save(output.as_posix())
+
+    logger.info(f"Saved multifunction model with functions {', '.join(functions)}, {format_size(get_path_size(output))}")
+    return step_configs
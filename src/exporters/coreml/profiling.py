@@ -0,0 +1,258 @@
+# coding=utf-8
+# Copyright 2022 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Profile an export with cProfile and tracemalloc."""
+
+import cProfile
+import io
+import os
+import pstats
+import sys
+import tracemalloc
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+from .cache import format_size
+from .memory import ExportCallback, MemoryPhase
+from ..utils import logging
+
+
+logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
+
+# The phases and spans after which the Python memory is recorded.
+SNAPSHOT_AFTER = ("trace", "convert", "save")
+
+# The packages that time is attributed to, in the order they are checked. Built-in functions are
+# recognized by name, for example "<built-in method torch._C._jit_pass_inline>".
+PROFILE_PACKAGES = ["exporters", "coremltools", "torch", "transformers", "numpy"]
+
+_EXPORTERS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def get_profile_dir(output: Union[str, Path]) -> Path:
+    """The profile of an export to `Model.mlpackage` is saved in the `Model.profile` folder next to it."""
+    output = Path(output)
+    return output.with_name(output.stem + ".profile")
+
+
+def _package_dirs() -> Dict[str, str]:
+    dirs = {"exporters": _EXPORTERS_DIR}
+    for name in PROFILE_PACKAGES[1:]:
+        module = sys.modules.get(name)
+        if module is not None and getattr(module, "__file__", None) is not None:
+            dirs[name] = os.path.dirname(os.path.abspath(module.__file__))
+    return dirs
+
+
+def get_function_package(filename: str, funcname: str, package_dirs: Optional[Dict[str, str]] = None) -> str:
+    """
+    The package a profiled function belongs to: one of `PROFILE_PACKAGES`, `"builtins"` for other built-in
+    functions, or `"other"`.
+    """
+    if package_dirs is None:
+        package_dirs = _package_dirs()
+
+    # cProfile reports built-in functions with the file "~".
+    if filename == "~":
+        for package in PROFILE_PACKAGES:
+            if package in funcname:
+                return package
+        return "builtins"
+
+    path = os.path.abspath(filename)
+    for package in PROFILE_PACKAGES:
+        package_dir = package_dirs.get(package)
+        if package_dir is not None and path.startswith(package_dir + os.sep):
+            return package
+    return "other"
+
+
+def get_time_by_package(stats: pstats.Stats) -> "OrderedDict[str, float]":
+    """
+    The time spent in the functions of each package, not counting the functions they call, the largest first.
+    """
+    package_dirs = _package_dirs()
+    times = {}
+    for (filename, _, funcname), (_, _, self_time, _, _) in stats.stats.items():
+        package = get_function_package(filename, funcname, package_dirs)
+        times[package] = times.get(package, 0.0) + self_time
+    return OrderedDict(sorted(times.items(), key=lambda item: item[1], reverse=True))
+
+
+def get_exporters_functions(stats: pstats.Stats, top_n: int) -> List[Tuple[str, int, float]]:
+    """
+    The functions of this package with the most time spent in them and in what they call, such as
+    `Wrapper.forward` and the patched conversion ops, as `(name, calls, seconds)`.
+    """
+    functions = []
+    for (filename, lineno, funcname), (_, num_calls, _, cumulative_time, _) in stats.stats.items():
+        if filename != "~" and os.path.abspath(filename).startswith(_EXPORTERS_DIR + os.sep):
+            name = f"{os.path.relpath(filename, _EXPORTERS_DIR)}:{lineno}({funcname})"
+            functions.append((name, num_calls, cumulative_time))
+    functions.sort(key=lambda function: function[2], reverse=True)
+    return functions[:top_n]
+
+
+@dataclass
+class MemorySnapshot:
+    """
+    The Python memory when a phase or step of the export ended, as traced by tracemalloc. Memory allocated by
+    PyTorch is not included, memory allocated by NumPy is.
+
+    Args:
+        name (`str`):
+            The phase or step after which the snapshot was taken.
+        path (`Path`):
+            Where the snapshot is saved, for `tracemalloc.Snapshot.load()`.
+        current_memory (`int`):
+            Bytes allocated when the snapshot was taken.
+        peak_memory (`int`):
+            The most bytes allocated at once since the previous snapshot, or on Python 3.8 since the profiler
+            started.
+        top_allocations (`List[str]`):
+            The lines of code that hold the most memory.
+    """
+
+    name: str
+    path: Path
+    current_memory: int
+    peak_memory: int
+    top_allocations: List[str]
+
+
+class ExportProfiler(ExportCallback):
+    """
+    Profiles an export with cProfile and tracemalloc. Pass it to the [`~coreml.memory.MemoryTracker`] of the
+    export and run the export in a `with profiler:` block. Afterwards, `profile_dir` contains:
+
+    - `export.pstats`: the cProfile statistics, to inspect with `python -m pstats` or a viewer such as snakeviz.
+    - `summary.txt`: the time spent in each package, the functions of this package that took the longest,
+      the slowest functions overall, and the Python memory at the phase boundaries.
+    - `after_<name>.snapshot`: tracemalloc snapshots taken when the phases or steps in `snapshot_after` end.
+
+    Both profilers slow the export down, so the durations are only meaningful relative to each other. Only
+    the main thread of this process is profiled, not worker processes.
+
+    Args:
+        profile_dir (`str` or `Path`):
+            Folder to save the profile in.
+        top_n (`int`, *optional*, defaults to 30):
+            The number of functions to list in the summary.
+        snapshot_after (`Tuple[str]`, *optional*, defaults to `("trace", "convert", "save")`):
+            The phases and spans after which a tracemalloc snapshot is taken.
+    """
+
+    def __init__(
+        self,
+        profile_dir: Union[str, Path],
+        top_n: int = 30,
+        snapshot_after: Tuple[str, ...] = SNAPSHOT_AFTER,
+    ):
+        self.profile_dir = Path(profile_dir)
+        self.top_n = top_n
+        self.snapshot_after = snapshot_after
+        self.snapshots = []
+        self.profiler = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        self.profile_dir.mkdir(parents=True, exist_ok=True)
+        self.snapshots = []
+        tracemalloc.start()
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+
+    def stop(self):
+        """Stop profiling and save the statistics and the summary."""
+        self.profiler.disable()
+        tracemalloc.stop()
+
+        stats_path = self.profile_dir / "export.pstats"
+        self.profiler.dump_stats(stats_path.as_posix())
+        with open(self.profile_dir / "summary.txt", "w") as f:
+            f.write(self.summary())
+        logger.info(f"Saved the profile in: {self.profile_dir}")
+
+    def on_phase_end(self, phase: MemoryPhase):
+        if phase.name in self.snapshot_after:
+            self.take_snapshot(phase.name)
+
+    def on_span_end(self, name: str, duration: float):
+        if name in self.snapshot_after:
+            self.take_snapshot(name)
+
+    def take_snapshot(self, name: str):
+        if not tracemalloc.is_tracing():
+            return
+
+        # The profiler keeps running, turning it off would lose track of the functions that are running.
+        # Taking the snapshot shows up as time spent in tracemalloc.
+
+        # A phase that runs more than once, such as converting the encoder and the decoder, gets numbered
+        # snapshots.
+        count = sum(snapshot.name == name for snapshot in self.snapshots)
+        filename = f"after_{name}.snapshot" if count == 0 else f"after_{name}_{count + 1}.snapshot"
+        path = self.profile_dir / filename
+        snapshot = tracemalloc.take_snapshot()
+        snapshot.dump(path.as_posix())
+
+        current_memory, peak_memory = tracemalloc.get_traced_memory()
+        # Python 3.8 can't reset the peak, it then holds the most bytes since tracing started.
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        top_allocations = [
+            f"{format_size(stat.size)} in {stat.count} blocks: {stat.traceback[0]}"
+            for stat in snapshot.statistics("lineno")[:10]
+        ]
+        self.snapshots.append(MemorySnapshot(name, path, current_memory, peak_memory, top_allocations))
+        logger.info(f"Python memory after {name}: {format_size(current_memory)}, peak {format_size(peak_memory)}")
+
+    def summary(self) -> str:
+        """The summary of the profile as text."""
+        stream = io.StringIO()
+        stats = pstats.Stats(self.profiler, stream=stream)
+        total_time = stats.total_tt
+
+        stream.write(f"Profile of the export: {total_time:.2f}s\n\n")
+
+        stream.write("Time spent in each package, not counting the functions it calls:\n")
+        for package, seconds in get_time_by_package(stats).items():
+            share = seconds / total_time if total_time > 0 else 0.0
+            stream.write(f"  {package:<14}{seconds:10.2f}s {share:7.1%}\n")
+
+        stream.write("\nFunctions of exporters, including the functions they call:\n")
+        for name, num_calls, seconds in get_exporters_functions(stats, self.top_n):
+            stream.write(f"  {seconds:10.2f}s {num_calls:8d} calls  {name}\n")
+
+        if len(self.snapshots) > 0:
+            stream.write("\nPython memory (tracemalloc, without PyTorch tensors):\n")
+            for snapshot in self.snapshots:
+                stream.write(
+                    f"  after {snapshot.name}: {format_size(snapshot.current_memory)}, peak "
+                    f"{format_size(snapshot.peak_memory)} ({snapshot.path.name})\n"
+                )
+                for allocation in snapshot.top_allocations:
+                    stream.write(f"    {allocation}\n")
+
+        stream.write("\nSlowest functions, not counting the functions they call:\n")
+        stats.sort_stats(pstats.SortKey.TIME).print_stats(self.top_n)
+        return stream.getvalue()
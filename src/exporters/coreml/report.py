@@ -0,0 +1,179 @@
+# coding=utf-8
+# Copyright 2022 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""A JSON report of an export: what was exported, how large it is, and where the time and memory went."""
+
+import json
+import platform
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Union
+
+import coremltools as ct
+import transformers
+from transformers.utils import is_torch_available
+
+from .. import __version__
+from .cache import get_path_size
+from .config import CoreMLConfig
+from .memory import MemoryPhase, MemoryTracker, Span
+
+
+if TYPE_CHECKING:
+    from transformers.modeling_utils import PreTrainedModel
+
+    from .compression import CompressionConfig
+    from .validate import ValidationResult
+
+
+def get_report_filename(output: Union[str, Path]) -> Path:
+    """The report of `Model.mlpackage` is `Model.report.json` in the same folder."""
+    output = Path(output)
+    return output.with_name(output.stem + ".report.json")
+
+
+def get_versions() -> Dict[str, str]:
+    """The versions of the packages that affect the result and the speed of an export."""
+    versions = {
+        "exporters": __version__,
+        "coremltools": ct.__version__,
+        "transformers": transformers.__version__,
+        "python": platform.python_version(),
+    }
+    if is_torch_available():
+        import torch
+
+        versions["torch"] = torch.__version__
+    return versions
+
+
+@dataclass
+class ExportReport:
+    """
+    Describes one exported model, for comparing exports across models, options and package versions.
+
+    Args:
+        model (`str`):
+            Name or path of the exported model.
+        task (`str`):
+            The task the model was exported for.
+        output (`str`):
+            Where the Core ML model was saved.
+        quantize (`str`):
+            The quantize option of the export.
+        compression (`str`, *optional*):
+            Name of the weight compression, if any.
+        num_parameters (`int`, *optional*):
+            Number of parameters of the PyTorch model.
+        package_size (`int`, *optional*):
+            Size of the saved Core ML model in bytes.
+        validation (`Dict[str, Any]`, *optional*):
+            The tolerance `"atol"` and the largest absolute difference `"max_error"` between the outputs of
+            the Core ML model and the PyTorch model, and the `"backend"` that ran the Core ML model, if the
+            model was validated. When it was validated on several samples, also the number of `"samples"` and
+            the metrics of each output in `"outputs"`.
+        phases (`List[MemoryPhase]`):
+            The duration and peak memory of each phase of the export.
+        spans (`List[Span]`):
+            The time spent in each step of the export.
+        versions (`Dict[str, str]`):
+            The versions of the packages used for the export.
+    """
+
+    model: str
+    task: str
+    output: str
+    quantize: str
+    compression: Optional[str] = None
+    num_parameters: Optional[int] = None
+    package_size: Optional[int] = None
+    validation: Optional[Dict[str, Any]] = None
+    phases: List[MemoryPhase] = field(default_factory=list)
+    spans: List[Span] = field(default_factory=list)
+    versions: Dict[str, str] = field(default_factory=get_versions)
+
+    @classmethod
+    def from_export(
+        cls,
+        model: "PreTrainedModel",
+        config: CoreMLConfig,
+        output: Union[str, Path],
+        memory_tracker: MemoryTracker,
+        quantize: str = "float32",
+        compression: Optional["CompressionConfig"] = None,
+        atol: Optional[float] = None,
+        max_error: Optional[float] = None,
+        validation_backend: Optional[str] = None,
+        validation_result: Optional["ValidationResult"] = None,
+    ) -> "ExportReport":
+        """
+        Builds the report of a model that was exported and saved to `output`.
+
+        Args:
+            model ([`PreTrainedModel`]):
+                The exported model.
+            config ([`~coreml.config.CoreMLConfig`]):
+                The Core ML configuration associated with the exported model.
+            output (`str` or `Path`):
+                Where the Core ML model was saved.
+            memory_tracker ([`~coreml.memory.MemoryTracker`]):
+                The tracker that was passed to [`~coreml.convert.export`] and
+                [`~coreml.validate.validate_model_outputs`].
+            quantize (`str`, *optional*, defaults to `"float32"`):
+                The quantize option of the export.
+            compression (`CompressionConfig`, *optional*):
+                The weight compression of the export.
+            atol (`float`, *optional*):
+                The tolerance the model was validated with.
+            max_error (`float`, *optional*):
+                The largest absolute difference found by validation. Leave out if the model wasn't validated.
+            validation_backend (`str`, *optional*):
+                What ran the model during validation, `"coreml"` or `"numpy"`.
+            validation_result ([`~coreml.validate.ValidationResult`], *optional*):
+                The metrics of validation on several samples.
+        """
+        validation = None
+        if max_error is not None:
+            validation = {"atol": atol, "max_error": max_error, "backend": validation_backend}
+            if validation_result is not None:
+                validation["samples"] = validation_result.num_samples
+                validation["outputs"] = validation_result.to_dict()["outputs"]
+
+        return cls(
+            model=model.name_or_path,
+            task=config.task,
+            output=Path(output).as_posix(),
+            quantize=quantize,
+            compression=compression.name if compression is not None else None,
+            num_parameters=model.num_parameters(),
+            package_size=get_path_size(output),
+            validation=validation,
+            phases=list(memory_tracker.phases.values()),
+            spans=list(memory_tracker.spans.values()),
+        )
+
+    @property
+    def duration(self) -> float:
+        """Total seconds of all phases."""
+        return sum(phase.duration for phase in self.phases)
+
+    def to_dict(self) -> Dict[str, Any]:
+        report = asdict(self)
+        report["duration"] = self.duration
+        return report
+
+    def save(self, path: Union[str, Path]):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+            f.write("\n")
@@ -13,20 +13,42 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import TYPE_CHECKING, Any, Dict, Iterable, List, Tuple, Union
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterable, List, Optional, Tuple, Union
 
 import coremltools as ct
 import numpy as np
+from coremltools.models.utils import _is_macos, _macos_version
 
 from transformers.utils import TensorType, is_torch_available
 from transformers.modeling_utils import PreTrainedModel
 
+from .cache import WEIGHTS_HASH_METADATA_KEY, ReferenceOutputStore, hash_model_weights
 from .config import CoreMLConfig
+from .data import ValidationData, split_coreml_inputs
+from .interpreter import MILInterpreter
+from .memory import MemoryTracker
 from ..utils import logging
 
 
 logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
 
+# What runs the exported model during validation. "auto" uses Core ML where it is available, and otherwise
+# the NumPy interpreter, which only supports ML Programs.
+VALIDATION_BACKENDS = ["auto", "coreml", "numpy"]
+
+# The percentiles of the relative error that multi-sample validation reports.
+RELATIVE_ERROR_PERCENTILES = (50, 90, 99)
+
+# Relative errors are counted in logarithmic bins, so that their percentiles can be computed over any number
+# of samples without keeping all the errors in memory. A percentile is reported as the upper edge of its bin,
+# which is at most 12% above the exact value.
+_RELATIVE_ERROR_BINS = np.logspace(-10, 2, 241)
+
+# The seed of the validation inputs whose reference outputs are kept in a `ReferenceOutputStore`.
+REFERENCE_OUTPUTS_SEED = 0
+
 
 def softmax(x, axis=-1):
     maxes = np.max(x, axis=axis, keepdims=True)
@@ -34,13 +56,66 @@ def softmax(x, axis=-1):
     return shifted_exp / shifted_exp.sum(axis=axis, keepdims=True)
 
 
+def get_validation_backend(
+    filename: Union[str, Path], backend: str = "auto", minimum_macos_version: Tuple[int, int] = (12, 0)
+) -> Optional[str]:
+    """
+    Chooses what runs a saved model during validation: `"coreml"`, `"numpy"`, or `None` when the model
+    can't be validated on this machine.
+
+    Args:
+        filename (`str` or `Path`):
+            The saved Core ML model.
+        backend (`str`, *optional*, defaults to `"auto"`):
+            One of `VALIDATION_BACKENDS`.
+        minimum_macos_version (`Tuple[int, int]`, *optional*, defaults to `(12, 0)`):
+            The macOS version Core ML needs to run the model.
+    """
+    if backend not in VALIDATION_BACKENDS:
+        raise ValueError(f"Unknown validation backend '{backend}', choose one of {VALIDATION_BACKENDS}")
+
+    macos_version = ".".join(str(number) for number in minimum_macos_version)
+    has_coreml = _is_macos() and _macos_version() >= minimum_macos_version
+    if backend == "coreml" or (backend == "auto" and has_coreml):
+        if not has_coreml:
+            logger.info(f"Skipping model validation, Core ML requires macOS {macos_version} or later")
+            return None
+        return "coreml"
+
+    if ct.utils.load_spec(Path(filename).as_posix()).WhichOneof("Type") != "mlProgram":
+        logger.info(
+            f"Skipping model validation, the NumPy interpreter only runs ML Programs and Core ML requires "
+            f"macOS {macos_version} or later"
+        )
+        return None
+    return "numpy"
+
+
+def load_validation_model(
+    filename: Union[str, Path], backend: str, function_name: Optional[str] = None
+) -> Union[ct.models.MLModel, MILInterpreter]:
+    """
+    Loads a saved model to validate with the backend chosen by [`~coreml.validate.get_validation_backend`].
+    Core ML runs the model on the CPU, which computes float16 models in float32, and so does the interpreter.
+    """
+    filename = Path(filename).as_posix()
+    if backend == "numpy":
+        logger.info("Running the model with the NumPy interpreter")
+        return MILInterpreter(filename, function_name=function_name, emulate_float16=False)
+    return ct.models.MLModel(filename, compute_units=ct.ComputeUnit.CPU_ONLY, function_name=function_name)
+
+
 def validate_model_outputs(
     config: CoreMLConfig,
     preprocessor: Union["PreTrainedTokenizer", "FeatureExtractionMixin", "ProcessorMixin"],
-    reference_model: Union["PreTrainedModel", "TFPreTrainedModel"],
-    mlmodel: ct.models.MLModel,
+    reference_model: Optional[Union["PreTrainedModel", "TFPreTrainedModel"]],
+    mlmodel: Union[ct.models.MLModel, MILInterpreter],
     atol: float,
-):
+    memory_tracker: Optional[MemoryTracker] = None,
+    reference_store: Optional[ReferenceOutputStore] = None,
+    weights_hash: Optional[str] = None,
+    load_reference_model: Optional[Callable[[], "PreTrainedModel"]] = None,
+) -> float:
     """
     Validate that the outputs from the base and exported model agree within some absolute tolerance.
 
@@ -49,31 +124,668 @@ def validate_model_outputs(
             The Core ML configuration associated with the exported model.
         preprocessor ([`PreTrainedTokenizer`], [`FeatureExtractionMixin`] or [`ProcessorMixin`]):
             The preprocessor used for encoding the data.
-        reference_model ([`PreTrainedModel`] or [`TFPreTrainedModel`]):
-            The model to export.
-        mlmodel (`ct.models.MLModel`):
-            The exported Core ML model.
+        reference_model ([`PreTrainedModel`] or [`TFPreTrainedModel`], *optional*):
+            The model to export. Can be `None` when `reference_store` holds its outputs.
+        mlmodel (`ct.models.MLModel` or [`~coreml.interpreter.MILInterpreter`]):
+            The exported Core ML model, or an interpreter running it.
         atol (`float`):
             Absolute tolerance. Differences larger than this value are considered problematic.
+        memory_tracker ([`~coreml.memory.MemoryTracker`], *optional*):
+            If provided, the time spent running the reference model and the Core ML model is recorded in
+            this tracker.
+        reference_store ([`~coreml.cache.ReferenceOutputStore`], *optional*):
+            Where to look up the outputs of the reference model before running it, and to store them after.
+            The inputs are then always generated from the same seed. Only PyTorch models, and not models with
+            a stateful or fixed-size cache, use the store.
+        weights_hash (`str`, *optional*):
+            The `hash_model_weights()` of the reference model, to look up its outputs. Defaults to the hash
+            in the metadata of `mlmodel`, or else the hash of `reference_model`.
+        load_reference_model (`Callable`, *optional*):
+            Loads the reference model when `reference_model` is `None` and its outputs are not in
+            `reference_store`.
+
+    Returns:
+        `float`: the largest absolute difference between the outputs of the two models.
     """
     logger.info("Validating Core ML model...")
 
-    input_descs = config.inputs
+    if memory_tracker is None:
+        memory_tracker = MemoryTracker()
+
+    get_reference_model = _reference_model_loader(reference_model, load_reference_model)
+
+    if config.kv_cache_capacity is not None or config.stateful:
+        reference_store = None
+    reference_store, weights_hash = _resolve_reference_store(
+        reference_store, weights_hash, reference_model, get_reference_model, mlmodel
+    )
+
+    if config.kv_cache_capacity is not None:
+        reference_model = get_reference_model()
+        return _validate_fixed_cache_model_outputs(
+            config, preprocessor, reference_model, mlmodel, atol, memory_tracker=memory_tracker
+        )
+
+    if config.stateful:
+        reference_model = get_reference_model()
+        return _validate_stateful_model_outputs(config, preprocessor, reference_model, mlmodel, atol, memory_tracker)
+
+    # A model with enumerated shapes is validated once for each sequence length it accepts,
+    # and a model with a flexible batch size at more than one batch size.
+    sequence_lengths = config.get_input_sequence_length(config.inputs)
+    if not isinstance(sequence_lengths, list):
+        sequence_lengths = [None]
+
+    max_error = 0.0
+    for batch_size in get_validation_batch_sizes(config):
+        for sequence_length in sequence_lengths:
+            if batch_size is not None:
+                logger.info(f"Validating batch size {batch_size}...")
+            if sequence_length is not None:
+                logger.info(f"Validating sequence length {sequence_length}...")
+            error = _validate_model_outputs(
+                config,
+                preprocessor,
+                get_reference_model,
+                mlmodel,
+                atol,
+                sequence_length,
+                batch_size,
+                memory_tracker,
+                reference_store,
+                weights_hash,
+            )
+            max_error = max(max_error, error)
+
+    return max_error
+
+
+def _reference_model_loader(reference_model, load_reference_model):
+    """Returns a function that gives the reference model, and loads it on first use when there is none."""
+
+    def get_reference_model():
+        nonlocal reference_model
+        if reference_model is None:
+            if load_reference_model is None:
+                raise ValueError("The reference outputs are not in the store, validation needs the reference model")
+            logger.info("Loading the reference model...")
+            reference_model = load_reference_model()
+        return reference_model
+
+    return get_reference_model
+
+
+def _resolve_reference_store(reference_store, weights_hash, reference_model, get_reference_model, mlmodel):
+    """Finds the weights hash that keys the reference outputs, or drops the store for non-PyTorch models."""
+    if reference_store is None:
+        return None, None
+    if reference_model is not None and _get_framework(reference_model) != TensorType.PYTORCH:
+        return None, None
+    if weights_hash is None:
+        weights_hash = mlmodel.user_defined_metadata.get(WEIGHTS_HASH_METADATA_KEY)
+    if weights_hash is None:
+        weights_hash = hash_model_weights(get_reference_model())
+    return reference_store, weights_hash
+
+
+def get_validation_batch_sizes(config: CoreMLConfig) -> List[Optional[int]]:
+    """
+    The batch sizes to validate the model with: the smallest and a larger one for a range of sizes,
+    every size for a list of sizes, or `[None]` when the model takes a single example.
+    """
+    if config.batch_size is None:
+        return [None]
+    elif isinstance(config.batch_size, tuple):
+        min_size, max_size = config.batch_size
+        larger_size = min_size + 3 if max_size == -1 else min(min_size + 3, max_size)
+        return sorted({min_size, larger_size})
+    elif isinstance(config.batch_size, list):
+        return list(config.batch_size)
+    else:
+        return [config.batch_size]
+
+
+@dataclass
+class OutputMetrics:
+    """
+    How much one output of the Core ML model differs from the reference model, over all validation samples.
+
+    Args:
+        name (`str`):
+            Name of the output in the Core ML configuration.
+        num_values (`int`):
+            Number of values compared.
+        max_abs_error (`float`):
+            Largest absolute difference.
+        mean_abs_error (`float`):
+            Average absolute difference.
+        relative_error (`Dict[str, float]`):
+            Percentiles of the absolute difference divided by the magnitude of the reference value, for
+            example `"p99"`. Reference values smaller than the tolerance are divided by the tolerance instead,
+            so that values close to zero don't dominate.
+        min_cosine_similarity (`float`):
+            Lowest cosine similarity between the reference and Core ML output of a sample.
+        mean_cosine_similarity (`float`):
+            Average cosine similarity of the samples.
+        top1_agreement (`float`, *optional*):
+            For probabilities and classifiers, the fraction of predictions where both models pick the same
+            class.
+        topk_agreement (`float`, *optional*):
+            The fraction of predictions where the class picked by the reference model is among the `top_k`
+            classes of the Core ML model.
+    """
+
+    name: str
+    num_values: int
+    max_abs_error: float
+    mean_abs_error: float
+    relative_error: Dict[str, float]
+    min_cosine_similarity: float
+    mean_cosine_similarity: float
+    top1_agreement: Optional[float] = None
+    topk_agreement: Optional[float] = None
+
+
+class _OutputMetricsAccumulator:
+    """Collects the metrics of an output one batch of samples at a time."""
+
+    def __init__(self, name: str, atol: float, top_k: int):
+        self.name = name
+        self.atol = atol
+        self.top_k = top_k
+        self.num_values = 0
+        self.max_abs_error = 0.0
+        self.sum_abs_error = 0.0
+        self.max_relative_error = 0.0
+        self.histogram = np.zeros(len(_RELATIVE_ERROR_BINS) + 1, dtype=np.int64)
+        self.num_samples = 0
+        self.min_cosine_similarity = 1.0
+        self.sum_cosine_similarity = 0.0
+        self.num_predictions = 0
+        self.num_top1 = 0
+        self.num_topk = 0
+        self.within_tolerance = True
+
+    def update(self, ref_value: np.ndarray, coreml_value: np.ndarray, class_axis: Optional[int] = None):
+        """
+        Adds a batch of outputs, with the samples along the first axis. With `class_axis`, the outputs are
+        scores for the classes along that axis.
+        """
+        ref_value = np.asarray(ref_value, dtype=np.float32)
+        coreml_value = np.asarray(coreml_value, dtype=np.float32)
+        self.within_tolerance &= bool(np.allclose(ref_value, coreml_value, atol=self.atol))
+
+        abs_error = np.abs(ref_value - coreml_value)
+        relative_error = abs_error / np.maximum(np.abs(ref_value), self.atol)
+        self.num_values += abs_error.size
+        self.max_abs_error = max(self.max_abs_error, float(np.max(abs_error, initial=0.0)))
+        self.sum_abs_error += float(np.sum(abs_error, dtype=np.float64))
+        self.max_relative_error = max(self.max_relative_error, float(np.max(relative_error, initial=0.0)))
+        self.histogram += np.bincount(
+            np.searchsorted(_RELATIVE_ERROR_BINS, relative_error.ravel()), minlength=len(self.histogram)
+        )
+
+        ref_flat = ref_value.reshape(len(ref_value), -1).astype(np.float64)
+        coreml_flat = coreml_value.reshape(len(coreml_value), -1).astype(np.float64)
+        dot = np.sum(ref_flat * coreml_flat, axis=1)
+        norms = np.linalg.norm(ref_flat, axis=1) * np.linalg.norm(coreml_flat, axis=1)
+        # Two outputs that are both zero are the same.
+        cosine = np.where(norms > 0, dot / np.where(norms > 0, norms, 1.0), np.where(dot == 0, 1.0, 0.0))
+        cosine = np.clip(cosine, -1.0, 1.0)
+        self.num_samples += len(cosine)
+        self.min_cosine_similarity = min(self.min_cosine_similarity, float(np.min(cosine, initial=1.0)))
+        self.sum_cosine_similarity += float(np.sum(cosine))
+
+        if class_axis is not None:
+            num_classes = ref_value.shape[class_axis]
+            ref_scores = np.moveaxis(ref_value, class_axis, -1).reshape(-1, num_classes)
+            coreml_scores = np.moveaxis(coreml_value, class_axis, -1).reshape(-1, num_classes)
+            ref_top1 = np.argmax(ref_scores, axis=-1)
+            k = min(self.top_k, num_classes)
+            coreml_topk = np.argpartition(-coreml_scores, k - 1, axis=-1)[:, :k]
+            self.num_predictions += len(ref_top1)
+            self.num_top1 += int(np.sum(ref_top1 == np.argmax(coreml_scores, axis=-1)))
+            self.num_topk += int(np.sum(np.any(coreml_topk == ref_top1[:, None], axis=-1)))
+
+    def percentile(self, q: float) -> float:
+        cumulative = np.cumsum(self.histogram)
+        index = int(np.searchsorted(cumulative, q / 100 * cumulative[-1]))
+        if index >= len(_RELATIVE_ERROR_BINS):
+            return self.max_relative_error
+        return min(float(_RELATIVE_ERROR_BINS[index]), self.max_relative_error)
+
+    def result(self) -> OutputMetrics:
+        has_predictions = self.num_predictions > 0
+        return OutputMetrics(
+            name=self.name,
+            num_values=self.num_values,
+            max_abs_error=self.max_abs_error,
+            mean_abs_error=self.sum_abs_error / max(self.num_values, 1),
+            relative_error={f"p{q}": self.percentile(q) for q in RELATIVE_ERROR_PERCENTILES},
+            min_cosine_similarity=self.min_cosine_similarity,
+            mean_cosine_similarity=self.sum_cosine_similarity / self.num_samples if self.num_samples else 1.0,
+            top1_agreement=self.num_top1 / self.num_predictions if has_predictions else None,
+            topk_agreement=self.num_topk / self.num_predictions if has_predictions else None,
+        )
+
+
+@dataclass
+class ValidationResult:
+    """
+    The outcome of validating a model on several samples, as returned by
+    [`~coreml.validate.validate_model_samples`].
+
+    Args:
+        num_samples (`int`):
+            Number of samples the models were run on.
+        atol (`float`):
+            The absolute tolerance the outputs were checked with.
+        outputs (`Dict[str, OutputMetrics]`):
+            The metrics of each output that was compared.
+        failures (`List[str]`):
+            Why validation failed, empty if it passed.
+    """
+
+    num_samples: int
+    atol: float
+    outputs: Dict[str, OutputMetrics] = field(default_factory=dict)
+    failures: List[str] = field(default_factory=list)
+
+    @property
+    def passed(self) -> bool:
+        return len(self.failures) == 0
+
+    @property
+    def max_error(self) -> float:
+        """The largest absolute difference of all outputs."""
+        return max((metrics.max_abs_error for metrics in self.outputs.values()), default=0.0)
+
+    def raise_for_failure(self):
+        """Raises a `ValueError` like [`~coreml.validate.validate_model_outputs`] if validation failed."""
+        if not self.passed:
+            raise ValueError("\n".join(self.failures))
+
+    def log_summary(self):
+        logger.info(f"Validation on {self.num_samples} samples (atol: {self.atol}):")
+        for name, metrics in self.outputs.items():
+            relative_error = ", ".join(f"{key} {value:.3g}" for key, value in metrics.relative_error.items())
+            line = (
+                f"\t- {name}: max abs error {metrics.max_abs_error:.3g}, mean {metrics.mean_abs_error:.3g}, "
+                f"relative error {relative_error}, cosine similarity min {metrics.min_cosine_similarity:.6f}"
+            )
+            if metrics.top1_agreement is not None:
+                line += f", top-1 agreement {metrics.top1_agreement:.1%}, top-k agreement {metrics.topk_agreement:.1%}"
+            logger.info(line)
+        for failure in self.failures:
+            logger.info(f"\t-[x] {failure}")
+
+    def to_dict(self) -> Dict[str, Any]:
+        result = asdict(self)
+        result["passed"] = self.passed
+        result["max_error"] = self.max_error
+        return result
+
+
+def validate_model_samples(
+    config: CoreMLConfig,
+    preprocessor: Union["PreTrainedTokenizer", "FeatureExtractionMixin", "ProcessorMixin"],
+    reference_model: Union["PreTrainedModel", "TFPreTrainedModel"],
+    mlmodel: Union[ct.models.MLModel, MILInterpreter],
+    atol: float,
+    num_samples: int = 8,
+    seed: Optional[int] = 0,
+    top_k: int = 5,
+    min_top1_agreement: float = 1.0,
+    memory_tracker: Optional[MemoryTracker] = None,
+    reference_store: Optional[ReferenceOutputStore] = None,
+    weights_hash: Optional[str] = None,
+    load_reference_model: Optional[Callable[[], "PreTrainedModel"]] = None,
+) -> ValidationResult:
+    """
+    Validate the Core ML model on several random samples, and measure how far its outputs are from the
+    reference model's. The reference model runs once on all samples together, the Core ML model once per
+    sample. Unlike [`~coreml.validate.validate_model_outputs`], this doesn't raise an error when the outputs
+    differ, call `raise_for_failure()` on the result for that.
+
+    Args:
+        config ([`~coreml.config.CoreMLConfig`]):
+            The Core ML configuration associated with the exported model.
+        preprocessor ([`PreTrainedTokenizer`], [`FeatureExtractionMixin`] or [`ProcessorMixin`]):
+            The preprocessor used for encoding the data.
+        reference_model ([`PreTrainedModel`] or [`TFPreTrainedModel`], *optional*):
+            The model to export. Can be `None` when `reference_store` holds its outputs.
+        mlmodel (`ct.models.MLModel` or [`~coreml.interpreter.MILInterpreter`]):
+            The exported Core ML model, or an interpreter running it.
+        atol (`float`):
+            Absolute tolerance. Outputs that differ by more than this fail validation.
+        num_samples (`int`, *optional*, defaults to 8):
+            Number of random samples to generate, for every sequence length and batch size the model accepts.
+        seed (`int`, *optional*, defaults to 0):
+            Seed of the random samples, so that validation is repeatable. `None` for different samples every
+            time.
+        top_k (`int`, *optional*, defaults to 5):
+            The `k` of the top-k agreement.
+        min_top1_agreement (`float`, *optional*, defaults to 1.0):
+            For classifiers, the fraction of samples whose predicted class must match the reference model.
+        memory_tracker ([`~coreml.memory.MemoryTracker`], *optional*):
+            If provided, the time spent running the reference model and the Core ML model is recorded in
+            this tracker.
+        reference_store ([`~coreml.cache.ReferenceOutputStore`], *optional*):
+            Where to look up the outputs of the reference model before running it, and to store them after.
+            Not used when `seed` is `None`.
+        weights_hash (`str`, *optional*):
+            The `hash_model_weights()` of the reference model, see [`~coreml.validate.validate_model_outputs`].
+        load_reference_model (`Callable`, *optional*):
+            Loads the reference model when `reference_model` is `None` and its outputs are not in
+            `reference_store`.
+
+    Returns:
+        [`~coreml.validate.ValidationResult`]: the metrics of every output, and whether validation passed.
+    """
+    if config.stateful or config.kv_cache_capacity is not None:
+        raise ValueError(
+            "Validating on several samples is not supported for models with a stateful or fixed-size cache, "
+            "use validate_model_outputs() instead"
+        )
+
+    if memory_tracker is None:
+        memory_tracker = MemoryTracker()
+
+    logger.info(f"Validating Core ML model on {num_samples} samples...")
+
+    get_reference_model = _reference_model_loader(reference_model, load_reference_model)
+    if seed is None:
+        reference_store = None
+    reference_store, weights_hash = _resolve_reference_store(
+        reference_store, weights_hash, reference_model, get_reference_model, mlmodel
+    )
+    framework = TensorType.PYTORCH if reference_store is not None else _get_framework(get_reference_model())
+
+    sequence_lengths = config.get_input_sequence_length(config.inputs)
+    if not isinstance(sequence_lengths, list):
+        sequence_lengths = [None]
+
+    random_state = np.random.get_state()
+    if seed is not None:
+        np.random.seed(seed)
+    try:
+        result = ValidationResult(num_samples=num_samples, atol=atol)
+        accumulators = {}
+        for batch_size in get_validation_batch_sizes(config):
+            for sequence_length in sequence_lengths:
+                samples = [
+                    config.generate_dummy_inputs(
+                        preprocessor, framework, sequence_length=sequence_length, batch_size=batch_size
+                    )
+                    for _ in range(num_samples)
+                ]
+                key = None
+                if reference_store is not None:
+                    key = reference_store.key_for(
+                        preprocessor,
+                        config,
+                        weights_hash,
+                        seed=seed,
+                        num_samples=num_samples,
+                        sequence_length=sequence_length,
+                        batch_size=batch_size,
+                    )
+                _validate_samples(
+                    config,
+                    get_reference_model,
+                    mlmodel,
+                    samples,
+                    accumulators,
+                    result,
+                    top_k,
+                    memory_tracker,
+                    reference_store,
+                    key,
+                )
+    finally:
+        np.random.set_state(random_state)
+
+    _finish_result(config, result, accumulators, min_top1_agreement)
+    return result
+
+
+def validate_model_on_data(
+    config: CoreMLConfig,
+    preprocessor: Union["PreTrainedTokenizer", "FeatureExtractionMixin", "ProcessorMixin"],
+    reference_model: Union["PreTrainedModel", "TFPreTrainedModel"],
+    mlmodel: Union[ct.models.MLModel, MILInterpreter],
+    atol: float,
+    data: ValidationData,
+    top_k: int = 5,
+    min_top1_agreement: float = 1.0,
+    memory_tracker: Optional[MemoryTracker] = None,
+) -> ValidationResult:
+    """
+    Validate the Core ML model on real examples instead of random inputs. The examples are streamed through
+    both models one batch at a time, and the metrics are accumulated as they go, so the memory used doesn't
+    grow with the number of examples. Like [`~coreml.validate.validate_model_samples`], this doesn't raise an
+    error when the outputs differ.
+
+    Args:
+        config ([`~coreml.config.CoreMLConfig`]):
+            The Core ML configuration associated with the exported model.
+        preprocessor ([`PreTrainedTokenizer`], [`FeatureExtractionMixin`] or [`ProcessorMixin`]):
+            The preprocessor used for encoding the data.
+        reference_model ([`PreTrainedModel`] or [`TFPreTrainedModel`]):
+            The model to export.
+        mlmodel (`ct.models.MLModel` or [`~coreml.interpreter.MILInterpreter`]):
+            The exported Core ML model, or an interpreter running it.
+        atol (`float`):
+            Absolute tolerance. Outputs that differ by more than this fail validation.
+        data ([`~coreml.data.ValidationData`]):
+            The examples to validate on.
+        top_k (`int`, *optional*, defaults to 5):
+            The `k` of the top-k agreement.
+        min_top1_agreement (`float`, *optional*, defaults to 1.0):
+            For classifiers, the fraction of examples whose predicted class must match the reference model.
+        memory_tracker ([`~coreml.memory.MemoryTracker`], *optional*):
+            If provided, the time spent running the reference model and the Core ML model is recorded in
+            this tracker.
+
+    Returns:
+        [`~coreml.validate.ValidationResult`]: the metrics of every output, and whether validation passed.
+    """
+    if memory_tracker is None:
+        memory_tracker = MemoryTracker()
+
+    logger.info(f"Validating Core ML model on {data.path}...")
+
+    get_reference_model = _reference_model_loader(reference_model, None)
+    result = ValidationResult(num_samples=0, atol=atol)
+    accumulators = {}
+    for batch in data.batches(_get_framework(reference_model)):
+        reference_model_inputs = {}
+        for name, (ref_value, _) in batch.items():
+            reference_model_inputs[name] = ref_value
+        coreml_inputs = split_coreml_inputs(config, batch)
+        _validate_batch(
+            config,
+            get_reference_model,
+            mlmodel,
+            reference_model_inputs,
+            coreml_inputs,
+            accumulators,
+            result,
+            top_k,
+            memory_tracker,
+        )
+        result.num_samples += len(coreml_inputs)
+
+    _finish_result(config, result, accumulators, min_top1_agreement)
+    return result
+
+
+def _finish_result(config, result, accumulators, min_top1_agreement):
+    """Fills in the metrics of the outputs, and the failures, once all samples are in."""
+    result.outputs = {name: accumulator.result() for name, accumulator in accumulators.items()}
+    for name, accumulator in accumulators.items():
+        if not accumulator.within_tolerance:
+            result.failures.append(
+                f'Output values of "{name}" do not match between reference model and Core ML exported model: '
+                f"Got max absolute difference of: {accumulator.max_abs_error}"
+            )
+    if config.is_classifier and "logits" in result.outputs:
+        agreement = result.outputs["logits"].top1_agreement
+        if agreement < min_top1_agreement:
+            result.failures.append(
+                "Predicted class doesn't match between reference model and Core ML exported model: "
+                f"Got {agreement:.1%} agreement, needs {min_top1_agreement:.1%}"
+            )
+
+    result.log_summary()
+
+
+def _concat_samples(values: List[Any]) -> Any:
+    """Joins the reference inputs of several samples into one batch."""
+    if isinstance(values[0], tuple):
+        return tuple(_concat_samples(list(parts)) for parts in zip(*values))
+    if isinstance(values[0], list):
+        return [_concat_samples(list(parts)) for parts in zip(*values)]
+    if isinstance(values[0], np.ndarray):
+        return np.concatenate(values)
+    if is_torch_available():
+        import torch
+
+        if isinstance(values[0], torch.Tensor):
+            return torch.cat(values)
+    import tensorflow as tf
+
+    return tf.concat(values, axis=0)
+
+
+def _validate_samples(
+    config,
+    get_reference_model,
+    mlmodel,
+    samples,
+    accumulators,
+    result,
+    top_k,
+    memory_tracker,
+    reference_store=None,
+    key=None,
+):
+    """Runs both models on a list of samples, and adds their outputs to the metrics."""
+    split_samples = [_split_dummy_inputs(config, sample) for sample in samples]
+    reference_model_inputs = {
+        name: _concat_samples([inputs[name] for inputs, _ in split_samples]) for name in split_samples[0][0]
+    }
+    coreml_inputs = [inputs for _, inputs in split_samples]
+    _validate_batch(
+        config,
+        get_reference_model,
+        mlmodel,
+        reference_model_inputs,
+        coreml_inputs,
+        accumulators,
+        result,
+        top_k,
+        memory_tracker,
+        reference_store,
+        key,
+    )
+
+
+def _validate_batch(
+    config,
+    get_reference_model,
+    mlmodel,
+    reference_model_inputs,
+    coreml_inputs,
+    accumulators,
+    result,
+    top_k,
+    memory_tracker,
+    reference_store=None,
+    key=None,
+):
+    """
+    Runs the reference model once on a batch of inputs, and the Core ML model on each of its samples, and adds
+    their outputs to the metrics.
+    """
     output_descs = config.outputs
 
-    if is_torch_available() and issubclass(type(reference_model), PreTrainedModel):
-        framework = TensorType.PYTORCH
+    ref_outputs = reference_store.get(key) if reference_store is not None else None
+    if ref_outputs is not None:
+        logger.info(f"\t- Using stored reference outputs {key[:12]}")
     else:
-        framework = TensorType.TENSORFLOW
+        reference_model = get_reference_model()
+        if _get_framework(reference_model) == TensorType.PYTORCH:
+            import torch
+
+            with torch.no_grad():
+                ref_outputs = _run_reference_model(config, reference_model, reference_model_inputs, memory_tracker)
+        else:
+            ref_outputs = _run_reference_model(config, reference_model, reference_model_inputs, memory_tracker)
+        if reference_store is not None:
+            _store_reference_outputs(reference_store, key, config, ref_outputs)
+
+    coreml_outputs = []
+    for inputs in coreml_inputs:
+        with memory_tracker.span("predict"):
+            coreml_outputs.append(mlmodel.predict(inputs))
+
+    def add(name, ref_value, coreml_value, class_axis=None):
+        if name not in accumulators:
+            accumulators[name] = _OutputMetricsAccumulator(name, result.atol, top_k)
+        accumulators[name].update(ref_value, coreml_value, class_axis)
+
+    if config.is_classifier:
+        spec = mlmodel.get_spec()
+        probabilities = [outputs[spec.description.predictedProbabilitiesName] for outputs in coreml_outputs]
+        coreml_probs = _probabilities_to_array(probabilities, config.get_class_labels())
+        ref_probs = softmax(ref_outputs["logits"], axis=-1).reshape(coreml_probs.shape)
+        add("logits", ref_probs, coreml_probs, class_axis=-1)
+        return
+
+    for name, output_desc in output_descs.items():
+        if output_desc.name not in coreml_outputs[0]:
+            continue
+        if name not in ref_outputs:
+            result.failures.append(
+                "Output names do not match between reference model and Core ML exported model: " + f"{{'{name}'}}"
+            )
+            continue
 
-    dummy_inputs = config.generate_dummy_inputs(preprocessor, framework)
+        ref_value = ref_outputs[name]
+        class_axis = None
+        if output_desc.do_softmax:
+            class_axis = 1 if config.task == "semantic-segmentation" else -1
+            ref_value = softmax(ref_value, axis=class_axis)
+        coreml_value = np.concatenate([outputs[output_desc.name] for outputs in coreml_outputs])
 
+        if coreml_value.shape != ref_value.shape:
+            if config.task == "semantic-segmentation" and (output_desc.do_upsample or output_desc.do_argmax):
+                continue
+            result.failures.append(
+                "Output shape doesn't match between reference model and Core ML exported model: "
+                f"Got {ref_value.shape} (reference) and {coreml_value.shape} (Core ML)"
+            )
+            continue
+        add(name, ref_value, coreml_value, class_axis)
+
+
+def _get_framework(reference_model) -> TensorType:
+    if is_torch_available() and issubclass(type(reference_model), PreTrainedModel):
+        return TensorType.PYTORCH
+    return TensorType.TENSORFLOW
+
+
+def _split_dummy_inputs(config: CoreMLConfig, dummy_inputs) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """
+    Puts the dummy inputs into the reference model and Core ML input dictionaries. The separate
+    past_key_values inputs are combined into a tuple of tuples for the reference model.
+    """
+    input_descs = config.inputs
     reference_model_inputs = {}
     past_key_values = []
     coreml_inputs = {}
 
-    # Put the dummy inputs into Core ML and reference model input dictionaries.
-    # The separate past_key_values inputs are combined into a tuple of tuples.
     for name in input_descs.keys():
         ref_value, coreml_value = dummy_inputs[name]
         if name.startswith("past_key_values_"):
@@ -90,22 +802,105 @@ def validate_model_outputs(
     if len(past_key_values) > 0:
         reference_model_inputs["past_key_values"] = past_key_values
 
-    # Compute outputs from the reference model
-    if is_torch_available() and issubclass(type(reference_model), PreTrainedModel):
+    return reference_model_inputs, coreml_inputs
+
+
+def _run_reference_model(
+    config: CoreMLConfig, reference_model, reference_model_inputs: Dict[str, Any], memory_tracker: MemoryTracker
+) -> Dict[str, np.ndarray]:
+    """Runs the reference model, and returns its outputs as NumPy arrays."""
+    is_torch = _get_framework(reference_model) == TensorType.PYTORCH
+    if is_torch:
         reference_model.to("cpu").eval()
     if config.seq2seq == "encoder":
         reference_model = reference_model.get_encoder()
-    ref_outputs_dict = reference_model(**reference_model_inputs, return_dict=True)
+    with memory_tracker.span("reference_forward"):
+        ref_outputs_dict = reference_model(**reference_model_inputs, return_dict=True)
 
     # Unpack the past_key_values output into separate outputs, as that is also
     # how the Core ML mdel does it.
-    if "past_key_values" in ref_outputs_dict:
-        for i in range(len(ref_outputs_dict["past_key_values"])):
-            ref_outputs_dict[f"present_{i}_key"] = ref_outputs_dict["past_key_values"][i][0]
-            ref_outputs_dict[f"present_{i}_value"] = ref_outputs_dict["past_key_values"][i][1]
+    def to_numpy(tensor):
+        return tensor.detach().numpy() if is_torch else tensor.numpy()
+
+    outputs = {}
+    for name, value in ref_outputs_dict.items():
+        if name == "past_key_values":
+            for i, (past_key, past_value) in enumerate(value):
+                outputs[f"present_{i}_key"] = to_numpy(past_key)
+                outputs[f"present_{i}_value"] = to_numpy(past_value)
+        elif hasattr(value, "numpy"):
+            outputs[name] = to_numpy(value)
+    return outputs
+
+
+def _store_reference_outputs(
+    reference_store: ReferenceOutputStore, key: str, config: CoreMLConfig, ref_outputs: Dict[str, np.ndarray]
+):
+    """Stores the reference outputs that validation compares, leaving out others such as the cache."""
+    outputs = {name: value for name, value in ref_outputs.items() if name in config.outputs}
+    reference_store.put(key, outputs, info={"model": config._config.name_or_path, "task": config.task})
+
+
+def _probabilities_to_array(probabilities: List[Dict[str, float]], class_labels: List[str]) -> np.ndarray:
+    """Core ML classifiers return the probabilities as a dict, this puts them in the order of the labels."""
+    return np.array([[probs[label] for label in class_labels] for probs in probabilities], dtype=np.float32)
+
+
+def _validate_model_outputs(
+    config: CoreMLConfig,
+    preprocessor: Union["PreTrainedTokenizer", "FeatureExtractionMixin", "ProcessorMixin"],
+    get_reference_model: Callable[[], Union["PreTrainedModel", "TFPreTrainedModel"]],
+    mlmodel: ct.models.MLModel,
+    atol: float,
+    sequence_length: Optional[int] = None,
+    batch_size: Optional[int] = None,
+    memory_tracker: Optional[MemoryTracker] = None,
+    reference_store: Optional[ReferenceOutputStore] = None,
+    weights_hash: Optional[str] = None,
+) -> float:
+    if memory_tracker is None:
+        memory_tracker = MemoryTracker()
+
+    output_descs = config.outputs
+
+    key = None
+    if reference_store is None:
+        framework = _get_framework(get_reference_model())
+        dummy_inputs = config.generate_dummy_inputs(
+            preprocessor, framework, sequence_length=sequence_length, batch_size=batch_size
+        )
+    else:
+        # The stored outputs only match inputs generated from the same seed.
+        random_state = np.random.get_state()
+        np.random.seed(REFERENCE_OUTPUTS_SEED)
+        try:
+            dummy_inputs = config.generate_dummy_inputs(
+                preprocessor, TensorType.PYTORCH, sequence_length=sequence_length, batch_size=batch_size
+            )
+        finally:
+            np.random.set_state(random_state)
+        key = reference_store.key_for(
+            preprocessor,
+            config,
+            weights_hash,
+            seed=REFERENCE_OUTPUTS_SEED,
+            sequence_length=sequence_length,
+            batch_size=batch_size,
+        )
+
+    reference_model_inputs, coreml_inputs = _split_dummy_inputs(config, dummy_inputs)
+
+    ref_outputs_dict = reference_store.get(key) if reference_store is not None else None
+    if ref_outputs_dict is not None:
+        logger.info(f"\t- Using stored reference outputs {key[:12]}")
+    else:
+        ref_outputs_dict = _run_reference_model(config, get_reference_model(), reference_model_inputs, memory_tracker)
+        if reference_store is not None:
+            _store_reference_outputs(reference_store, key, config, ref_outputs_dict)
 
     # Compute outputs from the Core ML model
-    coreml_outputs = mlmodel.predict(coreml_inputs)
+    with memory_tracker.span("predict"):
+        coreml_outputs = mlmodel.predict(coreml_inputs)
 
     # Map the Core ML output names back to the names used by the reference model
     coreml_output_names = list(coreml_outputs.keys())
@@ -114,21 +909,18 @@ def validate_model_outputs(
         if desc.name in coreml_output_names:
             coreml_output_internal_names.append(name)
 
-    spec = mlmodel._spec
+    spec = mlmodel.get_spec()
 
     # Classifier models are special in Core ML
     if config.is_classifier:
         logger.info("\t- Core ML model is classifier, validating output")
 
-        if is_torch_available() and issubclass(type(reference_model), PreTrainedModel):
-            ref_logits = ref_outputs_dict["logits"].detach().numpy()
-        else:
-            ref_logits = ref_outputs_dict["logits"].numpy()
+        ref_logits = ref_outputs_dict["logits"]
 
         labels_name = spec.description.predictedFeatureName
         coreml_value = coreml_outputs[labels_name]
 
-        ref_value = reference_model.config.id2label[np.argmax(ref_logits, axis=-1)[0]]
+        ref_value = config.get_class_labels()[np.argmax(ref_logits, axis=-1)[0]]
         if coreml_value != ref_value:
             logger.info(f"\t\t-[x] predicted class '{coreml_value}' doesn't match '{ref_value}'")
             raise ValueError(
@@ -152,23 +944,20 @@ def validate_model_outputs(
         else:
             logger.info(f"\t\t-[✓] number of classes {len(coreml_value)} matches {len(ref_value)}")
 
-        # Core ML probabilities are in a dict, put in sorted list for comparing
-        class_labels = config.get_class_labels()
-        coreml_probs = np.zeros_like(ref_value)
-        for i in range(len(ref_value)):
-            coreml_probs[i] = coreml_value[class_labels[i]]
+        coreml_probs = _probabilities_to_array([coreml_value], config.get_class_labels())[0]
 
         # Values
+        error = float(np.amax(np.abs(ref_value - coreml_probs)))
         if not np.allclose(ref_value, coreml_probs, atol=atol):
             logger.info(f"\t\t-[x] values not close enough (atol: {atol})")
             raise ValueError(
                 "Output values do not match between reference model and Core ML exported model: "
-                f"Got max absolute difference of: {np.amax(np.abs(ref_value - coreml_probs))}"
+                f"Got max absolute difference of: {error}"
             )
         else:
             logger.info(f"\t\t-[✓] all values close (atol: {atol})")
 
-        return
+        return error
 
     # Check that keys in coreml_output_internal are a subset of keys from ref_outputs
     ref_outputs_set = set(ref_outputs_dict.keys())
@@ -185,14 +974,11 @@ def validate_model_outputs(
         logger.info(f"\t-[✓] Core ML model output names match reference model ({coreml_outputs_set})")
 
     # Check the shape and values match
+    max_error = 0.0
     for name in coreml_output_internal_names:
         coreml_name = output_descs[name].name
         coreml_value = coreml_outputs[coreml_name]
-
-        if is_torch_available() and issubclass(type(reference_model), PreTrainedModel):
-            ref_value = ref_outputs_dict[name].detach().numpy()
-        else:
-            ref_value = ref_outputs_dict[name].numpy()
+        ref_value = ref_outputs_dict[name]
 
         if output_descs[name].do_softmax:
             axis = 1 if config.task == "semantic-segmentation" else -1
@@ -215,11 +1001,221 @@ def validate_model_outputs(
             logger.info(f"\t\t-[✓] {coreml_value.shape} matches {ref_value.shape}")
 
         # Values
+        error = float(np.amax(np.abs(ref_value - coreml_value)))
+        max_error = max(max_error, error)
         if not np.allclose(ref_value, coreml_value, atol=atol):
             logger.info(f"\t\t-[x] values not close enough (atol: {atol})")
             raise ValueError(
                 "Output values do not match between reference model and Core ML exported model: "
-                f"Got max absolute difference of: {np.amax(np.abs(ref_value - coreml_value))}"
+                f"Got max absolute difference of: {error}"
             )
         else:
             logger.info(f"\t\t-[✓] all values close (atol: {atol})")
+
+    return max_error
+
+
+def _check_step_outputs(output_descs, ref_outputs_dict, coreml_outputs, atol, step):
+    max_error = 0.0
+    for name, output_desc in output_descs.items():
+        if name.startswith("present_"):
+            # The caches are compared indirectly, through the outputs of the next steps.
+            continue
+
+        coreml_value = coreml_outputs[output_desc.name]
+        ref_value = ref_outputs_dict[name].numpy()
+        if output_desc.do_softmax:
+            ref_value = softmax(ref_value, axis=-1)
+
+        logger.info(f'\t- Validating Core ML model output "{name}" at step {step + 1}:')
+
+        if not coreml_value.shape == ref_value.shape:
+            logger.info(f"\t\t-[x] shape {coreml_value.shape} doesn't match {ref_value.shape}")
+            raise ValueError(
+                "Output shape doesn't match between reference model and Core ML exported model: "
+                f"Got {ref_value.shape} (reference) and {coreml_value.shape} (Core ML)"
+            )
+        else:
+            logger.info(f"\t\t-[✓] {coreml_value.shape} matches {ref_value.shape}")
+
+        error = float(np.amax(np.abs(ref_value - coreml_value)))
+        max_error = max(max_error, error)
+        if not np.allclose(ref_value, coreml_value, atol=atol):
+            logger.info(f"\t\t-[x] values not close enough (atol: {atol})")
+            raise ValueError(
+                "Output values do not match between reference model and Core ML exported model: "
+                f"Got max absolute difference of: {error}"
+            )
+        else:
+            logger.info(f"\t\t-[✓] all values close (atol: {atol})")
+
+    return max_error
+
+
+def _validate_stateful_model_outputs(
+    config: CoreMLConfig,
+    preprocessor: "PreTrainedTokenizer",
+    reference_model: "PreTrainedModel",
+    mlmodel: ct.models.MLModel,
+    atol: float,
+    memory_tracker: Optional[MemoryTracker] = None,
+):
+    """
+    A stateful model keeps the key and value cache in between predictions, so it is validated over two
+    steps: the prompt, followed by a single new token that attends to the cached prompt.
+    """
+    import torch
+
+    if memory_tracker is None:
+        memory_tracker = MemoryTracker()
+
+    input_descs = config.inputs
+    output_descs = config.outputs
+
+    dummy_inputs = config.generate_dummy_inputs(preprocessor, TensorType.PYTORCH)
+    prompt_ids = dummy_inputs["input_ids"][0]
+    next_ids = torch.randint(0, preprocessor.vocab_size, (prompt_ids.shape[0], 1))
+
+    reference_model.to("cpu").eval()
+    state = mlmodel.make_state()
+    past_key_values = None
+    sequence_length = 0
+    max_error = 0.0
+
+    for step, input_ids in enumerate([prompt_ids, next_ids]):
+        sequence_length += input_ids.shape[-1]
+        attention_mask = torch.ones((input_ids.shape[0], sequence_length), dtype=torch.int64)
+
+        with memory_tracker.span("reference_forward"), torch.no_grad():
+            ref_outputs_dict = reference_model(
+                input_ids,
+                attention_mask=attention_mask,
+                past_key_values=past_key_values,
+                use_cache=True,
+                return_dict=True,
+            )
+        past_key_values = ref_outputs_dict["past_key_values"]
+
+        coreml_inputs = {
+            input_descs["input_ids"].name: input_ids.numpy().astype(np.int32),
+            input_descs["attention_mask"].name: attention_mask.numpy().astype(np.int32),
+        }
+        with memory_tracker.span("predict"):
+            coreml_outputs = mlmodel.predict(coreml_inputs, state=state)
+
+        error = _check_step_outputs(output_descs, ref_outputs_dict, coreml_outputs, atol, step)
+        max_error = max(max_error, error)
+
+    return max_error
+
+
+def _fixed_cache_reference_steps(
+    config: CoreMLConfig,
+    preprocessor: "PreTrainedTokenizer",
+    reference_model: "PreTrainedModel",
+    num_steps: int,
+    memory_tracker: Optional[MemoryTracker] = None,
+    output_hidden_states: bool = False,
+):
+    """
+    Generates tokens with the reference model one at a time, the way a model with a fixed-size cache sees
+    them. Yields the position, the input ids and the reference outputs of every step, and continues with the
+    token the reference model predicts. Runs `num_steps` steps, and with a sliding window, goes past the end
+    of the cache.
+    """
+    import torch
+
+    if memory_tracker is None:
+        memory_tracker = MemoryTracker()
+
+    capacity = config.kv_cache_capacity
+    if config.kv_cache_sliding_window:
+        # Go past the end of the cache, so that the oldest tokens get overwritten.
+        num_steps = max(num_steps, capacity + 2)
+    else:
+        num_steps = min(num_steps, capacity)
+    # Every step has its own position, which must exist in the model's position embeddings.
+    max_positions = getattr(config._config, "max_position_embeddings", None)
+    if max_positions is not None:
+        num_steps = min(num_steps, max_positions)
+
+    past_key_values = None
+    input_ids = torch.randint(0, preprocessor.vocab_size, (1, 1))
+    for position in range(num_steps):
+        # The reference model sees the same window of past tokens as the Core ML model.
+        if past_key_values is not None and config.kv_cache_sliding_window:
+            past_key_values = tuple(
+                tuple(past[:, :, max(0, past.shape[2] - capacity + 1):] for past in layer)
+                for layer in past_key_values
+            )
+        past_length = 0 if past_key_values is None else past_key_values[0][0].shape[2]
+
+        with memory_tracker.span("reference_forward"), torch.no_grad():
+            ref_outputs_dict = reference_model(
+                input_ids,
+                attention_mask=torch.ones((1, past_length + 1), dtype=torch.int64),
+                position_ids=torch.tensor([[position]]),
+                past_key_values=past_key_values,
+                use_cache=True,
+                output_hidden_states=output_hidden_states,
+                return_dict=True,
+            )
+        past_key_values = ref_outputs_dict["past_key_values"]
+
+        yield position, input_ids, ref_outputs_dict
+
+        input_ids = ref_outputs_dict["logits"][:, -1:].argmax(dim=-1)
+
+
+def _validate_fixed_cache_model_outputs(
+    config: CoreMLConfig,
+    preprocessor: "PreTrainedTokenizer",
+    reference_model: "PreTrainedModel",
+    mlmodel: ct.models.MLModel,
+    atol: float,
+    num_steps: int = 16,
+    memory_tracker: Optional[MemoryTracker] = None,
+):
+    """
+    A model with a fixed-size cache processes one token per prediction. It is validated by generating
+    `num_steps` tokens, and with a sliding window, by going past the end of the cache.
+    """
+    if memory_tracker is None:
+        memory_tracker = MemoryTracker()
+
+    input_descs = config.inputs
+    output_descs = config.outputs
+
+    reference_model.to("cpu").eval()
+    state = mlmodel.make_state() if config.stateful else None
+
+    coreml_caches = {}
+    if not config.stateful:
+        shape = config.kv_cache_shape[1:]
+        for i in range(config.num_layers):
+            coreml_caches[input_descs[f"past_key_values_{i}_key"].name] = np.zeros(shape, dtype=np.float32)
+            coreml_caches[input_descs[f"past_key_values_{i}_value"].name] = np.zeros(shape, dtype=np.float32)
+
+    max_error = 0.0
+    steps = _fixed_cache_reference_steps(config, preprocessor, reference_model, num_steps, memory_tracker)
+    for position, input_ids, ref_outputs_dict in steps:
+        coreml_inputs = {
+            input_descs["input_ids"].name: input_ids.numpy().astype(np.int32),
+            input_descs["position"].name: np.array([position], dtype=np.int32),
+            **coreml_caches,
+        }
+        with memory_tracker.span("predict"):
+            if config.stateful:
+                coreml_outputs = mlmodel.predict(coreml_inputs, state=state)
+            else:
+                coreml_outputs = mlmodel.predict(coreml_inputs)
+        if not config.stateful:
+            for i in range(config.num_layers):
+                for kind in ["key", "value"]:
+                    input_name = input_descs[f"past_key_values_{i}_{kind}"].name
+                    coreml_caches[input_name] = coreml_outputs[output_descs[f"present_{i}_{kind}"].name]
+
+        error = _check_step_outputs(output_descs, ref_outputs_dict, coreml_outputs, atol, position)
+        max_error = max(max_error, error)
+
+    return max_error
@@ -0,0 +1,341 @@
+# coding=utf-8
+# Copyright 2022 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Export several variants of a model from a single TorchScript trace."""
+
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING, List, Optional, Union
+
+import coremltools as ct
+
+from transformers.utils import TensorType, is_torch_available
+
+from .cache import format_size, get_path_size
+from .compression import QUANTIZE_OPTIONS, PalettizationConfig, PruningConfig
+from .config import CoreMLConfig
+from .convert import _apply_values_override, _trace_or_load, convert_traced_pytorch
+from ..utils import logging
+
+
+if is_torch_available():
+    import torch
+    from transformers.modeling_utils import PreTrainedModel
+
+if TYPE_CHECKING:
+    from transformers.feature_extraction_utils import FeatureExtractionMixin
+    from transformers.processing_utils import ProcessorMixin
+    from transformers.tokenization_utils import PreTrainedTokenizer
+    from .cache import TraceStore
+
+
+logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
+
+# Rough peak memory use of one conversion, as a multiple of the size of the float32 weights, plus a
+# fixed overhead for the Python process with torch and coremltools loaded.
+_CONVERSION_MEMORY_FACTOR = 4
+_CONVERSION_MEMORY_OVERHEAD = 1024**3
+
+
+@dataclass(frozen=True)
+class ExportVariant:
+    """
+    One flavor of a Core ML model: the options that are applied when converting the TorchScript trace.
+
+    Args:
+        quantize (`str`, *optional*, defaults to `"float32"`):
+            Precision of the weights and activations. Possible values: `"float32"`, `"float16"`, `"int8"`,
+            `"int4-block32"`, `"int4-block64"`, `"int4-block128"`.
+        compute_units (`ct.ComputeUnit`, *optional*, defaults to `ct.ComputeUnit.ALL`):
+            Whether to optimize the model for CPU, GPU, and/or Neural Engine.
+        minimum_deployment_target (`ct.target`, *optional*):
+            The oldest OS version the model must run on. Defaults to the coremltools default.
+        use_legacy_format (`bool`, *optional*):
+            Produce a NeuralNetwork model instead of an ML Program. Defaults to the setting of the
+            `CoreMLConfig`.
+        compression ([`~coreml.compression.PalettizationConfig`] or [`~coreml.compression.PruningConfig`], *optional*):
+            How to compress the weights after conversion.
+    """
+
+    quantize: str = "float32"
+    compute_units: ct.ComputeUnit = ct.ComputeUnit.ALL
+    minimum_deployment_target: Optional[ct.target] = None
+    use_legacy_format: Optional[bool] = None
+    compression: Optional[Union[PalettizationConfig, PruningConfig]] = None
+
+    @classmethod
+    def from_string(cls, spec: str) -> "ExportVariant":
+        """
+        Parse a variant from a comma-separated list of `key=value` options, for example
+        `"quantize=float16,compute_units=cpu_and_ne,minimum_deployment_target=iOS16,format=mlprogram"`.
+        Weights are palettized with `palettize=<nbits>`, optionally with `palettize_group_size=<size>`
+        for grouped lookup tables, and pruned to a fraction of zero weights with `prune=<sparsity>`, which
+        can be combined with palettization. Options that are left out take their default value.
+        """
+        kwargs = {}
+        palettization = {}
+        target_sparsity = None
+        for option in filter(None, spec.split(",")):
+            key, sep, value = option.partition("=")
+            key, value = key.strip(), value.strip()
+            if not sep:
+                raise ValueError(f"Invalid variant option '{option}', expected key=value")
+
+            if key == "quantize":
+                if value not in QUANTIZE_OPTIONS:
+                    raise ValueError(f"Unknown quantize option '{value}'")
+                kwargs["quantize"] = value
+            elif key == "compute_units":
+                try:
+                    kwargs["compute_units"] = ct.ComputeUnit[value.upper()]
+                except KeyError:
+                    raise ValueError(f"Unknown compute units '{value}'") from None
+            elif key == "minimum_deployment_target":
+                try:
+                    kwargs["minimum_deployment_target"] = ct.target[value]
+                except KeyError:
+                    raise ValueError(f"Unknown deployment target '{value}'") from None
+            elif key == "format":
+                if value not in ["mlprogram", "neuralnetwork"]:
+                    raise ValueError(f"Unknown model format '{value}'")
+                kwargs["use_legacy_format"] = value == "neuralnetwork"
+            elif key == "palettize":
+                palettization["nbits"] = int(value)
+            elif key == "palettize_group_size":
+                palettization["granularity"] = "per_grouped_channel"
+                palettization["group_size"] = int(value)
+            elif key == "prune":
+                target_sparsity = float(value)
+            else:
+                raise ValueError(f"Unknown variant option '{key}'")
+
+        if len(palettization) > 0:
+            if "nbits" not in palettization:
+                raise ValueError("The palettize_group_size option requires palettize=<nbits>")
+            kwargs["compression"] = PalettizationConfig(**palettization)
+        if target_sparsity is not None:
+            kwargs["compression"] = PruningConfig(
+                target_sparsity=target_sparsity, palettization=kwargs.get("compression")
+            )
+
+        return cls(**kwargs)
+
+    @property
+    def name(self) -> str:
+        """Short name of the variant, used in filenames."""
+        parts = [self.quantize, self.compute_units.name.lower()]
+        if self.minimum_deployment_target is not None:
+            parts.append(self.minimum_deployment_target.name)
+        if self.use_legacy_format is not None:
+            parts.append("neuralnetwork" if self.use_legacy_format else "mlprogram")
+        if self.compression is not None:
+            parts.append(self.compression.name)
+        return "-".join(parts)
+
+    def get_output_filename(self, output: Path, default_legacy_format: bool = False) -> Path:
+        """
+        Where this variant is saved, given the output path of the model. `default_legacy_format` is the
+        `use_legacy_format` setting of the `CoreMLConfig`, which applies when the variant doesn't choose a format.
+        """
+        use_legacy_format = default_legacy_format if self.use_legacy_format is None else self.use_legacy_format
+        suffix = ".mlmodel" if use_legacy_format else ".mlpackage"
+        return output.parent / f"{output.stem}-{self.name}{suffix}"
+
+
+@dataclass
+class VariantResult:
+    """
+    The outcome of converting one [`~coreml.variants.ExportVariant`].
+
+    Args:
+        variant ([`~coreml.variants.ExportVariant`]):
+            The variant that was converted.
+        path (`str`):
+            Where the Core ML model was saved.
+        convert_time (`float`):
+            Seconds spent in the Core ML conversion.
+        save_time (`float`):
+            Seconds spent saving the model.
+        size (`int`):
+            Size of the saved model in bytes.
+    """
+
+    variant: ExportVariant
+    path: str
+    convert_time: float
+    save_time: float
+    size: int
+
+
+def _available_memory() -> Optional[int]:
+    try:
+        if sys.platform == "darwin":
+            # macOS has no count of available pages, keep half the physical memory free.
+            return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") // 2
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def get_num_variant_workers(model: "PreTrainedModel", num_variants: int) -> int:
+    """
+    How many variants can be converted at the same time without running out of memory or CPUs.
+    """
+    num_workers = min(num_variants, os.cpu_count() or 1)
+
+    available = _available_memory()
+    if available is not None:
+        weights_size = sum(p.numel() for p in model.parameters()) * 4
+        per_worker = weights_size * _CONVERSION_MEMORY_FACTOR + _CONVERSION_MEMORY_OVERHEAD
+        num_workers = min(num_workers, available // per_worker)
+
+    return max(1, num_workers)
+
+
+def _convert_variant(preprocessor, model_config, config, traced_model, dummy_inputs, variant, filename):
+    if isinstance(traced_model, (str, Path)):
+        traced_model = torch.jit.load(traced_model)
+
+    start = time.perf_counter()
+    mlmodel = convert_traced_pytorch(
+        preprocessor,
+        model_config,
+        config,
+        traced_model,
+        dummy_inputs,
+        quantize=variant.quantize,
+        compute_units=variant.compute_units,
+        use_legacy_format=variant.use_legacy_format,
+        minimum_deployment_target=variant.minimum_deployment_target,
+        compression=variant.compression,
+    )
+    convert_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    mlmodel.save(filename)
+    save_time = time.perf_counter() - start
+
+    return VariantResult(variant, filename, convert_time, save_time, get_path_size(filename))
+
+
+def _init_worker(log_level: int, num_threads: int):
+    logging.get_logger("exporters.coreml").setLevel(log_level)
+    torch.set_num_threads(num_threads)
+
+
+def export_variants(
+    preprocessor: Union["PreTrainedTokenizer", "FeatureExtractionMixin", "ProcessorMixin"],
+    model: "PreTrainedModel",
+    config: CoreMLConfig,
+    variants: List[ExportVariant],
+    output: Union[str, Path],
+    num_workers: Optional[int] = None,
+    trace_store: Optional["TraceStore"] = None,
+) -> List[VariantResult]:
+    """
+    Export several variants of a PyTorch model to Core ML, for example float32 and float16 versions or
+    versions for different deployment targets.
+
+    The model is traced only once. The trace is then converted once per variant, in parallel worker
+    processes when there is enough memory for it.
+
+    Args:
+        preprocessor ([`PreTrainedTokenizer`], [`FeatureExtractionMixin`] or [`ProcessorMixin`]):
+            The preprocessor used for encoding the data.
+        model ([`PreTrainedModel`]):
+            The model to export.
+        config ([`~coreml.config.CoreMLConfig`]):
+            The Core ML configuration associated with the exported model.
+        variants (`List[ExportVariant]`):
+            The variants to convert.
+        output (`str` or `Path`):
+            The output path of the model. Each variant is saved next to it, with the name of the variant
+            added to the filename.
+        num_workers (`int`, *optional*):
+            How many variants to convert at the same time. By default this is based on the size of the
+            model and the available memory.
+        trace_store ([`~coreml.cache.TraceStore`], *optional*):
+            If provided, the TorchScript trace is loaded from this store when available, and saved into
+            it otherwise.
+
+    Returns:
+        `List[VariantResult]`: the saved file, timings and size of each variant, in the same order as
+        `variants`.
+    """
+    if not (is_torch_available() and issubclass(type(model), PreTrainedModel)):
+        raise ValueError(f"Cannot convert unknown model type: {type(model)}")
+
+    output = Path(output)
+    filenames = [variant.get_output_filename(output, config.use_legacy_format).as_posix() for variant in variants]
+    if len(set(filenames)) != len(filenames):
+        raise ValueError("The same variant was requested more than once")
+
+    _apply_values_override(model, config)
+    dummy_inputs = config.generate_dummy_inputs(preprocessor, framework=TensorType.PYTORCH)
+
+    start = time.perf_counter()
+    traced_model = _trace_or_load(preprocessor, model, config, dummy_inputs, trace_store)
+    logger.info(f"Traced the model in {time.perf_counter() - start:.1f} s")
+
+    if num_workers is None:
+        num_workers = get_num_variant_workers(model, len(variants))
+    num_workers = min(num_workers, len(variants))
+
+    if num_workers <= 1:
+        results = []
+        for variant, filename in zip(variants, filenames):
+            logger.info(f"Converting variant {variant.name}...")
+            results.append(
+                _convert_variant(preprocessor, model.config, config, traced_model, dummy_inputs, variant, filename)
+            )
+    else:
+        logger.info(f"Converting {len(variants)} variants with {num_workers} worker processes...")
+
+        # Use fresh processes instead of forking: the model was traced and run, so torch's thread pool is
+        # already started, and forking a process that uses Apple frameworks is not safe either.
+        mp_context = multiprocessing.get_context("spawn")
+        num_threads = max(1, torch.get_num_threads() // num_workers)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # TorchScript modules can't be pickled, so the workers load the trace from disk.
+            trace_path = os.path.join(tmp_dir, "trace.pt")
+            torch.jit.save(traced_model, trace_path)
+
+            with ProcessPoolExecutor(
+                max_workers=num_workers,
+                mp_context=mp_context,
+                initializer=_init_worker,
+                initargs=(logging.get_logger("exporters.coreml").getEffectiveLevel(), num_threads),
+            ) as executor:
+                futures = [
+                    executor.submit(
+                        _convert_variant, preprocessor, model.config, config, trace_path, dummy_inputs, variant, filename
+                    )
+                    for variant, filename in zip(variants, filenames)
+                ]
+                results = [future.result() for future in futures]
+
+    for result in results:
+        logger.info(
+            f"Variant {result.variant.name}: converted in {result.convert_time:.1f} s, "
+            f"saved in {result.save_time:.1f} s, {format_size(result.size)} at {result.path}"
+        )
+
+    return results
@@ -0,0 +1,123 @@
+# coding=utf-8
+# Copyright 2022 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import tempfile
+from pathlib import Path
+from unittest import TestCase
+
+from exporters.coreml.__main__ import get_parser
+from exporters.coreml.batch import job_name, job_to_argv, load_manifest, run_batch
+
+
+class BatchTestCase(TestCase):
+    def test_manifest_to_args(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            manifest = Path(tmp_dir) / "manifest.jsonl"
+            jobs = [
+                {"model": "t5-small", "feature": "text2text-generation", "output": f"{tmp_dir}/t5"},
+                {"model": "bert-base-cased", "quantize": "float16", "use_past": False, "output": f"{tmp_dir}/bert.mlpackage"},
+            ]
+            manifest.write_text("\n".join(json.dumps(job) for job in jobs))
+            self.assertEqual(load_manifest(manifest), jobs)
+
+            args = get_parser().parse_args(job_to_argv(jobs[0], ["--compute_units", "cpu_only"]))
+            self.assertEqual(args.model, "t5-small")
+            self.assertEqual(args.compute_units, "cpu_only")
+
+            args = get_parser().parse_args(job_to_argv(jobs[1]))
+            self.assertEqual(args.quantize, "float16")
+            self.assertFalse(args.use_past)
+            self.assertEqual(job_name(1, jobs[1]), "0001-bert-base-cased-feature-extraction")
+
+            # Lists repeat the options that can be repeated, and are comma-separated otherwise.
+            job = {
+                "model": "bert-base-cased",
+                "variant": ["quantize=float16", "quantize=int8"],
+                "sequence_length_buckets": [32, 64],
+                "output": f"{tmp_dir}/bert",
+            }
+            args = get_parser().parse_args(job_to_argv(job))
+            self.assertEqual([variant.quantize for variant in args.variant], ["float16", "int8"])
+            self.assertEqual(args.sequence_length_buckets, [32, 64])
+
+    def test_skip_existing(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # The model is not needed as long as the job is skipped.
+            model = Path(tmp_dir) / "missing-model"
+            output = Path(tmp_dir) / "Model.mlpackage"
+            job = {"name": "done", "model": str(model), "feature": "text-generation", "chunks": 2, "output": str(output)}
+            manifest = Path(tmp_dir) / "manifest.json"
+            manifest.write_text(json.dumps([job]))
+
+            # A chunked model is saved as several packages next to the output path.
+            artifacts = [(Path(tmp_dir) / f"Model_chunk{i}of2.mlpackage").as_posix() for i in [1, 2]]
+            for path in artifacts:
+                Path(path).mkdir()
+            results_dir = Path(tmp_dir) / "manifest.results"
+            results_dir.mkdir()
+            previous = {"name": "done", "argv": job_to_argv(job), "status": "succeeded", "artifacts": artifacts}
+            (results_dir / "done.json").write_text(json.dumps(previous))
+
+            results = run_batch(manifest)
+            self.assertEqual(results[0]["status"], "skipped")
+            self.assertEqual(results[0]["artifacts"], artifacts)
+            with open(results_dir / "done.json") as f:
+                self.assertEqual(json.load(f)["status"], "skipped")
+
+            # Skipping again keeps the job as succeeded.
+            self.assertEqual(run_batch(manifest)[0]["status"], "skipped")
+
+            # The job runs again when its options change.
+            manifest.write_text(json.dumps([{**job, "chunks": 3}]))
+            self.assertEqual(run_batch(manifest)[0]["status"], "failed")
+
+    def test_rerun_failed(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # The output was saved, but the job failed afterwards, for example in validation.
+            output = Path(tmp_dir) / "Model.mlpackage"
+            output.mkdir()
+            manifest = Path(tmp_dir) / "manifest.json"
+            model = Path(tmp_dir) / "missing-model"
+            manifest.write_text(json.dumps([{"name": "invalid", "model": str(model), "output": str(output)}]))
+            results_dir = Path(tmp_dir) / "manifest.results"
+            results_dir.mkdir()
+            (results_dir / "invalid.json").write_text(json.dumps({"name": "invalid", "status": "failed"}))
+
+            results = run_batch(manifest)
+            self.assertEqual(results[0]["status"], "failed")
+            self.assertIn("started", results[0])
+
+    def test_invalid_job(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output = Path(tmp_dir) / "Model.mlpackage"
+            output.mkdir()
+            manifest = Path(tmp_dir) / "manifest.json"
+            jobs = [
+                {"name": "invalid", "model": "bert-base-cased", "quantize": "int3", "output": str(output)},
+                {"name": "done", "model": "bert-base-cased", "output": str(output)},
+            ]
+            manifest.write_text(json.dumps(jobs))
+            results_dir = Path(tmp_dir) / "manifest.results"
+            results_dir.mkdir()
+            previous = {"name": "done", "argv": job_to_argv(jobs[1]), "status": "succeeded", "artifacts": [str(output)]}
+            (results_dir / "done.json").write_text(json.dumps(previous))
+
+            # A job with invalid options fails on its own, the other jobs still run.
+            results = run_batch(manifest)
+            self.assertEqual([result["status"] for result in results], ["failed", "skipped"])
+            self.assertIn("--quantize", results[0]["error"])
+            with open(results_dir / "invalid.json") as f:
+                self.assertEqual(json.load(f)["status"], "failed")
@@ -0,0 +1,184 @@
+# coding=utf-8
+# Copyright 2022 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+from functools import partial
+from unittest import TestCase
+
+import numpy as np
+from transformers.testing_utils import require_torch, require_vision
+
+from exporters.coreml import export
+from exporters.coreml.bench import (
+    LatencyResult,
+    benchmark_model,
+    generate_config_inputs,
+    generate_spec_inputs,
+    get_bench_backend,
+    get_bench_sizes,
+    get_config_options,
+    get_function_description,
+    load_bench_model,
+    main,
+)
+from exporters.coreml.benchmark import load_results
+from exporters.coreml.models import BertCoreMLConfig, GPT2CoreMLConfig
+from exporters.coreml.multifunction import export_multifunction
+from .test_interpreter import _tiny_model
+from .testing_utils import get_tiny_bert, get_tiny_gpt2, is_macos_available, require_coreml
+
+
+class LatencyResultTestCase(TestCase):
+    def test_from_latencies(self):
+        latencies = [0.01 * (i + 1) for i in range(100)]
+        result = LatencyResult.from_latencies(latencies, batch_size=4, sequence_length=32)
+        self.assertEqual(result.num_runs, 100)
+        self.assertAlmostEqual(result.latency["p50"], np.percentile(latencies, 50))
+        self.assertLess(result.latency["p50"], result.latency["p90"])
+        self.assertLess(result.latency["p90"], result.latency["p99"])
+        self.assertAlmostEqual(result.mean_latency, 0.505)
+        self.assertAlmostEqual(result.throughput, 4 / 0.505)
+
+    def test_backends(self):
+        self.assertEqual(get_bench_backend(), "coreml" if is_macos_available() else "numpy")
+        self.assertEqual(get_bench_backend("numpy"), "numpy")
+        with self.assertRaises(ValueError):
+            get_bench_backend("torch")
+
+
+@require_coreml
+@require_torch
+class BenchmarkModelTestCase(TestCase):
+    def test_text_model(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer, model = get_tiny_bert(tmp_dir)
+            coreml_config = BertCoreMLConfig(
+                model.config, task="feature-extraction", sequence_length_buckets=[16, 32], batch_size=[1, 4]
+            )
+            filename = os.path.join(tmp_dir, "Model.mlpackage")
+            export(tokenizer, model.eval(), coreml_config).save(filename)
+
+            mlmodel = load_bench_model(filename, "numpy")
+            description = get_function_description(mlmodel.get_spec())
+            self.assertEqual(get_bench_sizes(description), {"batch_size": [1, 4], "sequence_length": [16, 32]})
+
+            inputs = generate_spec_inputs(description, batch_size=4, sequence_length=16)
+            self.assertEqual(inputs["input_ids"].shape, (4, 16))
+            self.assertEqual(inputs["input_ids"].dtype, np.int32)
+            self.assertTrue(np.all(inputs["attention_mask"] == 1))
+            with self.assertRaises(ValueError):
+                generate_spec_inputs(description, sequence_length=24)
+
+            results = benchmark_model(mlmodel, num_warmup=1, num_runs=3)
+            self.assertEqual([(r.batch_size, r.sequence_length) for r in results], [(1, 16), (1, 32), (4, 16), (4, 32)])
+            self.assertTrue(all(r.num_runs == 3 and r.throughput > 0 for r in results))
+
+            # Sizes the model doesn't accept are skipped.
+            results = benchmark_model(mlmodel, batch_sizes=[1, 2], sequence_lengths=[32], num_warmup=0, num_runs=1)
+            self.assertEqual([(r.batch_size, r.sequence_length) for r in results], [(1, 32)])
+
+            # The Core ML configuration generates real token ids.
+            generate_inputs = partial(generate_config_inputs, coreml_config, tokenizer)
+            results = benchmark_model(
+                mlmodel, batch_sizes=[4], sequence_lengths=[16], num_warmup=0, num_runs=1, generate_inputs=generate_inputs
+            )
+            self.assertEqual(results[0].batch_size, 4)
+
+    def test_stateful_model(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer, model = get_tiny_gpt2(tmp_dir)
+            coreml_config = GPT2CoreMLConfig(model.config, task="text-generation", use_past=True, stateful=True)
+            filename = os.path.join(tmp_dir, "Model.mlpackage")
+            export(tokenizer, model, coreml_config).save(filename)
+
+            mlmodel = load_bench_model(filename, "numpy")
+            results = benchmark_model(mlmodel, sequence_lengths=[1, 8], num_warmup=1, num_runs=2)
+            self.assertEqual([r.sequence_length for r in results], [1, 8])
+
+    @require_vision
+    def test_vision_model(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            preprocessor, model, coreml_config = _tiny_model("vit", "image-classification", tmp_dir)
+            filename = os.path.join(tmp_dir, "Model.mlpackage")
+            export(preprocessor, model, coreml_config).save(filename)
+
+            mlmodel = load_bench_model(filename, "numpy")
+            description = get_function_description(mlmodel.get_spec())
+            self.assertEqual(get_bench_sizes(description), {"batch_size": [None], "sequence_length": [None]})
+            image = generate_spec_inputs(description)["image"]
+            self.assertEqual(image.size, (32, 32))
+
+            results = benchmark_model(mlmodel, num_warmup=1, num_runs=2)
+            self.assertEqual(len(results), 1)
+            self.assertEqual(results[0].batch_size, 1)
+
+    def test_config_options(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer, model = get_tiny_bert(tmp_dir)
+            for options in [{"sequence_length_buckets": [8, 16], "batch_size": [1, 4]}, {"batch_size": (1, 8)}, {}]:
+                coreml_config = BertCoreMLConfig(model.config, task="feature-extraction", **options)
+                filename = os.path.join(tmp_dir, "Model.mlpackage")
+                export(tokenizer, model.eval(), coreml_config).save(filename)
+                self.assertEqual(get_config_options(load_bench_model(filename, "numpy").get_spec()), options)
+
+            tokenizer, model = get_tiny_gpt2(tmp_dir)
+            for options in [
+                {"use_past": True, "stateful": True},
+                {"use_past": True, "kv_cache_capacity": 16},
+                {"use_past": True, "stateful": True, "kv_cache_capacity": 16},
+            ]:
+                coreml_config = GPT2CoreMLConfig(model.config, task="text-generation", **options)
+                filename = os.path.join(tmp_dir, "Model.mlpackage")
+                export(tokenizer, model, coreml_config).save(filename)
+                self.assertEqual(get_config_options(load_bench_model(filename, "numpy").get_spec()), options)
+
+            coreml_config = GPT2CoreMLConfig(model.config, task="text-generation", use_past=True)
+            filename = os.path.join(tmp_dir, "Multifunction.mlpackage")
+            export_multifunction(tokenizer, model, coreml_config, filename, prefill_length=16)
+            spec = load_bench_model(filename, "numpy").get_spec()
+            for function_name in [None, "prefill"]:
+                self.assertEqual(
+                    get_config_options(spec, function_name),
+                    {"use_past": True, "generation_step": function_name or "decode", "prefill_length": 16},
+                )
+
+    def test_main(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer, model = get_tiny_gpt2(tmp_dir)
+            model_dir = os.path.join(tmp_dir, "model")
+            model.save_pretrained(model_dir)
+            tokenizer.save_pretrained(model_dir)
+            filename = os.path.join(tmp_dir, "Model.mlpackage")
+            export(tokenizer, model, GPT2CoreMLConfig(model.config, task="text-generation")).save(filename)
+
+            output = os.path.join(tmp_dir, "results.json")
+            main([filename, "--backend", "numpy", "--warmup", "1", "--runs", "2", "--output", output])
+            results = load_results(output)
+            self.assertEqual(results["backend"], "numpy")
+            self.assertEqual(len(results["results"]), 1)
+            self.assertEqual(sorted(results["results"][0]["latency"]), ["p50", "p90", "p99"])
+
+            main([filename, "--backend", "numpy", "--runs", "1", "--config_model", model_dir, "--feature", "text-generation"])
+
+            # The configuration follows the options the model was exported with.
+            coreml_config = GPT2CoreMLConfig(model.config, task="text-generation", use_past=True, kv_cache_capacity=16)
+            export(tokenizer, model, coreml_config).save(filename)
+            main([filename, "--backend", "numpy", "--runs", "1", "--config_model", model_dir, "--feature", "text-generation"])
+
+            with self.assertRaises(ValueError):
+                main([filename, "--backend", "numpy", "--batch_size", "2"])
+            with self.assertRaises(ValueError):
+                main([filename, "--config_model", model_dir])
@@ -0,0 +1,148 @@
+# coding=utf-8
+# Copyright 2022 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import copy
+import os
+import tempfile
+from unittest import TestCase
+
+from transformers.testing_utils import require_torch, require_vision
+
+from exporters.coreml.benchmark import (
+    MIN_DURATION_CHANGE,
+    MIN_MEMORY_CHANGE,
+    TINY_CONFIGS,
+    compare_results,
+    get_benchmark_cases,
+    get_tiny_model_config,
+    load_results,
+    main,
+    run_benchmark,
+    save_results,
+)
+from exporters.coreml.features import FeaturesManager
+from .testing_utils import require_coreml
+
+
+def _result(model_type, feature, duration=1.0, convert_duration=0.5, peak_increase=100 * 1024 * 1024, status="succeeded"):
+    return {
+        "model_type": model_type,
+        "feature": feature,
+        "status": status,
+        "error": None if status == "succeeded" else "RuntimeError: failed",
+        "num_parameters": 1000,
+        "duration": duration,
+        "phases": {
+            "trace": {"duration": duration - convert_duration, "peak_memory": None, "peak_increase": None},
+            "convert": {"duration": convert_duration, "peak_memory": None, "peak_increase": peak_increase},
+        },
+        "spans": {},
+    }
+
+
+class BenchmarkCasesTestCase(TestCase):
+    def test_cases(self):
+        cases = get_benchmark_cases()
+        self.assertEqual(set(model_type for model_type, _ in cases), set(FeaturesManager._SUPPORTED_MODEL_TYPE))
+        self.assertEqual(set(TINY_CONFIGS), set(FeaturesManager._SUPPORTED_MODEL_TYPE))
+        self.assertIn(("t5", "text2text-generation"), cases)
+
+        self.assertEqual(
+            get_benchmark_cases(["bert", "vit"], ["feature-extraction", "image-classification"]),
+            [("bert", "feature-extraction"), ("vit", "feature-extraction"), ("vit", "image-classification")],
+        )
+
+    @require_torch
+    def test_tiny_models(self):
+        for model_type, features in FeaturesManager._SUPPORTED_MODEL_TYPE.items():
+            feature = next(iter(features))
+            model_config = get_tiny_model_config(model_type, feature)
+            model = FeaturesManager.get_model_class_for_feature(feature).from_config(model_config)
+            self.assertLess(model.num_parameters(), 1_000_000, model_type)
+
+        self.assertTrue(get_tiny_model_config("bert", "text-generation-with-past").is_decoder)
+
+
+class CompareResultsTestCase(TestCase):
+    def test_compare_results(self):
+        baseline = {
+            "quantize": "float32",
+            "results": [
+                _result("bert", "feature-extraction"),
+                _result("gpt2", "text-generation", duration=10.0, convert_duration=8.0),
+                _result("bloom", "text-generation", status="failed"),
+            ],
+        }
+        self.assertEqual(compare_results(baseline, baseline), [])
+
+        # Small changes are noise, even when they are large relative to the baseline.
+        current = copy.deepcopy(baseline)
+        current["results"][0]["duration"] += MIN_DURATION_CHANGE / 2
+        current["results"][0]["phases"]["convert"]["peak_increase"] += MIN_MEMORY_CHANGE / 2
+        self.assertEqual(compare_results(baseline, current), [])
+
+        current = copy.deepcopy(baseline)
+        current["results"][1]["duration"] = 12.0
+        current["results"][1]["phases"]["convert"]["duration"] = 10.0
+        self.assertEqual(compare_results(baseline, current), [])
+        regressions = compare_results(baseline, current, threshold=0.1)
+        self.assertEqual([regression.metric for regression in regressions], ["duration", "convert.duration"])
+        self.assertEqual(regressions[0].name, "gpt2/text-generation")
+        self.assertIn("10.00s -> 12.00s (+20%)", str(regressions[0]))
+
+        current = copy.deepcopy(baseline)
+        current["results"][0]["phases"]["convert"]["peak_increase"] *= 2
+        regressions = compare_results(baseline, current)
+        self.assertEqual([regression.metric for regression in regressions], ["convert.peak_increase"])
+
+        # Failing is a regression, unless the model failed in the baseline too.
+        current = copy.deepcopy(baseline)
+        current["results"][0] = _result("bert", "feature-extraction", status="failed")
+        regressions = compare_results(baseline, current)
+        self.assertEqual([(regression.name, regression.metric) for regression in regressions], [("bert/feature-extraction", "status")])
+
+
+class RunBenchmarkTestCase(TestCase):
+    @require_coreml
+    @require_torch
+    @require_vision
+    def test_run_benchmark(self):
+        results = run_benchmark(["bert", "vit"], ["feature-extraction"])
+        self.assertEqual(results["quantize"], "float32")
+        self.assertIn("coremltools", results["versions"])
+        self.assertEqual(
+            [(result["model_type"], result["status"]) for result in results["results"]],
+            [("bert", "succeeded"), ("vit", "succeeded")],
+        )
+        for result in results["results"]:
+            self.assertEqual(list(result["phases"]), ["trace", "convert", "finalize"])
+            self.assertGreater(result["duration"], 0)
+            self.assertIn("jit_trace", result["spans"])
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "results.json")
+            save_results(results, path)
+            self.assertEqual(load_results(path), results)
+
+            # A baseline that was much faster makes the benchmark fail.
+            baseline = copy.deepcopy(results)
+            for result in baseline["results"]:
+                result["duration"] /= 100
+            baseline_path = os.path.join(tmp_dir, "baseline.json")
+            save_results(baseline, baseline_path)
+            output = os.path.join(tmp_dir, "new.json")
+            with self.assertRaises(SystemExit):
+                main([output, "--model_type", "bert", "--feature", "feature-extraction", "--baseline", baseline_path, "--threshold", "0.0"])
+            self.assertTrue(os.path.exists(output))
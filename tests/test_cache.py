@@ -0,0 +1,171 @@
+# coding=utf-8
+# Copyright 2022 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+import time
+from unittest import TestCase
+from unittest.mock import patch
+
+import numpy as np
+from transformers import is_torch_available
+from transformers.testing_utils import require_torch
+
+from exporters.coreml import (
+    ExportCache,
+    MILInterpreter,
+    ReferenceOutputStore,
+    TraceStore,
+    export,
+    trace_pytorch,
+    validate_model_outputs,
+)
+from exporters.coreml.cache import WEIGHTS_HASH_METADATA_KEY, hash_model_weights, parse_size
+from exporters.coreml.models import BertCoreMLConfig
+from .testing_utils import get_tiny_bert, require_coreml
+
+
+if is_torch_available():
+    from transformers import BertForSequenceClassification
+
+
+class ExportCacheTestCase(TestCase):
+    def test_parse_size(self):
+        self.assertEqual(parse_size(1000), 1000)
+        self.assertEqual(parse_size("512"), 512)
+        self.assertEqual(parse_size("2KB"), 2048)
+        self.assertEqual(parse_size("1.5 GB"), int(1.5 * 1024**3))
+
+    @require_coreml
+    @require_torch
+    def test_hit_and_eviction(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer, model = get_tiny_bert(tmp_dir)
+            coreml_config = BertCoreMLConfig(model.config, task="feature-extraction")
+            cache = ExportCache(os.path.join(tmp_dir, "cache"))
+
+            key = cache.key_for(tokenizer, model, coreml_config)
+            self.assertIsNone(cache.get(key))
+
+            export(tokenizer, model, coreml_config, cache=cache)
+            self.assertEqual([entry.key for entry in cache.entries()], [key])
+
+            # A second export must not convert the model again.
+            with patch("exporters.coreml.convert.export_pytorch") as export_pytorch:
+                export(tokenizer, model, coreml_config, cache=cache)
+                export_pytorch.assert_not_called()
+
+            # Changing the export options gives a different key.
+            self.assertNotEqual(key, cache.key_for(tokenizer, model, coreml_config, quantize="float16"))
+
+            # Adding an entry beyond the size limit evicts the least recently used one.
+            export(tokenizer, model, coreml_config, quantize="float16", cache=cache)
+            time.sleep(0.01)
+            cache.get(key)
+            entries = cache.entries()
+            self.assertEqual(len(entries), 2)
+            self.assertEqual(entries[0].key, key)
+
+            evicted = cache.evict(max_size=entries[0].size)
+            self.assertEqual([entry.key for entry in evicted], [entries[1].key])
+            self.assertEqual(cache.purge(), 1)
+            self.assertEqual(cache.entries(), [])
+
+
+class TraceStoreTestCase(TestCase):
+    @require_coreml
+    @require_torch
+    def test_reuse_trace(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer, model = get_tiny_bert(tmp_dir)
+            coreml_config = BertCoreMLConfig(model.config, task="feature-extraction")
+            trace_store = TraceStore(os.path.join(tmp_dir, "traces"))
+
+            export(tokenizer, model, coreml_config, trace_store=trace_store)
+            self.assertEqual(len(trace_store.entries()), 1)
+
+            with patch("exporters.coreml.convert._trace_wrapper") as trace_wrapper:
+                mlmodel = export(tokenizer, model, coreml_config, trace_store=trace_store)
+                trace_wrapper.assert_not_called()
+            self.assertEqual(
+                [output.name for output in mlmodel.get_spec().description.output],
+                ["last_hidden_state", "pooler_output"],
+            )
+
+    @require_coreml
+    @require_torch
+    def test_export_pretraced(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer, model = get_tiny_bert(tmp_dir, BertForSequenceClassification)
+            coreml_config = BertCoreMLConfig(model.config, task="text-classification")
+            traced_model = trace_pytorch(tokenizer, model, coreml_config)
+
+            with patch("exporters.coreml.convert._trace_wrapper") as trace_wrapper:
+                mlmodel = export(tokenizer, model, coreml_config, traced_model=traced_model)
+                trace_wrapper.assert_not_called()
+            self.assertEqual(mlmodel.get_spec().description.predictedFeatureName, "classLabel")
+
+
+class ReferenceOutputStoreTestCase(TestCase):
+    def test_put_and_get(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store = ReferenceOutputStore(tmp_dir)
+            logits = np.arange(12, dtype=np.float32).reshape(3, 4)
+            store.put("key", {"logits": logits})
+
+            outputs = store.get("key")
+            self.assertEqual(list(outputs), ["logits"])
+            self.assertIsInstance(outputs["logits"], np.memmap)
+            np.testing.assert_equal(outputs["logits"], logits)
+            self.assertIsNone(store.get("other"))
+
+    @require_coreml
+    @require_torch
+    def test_reuse_reference_outputs(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer, model = get_tiny_bert(tmp_dir)
+            coreml_config = BertCoreMLConfig(model.config, task="feature-extraction")
+            mlmodel = export(tokenizer, model, coreml_config)
+            store = ReferenceOutputStore(os.path.join(tmp_dir, "reference_outputs"))
+
+            error = validate_model_outputs(coreml_config, tokenizer, model, MILInterpreter(mlmodel), 1e-4, reference_store=store)
+            self.assertEqual(len(store.entries()), 1)
+            self.assertEqual(store.entries()[0].info["outputs"], ["last_hidden_state", "pooler_output"])
+
+            # With the weights hash in its metadata, the model is validated without the reference model.
+            mlmodel.user_defined_metadata[WEIGHTS_HASH_METADATA_KEY] = hash_model_weights(model)
+            with patch("exporters.coreml.validate._run_reference_model") as run_reference_model:
+                self.assertEqual(
+                    validate_model_outputs(coreml_config, tokenizer, None, MILInterpreter(mlmodel), 1e-4, reference_store=store),
+                    error,
+                )
+                run_reference_model.assert_not_called()
+
+            # Different weights are a miss, which needs the reference model.
+            with self.assertRaises(ValueError):
+                validate_model_outputs(
+                    coreml_config, tokenizer, None, MILInterpreter(mlmodel), 1e-4, reference_store=store, weights_hash="other"
+                )
+            validate_model_outputs(
+                coreml_config,
+                tokenizer,
+                None,
+                MILInterpreter(mlmodel),
+                1e-4,
+                reference_store=store,
+                weights_hash="other",
+                load_reference_model=lambda: model,
+            )
+            self.assertEqual(len(store.entries()), 2)
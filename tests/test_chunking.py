@@ -0,0 +1,195 @@
+# coding=utf-8
+# Copyright 2022 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+import coremltools as ct
+from transformers.testing_utils import require_torch
+from transformers.utils import TensorType
+
+from exporters.coreml.chunking import (
+    ChunkWrapper,
+    export_chunks,
+    get_chunk_features,
+    get_model_chunks,
+    split_layers,
+    validate_chunks,
+)
+from exporters.coreml.models import GPT2CoreMLConfig, LlamaCoreMLConfig
+from .testing_utils import get_tiny_gpt2, get_tiny_llama, load_test_model, require_coreml
+
+
+class SplitLayersTestCase(TestCase):
+    def test_split_layers(self):
+        self.assertEqual(split_layers([1, 1, 1, 1], 2), [(0, 2), (2, 4)])
+        self.assertEqual(split_layers([1, 1, 1, 1, 1, 1], 3), [(0, 2), (2, 4), (4, 6)])
+        self.assertEqual(split_layers([1, 1, 1], 1), [(0, 3)])
+
+        # Large embeddings in the first layer leave fewer layers for the first chunk.
+        self.assertEqual(split_layers([4, 1, 1, 1, 1], 2), [(0, 1), (1, 5)])
+
+        # Every chunk gets at least one layer.
+        self.assertEqual(split_layers([100, 1, 1], 3), [(0, 1), (1, 2), (2, 3)])
+
+        with self.assertRaises(ValueError):
+            split_layers([1, 1], 3)
+        with self.assertRaises(ValueError):
+            split_layers([1, 1], 0)
+
+
+class ChunkWrapperTestCase(TestCase):
+    def _run_chunks(self, config, chunks, model, dummy_inputs, caches=None):
+        hidden_states = None
+        for chunk in chunks:
+            names = list(get_chunk_features(config, chunk)[0])
+            inputs = []
+            for name in names:
+                if name.startswith("hidden_states_"):
+                    inputs.append(hidden_states)
+                elif caches is not None and name in caches:
+                    inputs.append(caches[name])
+                else:
+                    inputs.append(dummy_inputs[name])
+            outputs = ChunkWrapper(model, config, chunk)(*inputs)
+            hidden_states = outputs[0]
+            if caches is not None:
+                cache_names = [name for name in names if name.startswith("past_key_values_")]
+                caches.update(zip(cache_names, outputs[1:]))
+        return hidden_states
+
+    @require_torch
+    def test_chained_chunks_match_model(self):
+        import torch
+
+        for get_tiny_model, config_class in [(get_tiny_gpt2, GPT2CoreMLConfig), (get_tiny_llama, LlamaCoreMLConfig)]:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                tokenizer, model = get_tiny_model(tmp_dir, num_layers=4)
+                config = config_class(model.config, task="text-generation")
+                chunks = get_model_chunks(model, 3)
+                self.assertEqual(chunks[0].start_layer, 0)
+                self.assertEqual(chunks[-1].end_layer, 4)
+
+                dummy_inputs = config.generate_dummy_inputs(tokenizer, framework=TensorType.PYTORCH)
+                dummy_inputs = {name: value[0] for name, value in dummy_inputs.items()}
+                with torch.no_grad():
+                    logits = self._run_chunks(config, chunks, model, dummy_inputs)
+                    ref_logits = model(dummy_inputs["input_ids"], attention_mask=dummy_inputs["attention_mask"]).logits
+                self.assertTrue(torch.allclose(logits, ref_logits, atol=1e-5))
+
+    @require_torch
+    def test_chained_chunks_with_fixed_cache(self):
+        import torch
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer, model = get_tiny_llama(tmp_dir, num_layers=3)
+            config = LlamaCoreMLConfig(model.config, task="text-generation", use_past=True, kv_cache_capacity=8)
+            chunks = get_model_chunks(model, 2)
+
+            caches = {}
+            for chunk in chunks:
+                for name in get_chunk_features(config, chunk)[0]:
+                    if name.startswith("past_key_values_"):
+                        caches[name] = torch.zeros(config.kv_cache_shape[1:])
+            self.assertEqual(len(caches), 6)
+
+            input_ids = torch.tensor([[5]])
+            past_key_values = None
+            for position in range(4):
+                inputs = {"input_ids": input_ids, "position": torch.tensor([position])}
+                with torch.no_grad():
+                    logits = self._run_chunks(config, chunks, model, inputs, caches)
+                    ref_outputs = model(
+                        input_ids,
+                        attention_mask=torch.ones((1, position + 1), dtype=torch.int64),
+                        past_key_values=past_key_values,
+                        use_cache=True,
+                    )
+                self.assertTrue(torch.allclose(logits, ref_outputs.logits, atol=1e-5))
+                past_key_values = ref_outputs.past_key_values
+                input_ids = ref_outputs.logits[:, -1:].argmax(dim=-1)
+
+
+class ChunkedExportTestCase(TestCase):
+    @require_coreml
+    @require_torch
+    def test_export_chunks(self):
+        import coremltools.optimize.coreml as cto
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer, model = get_tiny_gpt2(tmp_dir, num_layers=3)
+            config = GPT2CoreMLConfig(model.config, task="text-generation", use_past=True, kv_cache_capacity=8)
+            output = os.path.join(tmp_dir, "Model.mlpackage")
+            results = export_chunks(tokenizer, model, config, output, 3, quantize="float16", num_workers=2)
+
+            self.assertEqual(
+                [os.path.basename(result.path) for result in results],
+                ["Model_chunk1of3.mlpackage", "Model_chunk2of3.mlpackage", "Model_chunk3of3.mlpackage"],
+            )
+
+            for i, result in enumerate(results):
+                mlmodel = ct.models.MLModel(result.path, skip_model_load=True)
+                metadata = mlmodel.user_defined_metadata
+                self.assertEqual(metadata["co.huggingface.exporters.precision"], "float16")
+
+                contract = json.loads(metadata["co.huggingface.exporters.chunk"])
+                self.assertEqual(contract["index"], i)
+                self.assertEqual(contract["layers"], [i, i + 1])
+                self.assertEqual(contract["cache"], {f"past_key_values_{i}_key": f"present_{i}_key", f"past_key_values_{i}_value": f"present_{i}_value"})
+                self.assertEqual(contract["inputs"][f"past_key_values_{i}_key"], [1, 2, 8, 16])
+                self.assertEqual(contract["inputs"]["position"], [1])
+
+                # Each chunk only holds the weights of its own layers.
+                weights = cto.get_weights_metadata(mlmodel, weight_threshold=100)
+                for layer in range(3):
+                    has_layer = any(name.startswith(f"model_transformer_h_{layer}_") for name in weights)
+                    self.assertEqual(has_layer, layer == i)
+
+            first, middle, last = [
+                json.loads(ct.models.MLModel(result.path, skip_model_load=True).user_defined_metadata["co.huggingface.exporters.chunk"])
+                for result in results
+            ]
+            self.assertIn("input_ids", first["inputs"])
+            self.assertEqual(first["outputs"]["hidden_states_1"], [1, 1, 32])
+            self.assertEqual(middle["previous_chunk"], {"hidden_states_1": "hidden_states_1"})
+            self.assertEqual(last["outputs"]["logits"], [1, 1, tokenizer.vocab_size])
+
+    @require_torch
+    def test_unsupported_options(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer, model = get_tiny_gpt2(tmp_dir, num_layers=3)
+            output = os.path.join(tmp_dir, "Model.mlpackage")
+            for options in [{"use_past": True}, {"use_past": True, "stateful": True}, {"batch_size": 4}]:
+                config = GPT2CoreMLConfig(model.config, task="text-generation", **options)
+                with self.assertRaises(ValueError):
+                    export_chunks(tokenizer, model, config, output, 2)
+
+            config = GPT2CoreMLConfig(model.config, task="text-generation")
+            with self.assertRaises(ValueError):
+                export_chunks(tokenizer, model, config, output, 4)
+
+    @require_coreml
+    @require_torch
+    def test_validate_chunks(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer, model = get_tiny_gpt2(tmp_dir, num_layers=3)
+            for options in [{}, {"use_past": True, "kv_cache_capacity": 8, "kv_cache_sliding_window": True}]:
+                config = GPT2CoreMLConfig(model.config, task="text-generation", **options)
+                output = os.path.join(tmp_dir, "Model.mlpackage")
+                results = export_chunks(tokenizer, model, config, output, 3)
+                mlmodels = [load_test_model(result.path) for result in results]
+                validate_chunks(config, tokenizer, model, mlmodels, config.atol_for_validation)
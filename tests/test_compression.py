@@ -0,0 +1,325 @@
+# coding=utf-8
+# Copyright 2022 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+import coremltools as ct
+import coremltools.optimize.coreml as cto
+from transformers.testing_utils import require_torch
+from transformers.utils import TensorType
+
+from exporters.coreml import export, trace_pytorch, validate_model_outputs
+from exporters.coreml.compression import (
+    LinearQuantizationConfig,
+    PalettizationConfig,
+    PruningConfig,
+    record_validation_error,
+)
+from exporters.coreml.convert import convert_traced_pytorch
+from exporters.coreml.models import GPT2CoreMLConfig
+from exporters.coreml.variants import ExportVariant
+from .testing_utils import get_tiny_gpt2, require_coreml, require_macos, require_sklearn
+
+
+class ExcludeAttentionCoreMLConfig(GPT2CoreMLConfig):
+    @property
+    def compression_exclude(self):
+        return ["transformer.h.0.attn.*"]
+
+
+def get_op_types(mlmodel):
+    op_types = set()
+    for function in mlmodel.get_spec().mlProgram.functions.values():
+        for block in function.block_specializations.values():
+            op_types.update(op.type for op in block.operations)
+    return op_types
+
+
+class PalettizationConfigTestCase(TestCase):
+    def test_options(self):
+        compression = PalettizationConfig(nbits=4)
+        self.assertEqual(compression.name, "palettize4")
+        self.assertEqual(compression.minimum_deployment_target, ct.target.iOS16)
+
+        compression = PalettizationConfig(nbits=2, granularity="per_grouped_channel", group_size=8)
+        self.assertEqual(compression.name, "palettize2-group8")
+        self.assertEqual(compression.minimum_deployment_target, ct.target.iOS18)
+        self.assertGreater(compression.atol_for_validation, PalettizationConfig(nbits=8).atol_for_validation)
+
+        with self.assertRaises(ValueError):
+            PalettizationConfig(nbits=3)
+        with self.assertRaises(ValueError):
+            PalettizationConfig(granularity="per_channel")
+
+    def test_variant(self):
+        variant = ExportVariant.from_string("quantize=float16,palettize=6,palettize_group_size=32")
+        self.assertEqual(variant.compression, PalettizationConfig(6, "per_grouped_channel", 32))
+        self.assertEqual(variant.name, "float16-all-palettize6-group32")
+
+        with self.assertRaises(ValueError):
+            ExportVariant.from_string("palettize_group_size=32")
+
+
+class LinearQuantizationConfigTestCase(TestCase):
+    def test_from_quantize(self):
+        self.assertIsNone(LinearQuantizationConfig.from_quantize("float16"))
+
+        compression = LinearQuantizationConfig.from_quantize("int8")
+        self.assertEqual(compression, LinearQuantizationConfig(dtype="int8"))
+        self.assertEqual(compression.name, "int8")
+        self.assertEqual(compression.minimum_deployment_target, ct.target.iOS16)
+
+        compression = LinearQuantizationConfig.from_quantize("int4-block64")
+        self.assertEqual(compression, LinearQuantizationConfig(dtype="int4", block_size=64))
+        self.assertEqual(compression.name, "int4-block64")
+        self.assertEqual(compression.minimum_deployment_target, ct.target.iOS18)
+
+        with self.assertRaises(ValueError):
+            LinearQuantizationConfig.from_quantize("int4")
+        with self.assertRaises(ValueError):
+            LinearQuantizationConfig(dtype="int4")
+
+        variant = ExportVariant.from_string("quantize=int4-block32")
+        self.assertEqual(variant.name, "int4-block32-all")
+
+
+class PruningConfigTestCase(TestCase):
+    def test_options(self):
+        compression = PruningConfig(target_sparsity=0.75, layers=["transformer.h.*"])
+        self.assertEqual(compression.name, "prune0.75")
+        self.assertEqual(compression.layers, ("transformer.h.*",))
+        self.assertEqual(compression.minimum_deployment_target, ct.target.iOS16)
+
+        compression = PruningConfig(palettization=PalettizationConfig(nbits=4))
+        self.assertEqual(compression.name, "prune0.5-palettize4")
+        self.assertEqual(compression.minimum_deployment_target, ct.target.iOS18)
+
+        self.assertEqual(PruningConfig(mode="threshold", threshold=0.01).name, "prune-threshold0.01")
+
+        with self.assertRaises(ValueError):
+            PruningConfig(mode="random")
+        with self.assertRaises(ValueError):
+            PruningConfig(target_sparsity=1.0)
+
+    def test_variant(self):
+        variant = ExportVariant.from_string("quantize=float16,prune=0.25,palettize=6")
+        self.assertEqual(variant.compression, PruningConfig(target_sparsity=0.25, palettization=PalettizationConfig(6)))
+        self.assertEqual(variant.name, "float16-all-prune0.25-palettize6")
+
+
+class PalettizationExportTestCase(TestCase):
+    @require_coreml
+    @require_torch
+    @require_sklearn
+    def test_palettize(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer, model = get_tiny_gpt2(tmp_dir)
+            coreml_config = ExcludeAttentionCoreMLConfig(model.config, task="text-generation")
+            mlmodel = export(tokenizer, model, coreml_config, compression=PalettizationConfig(nbits=4))
+
+            self.assertIn("constexpr_lut_to_dense", get_op_types(mlmodel))
+
+            metadata = mlmodel.user_defined_metadata
+            self.assertEqual(metadata["co.huggingface.exporters.compression"], "palettize4")
+            self.assertEqual(metadata["co.huggingface.exporters.precision"], "float32")
+            self.assertLess(
+                int(metadata["co.huggingface.exporters.weights_size"]),
+                int(metadata["co.huggingface.exporters.uncompressed_weights_size"]),
+            )
+            self.assertGreater(float(metadata["co.huggingface.exporters.compression_ratio"]), 1.0)
+
+            # Excluded layers and the causal mask keep their float values.
+            weights = cto.get_weights_metadata(mlmodel, weight_threshold=0)
+            self.assertIn("model_transformer_h_0_attn_c_attn_weight", weights)
+            self.assertNotIn("model_transformer_h_1_attn_c_attn_weight", weights)
+            self.assertTrue(any(weight.val.min() < -1e4 for weight in weights.values()))
+
+            filename = os.path.join(tmp_dir, "Model.mlpackage")
+            mlmodel.save(filename)
+            record_validation_error(filename, 0.125)
+            mlmodel = ct.models.MLModel(filename, skip_model_load=True)
+            self.assertEqual(mlmodel.user_defined_metadata["co.huggingface.exporters.validation_error"], "0.125")
+            self.assertEqual(mlmodel.user_defined_metadata["co.huggingface.exporters.compression"], "palettize4")
+
+    @require_coreml
+    @require_torch
+    @require_sklearn
+    def test_grouped_palettization_target(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer, model = get_tiny_gpt2(tmp_dir)
+            coreml_config = GPT2CoreMLConfig(model.config, task="text-generation")
+            compression = PalettizationConfig(nbits=4, granularity="per_grouped_channel", group_size=16)
+
+            dummy_inputs = coreml_config.generate_dummy_inputs(tokenizer, framework=TensorType.PYTORCH)
+            traced_model = trace_pytorch(tokenizer, model, coreml_config)
+            mlmodel = convert_traced_pytorch(
+                tokenizer, model.config, coreml_config, traced_model, dummy_inputs, compression=compression
+            )
+            self.assertGreaterEqual(mlmodel.get_spec().specificationVersion, ct.target.iOS18.value)
+            self.assertIn("constexpr_lut_to_dense", get_op_types(mlmodel))
+
+            with self.assertRaises(ValueError):
+                convert_traced_pytorch(
+                    tokenizer,
+                    model.config,
+                    coreml_config,
+                    traced_model,
+                    dummy_inputs,
+                    minimum_deployment_target=ct.target.iOS17,
+                    compression=compression,
+                )
+            with self.assertRaises(ValueError):
+                convert_traced_pytorch(
+                    tokenizer,
+                    model.config,
+                    coreml_config,
+                    traced_model,
+                    dummy_inputs,
+                    use_legacy_format=True,
+                    compression=compression,
+                )
+
+    @require_coreml
+    @require_torch
+    @require_sklearn
+    @require_macos
+    def test_validate_palettized(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer, model = get_tiny_gpt2(tmp_dir)
+            coreml_config = GPT2CoreMLConfig(model.config, task="text-generation")
+            compression = PalettizationConfig(nbits=8)
+            mlmodel = export(tokenizer, model, coreml_config, compression=compression)
+            error = validate_model_outputs(
+                coreml_config, tokenizer, model, mlmodel, compression.atol_for_validation
+            )
+            self.assertLess(error, compression.atol_for_validation)
+
+
+class PruningExportTestCase(TestCase):
+    @require_coreml
+    @require_torch
+    def test_prune_layers(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer, model = get_tiny_gpt2(tmp_dir)
+            coreml_config = GPT2CoreMLConfig(model.config, task="text-generation")
+            compression = PruningConfig(target_sparsity=0.5, layers=["transformer.h.1.*"])
+            mlmodel = export(tokenizer, model, coreml_config, quantize="float16", compression=compression)
+
+            self.assertIn("constexpr_sparse_to_dense", get_op_types(mlmodel))
+            metadata = mlmodel.user_defined_metadata
+            self.assertEqual(metadata["co.huggingface.exporters.compression"], "prune0.5")
+            self.assertEqual(metadata["co.huggingface.exporters.precision"], "float16")
+            self.assertAlmostEqual(float(metadata["co.huggingface.exporters.sparsity"]), 0.5, places=2)
+
+            layer_sparsity = json.loads(metadata["co.huggingface.exporters.layer_sparsity"])
+            self.assertEqual(
+                sorted(layer_sparsity),
+                [
+                    "model_transformer_h_1_attn_c_attn_weight_to_fp16",
+                    "model_transformer_h_1_mlp_c_fc_weight_to_fp16",
+                    "model_transformer_h_1_mlp_c_proj_weight_to_fp16",
+                ],
+            )
+            for sparsity in layer_sparsity.values():
+                self.assertAlmostEqual(sparsity, 0.5, places=2)
+
+            # The other layers stay dense.
+            weights = cto.get_weights_metadata(mlmodel, weight_threshold=0)
+            self.assertIn("model_transformer_h_0_attn_c_attn_weight_to_fp16", weights)
+            self.assertNotIn("model_transformer_h_1_attn_c_attn_weight_to_fp16", weights)
+
+    @require_coreml
+    @require_torch
+    @require_sklearn
+    def test_prune_and_palettize(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer, model = get_tiny_gpt2(tmp_dir)
+            coreml_config = GPT2CoreMLConfig(model.config, task="text-generation")
+            compression = PruningConfig(target_sparsity=0.5, palettization=PalettizationConfig(nbits=4))
+            mlmodel = export(tokenizer, model, coreml_config, quantize="float16", compression=compression)
+
+            self.assertGreaterEqual(mlmodel.get_spec().specificationVersion, ct.target.iOS18.value)
+            op_types = get_op_types(mlmodel)
+            self.assertIn("constexpr_sparse_to_dense", op_types)
+            self.assertIn("constexpr_lut_to_sparse", op_types)
+
+            metadata = mlmodel.user_defined_metadata
+            self.assertEqual(metadata["co.huggingface.exporters.compression"], "prune0.5-palettize4")
+            self.assertGreater(float(metadata["co.huggingface.exporters.compression_ratio"]), 1.0)
+
+            # The causal mask keeps its float values.
+            weights = cto.get_weights_metadata(mlmodel, weight_threshold=0)
+            self.assertTrue(any(weight.val.min() < -1e4 for weight in weights.values()))
+
+    @require_coreml
+    @require_torch
+    @require_macos
+    def test_validate_pruned(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer, model = get_tiny_gpt2(tmp_dir)
+            coreml_config = GPT2CoreMLConfig(model.config, task="text-generation")
+            compression = PruningConfig(mode="threshold", threshold=1e-3)
+            mlmodel = export(tokenizer, model, coreml_config, compression=compression)
+            validate_model_outputs(coreml_config, tokenizer, model, mlmodel, compression.atol_for_validation)
+
+
+class LinearQuantizationExportTestCase(TestCase):
+    @require_coreml
+    @require_torch
+    def test_int8(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer, model = get_tiny_gpt2(tmp_dir)
+            coreml_config = GPT2CoreMLConfig(model.config, task="text-generation")
+            mlmodel = export(tokenizer, model, coreml_config, quantize="int8")
+
+            self.assertIn("constexpr_affine_dequantize", get_op_types(mlmodel))
+            metadata = mlmodel.user_defined_metadata
+            self.assertEqual(metadata["co.huggingface.exporters.precision"], "int8")
+            self.assertEqual(metadata["co.huggingface.exporters.compression"], "int8")
+
+            # Only one kind of weight compression at a time.
+            with self.assertRaises(ValueError):
+                export(tokenizer, model, coreml_config, quantize="int8", compression=PalettizationConfig(nbits=4))
+
+    @require_coreml
+    @require_torch
+    def test_int4_block(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer, model = get_tiny_gpt2(tmp_dir)
+            coreml_config = GPT2CoreMLConfig(model.config, task="text-generation")
+            mlmodel = export(tokenizer, model, coreml_config, quantize="int4-block32")
+
+            self.assertIn("constexpr_blockwise_shift_scale", get_op_types(mlmodel))
+            self.assertGreaterEqual(mlmodel.get_spec().specificationVersion, ct.target.iOS18.value)
+            metadata = mlmodel.user_defined_metadata
+            self.assertEqual(metadata["co.huggingface.exporters.compression"], "int4-block32")
+            self.assertLess(
+                int(metadata["co.huggingface.exporters.weights_size"]),
+                int(metadata["co.huggingface.exporters.uncompressed_weights_size"]),
+            )
+
+    @require_coreml
+    @require_torch
+    @require_macos
+    def test_validate_int8(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer, model = get_tiny_gpt2(tmp_dir)
+            coreml_config = GPT2CoreMLConfig(model.config, task="text-generation")
+            mlmodel = export(tokenizer, model, coreml_config, quantize="int8")
+            compression = LinearQuantizationConfig.from_quantize("int8")
+            validate_model_outputs(coreml_config, tokenizer, model, mlmodel, compression.atol_for_validation)
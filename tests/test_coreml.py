@@ -13,6 +13,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import tempfile
+
 import pytest
 
 from unittest import TestCase
@@ -26,7 +28,7 @@ from exporters.coreml import (
 )
 from transformers.onnx.utils import get_preprocessor
 from transformers.testing_utils import require_tf, require_torch, require_vision, slow
-from .testing_utils import require_coreml, require_macos
+from .testing_utils import get_tiny_bert, require_coreml, require_macos
 
 
 if is_torch_available() or is_tf_available():
@@ -37,6 +39,32 @@ class TextCoreMLConfig(CoreMLConfig):
     modality = "text"
 
 
+class PatchTorchOpsTestCase(TestCase):
+    @require_coreml
+    @require_torch
+    def test_restore_after_failed_conversion(self):
+        from coremltools.converters.mil.frontend.torch.torch_op_registry import _TORCH_OPS_REGISTRY
+
+        from exporters.coreml.models import BertCoreMLConfig
+
+        def failing_op(context, node):
+            raise RuntimeError("conversion failed")
+
+        class PatchedBertCoreMLConfig(BertCoreMLConfig):
+            def patch_pytorch_ops(self):
+                return {"gelu": failing_op, "unused_op": failing_op}
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer, model = get_tiny_bert(tmp_dir)
+            gelu = _TORCH_OPS_REGISTRY["gelu"]
+            with self.assertRaises(RuntimeError):
+                export(tokenizer, model, PatchedBertCoreMLConfig(model.config, task="feature-extraction"))
+
+            # A later conversion in the same process uses the original ops.
+            self.assertIs(_TORCH_OPS_REGISTRY["gelu"], gelu)
+            self.assertNotIn("unused_op", _TORCH_OPS_REGISTRY)
+
+
 class CoreMLConfigTestCase(TestCase):
     def test_unknown_modality(self):
         with pytest.raises(ValueError):
@@ -0,0 +1,273 @@
+# coding=utf-8
+# Copyright 2022 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import tempfile
+import wave
+from unittest import TestCase
+
+import numpy as np
+from transformers import (
+    BertConfig,
+    ViTConfig,
+    Wav2Vec2Config,
+    Wav2Vec2CTCTokenizer,
+    Wav2Vec2FeatureExtractor,
+    Wav2Vec2Processor,
+    is_torch_available,
+    is_vision_available,
+)
+from transformers.testing_utils import require_torch, require_vision
+
+from exporters.coreml import export
+from exporters.coreml.compression import ActivationQuantizationConfig
+from exporters.coreml.config import CoreMLConfig
+from exporters.coreml.data import CalibrationData, ValidationData, read_wav, split_coreml_inputs
+from exporters.coreml.models import BertCoreMLConfig, ViTCoreMLConfig
+from .testing_utils import get_tiny_bert, get_tiny_bert_tokenizer, require_coreml, require_macos
+
+
+if is_torch_available():
+    from transformers import ViTForImageClassification
+
+if is_vision_available():
+    from PIL import Image
+    from transformers import ViTImageProcessor
+
+
+def get_tiny_vit_config(**kwargs):
+    return ViTConfig(
+        image_size=32,
+        patch_size=8,
+        hidden_size=32,
+        num_hidden_layers=1,
+        num_attention_heads=2,
+        intermediate_size=37,
+        architectures=["ViTForImageClassification"],
+        **kwargs,
+    )
+
+
+def write_images(data_dir, num_images):
+    os.makedirs(data_dir, exist_ok=True)
+    for i in range(num_images):
+        pixels = np.random.randint(0, 256, (40 + i, 50, 3), dtype=np.uint8)
+        Image.fromarray(pixels).save(os.path.join(data_dir, f"image{i}.png"))
+
+
+class CalibrationDataTestCase(TestCase):
+    def test_text(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer = get_tiny_bert_tokenizer(tmp_dir)
+            model_config = BertConfig(vocab_size=tokenizer.vocab_size, hidden_size=32, num_hidden_layers=1, num_attention_heads=2)
+            coreml_config = BertCoreMLConfig(model_config, task="feature-extraction", sequence_length_buckets=[16, 32])
+
+            data_dir = os.path.join(tmp_dir, "data")
+            os.makedirs(os.path.join(data_dir, "more"))
+            with open(os.path.join(data_dir, "a.txt"), "w") as f:
+                f.write("token1 token2\n\ntoken3\n")
+            with open(os.path.join(data_dir, "more", "b.txt"), "w") as f:
+                f.write("token4 token5 token6\ntoken7\n")
+            with open(os.path.join(data_dir, "ignored.json"), "w") as f:
+                f.write("{}")
+
+            data = CalibrationData(data_dir, coreml_config, tokenizer, num_samples=3, batch_size=2)
+            self.assertEqual(list(data.examples()), ["token1 token2", "token3", "token4 token5 token6"])
+
+            samples = list(data)
+            self.assertEqual(len(samples), 3)
+            self.assertEqual(sorted(samples[0].keys()), ["attention_mask", "input_ids"])
+            # Padded to the smallest bucket that fits the batch.
+            self.assertEqual(samples[0]["input_ids"].shape, (1, 16))
+            self.assertEqual(samples[0]["input_ids"].dtype, np.int32)
+            self.assertEqual(samples[1]["attention_mask"].sum(), 3)
+
+            # The files are read again on every pass.
+            self.assertEqual(len(list(data)), 3)
+
+            # Longer examples take a larger bucket, and are truncated to the largest one.
+            for num_tokens, length in [(14, 16), (15, 32), (40, 32)]:
+                text = " ".join(f"token{i}" for i in range(num_tokens))
+                _, input_ids = coreml_config.generate_inputs(tokenizer, ["token1", text])["input_ids"]
+                self.assertEqual(input_ids.shape, (2, length))
+
+            with self.assertRaises(ValueError):
+                CalibrationData(os.path.join(tmp_dir, "missing"), coreml_config, tokenizer)
+
+    @require_vision
+    def test_images(self):
+        preprocessor = ViTImageProcessor(size={"height": 32, "width": 32})
+        coreml_config = ViTCoreMLConfig(get_tiny_vit_config(), task="image-classification")
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            write_images(tmp_dir, 3)
+
+            samples = list(CalibrationData(tmp_dir, coreml_config, preprocessor, batch_size=2))
+            self.assertEqual(len(samples), 3)
+            self.assertEqual(samples[2]["image"].size, (32, 32))
+
+            coreml_config = ViTCoreMLConfig(get_tiny_vit_config(), task="image-classification", batch_size=(1, 4))
+            samples = list(CalibrationData(tmp_dir, coreml_config, preprocessor))
+            self.assertEqual(samples[0]["image"].shape, (1, 3, 32, 32))
+
+            with self.assertRaises(ValueError):
+                coreml_config = ViTCoreMLConfig(get_tiny_vit_config(), task="image-classification", batch_size=8)
+                CalibrationData(tmp_dir, coreml_config, preprocessor)
+
+    @require_vision
+    def test_generate_inputs(self):
+        preprocessor = ViTImageProcessor(size={"height": 32, "width": 32})
+        coreml_config = ViTCoreMLConfig(get_tiny_vit_config(), task="image-classification")
+
+        image = Image.fromarray(np.random.randint(0, 256, (64, 48, 3), dtype=np.uint8))
+        ref_value, coreml_value = coreml_config.generate_inputs(preprocessor, [image])["pixel_values"]
+
+        # The image is resized for Core ML, and the reference input is the normalized Core ML image.
+        self.assertEqual(coreml_value[0].size, (32, 32))
+        expected = preprocessor(coreml_value, do_resize=False)["pixel_values"]
+        self.assertTrue(np.allclose(ref_value, expected))
+
+
+def write_wav(filename, samples, sampling_rate=16000):
+    with wave.open(filename, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sampling_rate)
+        f.writeframes((samples * 32767).astype("<i2").tobytes())
+
+
+class ValidationDataTestCase(TestCase):
+    def test_text(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer = get_tiny_bert_tokenizer(tmp_dir)
+            model_config = BertConfig(vocab_size=tokenizer.vocab_size, hidden_size=32, num_hidden_layers=1, num_attention_heads=2)
+            coreml_config = BertCoreMLConfig(model_config, task="feature-extraction")
+
+            data_dir = os.path.join(tmp_dir, "data")
+            os.makedirs(os.path.join(data_dir, "more"))
+            with open(os.path.join(data_dir, "a.txt"), "w") as f:
+                f.write("\n".join(f"token{i}" for i in range(7)) + "\n")
+            with open(os.path.join(data_dir, "more", "b.txt"), "w") as f:
+                f.write("token7 token8\n")
+
+            data = ValidationData(data_dir, coreml_config, tokenizer, batch_size=3, num_workers=2)
+            batches = list(data.batches())
+            self.assertEqual([len(batch["input_ids"][0]) for batch in batches], [3, 3, 2])
+            self.assertEqual(batches[0]["input_ids"][0].shape, (3, 128))
+            self.assertEqual(batches[0]["input_ids"][1].dtype, np.int32)
+
+            # The batches come out in the order of the files, whichever thread prepared them.
+            input_ids = np.concatenate([batch["input_ids"][0] for batch in batches])
+            expected = tokenizer([f"token{i}" for i in range(7)] + ["token7 token8"], padding="max_length", max_length=128)
+            np.testing.assert_equal(input_ids, expected["input_ids"])
+
+            samples = split_coreml_inputs(coreml_config, batches[2])
+            self.assertEqual(len(samples), 2)
+            self.assertEqual(samples[1]["input_ids"].shape, (1, 128))
+            self.assertEqual(samples[1]["attention_mask"].sum(), 4)
+
+            data = ValidationData(os.path.join(data_dir, "a.txt"), coreml_config, tokenizer, num_samples=4)
+            self.assertEqual(sum(len(batch["input_ids"][0]) for batch in data.batches()), 4)
+
+            # Stopping early leaves the rest of the data unread: only the batches that were already queued
+            # are prepared.
+            data = ValidationData(data_dir, coreml_config, tokenizer, batch_size=1, num_workers=1)
+            prepared = []
+            prepare = data._prepare
+            data._prepare = lambda raw_batch, framework: prepared.append(raw_batch) or prepare(raw_batch, framework)
+            batches = data.batches()
+            next(batches)
+            batches.close()
+            self.assertLessEqual(len(prepared), 2)
+
+            with self.assertRaises(ValueError):
+                ValidationData(os.path.join(tmp_dir, "missing"), coreml_config, tokenizer)
+            with self.assertRaises(ValueError):
+                coreml_config = BertCoreMLConfig(model_config, task="feature-extraction", batch_size=8)
+                ValidationData(data_dir, coreml_config, tokenizer)
+
+    @require_vision
+    def test_images(self):
+        preprocessor = ViTImageProcessor(size={"height": 32, "width": 32})
+        coreml_config = ViTCoreMLConfig(get_tiny_vit_config(), task="image-classification")
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            write_images(tmp_dir, 5)
+
+            batches = list(ValidationData(tmp_dir, coreml_config, preprocessor, num_samples=4, batch_size=3).batches())
+            self.assertEqual([len(batch["pixel_values"][1]) for batch in batches], [3, 1])
+            self.assertEqual(np.array(batches[0]["pixel_values"][0]).shape, (3, 3, 32, 32))
+
+            samples = split_coreml_inputs(coreml_config, batches[0])
+            self.assertEqual(samples[2]["image"].size, (32, 32))
+
+    def test_audio(self):
+        class AudioCoreMLConfig(CoreMLConfig):
+            modality = "audio"
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            vocab_file = os.path.join(tmp_dir, "vocab.json")
+            with open(vocab_file, "w") as f:
+                json.dump({"<pad>": 0, "<unk>": 1, "|": 2}, f)
+            feature_extractor = Wav2Vec2FeatureExtractor(return_attention_mask=True)
+            processor = Wav2Vec2Processor(feature_extractor, Wav2Vec2CTCTokenizer(vocab_file))
+            coreml_config = AudioCoreMLConfig(Wav2Vec2Config(), task="feature-extraction")
+
+            data_dir = os.path.join(tmp_dir, "data")
+            os.makedirs(data_dir)
+            waveforms = [np.sin(np.arange(length) / 10.0) * 0.5 for length in [800, 1200]]
+            for i, waveform in enumerate(waveforms):
+                write_wav(os.path.join(data_dir, f"audio{i}.wav"), waveform)
+
+            samples, sampling_rate = read_wav(os.path.join(data_dir, "audio0.wav"))
+            self.assertEqual(sampling_rate, 16000)
+            self.assertEqual(samples.dtype, np.float32)
+            np.testing.assert_allclose(samples, waveforms[0], atol=1e-4)
+
+            batch = next(ValidationData(data_dir, coreml_config, processor).batches())
+            ref_value, coreml_value = batch["input_values"]
+            self.assertEqual(ref_value.shape, (2, 1200))
+            self.assertEqual(coreml_value.dtype, np.float32)
+            self.assertEqual(batch["attention_mask"][1][0].sum(), 800)
+
+            write_wav(os.path.join(data_dir, "audio2.wav"), waveforms[0], sampling_rate=8000)
+            with self.assertRaises(ValueError):
+                list(ValidationData(data_dir, coreml_config, processor).batches())
+
+
+class ActivationQuantizationTestCase(TestCase):
+    @require_coreml
+    @require_torch
+    @require_vision
+    @require_macos
+    def test_w8a8(self):
+        preprocessor = ViTImageProcessor(size={"height": 32, "width": 32})
+        model = ViTForImageClassification(get_tiny_vit_config()).eval()
+        coreml_config = ViTCoreMLConfig(model.config, task="image-classification")
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            write_images(tmp_dir, 4)
+            calibration_data = CalibrationData(tmp_dir, coreml_config, preprocessor)
+            mlmodel = export(
+                preprocessor, model, coreml_config, compression=ActivationQuantizationConfig(calibration_data)
+            )
+
+        op_types = set()
+        for function in mlmodel.get_spec().mlProgram.functions.values():
+            for block in function.block_specializations.values():
+                op_types.update(op.type for op in block.operations)
+        self.assertIn("quantize", op_types)
+        self.assertEqual(mlmodel.user_defined_metadata["co.huggingface.exporters.compression"], "w8a8")
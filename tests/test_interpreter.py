@@ -0,0 +1,248 @@
+# coding=utf-8
+# Copyright 2022 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+import os
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+from transformers import is_torch_available
+from transformers.testing_utils import require_torch, require_vision
+from transformers.utils import TensorType
+
+from exporters.coreml import MILInterpreter, export, trace_pytorch, validate_model_outputs
+from exporters.coreml.benchmark import get_tiny_model_config, get_tiny_preprocessor
+from exporters.coreml.convert import convert_traced_pytorch
+from exporters.coreml.features import FeaturesManager
+from exporters.coreml.interpreter import _OP_KERNELS
+from exporters.coreml.models import BertCoreMLConfig, GPT2CoreMLConfig
+from exporters.coreml.validate import get_validation_backend
+from .testing_utils import get_tiny_bert, get_tiny_gpt2, is_macos_available, require_coreml
+
+
+if is_torch_available():
+    import torch
+    import torch.nn.functional as F
+
+
+def _tiny_model(model_type, feature, tmp_dir):
+    model_config = get_tiny_model_config(model_type, feature)
+    model = FeaturesManager.get_model_class_for_feature(feature).from_config(model_config).eval()
+    model.config.architectures = [type(model).__name__]
+    coreml_config = FeaturesManager.get_config(model_type, feature)(model.config)
+    preprocessor = get_tiny_preprocessor(model.config, coreml_config.modality, tmp_dir)
+    return preprocessor, model, coreml_config
+
+
+@require_coreml
+@require_torch
+class KernelsTestCase(TestCase):
+    def test_erf(self):
+        x = np.linspace(-4, 4, 101, dtype=np.float32)
+        expected = np.array([math.erf(value) for value in x], dtype=np.float32)
+        self.assertLess(np.abs(_OP_KERNELS["erf"](x=x) - expected).max(), 1e-6)
+
+    def test_conv(self):
+        x = torch.randn(2, 4, 9, 8)
+        weight = torch.randn(6, 2, 3, 3)
+        bias = torch.randn(6)
+        expected = F.conv2d(x, weight, bias, stride=2, padding=(1, 2), dilation=(1, 2), groups=2)
+        result = _OP_KERNELS["conv"](
+            x=x.numpy(),
+            weight=weight.numpy(),
+            bias=bias.numpy(),
+            strides=np.array([2, 2]),
+            pad_type="custom",
+            pad=np.array([1, 1, 2, 2]),
+            dilations=np.array([1, 2]),
+            groups=2,
+        )
+        np.testing.assert_allclose(result, expected.numpy(), atol=1e-4)
+
+        # "same" padding keeps the size of the input with a stride of 1.
+        result = _OP_KERNELS["conv"](x=x.numpy(), weight=weight[:, :1].repeat(1, 4, 1, 1).numpy(), pad_type="same")
+        self.assertEqual(result.shape, (2, 6, 9, 8))
+
+    def test_conv_transpose(self):
+        x = torch.randn(1, 4, 5, 6)
+        weight = torch.randn(4, 3, 3, 2)
+        expected = F.conv_transpose2d(x, weight, stride=2, padding=1, output_padding=1)
+        result = _OP_KERNELS["conv_transpose"](
+            x=x.numpy(),
+            weight=weight.numpy(),
+            pad_type="custom",
+            pad=np.array([1, 1, 1, 1]),
+            output_shape=np.array(expected.shape),
+            strides=np.array([2, 2]),
+        )
+        np.testing.assert_allclose(result, expected.numpy(), atol=1e-4)
+
+    def test_pooling(self):
+        x = torch.randn(1, 3, 7, 7)
+        expected = F.max_pool2d(x, 3, stride=2, padding=1, ceil_mode=True)
+        result = _OP_KERNELS["max_pool"](
+            x=x.numpy(), kernel_sizes=[3, 3], strides=[2, 2], pad_type="custom", pad=[1, 1, 1, 1], ceil_mode=True
+        )
+        np.testing.assert_allclose(result, expected.numpy())
+
+        expected = F.avg_pool2d(x, 3, stride=2, padding=1, count_include_pad=False)
+        result = _OP_KERNELS["avg_pool"](
+            x=x.numpy(),
+            kernel_sizes=[3, 3],
+            strides=[2, 2],
+            pad_type="custom",
+            pad=[1, 1, 1, 1],
+            exclude_padding_from_average=True,
+        )
+        np.testing.assert_allclose(result, expected.numpy(), atol=1e-6)
+
+    def test_upsample_bilinear(self):
+        x = torch.randn(1, 2, 5, 4)
+        for align_corners in [True, False]:
+            expected = F.interpolate(x, scale_factor=2, mode="bilinear", align_corners=align_corners)
+            result = _OP_KERNELS["upsample_bilinear"](
+                x=x.numpy(), scale_factor_height=2, scale_factor_width=2, align_corners=align_corners
+            )
+            np.testing.assert_allclose(result, expected.numpy(), atol=1e-5)
+
+    def test_gather_and_scatter(self):
+        x = np.arange(24, dtype=np.float32).reshape(2, 3, 4)
+        indices = np.array([[2, 0], [1, -1]])
+        np.testing.assert_equal(
+            _OP_KERNELS["gather"](x=x, indices=indices, axis=1, batch_dims=1), np.stack([x[0, [2, 0]], x[1, [1, 2]]])
+        )
+
+        updates = np.ones((2, 2, 4), dtype=np.float32)
+        expected = x.copy()
+        expected[:, [2, 0]] = updates
+        result = _OP_KERNELS["scatter"](data=x, indices=np.array([2, 0]), updates=updates, axis=1, mode="update")
+        np.testing.assert_equal(result, expected)
+
+        expected = x.copy()
+        expected[:, [2, 0]] += updates
+        result = _OP_KERNELS["scatter"](data=x, indices=np.array([2, -3]), updates=updates, axis=1, mode="add")
+        np.testing.assert_equal(result, expected)
+
+
+@require_coreml
+@require_torch
+class InterpreterTestCase(TestCase):
+    def test_text_model(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer, model = get_tiny_bert(tmp_dir)
+            coreml_config = BertCoreMLConfig(model.config, task="feature-extraction")
+            mlmodel = export(tokenizer, model.eval(), coreml_config)
+
+            interpreter = MILInterpreter(mlmodel)
+            self.assertEqual(interpreter.input_names, ["input_ids", "attention_mask"])
+            self.assertEqual(interpreter.output_names, ["last_hidden_state", "pooler_output"])
+            self.assertIn("co.huggingface.exporters.name", interpreter.user_defined_metadata)
+
+            error = validate_model_outputs(coreml_config, tokenizer, model, interpreter, 1e-4)
+            self.assertLess(error, 1e-5)
+
+            # The interpreter can load the saved model too.
+            filename = os.path.join(tmp_dir, "Model.mlpackage")
+            mlmodel.save(filename)
+            validate_model_outputs(coreml_config, tokenizer, model, MILInterpreter(filename), 1e-4)
+
+            with self.assertRaises(ValueError):
+                interpreter.predict({"input_ids": np.zeros((1, 128), dtype=np.int32)})
+
+    def test_float16(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer, model = get_tiny_gpt2(tmp_dir)
+            coreml_config = GPT2CoreMLConfig(model.config, task="text-generation")
+            mlmodel = export(tokenizer, model, coreml_config, quantize="float16")
+
+            # Rounding to float16 after every op loses precision, which the attention masks survive.
+            error = validate_model_outputs(coreml_config, tokenizer, model, MILInterpreter(mlmodel), 0.02)
+            float32_error = validate_model_outputs(
+                coreml_config, tokenizer, model, MILInterpreter(mlmodel, emulate_float16=False), 0.02
+            )
+            self.assertGreater(error, float32_error)
+
+            inputs = coreml_config.generate_dummy_inputs(tokenizer, framework=TensorType.PYTORCH)
+            outputs = MILInterpreter(mlmodel).predict({name: value[1] for name, value in inputs.items()})
+            logits = outputs["logits"]
+            np.testing.assert_equal(logits, logits.astype(np.float16).astype(np.float32))
+
+    @require_vision
+    def test_vision_models(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for model_type, feature in [("vit", "image-classification"), ("convnext", "feature-extraction")]:
+                preprocessor, model, coreml_config = _tiny_model(model_type, feature, tmp_dir)
+                mlmodel = export(preprocessor, model, coreml_config)
+                error = validate_model_outputs(
+                    coreml_config, preprocessor, model, MILInterpreter(mlmodel), coreml_config.atol_for_validation
+                )
+                self.assertLessEqual(error, coreml_config.atol_for_validation)
+
+    def test_compressed_model(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer, model = get_tiny_gpt2(tmp_dir)
+            coreml_config = GPT2CoreMLConfig(model.config, task="text-generation")
+            mlmodel = export(tokenizer, model, coreml_config, quantize="int8")
+            validate_model_outputs(coreml_config, tokenizer, model, MILInterpreter(mlmodel), 0.05)
+
+    def test_stateful_model(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer, model = get_tiny_gpt2(tmp_dir)
+            for kv_cache_capacity in [None, 16]:
+                coreml_config = GPT2CoreMLConfig(
+                    model.config,
+                    task="text-generation",
+                    use_past=True,
+                    stateful=True,
+                    kv_cache_capacity=kv_cache_capacity,
+                )
+                mlmodel = export(tokenizer, model, coreml_config)
+                interpreter = MILInterpreter(mlmodel)
+                validate_model_outputs(coreml_config, tokenizer, model, interpreter, 1e-3)
+
+                state = interpreter.make_state()
+                self.assertEqual(state.read_state("key_cache").shape, coreml_config.kv_cache_shape)
+
+    def test_neural_network(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer, model = get_tiny_bert(tmp_dir)
+            coreml_config = BertCoreMLConfig(model.config, task="feature-extraction")
+            dummy_inputs = coreml_config.generate_dummy_inputs(tokenizer, framework=TensorType.PYTORCH)
+            traced_model = trace_pytorch(tokenizer, model.eval(), coreml_config)
+            mlmodel = convert_traced_pytorch(
+                tokenizer, model.config, coreml_config, traced_model, dummy_inputs, use_legacy_format=True
+            )
+            with self.assertRaises(ValueError):
+                MILInterpreter(mlmodel)
+
+            filename = os.path.join(tmp_dir, "Model.mlmodel")
+            mlmodel.save(filename)
+            expected = "coreml" if is_macos_available() else None
+            self.assertEqual(get_validation_backend(filename), expected)
+            self.assertEqual(get_validation_backend(filename, "numpy"), None)
+
+    def test_validation_backend(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer, model = get_tiny_bert(tmp_dir)
+            coreml_config = BertCoreMLConfig(model.config, task="feature-extraction")
+            filename = os.path.join(tmp_dir, "Model.mlpackage")
+            export(tokenizer, model.eval(), coreml_config).save(filename)
+
+            self.assertEqual(get_validation_backend(filename), "coreml" if is_macos_available() else "numpy")
+            self.assertEqual(get_validation_backend(filename, "numpy"), "numpy")
+            self.assertEqual(get_validation_backend(filename, "coreml"), "coreml" if is_macos_available() else None)
+            with self.assertRaises(ValueError):
+                get_validation_backend(filename, "torch")
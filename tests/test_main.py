@@ -0,0 +1,166 @@
+# coding=utf-8
+# Copyright 2022 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import tempfile
+from pathlib import Path
+from unittest import TestCase
+from unittest.mock import patch
+
+from transformers import BartConfig, is_torch_available
+from transformers.testing_utils import require_torch
+
+from exporters.coreml.__main__ import convert_model, convert_seq2seq_model, export_from_args, get_parser
+from exporters.coreml.features import FeaturesManager
+from exporters.coreml.memory import MemoryTracker
+from .testing_utils import get_tiny_bert_tokenizer, get_tiny_gpt2, require_coreml
+
+
+if is_torch_available():
+    from transformers import BartForConditionalGeneration
+
+
+class Seq2SeqExportTestCase(TestCase):
+    @require_coreml
+    @require_torch
+    def test_parallel_encoder_decoder(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer = get_tiny_bert_tokenizer(tmp_dir)
+            model_config = BartConfig(
+                vocab_size=tokenizer.vocab_size,
+                d_model=32,
+                encoder_layers=1,
+                decoder_layers=1,
+                encoder_attention_heads=2,
+                decoder_attention_heads=2,
+                encoder_ffn_dim=37,
+                decoder_ffn_dim=37,
+                architectures=["BartForConditionalGeneration"],
+            )
+            model = BartForConditionalGeneration(model_config).eval()
+            _, model_coreml_config = FeaturesManager.check_supported_model_or_raise(
+                model, feature="text2text-generation"
+            )
+
+            args = get_parser().parse_args(["-m", "bart", "--feature", "text2text-generation", tmp_dir])
+            args.output = Path(tmp_dir) / "Model.mlpackage"
+
+            filenames = convert_seq2seq_model(tokenizer, model, model_coreml_config, args)
+            self.assertEqual(
+                [os.path.basename(filename) for filename in filenames],
+                ["encoder_Model.mlpackage", "decoder_Model.mlpackage"],
+            )
+            for filename in filenames:
+                self.assertTrue(os.path.exists(filename))
+
+
+class ReportTestCase(TestCase):
+    @require_coreml
+    @require_torch
+    def test_report(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer, model = get_tiny_gpt2(tmp_dir)
+            _, model_coreml_config = FeaturesManager.check_supported_model_or_raise(model, feature="text-generation")
+
+            args = get_parser().parse_args(
+                ["-m", "gpt2", "--feature", "text-generation", "--quantize", "int8", "--report", "--profile", tmp_dir]
+            )
+            args.output = Path(tmp_dir) / "Model.mlpackage"
+
+            tracker = MemoryTracker()
+            filename = convert_model(tokenizer, model, model_coreml_config, args, memory_tracker=tracker)
+
+            with open(os.path.join(tmp_dir, "Model.report.json")) as f:
+                report = json.load(f)
+            self.assertEqual(report["output"], filename)
+            self.assertEqual(report["task"], "text-generation")
+            self.assertEqual(report["quantize"], "int8")
+            self.assertEqual(report["compression"], "int8")
+            self.assertEqual(report["num_parameters"], model.num_parameters())
+            self.assertGreater(report["package_size"], 0)
+            self.assertIn("coremltools", report["versions"])
+
+            phases = [phase["name"] for phase in report["phases"]]
+            self.assertEqual(phases[:4], ["trace", "convert", "finalize", "compress"])
+            spans = [span["name"] for span in report["spans"]]
+            for name in ["dummy_inputs", "forward", "jit_trace", "patch_ops", "describe", "save"]:
+                self.assertIn(name, spans)
+            self.assertAlmostEqual(report["duration"], sum(phase["duration"] for phase in report["phases"]))
+
+            # Without Core ML, the NumPy interpreter validates the model.
+            self.assertIn("validate", phases)
+            self.assertIn("predict", spans)
+            self.assertIn(report["validation"]["backend"], ["coreml", "numpy"])
+            self.assertLessEqual(report["validation"]["max_error"], report["validation"]["atol"])
+
+    @require_coreml
+    @require_torch
+    def test_validation_samples(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer, model = get_tiny_gpt2(tmp_dir)
+            _, model_coreml_config = FeaturesManager.check_supported_model_or_raise(model, feature="text-generation")
+
+            args = get_parser().parse_args(
+                ["-m", "gpt2", "--feature", "text-generation", "--validation_samples", "3", "--report", tmp_dir]
+            )
+            args.output = Path(tmp_dir) / "Model.mlpackage"
+            convert_model(tokenizer, model, model_coreml_config, args)
+
+            with open(os.path.join(tmp_dir, "Model.report.json")) as f:
+                validation = json.load(f)["validation"]
+            self.assertEqual(validation["samples"], 3)
+            metrics = validation["outputs"]["logits"]
+            self.assertEqual(metrics["max_abs_error"], validation["max_error"])
+            self.assertEqual(set(metrics["relative_error"]), {"p50", "p90", "p99"})
+            self.assertGreater(metrics["min_cosine_similarity"], 0.999)
+
+
+class ValidateOnlyTestCase(TestCase):
+    @require_coreml
+    @require_torch
+    def test_validate_only(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer, model = get_tiny_gpt2(tmp_dir)
+            model_dir = os.path.join(tmp_dir, "model")
+            model.save_pretrained(model_dir)
+            tokenizer.save_pretrained(model_dir)
+
+            options = ["-m", model_dir, "--feature", "text-generation", "--reference_cache"]
+            options += ["--reference_cache_dir", os.path.join(tmp_dir, "reference_outputs")]
+            output = os.path.join(tmp_dir, "exported")
+            export_from_args(get_parser().parse_args(options + [output]))
+
+            # The reference outputs were stored during the export, so the model isn't loaded again.
+            with patch("exporters.coreml.features.FeaturesManager.get_model_from_feature") as get_model_from_feature:
+                filenames = export_from_args(get_parser().parse_args(options + ["--validate_only", output]))
+                get_model_from_feature.assert_not_called()
+            self.assertEqual(filenames, [os.path.join(output, "Model.mlpackage")])
+
+            # Without stored outputs, the model is loaded during the validate phase, not in a phase of its own.
+            phases = []
+            original_phase = MemoryTracker.phase
+
+            def phase(tracker, name):
+                phases.append(name)
+                return original_phase(tracker, name)
+
+            empty_options = options[:-1] + [os.path.join(tmp_dir, "empty_reference_outputs")]
+            with patch.object(MemoryTracker, "phase", phase):
+                export_from_args(get_parser().parse_args(empty_options + ["--validate_only", output]))
+            self.assertEqual(phases, ["validate"])
+
+            with self.assertRaises(ValueError):
+                export_from_args(get_parser().parse_args(options + ["--validate_only", os.path.join(tmp_dir, "missing")]))
@@ -0,0 +1,165 @@
+# coding=utf-8
+# Copyright 2022 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+import tempfile
+from unittest import TestCase
+
+from transformers.testing_utils import require_torch
+from transformers.utils import is_accelerate_available
+
+from exporters.coreml import export
+from exporters.coreml.features import FeaturesManager
+from exporters.coreml.memory import (
+    ExportCallback,
+    MemoryTracker,
+    get_memory_usage,
+    get_peak_memory,
+    release_memory,
+    reset_peak_memory,
+)
+from exporters.coreml.models import GPT2CoreMLConfig
+from .testing_utils import get_tiny_gpt2, require_coreml
+
+
+class MemoryTrackerTestCase(TestCase):
+    def test_phases(self):
+        size = 64 * 1024 * 1024
+        tracker = MemoryTracker()
+        with tracker.phase("load"):
+            data = b"\x01" * size
+            del data
+        with tracker.phase("convert"):
+            pass
+        with tracker.phase("convert"):
+            pass
+
+        self.assertEqual(list(tracker.phases), ["load", "convert"])
+        self.assertGreater(tracker.phases["load"].peak_memory, size)
+        self.assertEqual(tracker.peak_memory, max(phase.peak_memory for phase in tracker.phases.values()))
+
+        # The peak can only be measured per phase where it can be reset.
+        if sys.platform.startswith("linux") and reset_peak_memory():
+            self.assertTrue(tracker.phases["load"].is_reset)
+            self.assertLess(tracker.phases["convert"].peak_memory, tracker.phases["load"].peak_memory)
+            self.assertGreater(tracker.phases["load"].peak_increase, size // 2)
+            self.assertLess(tracker.phases["convert"].peak_increase, size // 2)
+
+    def test_spans_and_callbacks(self):
+        class RecordingCallback(ExportCallback):
+            def __init__(self):
+                self.events = []
+
+            def on_phase_begin(self, name):
+                self.events.append(("phase_begin", name))
+
+            def on_phase_end(self, phase):
+                self.events.append(("phase_end", phase.name))
+
+            def on_span_end(self, name, duration):
+                self.events.append(("span_end", name))
+
+        callback = RecordingCallback()
+        tracker = MemoryTracker(callbacks=[callback])
+        with tracker.phase("convert"):
+            with tracker.span("patch_ops"):
+                pass
+            with tracker.span("describe"):
+                with tracker.span("rename"):
+                    pass
+        with tracker.span("patch_ops"):
+            pass
+
+        self.assertEqual(
+            callback.events,
+            [
+                ("phase_begin", "convert"),
+                ("span_end", "patch_ops"),
+                ("span_end", "rename"),
+                ("span_end", "describe"),
+                ("phase_end", "convert"),
+                ("span_end", "patch_ops"),
+            ],
+        )
+        self.assertEqual(list(tracker.spans), ["patch_ops", "rename", "describe"])
+        self.assertEqual(tracker.spans["patch_ops"].count, 2)
+        self.assertGreaterEqual(tracker.spans["describe"].duration, tracker.spans["rename"].duration)
+        self.assertEqual(list(tracker.phases), ["convert"])
+
+    def test_phase_with_error(self):
+        tracker = MemoryTracker()
+        with self.assertRaises(RuntimeError):
+            with tracker.phase("trace"):
+                raise RuntimeError("failed")
+        self.assertIn("trace", tracker.phases)
+        self.assertIsNotNone(get_peak_memory())
+
+
+class ExportMemoryTestCase(TestCase):
+    @require_coreml
+    @require_torch
+    def test_export_peak_memory(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer, model = get_tiny_gpt2(tmp_dir, num_layers=8, hidden_size=512)
+            weights_size = sum(param.numel() * param.element_size() for param in model.parameters())
+            config = GPT2CoreMLConfig(model.config, task="text-generation")
+
+            # Converting needs less than another copy of the weights on top of the model: the MIL constants
+            # share the memory of the PyTorch weights, until they are cast to float16.
+            exports = [
+                ("int8", ["trace", "convert", "finalize", "compress"], 1.5 * weights_size),
+                ("float32", ["trace", "convert", "finalize"], 0.75 * weights_size),
+            ]
+            for i, (quantize, phases, convert_limit) in enumerate(exports):
+                release_memory()
+                memory_before = get_memory_usage()
+
+                tracker = MemoryTracker()
+                mlmodel = export(tokenizer, model, config, quantize=quantize, memory_tracker=tracker)
+                self.assertEqual(list(tracker.phases), phases)
+                del mlmodel
+
+                if not (sys.platform.startswith("linux") and reset_peak_memory()):
+                    continue
+
+                self.assertLess(tracker.phases["trace"].peak_increase, 1.5 * weights_size)
+                self.assertLess(tracker.phases["convert"].peak_increase, convert_limit)
+                self.assertLess(tracker.phases["finalize"].peak_increase, weights_size // 4)
+
+                # Little of the conversion stays behind once the model is released. The first export also
+                # loads code and fills caches.
+                if i > 0:
+                    release_memory()
+                    self.assertLess(get_memory_usage() - memory_before, weights_size // 4)
+
+
+class LowMemoryLoadingTestCase(TestCase):
+    @require_torch
+    def test_low_cpu_mem_usage(self):
+        import torch
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            _, model = get_tiny_gpt2(tmp_dir)
+            model.save_pretrained(tmp_dir)
+
+            if not is_accelerate_available():
+                with self.assertRaises(ImportError):
+                    FeaturesManager.get_model_from_feature("text-generation", tmp_dir, low_cpu_mem_usage=True)
+                return
+
+            loaded = FeaturesManager.get_model_from_feature("text-generation", tmp_dir, low_cpu_mem_usage=True)
+            for name, param in loaded.state_dict().items():
+                self.assertNotEqual(param.device.type, "meta")
+                self.assertTrue(torch.equal(param, model.state_dict()[name]))
@@ -0,0 +1,111 @@
+# coding=utf-8
+# Copyright 2022 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+import coremltools as ct
+from transformers import GPT2Config
+from transformers.testing_utils import require_torch
+
+from exporters.coreml import export, validate_model_outputs
+from exporters.coreml.cache import get_path_size
+from exporters.coreml.models import GPT2CoreMLConfig
+from exporters.coreml.multifunction import export_multifunction, get_generation_step_configs
+from .testing_utils import get_tiny_gpt2, load_test_model, require_coreml
+
+
+class GenerationStepConfigTestCase(TestCase):
+    def test_inputs_and_outputs(self):
+        model_config = GPT2Config(n_embd=32, n_layer=2, n_head=2)
+        coreml_config = GPT2CoreMLConfig(model_config, task="text-generation", use_past=True)
+        step_configs = get_generation_step_configs(coreml_config, prefill_length=16)
+        self.assertEqual(list(step_configs), ["prefill", "decode"])
+
+        prefill_config = step_configs["prefill"]
+        self.assertEqual(list(prefill_config.inputs), ["input_ids", "attention_mask"])
+        self.assertEqual(prefill_config.inputs["input_ids"].sequence_length, 16)
+        self.assertIn("present_1_value", prefill_config.outputs)
+        self.assertEqual(prefill_config.get_flexible_outputs(), {})
+
+        decode_config = step_configs["decode"]
+        self.assertEqual(decode_config.prefill_length, 16)
+        self.assertEqual(decode_config.inputs["input_ids"].sequence_length, 1)
+        self.assertIn("past_key_values_1_value", decode_config.inputs)
+        self.assertNotIn("logits", decode_config.get_flexible_outputs())
+
+        # The prompt fills half of the maximum sequence length by default.
+        step_configs = get_generation_step_configs(coreml_config)
+        self.assertEqual(step_configs["prefill"].inputs["input_ids"].sequence_length, 64)
+
+        with self.assertRaises(ValueError):
+            GPT2CoreMLConfig(model_config, task="text-generation", generation_step="decode")
+        with self.assertRaises(ValueError):
+            GPT2CoreMLConfig(model_config, task="text-generation", use_past=True, generation_step="generate")
+        with self.assertRaises(ValueError):
+            GPT2CoreMLConfig(
+                model_config, task="text-generation", use_past=True, generation_step="prefill", prefill_length=128
+            )
+        with self.assertRaises(ValueError):
+            get_generation_step_configs(GPT2CoreMLConfig(model_config, task="text-generation"))
+
+
+class MultifunctionExportTestCase(TestCase):
+    @require_coreml
+    @require_torch
+    def test_shared_weights(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer, model = get_tiny_gpt2(tmp_dir)
+            coreml_config = GPT2CoreMLConfig(model.config, task="text-generation", use_past=True)
+            filename = os.path.join(tmp_dir, "Model.mlpackage")
+            export_multifunction(tokenizer, model, coreml_config, filename, quantize="float16", prefill_length=32)
+
+            mlmodel = ct.models.MLModel(filename, skip_model_load=True)
+            spec = mlmodel.get_spec()
+            self.assertGreaterEqual(spec.specificationVersion, ct.target.iOS18.value)
+            self.assertEqual([function.name for function in spec.description.functions], ["prefill", "decode"])
+            self.assertEqual(spec.description.defaultFunctionName, "decode")
+
+            metadata = mlmodel.user_defined_metadata
+            self.assertEqual(metadata["co.huggingface.exporters.task"], "text-generation")
+            self.assertEqual(metadata["co.huggingface.exporters.precision"], "float16")
+            functions = json.loads(metadata["co.huggingface.exporters.functions"])
+            self.assertEqual(functions["prefill"]["inputs"], {"input_ids": [1, 32], "attention_mask": [1, 32]})
+            self.assertEqual(functions["prefill"]["outputs"]["present_0_key"], [1, 2, 32, 16])
+            self.assertEqual(functions["decode"]["inputs"]["input_ids"], [1, 1])
+            self.assertEqual(functions["decode"]["inputs"]["attention_mask"], [1, [2, 128]])
+
+            # The weights of the two functions are stored once.
+            decode_config = GPT2CoreMLConfig(
+                model.config, task="text-generation", use_past=True, generation_step="decode"
+            )
+            decode_filename = os.path.join(tmp_dir, "Decode.mlpackage")
+            export(tokenizer, model, decode_config, quantize="float16").save(decode_filename)
+            self.assertLess(get_path_size(filename), 1.5 * get_path_size(decode_filename))
+
+    @require_coreml
+    @require_torch
+    def test_validate_functions(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer, model = get_tiny_gpt2(tmp_dir)
+            coreml_config = GPT2CoreMLConfig(model.config, task="text-generation", use_past=True)
+            filename = os.path.join(tmp_dir, "Model.mlpackage")
+            step_configs = export_multifunction(tokenizer, model, coreml_config, filename)
+
+            for name, step_config in step_configs.items():
+                mlmodel = load_test_model(filename, function_name=name)
+                validate_model_outputs(step_config, tokenizer, model, mlmodel, step_config.atol_for_validation)
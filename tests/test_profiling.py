@@ -0,0 +1,77 @@
+# coding=utf-8
+# Copyright 2022 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import pstats
+import tempfile
+import tracemalloc
+from unittest import TestCase
+
+import coremltools as ct
+from transformers.testing_utils import require_torch
+
+from exporters.coreml import export
+from exporters.coreml import convert as convert_module
+from exporters.coreml.memory import MemoryTracker
+from exporters.coreml.models import GPT2CoreMLConfig
+from exporters.coreml.profiling import ExportProfiler, get_function_package, get_profile_dir
+from .testing_utils import get_tiny_gpt2, require_coreml
+
+
+class FunctionPackageTestCase(TestCase):
+    def test_function_package(self):
+        self.assertEqual(get_function_package(convert_module.__file__, "export"), "exporters")
+        self.assertEqual(get_function_package(ct.__file__, "convert"), "coremltools")
+        self.assertEqual(get_function_package("~", "<built-in method torch._C._jit_pass_inline>"), "torch")
+        self.assertEqual(get_function_package("~", "<built-in method builtins.len>"), "builtins")
+        self.assertEqual(get_function_package(os.__file__, "join"), "other")
+
+    def test_profile_dir(self):
+        self.assertEqual(get_profile_dir("/models/Model.mlpackage").as_posix(), "/models/Model.profile")
+
+
+class ExportProfilerTestCase(TestCase):
+    @require_coreml
+    @require_torch
+    def test_profile_export(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer, model = get_tiny_gpt2(tmp_dir)
+            config = GPT2CoreMLConfig(model.config, task="text-generation")
+            filename = os.path.join(tmp_dir, "Model.mlpackage")
+
+            profiler = ExportProfiler(get_profile_dir(filename))
+            tracker = MemoryTracker(callbacks=[profiler])
+            with profiler:
+                mlmodel = export(tokenizer, model, config, memory_tracker=tracker)
+                with tracker.span("save"):
+                    mlmodel.save(filename)
+            self.assertFalse(tracemalloc.is_tracing())
+
+            profile_dir = os.path.join(tmp_dir, "Model.profile")
+            stats = pstats.Stats(os.path.join(profile_dir, "export.pstats"))
+            self.assertGreater(stats.total_tt, 0)
+
+            self.assertEqual([snapshot.name for snapshot in profiler.snapshots], ["trace", "convert", "save"])
+            for name in ["trace", "convert", "save"]:
+                snapshot = tracemalloc.Snapshot.load(os.path.join(profile_dir, f"after_{name}.snapshot"))
+                self.assertGreater(len(snapshot.traces), 0)
+
+            with open(os.path.join(profile_dir, "summary.txt")) as f:
+                summary = f.read()
+            self.assertIn("coremltools", summary)
+            self.assertIn("torch", summary)
+            # The model's forward pass is attributed to the wrapper that calls it.
+            self.assertRegex(summary, r"convert\.py:\d+\(forward\)")
+            self.assertIn("after convert", summary)
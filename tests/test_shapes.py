@@ -0,0 +1,241 @@
+# coding=utf-8
+# Copyright 2022 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+from unittest import TestCase
+
+import coremltools as ct
+import numpy as np
+from transformers import BertConfig, ViTConfig, is_torch_available, is_vision_available
+from transformers.testing_utils import require_torch, require_vision
+from transformers.utils import TensorType
+
+from exporters.coreml import export, trace_pytorch, validate_model_outputs
+from exporters.coreml.convert import convert_traced_pytorch
+from exporters.coreml.models import BertCoreMLConfig, ViTCoreMLConfig
+from exporters.coreml.validate import get_validation_batch_sizes
+from .testing_utils import get_tiny_bert, get_tiny_bert_tokenizer, load_test_model, require_coreml
+
+
+if is_torch_available():
+    import torch
+    from transformers import BertForSequenceClassification, ViTForImageClassification
+
+if is_vision_available():
+    from transformers import ViTImageProcessor
+
+
+class SequenceLengthBucketsConfigTestCase(TestCase):
+    def test_inputs_and_outputs(self):
+        model_config = BertConfig(hidden_size=32, num_hidden_layers=1, num_attention_heads=2)
+        coreml_config = BertCoreMLConfig(
+            model_config, task="feature-extraction", sequence_length_buckets=[64, 16, 32, 16]
+        )
+
+        self.assertEqual(coreml_config.sequence_length_buckets, [16, 32, 64])
+        self.assertEqual(coreml_config.inputs["input_ids"].sequence_length, [16, 32, 64])
+
+        flexible_output = coreml_config.get_flexible_outputs()["last_hidden_state"]
+        self.assertEqual(flexible_output, [{"axis": 1, "min": 16, "max": 64, "lengths": [16, 32, 64]}])
+
+        with self.assertRaises(ValueError):
+            BertCoreMLConfig(model_config, task="feature-extraction", sequence_length_buckets=[])
+        with self.assertRaises(ValueError):
+            BertCoreMLConfig(model_config, task="feature-extraction", sequence_length_buckets=[0, 16])
+
+    def test_dummy_inputs(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer = get_tiny_bert_tokenizer(tmp_dir)
+            model_config = BertConfig(vocab_size=tokenizer.vocab_size, hidden_size=32, num_hidden_layers=1, num_attention_heads=2)
+            coreml_config = BertCoreMLConfig(
+                model_config, task="feature-extraction", sequence_length_buckets=[16, 32]
+            )
+
+            dummy_inputs = coreml_config.generate_dummy_inputs(tokenizer)
+            self.assertEqual(dummy_inputs["input_ids"][1].shape, (1, 32))
+
+            dummy_inputs = coreml_config.generate_dummy_inputs(tokenizer, sequence_length=16)
+            self.assertEqual(dummy_inputs["input_ids"][1].shape, (1, 16))
+            self.assertEqual(dummy_inputs["attention_mask"][1].shape, (1, 16))
+
+
+class SequenceLengthBucketsExportTestCase(TestCase):
+    @require_coreml
+    @require_torch
+    def test_enumerated_shapes(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer, model = get_tiny_bert(tmp_dir)
+            coreml_config = BertCoreMLConfig(
+                model.config, task="feature-extraction", sequence_length_buckets=[8, 16, 32]
+            )
+            mlmodel = export(tokenizer, model, coreml_config)
+
+            spec = mlmodel.get_spec()
+            for name in ["input_ids", "attention_mask"]:
+                input_type = next(input for input in spec.description.input if input.name == name).type
+                shapes = [list(shape.shape) for shape in input_type.multiArrayType.enumeratedShapes.shapes]
+                self.assertEqual(sorted(shapes), [[1, 8], [1, 16], [1, 32]])
+
+            # Two inputs with enumerated shapes require iOS 18.
+            self.assertGreaterEqual(spec.specificationVersion, ct.target.iOS18.value)
+
+            dummy_inputs = coreml_config.generate_dummy_inputs(tokenizer, framework=TensorType.PYTORCH)
+            traced_model = trace_pytorch(tokenizer, model, coreml_config)
+            with self.assertRaises(ValueError):
+                convert_traced_pytorch(
+                    tokenizer,
+                    model.config,
+                    coreml_config,
+                    traced_model,
+                    dummy_inputs,
+                    minimum_deployment_target=ct.target.iOS16,
+                )
+
+    @require_coreml
+    @require_torch
+    def test_validate_every_bucket(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer, model = get_tiny_bert(tmp_dir)
+            coreml_config = BertCoreMLConfig(
+                model.config, task="feature-extraction", sequence_length_buckets=[8, 16]
+            )
+            filename = os.path.join(tmp_dir, "Model.mlpackage")
+            export(tokenizer, model, coreml_config).save(filename)
+            mlmodel = load_test_model(filename)
+            validate_model_outputs(coreml_config, tokenizer, model, mlmodel, coreml_config.atol_for_validation)
+
+
+class BatchSizeConfigTestCase(TestCase):
+    def test_batch_size_options(self):
+        model_config = BertConfig(hidden_size=32, num_hidden_layers=1, num_attention_heads=2)
+
+        coreml_config = BertCoreMLConfig(model_config, task="text-classification", batch_size=(1, 8))
+        self.assertFalse(coreml_config.is_classifier)
+        self.assertEqual(list(coreml_config.outputs.keys()), ["logits"])
+        self.assertEqual(coreml_config.get_flexible_outputs(), {"logits": [{"axis": 0, "min": 1, "max": 8}]})
+        self.assertEqual(get_validation_batch_sizes(coreml_config), [1, 4])
+
+        coreml_config = BertCoreMLConfig(model_config, task="feature-extraction", batch_size=[4, 1, 4])
+        self.assertEqual(coreml_config.batch_size, [1, 4])
+        self.assertEqual(
+            coreml_config.get_flexible_outputs()["last_hidden_state"],
+            [{"axis": 0, "min": 1, "max": 4, "lengths": [1, 4]}],
+        )
+
+        # A batch size of 1 is the default.
+        coreml_config = BertCoreMLConfig(model_config, task="text-classification", batch_size=[1])
+        self.assertIsNone(coreml_config.batch_size)
+        self.assertTrue(coreml_config.is_classifier)
+
+        with self.assertRaises(ValueError):
+            BertCoreMLConfig(model_config, task="feature-extraction", batch_size=(4, 2))
+        with self.assertRaises(ValueError):
+            BertCoreMLConfig(model_config, task="feature-extraction", batch_size=0)
+        # Core ML can't mix a range of batch sizes with enumerated sequence lengths.
+        with self.assertRaises(ValueError):
+            BertCoreMLConfig(model_config, task="feature-extraction", batch_size=(1, 8), sequence_length_buckets=[16])
+
+    def test_dummy_inputs(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer = get_tiny_bert_tokenizer(tmp_dir)
+            model_config = BertConfig(vocab_size=tokenizer.vocab_size, hidden_size=32, num_hidden_layers=1, num_attention_heads=2)
+            coreml_config = BertCoreMLConfig(
+                model_config, task="feature-extraction", batch_size=[1, 8], sequence_length_buckets=[16, 32]
+            )
+
+            dummy_inputs = coreml_config.generate_dummy_inputs(tokenizer)
+            self.assertEqual(dummy_inputs["input_ids"][1].shape, (8, 32))
+
+            dummy_inputs = coreml_config.generate_dummy_inputs(tokenizer, sequence_length=16, batch_size=5)
+            self.assertEqual(dummy_inputs["input_ids"][1].shape, (5, 16))
+            self.assertEqual(dummy_inputs["attention_mask"][1].shape, (5, 16))
+
+
+class BatchSizeExportTestCase(TestCase):
+    @require_coreml
+    @require_torch
+    def test_batched_classifier(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer, model = get_tiny_bert(tmp_dir, BertForSequenceClassification)
+            coreml_config = BertCoreMLConfig(model.config, task="text-classification", batch_size=(1, 8))
+            mlmodel = export(tokenizer, model, coreml_config)
+
+            spec = mlmodel.get_spec()
+            for input in spec.description.input:
+                size_range = input.type.multiArrayType.shapeRange.sizeRanges[0]
+                self.assertEqual((size_range.lowerBound, size_range.upperBound), (1, 8))
+
+            self.assertEqual([output.name for output in spec.description.output], ["probabilities"])
+            self.assertEqual(spec.description.metadata.userDefined["classes"], "LABEL_0,LABEL_1")
+
+    @require_coreml
+    @require_torch
+    def test_batch_sizes_and_buckets(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer, model = get_tiny_bert(tmp_dir)
+            coreml_config = BertCoreMLConfig(
+                model.config, task="feature-extraction", batch_size=[1, 4], sequence_length_buckets=[8, 16]
+            )
+            mlmodel = export(tokenizer, model, coreml_config)
+
+            input_type = mlmodel.get_spec().description.input[0].type.multiArrayType
+            shapes = [list(shape.shape) for shape in input_type.enumeratedShapes.shapes]
+            self.assertEqual(sorted(shapes), [[1, 8], [1, 16], [4, 8], [4, 16]])
+
+    @require_coreml
+    @require_torch
+    @require_vision
+    def test_batched_images(self):
+        preprocessor = ViTImageProcessor(
+            size={"height": 32, "width": 32}, image_mean=[0.4, 0.5, 0.6], image_std=[0.2, 0.3, 0.4]
+        )
+        model_config = ViTConfig(
+            image_size=32,
+            patch_size=8,
+            hidden_size=32,
+            num_hidden_layers=1,
+            num_attention_heads=2,
+            intermediate_size=37,
+            architectures=["ViTForImageClassification"],
+        )
+        model = ViTForImageClassification(model_config).eval()
+        coreml_config = ViTCoreMLConfig(model.config, task="image-classification", batch_size=[1, 2, 4])
+
+        # The model takes pixel values between 0 and 255 and normalizes them like the image processor.
+        dummy_inputs = coreml_config.generate_dummy_inputs(preprocessor, TensorType.PYTORCH, batch_size=4)
+        traced_model = trace_pytorch(preprocessor, model, coreml_config)
+        with torch.no_grad():
+            probabilities = traced_model(torch.tensor(dummy_inputs["pixel_values"][1]))
+            ref_probabilities = model(dummy_inputs["pixel_values"][0]).logits.softmax(dim=-1)
+        self.assertEqual(probabilities.shape, (4, 2))
+        self.assertTrue(np.allclose(probabilities.numpy(), ref_probabilities.numpy(), atol=1e-5))
+
+        mlmodel = export(preprocessor, model, coreml_config)
+        input_type = mlmodel.get_spec().description.input[0].type
+        self.assertEqual(input_type.WhichOneof("Type"), "multiArrayType")
+        shapes = [list(shape.shape) for shape in input_type.multiArrayType.enumeratedShapes.shapes]
+        self.assertEqual(sorted(shapes), [[1, 3, 32, 32], [2, 3, 32, 32], [4, 3, 32, 32]])
+
+    @require_coreml
+    @require_torch
+    def test_validate_batch_sizes(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer, model = get_tiny_bert(tmp_dir)
+            coreml_config = BertCoreMLConfig(model.config, task="feature-extraction", batch_size=(1, 4))
+            filename = os.path.join(tmp_dir, "Model.mlpackage")
+            export(tokenizer, model, coreml_config).save(filename)
+            mlmodel = load_test_model(filename)
+            validate_model_outputs(coreml_config, tokenizer, model, mlmodel, coreml_config.atol_for_validation)
@@ -0,0 +1,169 @@
+# coding=utf-8
+# Copyright 2022 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+from unittest import TestCase
+
+from transformers import GPT2Config, is_torch_available
+from transformers.testing_utils import require_torch
+
+from exporters.coreml import export, trace_pytorch, validate_model_outputs
+from exporters.coreml.models import GPT2CoreMLConfig
+from .testing_utils import get_tiny_gpt2, load_test_model, require_coreml
+
+
+if is_torch_available():
+    import torch
+
+
+class StatefulConfigTestCase(TestCase):
+    def test_inputs_and_outputs(self):
+        model_config = GPT2Config(n_embd=32, n_layer=3, n_head=4)
+        coreml_config = GPT2CoreMLConfig(model_config, task="text-generation", use_past=True, stateful=True)
+
+        self.assertEqual(list(coreml_config.inputs.keys()), ["input_ids", "attention_mask"])
+        self.assertEqual(list(coreml_config.outputs.keys()), ["logits"])
+        self.assertEqual(coreml_config.kv_cache_shape, (3, 1, 4, 128, 8))
+
+        with self.assertRaises(ValueError):
+            GPT2CoreMLConfig(model_config, task="text-generation", stateful=True)
+
+
+class StatefulExportTestCase(TestCase):
+    @require_torch
+    def test_trace_updates_cache(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer, model = get_tiny_gpt2(tmp_dir)
+            coreml_config = GPT2CoreMLConfig(model.config, task="text-generation", use_past=True, stateful=True)
+            traced_model = trace_pytorch(tokenizer, model, coreml_config)
+            self.assertEqual(traced_model.key_cache.abs().sum(), 0)
+
+            # Feed a prompt and then two more tokens, the trace must keep the cache in its buffers.
+            past_key_values = None
+            sequence_length = 0
+            for length in [7, 1, 1]:
+                input_ids = torch.randint(0, tokenizer.vocab_size, (1, length))
+                sequence_length += length
+                attention_mask = torch.ones((1, sequence_length), dtype=torch.int64)
+                with torch.no_grad():
+                    ref_outputs = model(
+                        input_ids, attention_mask=attention_mask, past_key_values=past_key_values, use_cache=True
+                    )
+                    logits = traced_model(input_ids, attention_mask)[0]
+                past_key_values = ref_outputs.past_key_values
+                self.assertTrue(torch.allclose(logits, ref_outputs.logits, atol=1e-5))
+
+    @require_coreml
+    @require_torch
+    def test_export(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer, model = get_tiny_gpt2(tmp_dir)
+            coreml_config = GPT2CoreMLConfig(model.config, task="text-generation", use_past=True, stateful=True)
+            mlmodel = export(tokenizer, model, coreml_config)
+
+            spec = mlmodel.get_spec()
+            self.assertGreaterEqual(spec.specificationVersion, 9)
+            self.assertEqual([input.name for input in spec.description.input], ["input_ids", "attention_mask"])
+            self.assertEqual([output.name for output in spec.description.output], ["logits"])
+            self.assertEqual([state.name for state in spec.description.state], ["key_cache", "value_cache"])
+
+    @require_torch
+    def test_validate(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer, model = get_tiny_gpt2(tmp_dir)
+            coreml_config = GPT2CoreMLConfig(model.config, task="text-generation", use_past=True, stateful=True)
+            filename = os.path.join(tmp_dir, "Model.mlpackage")
+            export(tokenizer, model, coreml_config).save(filename)
+            mlmodel = load_test_model(filename)
+            validate_model_outputs(coreml_config, tokenizer, model, mlmodel, coreml_config.atol_for_validation)
+
+
+class FixedSizeCacheTestCase(TestCase):
+    def test_inputs_and_outputs(self):
+        model_config = GPT2Config(n_embd=32, n_layer=2, n_head=4)
+        coreml_config = GPT2CoreMLConfig(model_config, task="text-generation", use_past=True, kv_cache_capacity=64)
+
+        self.assertEqual(list(coreml_config.inputs.keys())[:3], ["input_ids", "position", "past_key_values_0_key"])
+        self.assertEqual(list(coreml_config.outputs.keys())[:2], ["logits", "present_0_key"])
+        self.assertEqual(coreml_config.kv_cache_shape, (2, 1, 4, 64, 8))
+
+        with self.assertRaises(ValueError):
+            GPT2CoreMLConfig(model_config, task="text-generation", use_past=True, kv_cache_sliding_window=True)
+
+        # The cache needs room for a past token and the new one, and no more positions than the model has.
+        for capacity in [-5, 0, 1, model_config.n_positions + 1]:
+            with self.assertRaises(ValueError):
+                GPT2CoreMLConfig(model_config, task="text-generation", use_past=True, kv_cache_capacity=capacity)
+        coreml_config = GPT2CoreMLConfig(
+            model_config, task="text-generation", use_past=True, kv_cache_capacity=model_config.n_positions
+        )
+        self.assertEqual(coreml_config.kv_cache_shape[3], model_config.n_positions)
+
+    @require_torch
+    def test_sliding_window(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer, model = get_tiny_gpt2(tmp_dir)
+            capacity = 4
+            coreml_config = GPT2CoreMLConfig(
+                model.config,
+                task="text-generation",
+                use_past=True,
+                kv_cache_capacity=capacity,
+                kv_cache_sliding_window=True,
+            )
+            traced_model = trace_pytorch(tokenizer, model, coreml_config)
+
+            # Generate past the end of the cache. The reference model sees the same window of tokens.
+            caches = [torch.zeros(coreml_config.kv_cache_shape[1:]) for _ in range(2 * coreml_config.num_layers)]
+            past_key_values = None
+            for position in range(2 * capacity + 1):
+                input_ids = torch.randint(0, tokenizer.vocab_size, (1, 1))
+                if past_key_values is not None:
+                    past_key_values = tuple(
+                        tuple(past[:, :, -(capacity - 1):] for past in layer) for layer in past_key_values
+                    )
+                past_length = 0 if past_key_values is None else past_key_values[0][0].shape[2]
+
+                with torch.no_grad():
+                    ref_outputs = model(
+                        input_ids,
+                        attention_mask=torch.ones((1, past_length + 1), dtype=torch.int64),
+                        position_ids=torch.tensor([[position]]),
+                        past_key_values=past_key_values,
+                        use_cache=True,
+                    )
+                    outputs = traced_model(input_ids, torch.tensor([position]), *caches)
+
+                past_key_values = ref_outputs.past_key_values
+                caches = list(outputs[1:])
+                self.assertEqual(caches[0].shape, coreml_config.kv_cache_shape[1:])
+                self.assertTrue(torch.allclose(outputs[0], ref_outputs.logits, atol=1e-5))
+
+    @require_coreml
+    @require_torch
+    def test_export_fixed_shapes(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer, model = get_tiny_gpt2(tmp_dir)
+            coreml_config = GPT2CoreMLConfig(
+                model.config, task="text-generation", use_past=True, stateful=True, kv_cache_capacity=16
+            )
+            mlmodel = export(tokenizer, model, coreml_config)
+
+            spec = mlmodel.get_spec()
+            self.assertEqual([input.name for input in spec.description.input], ["input_ids", "position"])
+            for feature in list(spec.description.input) + list(spec.description.output):
+                self.assertIsNone(feature.type.multiArrayType.WhichOneof("ShapeFlexibility"))
+            self.assertEqual(list(spec.description.state[0].type.stateType.arrayType.shape), [2, 1, 2, 16, 16])
@@ -0,0 +1,205 @@
+# coding=utf-8
+# Copyright 2022 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+from transformers.testing_utils import require_torch, require_vision
+
+from exporters.coreml import MILInterpreter, export
+from exporters.coreml.data import ValidationData
+from exporters.coreml.memory import MemoryTracker
+from exporters.coreml.models import BertCoreMLConfig, GPT2CoreMLConfig
+from exporters.coreml.validate import (
+    ValidationResult,
+    _OutputMetricsAccumulator,
+    validate_model_on_data,
+    validate_model_samples,
+)
+from .test_data import write_images
+from .test_interpreter import _tiny_model
+from .testing_utils import get_tiny_bert, get_tiny_gpt2, require_coreml
+
+
+class OutputMetricsTestCase(TestCase):
+    def test_errors(self):
+        rng = np.random.default_rng(0)
+        ref = rng.standard_normal((4, 10, 8)).astype(np.float32)
+        noise = rng.uniform(-1e-3, 1e-3, size=ref.shape).astype(np.float32)
+
+        # Adding the samples in two batches gives the same metrics as all at once.
+        accumulator = _OutputMetricsAccumulator("output", atol=1e-2, top_k=5)
+        accumulator.update(ref[:1], ref[:1] + noise[:1])
+        accumulator.update(ref[1:], ref[1:] + noise[1:])
+        metrics = accumulator.result()
+
+        abs_error = np.abs(noise)
+        self.assertEqual(metrics.num_values, ref.size)
+        self.assertAlmostEqual(metrics.max_abs_error, abs_error.max(), places=6)
+        self.assertAlmostEqual(metrics.mean_abs_error, abs_error.mean(), places=6)
+        self.assertTrue(accumulator.within_tolerance)
+        self.assertIsNone(metrics.top1_agreement)
+
+        # The percentiles are accurate to one bin.
+        relative_error = abs_error / np.maximum(np.abs(ref), 1e-2)
+        for q in [50, 90, 99]:
+            expected = np.percentile(relative_error, q)
+            self.assertGreaterEqual(metrics.relative_error[f"p{q}"], expected * 0.88)
+            self.assertLessEqual(metrics.relative_error[f"p{q}"], expected * 1.13)
+        self.assertLessEqual(metrics.relative_error["p99"], relative_error.max())
+
+        self.assertGreater(metrics.min_cosine_similarity, 0.999)
+        self.assertLessEqual(metrics.mean_cosine_similarity, 1.0)
+
+        accumulator = _OutputMetricsAccumulator("output", atol=1e-4, top_k=5)
+        accumulator.update(ref, -ref)
+        metrics = accumulator.result()
+        self.assertFalse(accumulator.within_tolerance)
+        self.assertAlmostEqual(metrics.min_cosine_similarity, -1.0)
+
+        accumulator = _OutputMetricsAccumulator("output", atol=1e-4, top_k=5)
+        accumulator.update(np.zeros((2, 3)), np.zeros((2, 3)))
+        metrics = accumulator.result()
+        self.assertEqual(metrics.max_abs_error, 0.0)
+        self.assertEqual(metrics.relative_error["p99"], 0.0)
+        self.assertEqual(metrics.min_cosine_similarity, 1.0)
+
+    def test_agreement(self):
+        ref = np.array([[0.1, 0.7, 0.2], [0.5, 0.3, 0.2], [0.2, 0.2, 0.6], [0.3, 0.4, 0.3]])
+        coreml = np.array([[0.1, 0.7, 0.2], [0.3, 0.5, 0.2], [0.6, 0.3, 0.1], [0.3, 0.4, 0.3]])
+
+        accumulator = _OutputMetricsAccumulator("logits", atol=1e-4, top_k=2)
+        accumulator.update(ref, coreml, class_axis=-1)
+        metrics = accumulator.result()
+        self.assertEqual(metrics.top1_agreement, 0.5)
+        self.assertEqual(metrics.topk_agreement, 0.75)
+
+        # Segmentation masks have the classes on the second axis, and a prediction for every pixel.
+        accumulator = _OutputMetricsAccumulator("logits", atol=1e-4, top_k=2)
+        accumulator.update(ref.T[None, :, :, None], coreml.T[None, :, :, None], class_axis=1)
+        self.assertEqual(accumulator.result().top1_agreement, 0.5)
+
+    def test_result(self):
+        result = ValidationResult(num_samples=2, atol=1e-4)
+        self.assertTrue(result.passed)
+        self.assertEqual(result.max_error, 0.0)
+        result.raise_for_failure()
+
+        result.failures.append("Output values do not match")
+        self.assertFalse(result.passed)
+        with self.assertRaises(ValueError):
+            result.raise_for_failure()
+
+
+@require_coreml
+@require_torch
+class ValidateModelSamplesTestCase(TestCase):
+    def test_text_model(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer, model = get_tiny_bert(tmp_dir)
+            coreml_config = BertCoreMLConfig(model.config, task="feature-extraction")
+            interpreter = MILInterpreter(export(tokenizer, model.eval(), coreml_config))
+
+            random_state = np.random.get_state()
+            tracker = MemoryTracker()
+            result = validate_model_samples(
+                coreml_config, tokenizer, model, interpreter, 1e-4, num_samples=3, memory_tracker=tracker
+            )
+            np.testing.assert_equal(np.random.get_state()[1], random_state[1])
+
+            self.assertTrue(result.passed)
+            self.assertEqual(list(result.outputs), ["last_hidden_state", "pooler_output"])
+            metrics = result.outputs["last_hidden_state"]
+            self.assertEqual(metrics.num_values, 3 * 128 * model.config.hidden_size)
+            self.assertLess(metrics.max_abs_error, 1e-4)
+            self.assertGreater(metrics.min_cosine_similarity, 0.9999)
+            self.assertEqual(result.max_error, max(m.max_abs_error for m in result.outputs.values()))
+
+            # The reference model runs once for all samples, the Core ML model once per sample.
+            self.assertEqual(tracker.spans["reference_forward"].count, 1)
+            self.assertEqual(tracker.spans["predict"].count, 3)
+
+            # The same seed gives the same samples.
+            again = validate_model_samples(coreml_config, tokenizer, model, interpreter, 1e-4, num_samples=3)
+            self.assertEqual(again.to_dict(), result.to_dict())
+
+            result = validate_model_samples(coreml_config, tokenizer, model, interpreter, 1e-12, num_samples=2)
+            self.assertFalse(result.passed)
+            with self.assertRaises(ValueError):
+                result.raise_for_failure()
+
+    @require_vision
+    def test_classifier(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            preprocessor, model, coreml_config = _tiny_model("vit", "image-classification", tmp_dir)
+            interpreter = MILInterpreter(export(preprocessor, model, coreml_config))
+            result = validate_model_samples(
+                coreml_config, preprocessor, model, interpreter, coreml_config.atol_for_validation, num_samples=4
+            )
+            self.assertTrue(result.passed)
+            self.assertEqual(result.outputs["logits"].top1_agreement, 1.0)
+            self.assertEqual(result.outputs["logits"].topk_agreement, 1.0)
+
+    def test_stateful_model(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer, model = get_tiny_gpt2(tmp_dir)
+            coreml_config = GPT2CoreMLConfig(model.config, task="text-generation", use_past=True, stateful=True)
+            with self.assertRaises(ValueError):
+                validate_model_samples(coreml_config, tokenizer, model, None, 1e-4)
+
+
+@require_coreml
+@require_torch
+class ValidateModelOnDataTestCase(TestCase):
+    def test_text_model(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer, model = get_tiny_bert(tmp_dir)
+            coreml_config = BertCoreMLConfig(model.config, task="feature-extraction")
+            interpreter = MILInterpreter(export(tokenizer, model.eval(), coreml_config))
+
+            filename = os.path.join(tmp_dir, "data.txt")
+            with open(filename, "w") as f:
+                f.write("\n".join(["hello world", "the quick brown fox", "jumps over", "the lazy dog", "end"]))
+
+            tracker = MemoryTracker()
+            data = ValidationData(filename, coreml_config, tokenizer, batch_size=2)
+            result = validate_model_on_data(
+                coreml_config, tokenizer, model, interpreter, 1e-4, data, memory_tracker=tracker
+            )
+            self.assertTrue(result.passed)
+            self.assertEqual(result.num_samples, 5)
+            self.assertEqual(result.outputs["last_hidden_state"].num_values, 5 * 128 * model.config.hidden_size)
+
+            # The reference model runs once per batch, the Core ML model once per example.
+            self.assertEqual(tracker.spans["reference_forward"].count, 3)
+            self.assertEqual(tracker.spans["predict"].count, 5)
+
+    @require_vision
+    def test_classifier(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            preprocessor, model, coreml_config = _tiny_model("vit", "image-classification", tmp_dir)
+            interpreter = MILInterpreter(export(preprocessor, model, coreml_config))
+
+            data_dir = os.path.join(tmp_dir, "images")
+            write_images(data_dir, 3)
+            data = ValidationData(data_dir, coreml_config, preprocessor)
+            result = validate_model_on_data(
+                coreml_config, preprocessor, model, interpreter, coreml_config.atol_for_validation, data
+            )
+            self.assertTrue(result.passed)
+            self.assertEqual(result.num_samples, 3)
+            self.assertEqual(result.outputs["logits"].top1_agreement, 1.0)
@@ -0,0 +1,76 @@
+# coding=utf-8
+# Copyright 2022 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+from pathlib import Path
+from unittest import TestCase
+from unittest.mock import patch
+
+import coremltools as ct
+from transformers.testing_utils import require_torch
+
+from exporters.coreml.convert import _trace_wrapper
+from exporters.coreml.models import BertCoreMLConfig
+from exporters.coreml.variants import ExportVariant, export_variants
+from .testing_utils import get_tiny_bert, require_coreml
+
+
+class ExportVariantTestCase(TestCase):
+    def test_from_string(self):
+        variant = ExportVariant.from_string("quantize=float16,compute_units=cpu_and_ne,minimum_deployment_target=iOS16")
+        self.assertEqual(variant.quantize, "float16")
+        self.assertEqual(variant.compute_units, ct.ComputeUnit.CPU_AND_NE)
+        self.assertEqual(variant.minimum_deployment_target, ct.target.iOS16)
+        self.assertIsNone(variant.use_legacy_format)
+        self.assertEqual(variant.name, "float16-cpu_and_ne-iOS16")
+
+        variant = ExportVariant.from_string("format=neuralnetwork")
+        self.assertEqual(variant, ExportVariant(use_legacy_format=True))
+        self.assertEqual(variant.get_output_filename(Path("out/Model.mlpackage")).name, "Model-float32-all-neuralnetwork.mlmodel")
+
+        with self.assertRaises(ValueError):
+            ExportVariant.from_string("quantize=int3")
+        with self.assertRaises(ValueError):
+            ExportVariant.from_string("precision=float16")
+
+    @require_coreml
+    @require_torch
+    def test_export_variants(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tokenizer, model = get_tiny_bert(tmp_dir)
+            coreml_config = BertCoreMLConfig(model.config, task="feature-extraction")
+            variants = [
+                ExportVariant(quantize="float32"),
+                ExportVariant(quantize="float16", compute_units=ct.ComputeUnit.CPU_ONLY),
+            ]
+
+            with patch("exporters.coreml.convert._trace_wrapper", wraps=_trace_wrapper) as trace_wrapper:
+                results = export_variants(
+                    tokenizer, model, coreml_config, variants, os.path.join(tmp_dir, "Model.mlpackage"), num_workers=2
+                )
+                self.assertEqual(trace_wrapper.call_count, 1)
+
+            self.assertEqual([result.variant for result in results], variants)
+            self.assertEqual(
+                [os.path.basename(result.path) for result in results],
+                ["Model-float32-all.mlpackage", "Model-float16-cpu_only.mlpackage"],
+            )
+            for result in results:
+                self.assertTrue(os.path.exists(result.path))
+                self.assertGreater(result.size, 0)
+
+            # The float16 weights take up about half the space.
+            self.assertLess(results[1].size, results[0].size)
@@ -13,6 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
 import unittest
 import importlib.util
 from transformers.utils.versions import importlib_metadata
@@ -29,6 +30,8 @@ except importlib_metadata.PackageNotFoundError:
     _coreml_available = False
     _macos_available = False
 
+_sklearn_available = importlib.util.find_spec("sklearn") is not None
+
 def is_coreml_available():
     return _coreml_available
 
@@ -40,3 +43,68 @@ def require_coreml(test_case):
 
 def require_macos(test_case):
     return unittest.skipUnless(is_macos_available(), "test requires macOS")(test_case)
+
+def require_sklearn(test_case):
+    """Palettization clusters the weights with scikit-learn's k-means."""
+    return unittest.skipUnless(_sklearn_available, "test requires scikit-learn")(test_case)
+
+def load_test_model(filename, function_name=None):
+    """Loads a saved model to validate, with Core ML on macOS and with the NumPy interpreter elsewhere."""
+    from exporters.coreml.validate import load_validation_model
+
+    backend = "coreml" if is_macos_available() else "numpy"
+    return load_validation_model(filename, backend, function_name=function_name)
+
+def get_tiny_bert_tokenizer(tmp_dir):
+    """Creates a small BERT tokenizer without downloading anything."""
+    from transformers import BertTokenizer
+
+    vocab_file = os.path.join(tmp_dir, "vocab.txt")
+    with open(vocab_file, "w") as f:
+        tokens = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"] + [f"token{i}" for i in range(95)]
+        f.write("\n".join(tokens))
+    return BertTokenizer(vocab_file)
+
+def get_tiny_bert(tmp_dir, model_class=None):
+    """Creates a small randomly initialized BERT model and its tokenizer."""
+    from transformers import BertConfig, BertModel
+
+    tokenizer = get_tiny_bert_tokenizer(tmp_dir)
+    model_config = BertConfig(
+        vocab_size=tokenizer.vocab_size,
+        hidden_size=32,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        intermediate_size=37,
+        architectures=["BertModel"],
+    )
+    return tokenizer, (model_class or BertModel)(model_config)
+
+def get_tiny_gpt2(tmp_dir, num_layers=2, hidden_size=32):
+    """Creates a small randomly initialized GPT-2 language model and a tokenizer."""
+    from transformers import GPT2Config, GPT2LMHeadModel
+
+    tokenizer = get_tiny_bert_tokenizer(tmp_dir)
+    model_config = GPT2Config(
+        vocab_size=tokenizer.vocab_size,
+        n_embd=hidden_size,
+        n_layer=num_layers,
+        n_head=2,
+        architectures=["GPT2LMHeadModel"],
+    )
+    return tokenizer, GPT2LMHeadModel(model_config).eval()
+
+def get_tiny_llama(tmp_dir, num_layers=2):
+    """Creates a small randomly initialized Llama language model and a tokenizer."""
+    from transformers import LlamaConfig, LlamaForCausalLM
+
+    tokenizer = get_tiny_bert_tokenizer(tmp_dir)
+    model_config = LlamaConfig(
+        vocab_size=tokenizer.vocab_size,
+        hidden_size=32,
+        intermediate_size=37,
+        num_hidden_layers=num_layers,
+        num_attention_heads=2,
+        architectures=["LlamaForCausalLM"],
+    )
+    return tokenizer, LlamaForCausalLM(model_config).eval()